@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckan.model as model
+import ckan.plugins as plugins
+import ckanext.storepublisher.db as db
+import datetime
+import gettext
+import logging
+import pylons
+import threading
+import uuid
+
+from collections import OrderedDict
+from ckanext.storepublisher.locks import DatasetLock
+from ckanext.storepublisher.resource_sync import SKIP_RESOURCE_SYNC
+from paste.registry import Registry
+from pylons.util import AttribSafeContextObj
+
+log = logging.getLogger(__name__)
+
+# Key of the locks of the datasets whose users are being updated
+ACQUISITIONS = 'acquisitions'
+
+
+class AcquisitionQueue(object):
+    '''
+    Allows the users that acquire datasets in the Stores to access them. Notifications
+    are saved in the ``storepublisher_acquisition`` table as soon as they are
+    received and the users are added to the allowed users of the datasets once the
+    acquisition window expires. The acquisitions of the same dataset are applied
+    with a single package_update (and reindex), so bursts of acquisitions of popular
+    datasets do not turn into one full update per purchase.
+    '''
+
+    def __init__(self, config):
+        self.acquisition_window = float(config.get('ckan.storepublisher.acquisition_window', 5))
+        self._dataset_lock = DatasetLock(config)
+
+        self._lock = threading.Lock()
+        self._scheduled = False
+
+    def add(self, user_name, datasets):
+        '''
+        Saves the acquisition of the given datasets. The user is allowed to access
+        them when the acquisition window expires.
+
+        :param user_name: The name of the user that acquired the datasets
+        :type user_name: string
+
+        :param datasets: The ids or the names of the acquired datasets
+        :type datasets: list
+        '''
+
+        db.init_db(model)
+        received = datetime.datetime.utcnow()
+        for dataset in datasets:
+            entry = db.Acquisition()
+            entry.id = unicode(uuid.uuid4())
+            entry.user_name = user_name
+            entry.dataset = dataset
+            entry.received = received
+            model.Session.add(entry)
+        model.Session.commit()
+
+        if self.acquisition_window <= 0:
+            self.flush()
+            return
+
+        with self._lock:
+            scheduled, self._scheduled = self._scheduled, True
+
+        if not scheduled:
+            timer = threading.Timer(self.acquisition_window, self._run)
+            timer.daemon = True
+            timer.start()
+
+    def _run(self):
+        # The actions of CKAN use the translator and the template context of Pylons,
+        # which are only registered for the threads that serve requests. They are
+        # registered for the timer thread as CKAN does for its paster commands
+        registry = Registry()
+        registry.prepare()
+        registry.register(pylons.translator, gettext.NullTranslations())
+        registry.register(pylons.c, AttribSafeContextObj())
+
+        try:
+            self.flush()
+        finally:
+            registry.cleanup()
+            model.Session.remove()
+
+    def flush(self):
+        '''
+        Adds the users to the allowed users of the datasets they acquired. The
+        acquisitions received by other processes are also applied.
+        '''
+
+        with self._lock:
+            self._scheduled = False
+
+        db.init_db(model)
+        query = model.Session.query(db.Acquisition.dataset).order_by(db.Acquisition.received)
+        datasets = OrderedDict.fromkeys(dataset for dataset, in query)
+
+        for dataset in datasets:
+            try:
+                # Other processes may be applying the acquisitions of the same dataset
+                with self._dataset_lock.hold(ACQUISITIONS, dataset):
+                    entries = model.Session.query(db.Acquisition).filter_by(dataset=dataset).all()
+                    if entries:
+                        self._allow_users(dataset, [entry.user_name for entry in entries])
+                        for entry in entries:
+                            model.Session.delete(entry)
+                        model.Session.commit()
+            except Exception as e:
+                # The acquisitions are applied again in the next window
+                log.warn('Users could not be allowed to access the dataset %s: %s' % (dataset, e))
+                model.Session.rollback()
+
+    def _allow_users(self, dataset, user_names):
+        site_user = plugins.toolkit.get_action('get_site_user')({'model': model, 'ignore_auth': True}, {})
+        context = {'model': model, 'session': model.Session, 'user': site_user['name'], 'ignore_auth': True}
+
+        try:
+            package = plugins.toolkit.get_action('package_show')(dict(context), {'id': dataset})
+        except plugins.toolkit.ObjectNotFound:
+            log.warn('Dataset %s acquired by %s does not exist' % (dataset, ', '.join(user_names)))
+            return
+
+        allowed_users = package.get('allowed_users') or []
+        if isinstance(allowed_users, basestring):
+            allowed_users = [user for user in allowed_users.split(',') if user]
+
+        new_users = []
+        for user_name in user_names:
+            if user_name not in allowed_users and user_name not in new_users:
+                new_users.append(user_name)
+
+        if new_users:
+            # Allowed users are not part of the Store resources. The update is run
+            # outside any request, so there is no user to contact the Stores either
+            package['allowed_users'] = allowed_users + new_users
+            context[SKIP_RESOURCE_SYNC] = True
+            plugins.toolkit.get_action('package_update')(dict(context), package)
+
+        log.info('%d users allowed to access the dataset %s (%d acquisitions)' %
+                 (len(new_users), dataset, len(user_names)))
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import ckan.model as model
+import ckan.plugins as plugins
+import ckanext.storepublisher.db as db
+import logging
+import re
+
+from ckanext.storepublisher.acquisitions import AcquisitionQueue
+from ckanext.storepublisher.bulkhead import BulkheadFull, BUSY_MESSAGE
+from ckanext.storepublisher.drafts import DraftStore
+from ckanext.storepublisher.health import get_health_monitor
+from ckanext.storepublisher.offerings import LOGO_CKAN_B64, parse_price, validate_offering
+from ckanext.storepublisher.stats import activity
+from ckanext.storepublisher.store_connector import MultiStoreConnector, StoreException
+from pylons import config
+from StringIO import StringIO
+
+log = logging.getLogger(__name__)
+
+_store_connector = None
+_draft_store = None
+_acquisition_queue = None
+
+
+def _get_store_connector():
+    global _store_connector
+    if _store_connector is None:
+        _store_connector = MultiStoreConnector(config)
+    return _store_connector
+
+
+def _get_draft_store():
+    global _draft_store
+    if _draft_store is None:
+        _draft_store = DraftStore(config)
+    return _draft_store
+
+
+def _get_acquisition_queue():
+    global _acquisition_queue
+    if _acquisition_queue is None:
+        _acquisition_queue = AcquisitionQueue(config)
+    return _acquisition_queue
+
+
+def _get_offering_info(context, data_dict):
+    '''
+    Builds the offering with the given data and validates it as the publish form
+    does.
+
+    :returns: The dataset, the offering and the errors found
+    :rtype: tuple
+    '''
+
+    tk = plugins.toolkit
+    dataset = tk.get_action('package_show')(context, {'id': data_dict.get('id')})
+
+    # Tags can be given as a list or as a comma separated string
+    tags = data_dict.get('tags', [])
+    if isinstance(tags, basestring):
+        tags = [] if tags == '' else tags.split(',')
+
+    offering_info = {
+        'pkg_id': dataset['id'],
+        'name': data_dict.get('name', ''),
+        'description': data_dict.get('description', ''),
+        'license_title': data_dict.get('license_title', ''),
+        'license_description': data_dict.get('license_description', ''),
+        'version': data_dict.get('version', ''),
+        'tags': tags,
+        'price': data_dict.get('price', ''),
+        'is_open': tk.asbool(data_dict.get('is_open', False))
+    }
+
+    errors = validate_offering(dataset, offering_info, {})
+
+    return dataset, offering_info, errors
+
+
+def _get_offerings_results(results):
+    offerings = {}
+    for store_name, result in results.items():
+        if isinstance(result, StoreException):
+            offerings[store_name] = {'success': False, 'error': result.message}
+        else:
+            offerings[store_name] = {'success': True, 'offering_url': result}
+    return offerings
+
+
+def dataset_publish_validate(context, data_dict):
+    '''
+    Checks that an offering can be created with the given dataset without
+    publishing it. The same checks than the publish form are run.
+
+    :param id: The id or the name of the dataset
+    :type id: string
+    :param name: The name of the offering
+    :type name: string
+    :param version: The version of the offering
+    :type version: string
+    :param description: The description of the offering (optional)
+    :type description: string
+    :param license_title: The title of the license of the offering (optional)
+    :type license_title: string
+    :param license_description: The text of the license of the offering (optional)
+    :type license_description: string
+    :param tags: The tags of the offering, as a list or as a comma separated string
+        (optional)
+    :type tags: list
+    :param price: The price of the offering (optional, free by default)
+    :type price: float
+    :param is_open: Whether the offering is open (optional, ``False`` by default)
+    :type is_open: bool
+
+    :returns: The offering that would be created
+    :rtype: dict
+
+    :raises ValidationError: When the offering cannot be created
+    '''
+
+    plugins.toolkit.check_access('dataset_publish_validate', context, data_dict)
+
+    dataset, offering_info, errors = _get_offering_info(context, data_dict)
+    if errors:
+        raise plugins.toolkit.ValidationError(errors)
+
+    return offering_info
+
+
+def dataset_publish(context, data_dict):
+    '''
+    Publishes the given dataset in an offering in all the Stores. The offering is
+    validated as ``dataset_publish_validate`` does.
+
+    It accepts the same parameters than ``dataset_publish_validate`` and:
+
+    :param image_base64: The image of the offering encoded in base64 (optional, the
+        logo of CKAN by default)
+    :type image_base64: string
+    :param image_draft: The reference to an image uploaded before, returned when a
+        publication fails (optional)
+    :type image_draft: string
+
+    :returns: The result of the publication in each Store (``offerings``) and the
+        reference to the image when any Store failed (``image_draft``). Calling this
+        function again resumes the publications that failed
+    :rtype: dict
+
+    :raises ValidationError: When the offering cannot be created or the Stores
+        cannot be reached
+    '''
+
+    tk = plugins.toolkit
+    tk.check_access('dataset_publish', context, data_dict)
+
+    user = context.get('user')
+    draft_store = _get_draft_store()
+    dataset, offering_info, errors = _get_offering_info(context, data_dict)
+
+    image_file = None
+    image_draft = data_dict.get('image_draft')
+    image_content = None
+    if data_dict.get('image_base64'):
+        offering_info['image_base64'] = data_dict['image_base64']
+        try:
+            image_content = base64.b64decode(data_dict['image_base64'])
+        except TypeError:
+            errors['Image'] = ['The image is not encoded in base64']
+    elif image_draft:
+        # Only the image of the draft of the user can be used
+        draft = draft_store.load(user, dataset['id'])
+        if draft is not None and draft['image'] == image_draft:
+            image_file = draft_store.open_image(image_draft)
+        if image_file is None:
+            errors['Image'] = ['The image %s does not exist' % image_draft]
+        offering_info['image_file'] = image_file
+    else:
+        offering_info['image_base64'] = LOGO_CKAN_B64
+
+    if not errors and not get_health_monitor(config).is_available():
+        errors['Store'] = ['The Store cannot be reached right now. Please, try again later']
+
+    if errors:
+        if image_file is not None:
+            image_file.close()
+        raise tk.ValidationError(errors)
+
+    try:
+        results = _get_store_connector().create_offering(dataset, offering_info)
+    except BulkheadFull as e:
+        log.warn('Offering %s rejected: %s' % (offering_info['name'], e))
+        raise tk.ValidationError({'Store': [BUSY_MESSAGE]})
+    finally:
+        if image_file is not None:
+            image_file.close()
+
+    offerings = _get_offerings_results(results)
+
+    if all(offering['success'] for offering in offerings.values()):
+        draft_store.delete(user, dataset['id'])
+        image_draft = None
+    else:
+        # The image is kept so it does not have to be sent again to resume the publication
+        if image_content is not None:
+            image_draft = draft_store.save_image(StringIO(image_content))
+        if image_draft:
+            fields = dict((field, offering_info[field]) for field in ('pkg_id', 'name', 'description', 'license_title',
+                                                                      'license_description', 'version', 'price'))
+            fields['tag_string'] = ','.join(offering_info['tags'])
+            draft_store.save(user, dataset['id'], fields, image_draft)
+
+    return {'offerings': offerings, 'image_draft': image_draft}
+
+
+def storepublisher_dashboard(context, data_dict):
+    '''
+    Returns the activity of the Store Publisher: the last publications and deletions
+    with the time spent in each phase, the error rate of each Store endpoint, the
+    pending work and whether the Stores could be reached the last time they were
+    contacted. Only sysadmins can call this function.
+
+    Publications, endpoints and reachability are aggregated by the process that
+    answers the request. Pending publications and drafts are counted in the database.
+
+    :rtype: dict
+    '''
+
+    plugins.toolkit.check_access('storepublisher_dashboard', context, data_dict)
+
+    summary = activity.get_summary()
+
+    db.init_db(model)
+    summary['pending']['failed_publications'] = model.Session.query(db.PublishJournal).count()
+    summary['pending']['drafts'] = model.Session.query(db.PublishDraft).count()
+    summary['pending']['acquisitions'] = model.Session.query(db.Acquisition).count()
+
+    return summary
+
+
+def storepublisher_health(context, data_dict):
+    '''
+    Returns whether the Stores can be reached and their latency. Stores are checked
+    in background every ``ckan.storepublisher.health_interval`` seconds, so calling
+    this function never sends requests to them. Anyone can call this function.
+
+    :rtype: dict
+    '''
+
+    plugins.toolkit.check_access('storepublisher_health', context, data_dict)
+
+    return get_health_monitor(config).get_status()
+
+
+def dataset_publish_version(context, data_dict):
+    '''
+    Publishes a new version of an offering that already contains the given dataset
+    in all the Stores. The fields of the new version are copied from the existing
+    offering (including its image) and only the given ones are changed.
+
+    :param id: The id or the name of the dataset
+    :type id: string
+    :param base_name: The name of the existing offering
+    :type base_name: string
+    :param base_version: The version of the existing offering
+    :type base_version: string
+    :param version: The version of the new offering
+    :type version: string
+
+    The rest of the parameters of ``dataset_publish`` (but ``image_draft``) can be
+    given to change them in the new version.
+
+    :returns: The result of the publication in each Store (``offerings``)
+    :rtype: dict
+
+    :raises ValidationError: When the changes are not valid or the Stores cannot be
+        reached
+    '''
+
+    tk = plugins.toolkit
+    tk.check_access('dataset_publish_version', context, data_dict)
+
+    dataset = tk.get_action('package_show')(context, {'id': data_dict.get('id')})
+    errors = {}
+
+    base_offering = {'name': data_dict.get('base_name', ''), 'version': data_dict.get('base_version', '')}
+    for field, value in base_offering.items():
+        if not value:
+            errors['Base_' + field] = ['This field is required to publish a new version']
+
+    changes = dict((field, data_dict[field]) for field in ('name', 'description', 'license_title',
+                                                           'license_description', 'version', 'tags',
+                                                           'price', 'image_base64')
+                   if field in data_dict)
+    if isinstance(changes.get('tags'), basestring):
+        changes['tags'] = [] if changes['tags'] == '' else changes['tags'].split(',')
+    if 'is_open' in data_dict:
+        changes['is_open'] = tk.asbool(data_dict['is_open'])
+    if 'image_base64' in changes:
+        try:
+            base64.b64decode(changes['image_base64'])
+        except TypeError:
+            errors['Image'] = ['The image is not encoded in base64']
+
+    # Only the changed fields can be checked since the rest are taken from the Stores
+    validate_offering(dataset, dict(changes, pkg_id=dataset['id'], name=changes.get('name', base_offering['name'])),
+                      errors)
+    if 'name' not in changes:
+        # The name of the existing offering is checked as base_name
+        errors.pop('Name', None)
+    if 'Price' not in errors and 'price' in changes:
+        changes['price'] = parse_price(changes['price'])
+
+    if not errors and not get_health_monitor(config).is_available():
+        errors['Store'] = ['The Store cannot be reached right now. Please, try again later']
+
+    if errors:
+        raise tk.ValidationError(errors)
+
+    try:
+        results = _get_store_connector().create_offering_version(dataset, base_offering, changes)
+    except BulkheadFull as e:
+        log.warn('Offering %s rejected: %s' % (base_offering['name'], e))
+        raise tk.ValidationError({'Store': [BUSY_MESSAGE]})
+
+    return {'offerings': _get_offerings_results(results)}
+
+
+def storepublisher_dataset_acquired(context, data_dict):
+    '''
+    Notifies that a user has acquired an offering in a Store (it is set as the
+    notification URL of the offerings). The acquisition is saved and the user is
+    allowed to access the datasets of the offering once the acquisition window
+    (``ckan.storepublisher.acquisition_window``) expires, so the acquisitions of the
+    same dataset are applied together. The same users that can call
+    ``dataset_acquired`` can call this function.
+
+    :param customer_name: The name of the user that acquired the offering
+    :type customer_name: string
+    :param resources: The resources of the offering. Datasets are identified by
+        their URL (``url``)
+    :type resources: list
+
+    :returns: The datasets acquired
+    :rtype: dict
+    '''
+
+    plugins.toolkit.check_access('storepublisher_dataset_acquired', context, data_dict)
+
+    # Previous versions of the Store send the name of the user as customer
+    user_name = data_dict.get('customer_name') or data_dict.get('customer')
+    resources = data_dict.get('resources')
+    errors = {}
+
+    if not user_name:
+        errors['Customer_name'] = [plugins.toolkit._('Missing value')]
+    if not isinstance(resources, list):
+        errors['Resources'] = [plugins.toolkit._('A list of resources is required')]
+    if errors:
+        raise plugins.toolkit.ValidationError(errors)
+
+    datasets = []
+    for resource in resources:
+        url = (resource.get('url') if isinstance(resource, dict) else None) or ''
+        match = re.search(r'/dataset/([^/?#]+)', url)
+        if match and match.group(1) not in datasets:
+            datasets.append(match.group(1))
+
+    if datasets:
+        _get_acquisition_queue().add(user_name, datasets)
+
+    return {'datasets': datasets}
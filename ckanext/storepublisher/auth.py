@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckan.plugins as plugins
+
+
+def storepublisher_dashboard(context, data_dict):
+    # Only sysadmins (who skip this function) can see the dashboard
+    return {'success': False}
+
+
+def storepublisher_health(context, data_dict):
+    return {'success': True}
+
+# Load balancers check the health of the Stores without logging in
+storepublisher_health.auth_allow_anonymous_access = True
+
+
+def dataset_publish(context, data_dict):
+    # Users that can update a dataset can publish it
+    try:
+        plugins.toolkit.check_access('package_update', context, {'id': data_dict.get('id')})
+        return {'success': True}
+    except plugins.toolkit.NotAuthorized:
+        return {'success': False,
+                'msg': plugins.toolkit._('User %s not authorized to publish %s') % (context.get('user'), data_dict.get('id'))}
+
+
+def dataset_publish_validate(context, data_dict):
+    return dataset_publish(context, data_dict)
+
+
+def dataset_publish_version(context, data_dict):
+    return dataset_publish(context, data_dict)
+
+
+def storepublisher_dataset_acquired(context, data_dict):
+    # Acquisitions are notified by the Stores, as they are to dataset_acquired
+    try:
+        plugins.toolkit.check_access('dataset_acquired', context, data_dict)
+        return {'success': True}
+    except (plugins.toolkit.NotAuthorized, ValueError):
+        return {'success': False,
+                'msg': plugins.toolkit._('User %s not authorized to notify acquisitions') % context.get('user')}
+
+# Whether the Store can notify acquisitions without logging in depends on dataset_acquired
+storepublisher_dataset_acquired.auth_allow_anonymous_access = True
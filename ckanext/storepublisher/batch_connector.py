@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import requests
+import threading
+import time
+
+from collections import OrderedDict
+from ckanext.storepublisher.journal import OFFERING_STEP, PUBLISH_STEP, TAG_STEP
+from ckanext.storepublisher.stats import activity, PUBLISH
+from ckanext.storepublisher.store_connector import bound, StoreConnector, StoreException
+from ckanext.storepublisher.workers import run_concurrently
+
+log = logging.getLogger(__name__)
+
+
+class BatchStoreConnector(StoreConnector):
+    '''
+    Variant of StoreConnector intended for batch jobs that have to deal with lots of
+    datasets. Each operation receives a list of items and returns a result for each
+    one of them. The list of resources of the Store is only retrieved once per batch
+    and the remaining requests are run concurrently. The number of requests in flight
+    is bounded by the ``ckan.storepublisher.batch_concurrency`` setting.
+    '''
+
+    def __init__(self, config, store_name=None):
+        super(BatchStoreConnector, self).__init__(config, store_name)
+        self.concurrency = int(config.get('ckan.storepublisher.batch_concurrency', 10))
+        self._semaphore = threading.BoundedSemaphore(self.concurrency)
+
+    def _make_request(self, method, url, headers={}, data=None, compress=False):
+        # Requests made by different batches running at the same time are also bounded
+        with self._semaphore:
+            return super(BatchStoreConnector, self)._make_request(method, url, headers, data, compress)
+
+    def _run(self, tasks):
+        results = []
+
+        for result, error in run_concurrently(tasks, self.concurrency):
+            if error is not None and not isinstance(error, StoreException):
+                log.warn(error)
+                error = StoreException(str(error))
+            results.append(result if error is None else error)
+
+        return results
+
+    @bound
+    def batch_get_existing_resources(self, datasets):
+        '''
+        Method to look for the resources that contain the given datasets. The list of
+        resources of the Store is only retrieved once.
+
+        :param datasets: The datasets whose resources want to be retrieved
+        :type datasets: list
+
+        :returns: The resource (provider, name and version) that contains each dataset
+            or None when the dataset is not included in any resource
+        :rtype: list
+        '''
+
+        resources = {}
+        for resource in self._get_resources():
+            if resource.get('state') != 'deleted':
+                # The first resource is used when there are several, as _get_existing_resource does
+                resources.setdefault(resource.get('link', ''), resource)
+
+        results = []
+        for dataset in datasets:
+            resource = resources.get(self._get_dataset_url(dataset))
+            if resource is not None:
+                self._update_acquire_url(dataset, resource)
+                results.append(self._generate_resource_info(resource))
+            else:
+                results.append(None)
+
+        return results
+
+    @bound
+    def batch_create_resources(self, datasets):
+        '''
+        Method to create concurrently a resource for each one of the given datasets.
+
+        :param datasets: The datasets to be included in the new resources
+        :type datasets: list
+
+        :returns: The created resource (provider, name and version) or the StoreException
+            raised for each dataset
+        :rtype: list
+        '''
+
+        return self._run([lambda dataset=dataset: self._create_resource(dataset) for dataset in datasets])
+
+    @bound
+    def batch_create_offerings(self, offerings):
+        '''
+        Method to create concurrently several offerings. The resources that contain
+        the datasets are retrieved at once and only the missing ones are created
+        (once per dataset, even if it is included in several offerings). Once all
+        the offerings have been created, they are tagged and published with
+        batch_tag_and_publish.
+
+        :param offerings: (dataset, offering_info) tuples, as expected by create_offering
+        :type offerings: list
+
+        :returns: The URL of the offering or the StoreException raised for each item
+        :rtype: list
+        '''
+
+        datasets = [dataset for dataset, _ in offerings]
+
+        try:
+            resources = self.batch_get_existing_resources(datasets)
+        except Exception as e:
+            log.warn(e)
+            error = StoreException('It was impossible to retrieve the resources from the Store')
+            return [error] * len(offerings)
+
+        # Create the missing resources
+        missing = {}
+        for dataset, resource in zip(datasets, resources):
+            if resource is None:
+                missing.setdefault(dataset['id'], dataset)
+
+        created = dict(zip(missing.keys(), self.batch_create_resources(missing.values())))
+
+        tasks = []
+        for (dataset, offering_info), resource in zip(offerings, resources):
+            resource = resource or created[dataset['id']]
+            if isinstance(resource, StoreException):
+                tasks.append(lambda error=resource: _raise(error))
+            else:
+                tasks.append(lambda dataset=dataset, offering_info=offering_info, resource=resource:
+                             self._publish_once(dataset, offering_info, resource, OFFERING_STEP))
+
+        results = self._run(tasks)
+
+        # None is returned for the offerings that have been created but not published yet
+        pending = [i for i, result in enumerate(results) if result is None]
+        published = self.batch_tag_and_publish([offerings[i] for i in pending])
+        for i, result in zip(pending, published):
+            results[i] = result
+
+        return results
+
+    @bound
+    def batch_tag_and_publish(self, offerings):
+        '''
+        Method to attach the tags and publish several offerings that have already been
+        created (e.g. by batch_create_offerings or by a publication that failed later).
+        WStore does not provide bulk endpoints for these operations, so the requests of
+        all the offerings are sent concurrently over the pooled connections and the
+        publication of an offering does not wait for its tags. The journals of the
+        offerings are updated, so the steps that fail can be retried later.
+
+        :param offerings: (dataset, offering_info) tuples, as expected by create_offering
+        :type offerings: list
+
+        :returns: The URL of the offering or the StoreException raised for each item
+        :rtype: list
+        '''
+
+        journals = [self._journal_store.load(self._get_journal_key(dataset, offering_info))
+                    for dataset, offering_info in offerings]
+
+        tasks = []
+        for i, (journal, (_, offering_info)) in enumerate(zip(journals, offerings)):
+            if journal is not None and journal.is_completed(OFFERING_STEP):
+                for step, send_request in ((TAG_STEP, self._tag_offering), (PUBLISH_STEP, self._publish_offering)):
+                    if not journal.is_completed(step):
+                        tasks.append((i, step, lambda send_request=send_request, offering_info=offering_info:
+                                      _timed(send_request, offering_info)))
+
+        # Time spent in each step and first error of each offering
+        phases = [OrderedDict() for _ in offerings]
+        errors = [None] * len(offerings)
+        for (i, step, _), (result, _) in zip(tasks, run_concurrently([task for _, _, task in tasks], self.concurrency)):
+            error, phases[i][step] = result
+            if error is None:
+                journals[i].complete(step)
+            else:
+                log.warn(error)
+                journals[i].fail(step, str(error))
+                errors[i] = errors[i] or _get_error_message(error)
+
+        results = []
+        for i, (dataset, offering_info) in enumerate(offerings):
+            journal = journals[i]
+            if journal is None or not journal.is_completed(OFFERING_STEP):
+                results.append(StoreException('The offering %s is not pending to be published' % offering_info['name']))
+                continue
+
+            try:
+                if errors[i] is None:
+                    results.append(self._complete_publication(dataset, offering_info, journal))
+                else:
+                    # The steps completed are kept so the publication can be resumed
+                    self._journal_store.save(journal)
+                    results.append(StoreException(errors[i]))
+            except Exception as e:
+                log.warn(e)
+                errors[i] = str(e)
+                results.append(StoreException(errors[i]))
+            finally:
+                activity.record_operation(PUBLISH, self.name, dataset['id'], phases[i], errors[i])
+
+        return results
+
+    @bound
+    def batch_delete_attached_resources(self, datasets):
+        '''
+        Method to delete the resources (and offerings) that contain any of the given
+        datasets. The list of resources of the Store is only retrieved once and the
+        resources are deleted concurrently.
+
+        :param datasets: The datasets whose attached resources want to be deleted
+        :type datasets: list
+
+        :returns: The deleted resources (as returned by the Store) and the StoreException
+            raised when deleting them (None if it was deleted correctly)
+        :rtype: list
+        '''
+
+        dataset_urls = set(self._get_dataset_url(dataset) for dataset in datasets)
+        resources = [resource for resource in self._get_resources()
+                     if resource.get('state') != 'deleted' and resource.get('link', '') in dataset_urls]
+
+        results = self._run([lambda resource=resource: self._delete_resource(resource) for resource in resources])
+
+        return zip(resources, results)
+
+
+def _raise(error):
+    raise error
+
+
+def _timed(send_request, offering_info):
+    # Errors are returned with the elapsed time instead of being raised
+    started = time.time()
+    try:
+        send_request(offering_info)
+        error = None
+    except Exception as e:
+        error = e
+    return error, time.time() - started
+
+
+def _get_error_message(error):
+    if isinstance(error, requests.ConnectionError):
+        return 'It was impossible to connect with the Store'
+    else:
+        return str(error)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Shown to the users whose operations are rejected
+BUSY_MESSAGE = 'Too many offerings are being published right now. Please, try again in a few seconds'
+
+
+class BulkheadFull(Exception):
+    pass
+
+
+class Bulkhead(object):
+    '''
+    Bounds the number of operations that wait for the Stores at the same time in
+    each process (``ckan.storepublisher.bulkhead.max_concurrent``), so a burst of
+    publications cannot take all the threads of the worker and block the rest of
+    the site. A few operations (``ckan.storepublisher.bulkhead.queue_size``) can
+    wait up to ``ckan.storepublisher.bulkhead.max_wait`` seconds for a slot. The
+    rest are rejected immediately.
+    '''
+
+    def __init__(self, config):
+        self.max_concurrent = int(config.get('ckan.storepublisher.bulkhead.max_concurrent', 4))
+        self.queue_size = int(config.get('ckan.storepublisher.bulkhead.queue_size', 2))
+        self.max_wait = float(config.get('ckan.storepublisher.bulkhead.max_wait', 2))
+
+        self._condition = threading.Condition()
+        self.in_flight = 0
+        self.queued = 0
+
+    @contextlib.contextmanager
+    def enter(self):
+        '''
+        Runs the enclosed block in one of the slots of the bulkhead.
+
+        :raises BulkheadFull: When there are no free slots and the queue is full or
+            no slot is released in ``max_wait`` seconds
+        '''
+
+        self._acquire()
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _acquire(self):
+        with self._condition:
+            # The number of operations is not limited when max_concurrent is 0
+            if 0 < self.max_concurrent <= self.in_flight:
+                if self.queued >= self.queue_size:
+                    raise BulkheadFull('%d operations are in progress and %d are waiting' % (self.in_flight, self.queued))
+
+                self.queued += 1
+                deadline = time.time() + self.max_wait
+                try:
+                    while self.in_flight >= self.max_concurrent:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise BulkheadFull('No operation finished in %s seconds' % self.max_wait)
+                        self._condition.wait(remaining)
+                finally:
+                    self.queued -= 1
+
+            self.in_flight += 1
+
+    def _release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+
+_bulkhead = None
+_bulkhead_lock = threading.Lock()
+
+
+def get_bulkhead(config):
+    '''
+    :returns: The bulkhead shared by all the connectors of this process. It is
+        created the first time it is requested
+    :rtype: Bulkhead
+    '''
+
+    global _bulkhead
+    with _bulkhead_lock:
+        if _bulkhead is None:
+            _bulkhead = Bulkhead(config)
+
+    return _bulkhead
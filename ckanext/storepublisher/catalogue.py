@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+
+class _PageFetch(object):
+    '''Retrieves a page in a different thread'''
+
+    def __init__(self, fetch_page, start, limit):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(fetch_page, start, limit))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, fetch_page, start, limit):
+        try:
+            self._result = fetch_page(start, limit)
+        except Exception as e:
+            self._error = e
+
+    def get(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class PagedListing(object):
+    '''
+    Iterates lazily over a listing of the Store (resources, offerings...) retrieving
+    it page by page. While the items of a page are being consumed, the next page is
+    retrieved in background. Callers that stop iterating as soon as they find what
+    they are looking for do not retrieve the rest of the pages.
+
+    Pages are requested with the ``start`` (first item, starting at 1) and ``limit``
+    parameters of the Store API. The listing ends with the first page that has
+    fewer items than requested. Stores that do not support pagination return the
+    whole listing every time: when the Store returns more items than requested,
+    or a page starts with the same item as the previous one, the first page is
+    assumed to be the whole listing.
+    '''
+
+    def __init__(self, fetch_page, page_size, prefetch=True):
+        '''
+        :param fetch_page: Function that receives the start and the limit of a page
+            and returns its items
+        :type fetch_page: callable
+
+        :param page_size: Number of items per page. The whole listing is retrieved at
+            once when it is 0
+        :type page_size: int
+
+        :param prefetch: Whether the next page is retrieved in background
+        :type prefetch: bool
+        '''
+
+        self._fetch_page = fetch_page
+        self.page_size = page_size
+        self.prefetch = prefetch
+
+    def __iter__(self):
+        if self.page_size <= 0:
+            for item in self._fetch_page(None, None):
+                yield item
+            return
+
+        start = 1
+        page = self._fetch_page(start, self.page_size)
+
+        while True:
+            # Full pages are followed by another page (that may be empty)
+            more = len(page) == self.page_size
+            next_page = None
+            if more and self.prefetch:
+                next_page = _PageFetch(self._fetch_page, start + self.page_size, self.page_size)
+
+            for item in page:
+                yield item
+
+            if not more:
+                return
+
+            previous_first = page[0]
+            start += self.page_size
+            page = next_page.get() if next_page is not None else self._fetch_page(start, self.page_size)
+
+            # The Store has ignored the start of the page
+            if page and page[0] == previous_first:
+                return
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+
+from ckanext.storepublisher.identity import IdentityUnavailable, StoreIdentity
+
+log = logging.getLogger(__name__)
+
+
+class DeletionCoalescer(object):
+    '''
+    Deletes from the Stores the resources of the datasets deleted in CKAN. Datasets
+    deleted by the same user within the delete window are handled together, so the
+    catalogue of each Store is only retrieved once per batch and the resources are
+    deleted concurrently. This way, purging an organization does not retrieve the
+    catalogue once per dataset.
+    '''
+
+    def __init__(self, batch_connectors, config):
+        self._batch_connectors = batch_connectors
+        self.delete_window = float(config.get('ckan.storepublisher.delete_window', 2))
+
+        self._lock = threading.Lock()
+        # Datasets waiting to be deleted from the Stores: {user: (identity, {dataset_id: dataset})}
+        self._pending = {}
+
+    @property
+    def pending_deletions(self):
+        '''Number of datasets waiting to be deleted from the Stores'''
+        with self._lock:
+            return sum(len(datasets) for _, datasets in self._pending.values())
+
+    def dataset_deleted(self, dataset, identity=None):
+        '''
+        Method to be called every time a dataset is deleted. Its resources are
+        deleted when the window of the user expires.
+
+        :param dataset: The deleted dataset. Only its id is required
+        :type dataset: dict
+
+        :param identity: The user that deleted the dataset. By default, the user of
+            the current request. The deletion is skipped when there is no request
+        :type identity: StoreIdentity
+        '''
+
+        try:
+            identity = identity or StoreIdentity.from_request()
+        except IdentityUnavailable as e:
+            log.warn('Dataset %s is not deleted from the Stores: %s' % (dataset['id'], e))
+            return
+
+        user = identity.user
+
+        with self._lock:
+            # The last identity of the user is kept since its token is the newest one
+            _, datasets = self._pending.get(user, (None, {}))
+            self._pending[user] = (identity, datasets)
+            scheduled = len(datasets) > 0
+            datasets[dataset['id']] = dataset
+
+        if self.delete_window <= 0:
+            self._flush(user)
+        elif not scheduled:
+            # The resources are deleted on behalf of the user that deleted the datasets
+            timer = threading.Timer(self.delete_window, self._flush, args=(user,))
+            timer.daemon = True
+            timer.start()
+
+    def _flush(self, user):
+        with self._lock:
+            identity, datasets = self._pending.pop(user, (None, {}))
+            datasets = datasets.values()
+
+        if not datasets:
+            return
+
+        for connector in self._batch_connectors:
+            connector = connector.with_identity(identity)
+            try:
+                results = connector.batch_delete_attached_resources(datasets)
+            except Exception as e:
+                log.warn('Resources of %d datasets could not be deleted from the Store %s: %s' %
+                         (len(datasets), connector.name, e))
+                continue
+
+            for resource, error in results:
+                if error is not None:
+                    log.warn('Resource %s could not be deleted from the Store %s: %s' %
+                             (resource.get('name'), connector.name, error))
+
+            log.info('%d resources of %d deleted datasets removed from the Store %s' %
+                     (len(results), len(datasets), connector.name))
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckan.lib.base as base
+import ckan.model as model
+import ckan.plugins as plugins
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class AdminControllerUI(base.BaseController):
+
+    def dashboard(self):
+
+        c = plugins.toolkit.c
+        tk = plugins.toolkit
+        context = {'model': model, 'session': model.Session,
+                   'user': c.user or c.author, 'auth_user_obj': c.userobj,
+                   }
+
+        try:
+            c.dashboard = tk.get_action('storepublisher_dashboard')(context, {})
+        except tk.NotAuthorized:
+            log.warn('User %s not authorized to see the Store Publisher dashboard' % c.user)
+            tk.abort(401, tk._('User %s not authorized to see the Store Publisher dashboard') % c.user)
+
+        return tk.render('admin/storepublisher.html')
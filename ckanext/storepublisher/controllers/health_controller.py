@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckan.lib.base as base
+import ckan.model as model
+import ckan.plugins as plugins
+import json
+
+from ckan.common import response
+from pylons import config
+
+
+class HealthController(base.BaseController):
+
+    def __init__(self, name=None):
+        # The Stores are external services, so CKAN is healthy even if they are down
+        self.fail_unavailable = config.get('ckan.storepublisher.health_fail_unavailable', 'false').lower() == 'true'
+
+    def health(self):
+        '''
+        Returns the status of the Stores in JSON. The status code is 200 unless
+        ckan.storepublisher.health_fail_unavailable is enabled and any of them
+        cannot be reached (503).
+        '''
+
+        c = plugins.toolkit.c
+        context = {'model': model, 'session': model.Session,
+                   'user': c.user or c.author, 'auth_user_obj': c.userobj,
+                   }
+
+        status = plugins.toolkit.get_action('storepublisher_health')(context, {})
+
+        response.status_int = 503 if self.fail_unavailable and not status['healthy'] else 200
+        response.headers['Content-Type'] = 'application/json;charset=utf-8'
+        response.headers['Cache-Control'] = 'no-cache'
+        return json.dumps(status)
@@ -23,25 +23,37 @@ import ckan.lib.helpers as helpers
 import ckan.model as model
 import ckan.plugins as plugins
 import logging
-import os
 
-from ckanext.storepublisher.store_connector import StoreConnector, StoreException
-from ckan.common import request
+from ckanext.storepublisher.bulkhead import BulkheadFull, BUSY_MESSAGE
+from ckanext.storepublisher.drafts import DraftStore
+from ckanext.storepublisher.health import get_health_monitor
+from ckanext.storepublisher.offerings import LOGO_CKAN_B64, validate_offering
+from ckanext.storepublisher.store_connector import DEFAULT_STORE, MultiStoreConnector, StoreException
+from ckan.common import request, response
 from pylons import config
+from StringIO import StringIO
 
 log = logging.getLogger(__name__)
 
-__dir__ = os.path.dirname(os.path.abspath(__file__))
-filepath = os.path.join(__dir__, '../assets/logo-ckan.png')
-
-with open(filepath, 'rb') as f:
-    LOGO_CKAN_B64 = base64.b64encode(f.read())
+# Fields of the publish form that are kept in drafts
+FORM_FIELDS = ('pkg_id', 'name', 'description', 'license_title', 'license_description',
+               'version', 'tag_string', 'price')
 
 
 class PublishControllerUI(base.BaseController):
 
     def __init__(self, name=None):
-        self._store_connector = StoreConnector(config)
+        self._store_connector = MultiStoreConnector(config)
+        self._draft_store = DraftStore(config)
+        # Images are resized by the browser before being uploaded
+        self.image_max_size = int(config.get('ckan.storepublisher.image_max_size', 512))
+        self.image_quality = float(config.get('ckan.storepublisher.image_quality', 0.85))
+
+    def _reject(self, error):
+        # The request is answered immediately so the thread can serve other requests
+        log.warn('Publication rejected: %s' % error)
+        plugins.toolkit.c.errors['Store'] = [BUSY_MESSAGE]
+        response.status_int = 503
 
     def publish(self, id, offering_info=None, errors=None):
 
@@ -64,82 +76,151 @@ class PublishControllerUI(base.BaseController):
         dataset = tk.get_action('package_show')(context, {'id': id})
         c.pkg_dict = dataset
         c.errors = {}
+        c.pending_publication = False
+        c.draft_image = None
+        c.image_max_size = self.image_max_size
+        c.image_quality = self.image_quality
+
+        # The form is disabled when the Stores are known to be unreachable, so
+        # users do not have to wait for the request to time out
+        c.store_unavailable = not get_health_monitor(config).is_available()
 
         # Tag string is needed in order to set the list of tags in the form
         if 'tag_string' not in c.pkg_dict:
             tags = [tag['name'] for tag in c.pkg_dict.get('tags', [])]
             c.pkg_dict['tag_string'] = ','.join(tags)
 
+        # The resource of the dataset is looked for while the user fills in the form
+        if not request.POST and not c.store_unavailable:
+            try:
+                self._store_connector.prefetch_resource(dataset)
+            except Exception as e:
+                log.warn('The resource of %s could not be prefetched: %s' % (dataset['id'], e))
+
         # when the data is provided
         if request.POST:
+            # Fields that are not submitted again are taken from the draft saved
+            # when the previous attempt to publish the offering failed
+            draft = self._draft_store.load(c.user, dataset['id'])
+            draft_fields = draft['fields'] if draft else {}
+            fields = dict((field, request.POST.get(field, draft_fields.get(field, ''))) for field in FORM_FIELDS)
+
             offering_info = {}
-            offering_info['pkg_id'] = request.POST.get('pkg_id', '')
-            offering_info['name'] = request.POST.get('name', '')
-            offering_info['description'] = request.POST.get('description', '')
-            offering_info['license_title'] = request.POST.get('license_title', '')
-            offering_info['license_description'] = request.POST.get('license_description', '')
-            offering_info['version'] = request.POST.get('version', '')
+            offering_info['pkg_id'] = fields['pkg_id']
+            offering_info['name'] = fields['name']
+            offering_info['description'] = fields['description']
+            offering_info['license_title'] = fields['license_title']
+            offering_info['license_description'] = fields['license_description']
+            offering_info['version'] = fields['version']
             offering_info['is_open'] = 'open' in request.POST
 
+            # The user can discard a publication that could not be completed
+            if 'abort' in request.POST:
+                try:
+                    results = self._store_connector.abort_offering(dataset, offering_info)
+                except BulkheadFull as e:
+                    self._reject(e)
+                    return tk.render('package/publish.html')
+                self._draft_store.delete(c.user, dataset['id'])
+                if True in results.values():
+                    helpers.flash_success(tk._('The pending publication of the offering %s has been discarded.' %
+                                               offering_info['name']))
+                return tk.render('package/publish.html')
+
             # Get tags
             # ''.split(',') ==> ['']
-            tag_string = request.POST.get('tag_string', '')
+            tag_string = fields['tag_string']
             offering_info['tags'] = [] if tag_string == '' else tag_string.split(',')
 
             # Read image
             # 'image_upload' == '' if the user has not set a file
             image_field = request.POST.get('image_upload', '')
 
+            # The image of the draft is kept unless the user has removed it
+            draft_image = None
+            if draft and draft['image'] and request.POST.get('image_draft', '') == draft['image']:
+                draft_image = draft['image']
+
+            # Images resized by the browser are sent encoded in base64
+            image_resized = request.POST.get('image_resized', '') if image_field == '' else ''
+            image_content = None
+            if image_resized != '':
+                try:
+                    image_content = base64.b64decode(image_resized)
+                except TypeError:
+                    log.warn('The resized image is not encoded in base64')
+                    c.errors['Image'] = ['The image could not be read. Please, upload it again']
+
+            image_file = None
+            if image_field == '' and image_resized == '' and draft_image is not None:
+                image_file = self._draft_store.open_image(draft_image)
+                if image_file is None:
+                    draft_image = None
+
+            # Uploaded images are encoded in base64 while they are sent to the Store
             if image_field != '':
-                offering_info['image_base64'] = base64.b64encode(image_field.file.read())
+                offering_info['image_file'] = image_field.file
+            elif image_content is not None:
+                offering_info['image_base64'] = image_resized
+            elif image_file is not None:
+                offering_info['image_file'] = image_file
             else:
                 offering_info['image_base64'] = LOGO_CKAN_B64
 
-            # Convert price into float (it's given as string)
-            price = request.POST.get('price', '')
-            if price == '':
-                offering_info['price'] = 0.0
-            else:
-                try:
-                    offering_info['price'] = float(price)
-                except Exception:
-                    offering_info['price'] = price
-                    log.warn('%r is not a valid price' % price)
-                    c.errors['Price'] = ['"%s" is not a valid number' % price]
+            offering_info['price'] = fields['price']
 
             # Set offering. In this way, we recover the values introduced previosly
             # and the user does not have to introduce them again
             c.offering = offering_info
 
-            # Check that all the required fields are provided
-            required_fields = ['pkg_id', 'name', 'version']
-            for field in required_fields:
-                if not offering_info[field]:
-                    log.warn('Field %r was not provided' % field)
-                    c.errors[field.capitalize()] = ['This filed is required to publish the offering']
-
-            # Private datasets cannot be offered as open offerings
-            if dataset['private'] is True and offering_info['is_open']:
-                log.warn('User tried to create an open offering for a private dataset')
-                c.errors['Open'] = ['Private Datasets cannot be offered as Open Offerings']
+            # Check the price, the required fields and the open/private rules
+            validate_offering(dataset, offering_info, c.errors)
 
-            # Public datasets cannot be offered with price
-            if 'price' in offering_info and dataset['private'] is False and offering_info['price'] != 0.0 and 'Price' not in c.errors:
-                log.warn('User tried to create a paid offering for a public dataset')
-                c.errors['Price'] = ['You cannot set a price to a dataset that is public since everyone can access it']
+            if not c.errors and c.store_unavailable:
+                c.errors['Store'] = ['The Store cannot be reached right now. Please, try again later']
 
             if not c.errors:
 
+                # The offering is published in all the Stores. Each one returns its own result
                 try:
-                    offering_url = self._store_connector.create_offering(dataset, offering_info)
-
-                    helpers.flash_success(tk._('Offering <a href="%s" target="_blank">%s</a> published correctly.' %
-                                               (offering_url, offering_info['name'])), allow_html=True)
-
-                    # FIX: When a redirection is performed, the success message is not shown
-                    # response.status_int = 302
-                    # response.location = '/dataset/%s' % id
-                except StoreException as e:
-                    c.errors['Store'] = [e.message]
+                    results = self._store_connector.create_offering(dataset, offering_info)
+                except BulkheadFull as e:
+                    self._reject(e)
+                    results = {}
+                finally:
+                    if image_file is not None:
+                        image_file.close()
+
+                for store_name, result in results.items():
+                    if store_name == DEFAULT_STORE:
+                        store_label, store_desc = 'Store', ''
+                    else:
+                        store_label, store_desc = 'Store (%s)' % store_name, ' in %s' % store_name
+
+                    if isinstance(result, StoreException):
+                        c.errors[store_label] = [result.message]
+                        # Resubmitting the form resumes the publication
+                        c.pending_publication = True
+                    else:
+                        helpers.flash_success(tk._('Offering <a href="%s" target="_blank">%s</a> published correctly%s.' %
+                                                   (result, offering_info['name'], store_desc)), allow_html=True)
+
+                # FIX: When a redirection is performed, the success message is not shown
+                # response.status_int = 302
+                # response.location = '/dataset/%s' % id
+
+            if c.errors:
+                # The valid fields and the uploaded image are kept so they do not have to
+                # be sent again. Images are only copied when the publication fails.
+                if image_field != '':
+                    draft_image = self._draft_store.save_image(image_field.file)
+                elif image_content is not None:
+                    draft_image = self._draft_store.save_image(StringIO(image_content))
+
+                valid_fields = dict((field, value) for field, value in fields.items() if field.capitalize() not in c.errors)
+                self._draft_store.save(c.user, dataset['id'], valid_fields, draft_image)
+                c.draft_image = draft_image
+            else:
+                self._draft_store.delete(c.user, dataset['id'])
 
         return tk.render('package/publish.html')
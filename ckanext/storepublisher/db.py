@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlalchemy as sa
+
+PublishJournal = None
+PublishDraft = None
+RateLimitBucket = None
+Publication = None
+MirroredOffering = None
+MirrorSync = None
+Acquisition = None
+
+
+def init_db(model):
+
+    global PublishJournal
+    global PublishDraft
+    global RateLimitBucket
+    global Publication
+    global MirroredOffering
+    global MirrorSync
+    global Acquisition
+    if PublishJournal is None:
+
+        class _PublishJournal(model.DomainObject):
+
+            @classmethod
+            def get(cls, **kw):
+                '''Finds a single entity in the register.'''
+                query = model.Session.query(cls).autoflush(False)
+                return query.filter_by(**kw).first()
+
+        PublishJournal = _PublishJournal
+
+        # Status of the steps of the publications that have not been completed
+        publish_journal_table = sa.Table('storepublisher_publish_journal', model.meta.metadata,
+            sa.Column('store', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('user_name', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('package_id', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('offering_name', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('offering_version', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('steps', sa.types.UnicodeText, nullable=False, default=u''),
+            sa.Column('updated', sa.types.DateTime, nullable=False)
+        )
+
+        # Create the table only if it does not exist
+        publish_journal_table.create(checkfirst=True)
+
+        model.meta.mapper(PublishJournal, publish_journal_table,)
+
+    if PublishDraft is None:
+
+        class _PublishDraft(model.DomainObject):
+
+            @classmethod
+            def get(cls, **kw):
+                '''Finds a single entity in the register.'''
+                query = model.Session.query(cls).autoflush(False)
+                return query.filter_by(**kw).first()
+
+        PublishDraft = _PublishDraft
+
+        # Fields submitted by users whose offerings could not be published yet
+        publish_draft_table = sa.Table('storepublisher_publish_draft', model.meta.metadata,
+            sa.Column('user_name', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('package_id', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('fields', sa.types.UnicodeText, nullable=False, default=u''),
+            sa.Column('image', sa.types.UnicodeText, nullable=True),
+            sa.Column('expires', sa.types.DateTime, nullable=False)
+        )
+
+        # Create the table only if it does not exist
+        publish_draft_table.create(checkfirst=True)
+
+        model.meta.mapper(PublishDraft, publish_draft_table,)
+
+    if RateLimitBucket is None:
+
+        class _RateLimitBucket(object):
+            pass
+
+        RateLimitBucket = _RateLimitBucket
+
+        # Token buckets shared by all the processes that send requests to the Stores
+        rate_limit_table = sa.Table('storepublisher_rate_limit', model.meta.metadata,
+            sa.Column('key', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('tokens', sa.types.Float, nullable=False),
+            sa.Column('updated', sa.types.Float, nullable=False)
+        )
+
+        # Create the table only if it does not exist
+        rate_limit_table.create(checkfirst=True)
+
+        model.meta.mapper(RateLimitBucket, rate_limit_table,)
+
+    if Publication is None:
+
+        class _Publication(model.DomainObject):
+
+            @classmethod
+            def get(cls, **kw):
+                '''Finds a single entity in the register.'''
+                query = model.Session.query(cls).autoflush(False)
+                return query.filter_by(**kw).first()
+
+            @classmethod
+            def get_package_publications(cls, package_id):
+                '''Returns the offerings that contain the given dataset'''
+                query = model.Session.query(cls).autoflush(False)
+                return query.filter_by(package_id=package_id).order_by(cls.published).all()
+
+        Publication = _Publication
+
+        # Offerings published successfully
+        publication_table = sa.Table('storepublisher_publication', model.meta.metadata,
+            sa.Column('store', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('package_id', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('offering_name', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('offering_version', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('user_name', sa.types.UnicodeText, nullable=False, default=u''),
+            sa.Column('offering_url', sa.types.UnicodeText, nullable=False, default=u''),
+            sa.Column('resource_name', sa.types.UnicodeText, nullable=False, default=u''),
+            sa.Column('price', sa.types.Float, nullable=False, default=0.0),
+            sa.Column('published', sa.types.DateTime, nullable=False)
+        )
+
+        # Create the table only if it does not exist
+        publication_table.create(checkfirst=True)
+
+        model.meta.mapper(Publication, publication_table,)
+
+    if MirroredOffering is None:
+
+        class _MirroredOffering(model.DomainObject):
+
+            @classmethod
+            def get(cls, **kw):
+                '''Finds a single entity in the register.'''
+                query = model.Session.query(cls).autoflush(False)
+                return query.filter_by(**kw).first()
+
+            @classmethod
+            def get_package_offerings(cls, package_id):
+                '''Returns the offerings of the Stores that contain the given dataset'''
+                query = model.Session.query(cls).autoflush(False)
+                return query.filter_by(package_id=package_id).order_by(cls.published.desc()).all()
+
+        MirroredOffering = _MirroredOffering
+
+        # Copy of the offerings of the Stores that contain datasets of this instance
+        mirrored_offering_table = sa.Table('storepublisher_offering', model.meta.metadata,
+            sa.Column('store', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('package_id', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('owner', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('name', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('version', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('state', sa.types.UnicodeText, nullable=False, default=u''),
+            sa.Column('price', sa.types.Float, nullable=False, default=0.0),
+            sa.Column('offering_url', sa.types.UnicodeText, nullable=False, default=u''),
+            sa.Column('resource_name', sa.types.UnicodeText, nullable=False, default=u''),
+            sa.Column('resource_link', sa.types.UnicodeText, nullable=False, default=u''),
+            sa.Column('published', sa.types.DateTime, nullable=True),
+            sa.Column('synced', sa.types.DateTime, nullable=False),
+            sa.Index('storepublisher_offering_package_id_idx', 'package_id')
+        )
+
+        # Create the table only if it does not exist
+        mirrored_offering_table.create(checkfirst=True)
+
+        model.meta.mapper(MirroredOffering, mirrored_offering_table,)
+
+    if MirrorSync is None:
+
+        class _MirrorSync(model.DomainObject):
+
+            @classmethod
+            def get(cls, **kw):
+                '''Finds a single entity in the register.'''
+                query = model.Session.query(cls).autoflush(False)
+                return query.filter_by(**kw).first()
+
+        MirrorSync = _MirrorSync
+
+        # Last synchronization of the copy of the offerings of each Store
+        mirror_sync_table = sa.Table('storepublisher_offering_sync', model.meta.metadata,
+            sa.Column('store', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('watermark', sa.types.DateTime, nullable=True),
+            sa.Column('synced', sa.types.DateTime, nullable=True),
+            sa.Column('full_synced', sa.types.DateTime, nullable=True)
+        )
+
+        # Create the table only if it does not exist
+        mirror_sync_table.create(checkfirst=True)
+
+        model.meta.mapper(MirrorSync, mirror_sync_table,)
+
+    if Acquisition is None:
+
+        class _Acquisition(model.DomainObject):
+            pass
+
+        Acquisition = _Acquisition
+
+        # Datasets acquired in the Stores whose users have not been allowed yet
+        acquisition_table = sa.Table('storepublisher_acquisition', model.meta.metadata,
+            sa.Column('id', sa.types.UnicodeText, primary_key=True, default=u''),
+            sa.Column('user_name', sa.types.UnicodeText, nullable=False, default=u''),
+            sa.Column('dataset', sa.types.UnicodeText, nullable=False, default=u''),
+            sa.Column('received', sa.types.DateTime, nullable=False),
+            sa.Index('storepublisher_acquisition_dataset_idx', 'dataset')
+        )
+
+        # Create the table only if it does not exist
+        acquisition_table.create(checkfirst=True)
+
+        model.meta.mapper(Acquisition, acquisition_table,)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckan.model as model
+import ckanext.storepublisher.db as db
+import datetime
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import uuid
+
+log = logging.getLogger(__name__)
+
+# References to images are generated by this module
+IMAGE_REF_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class DraftStore(object):
+    '''
+    Keeps the fields of the offerings that could not be published, so users do not
+    have to upload the same image again when they submit the publish form once
+    more. Drafts are stored per user and dataset and expire after
+    ``ckan.storepublisher.draft_ttl`` seconds. Images are saved as they were
+    uploaded in the ``ckan.storepublisher.drafts_dir`` directory.
+    '''
+
+    def __init__(self, config):
+        storage_path = config.get('ckan.storage_path')
+        if storage_path:
+            default_dir = os.path.join(storage_path, 'storepublisher', 'drafts')
+        else:
+            default_dir = os.path.join(tempfile.gettempdir(), 'storepublisher_drafts')
+
+        self.images_dir = config.get('ckan.storepublisher.drafts_dir', default_dir)
+        self.ttl = int(config.get('ckan.storepublisher.draft_ttl', 3600))
+
+    def _get_entry(self, user_name, package_id):
+        db.init_db(model)
+        return db.PublishDraft.get(user_name=user_name, package_id=package_id)
+
+    def _get_image_path(self, image_ref):
+        if not IMAGE_REF_RE.match(image_ref):
+            raise ValueError('Invalid image reference %r' % image_ref)
+        return os.path.join(self.images_dir, image_ref)
+
+    def _delete_image(self, image_ref):
+        try:
+            os.remove(self._get_image_path(image_ref))
+        except (OSError, ValueError) as e:
+            log.warn('Draft image %s could not be deleted: %s' % (image_ref, e))
+
+    def purge_expired(self):
+        '''Deletes the drafts (and their images) that have expired'''
+
+        db.init_db(model)
+        now = datetime.datetime.utcnow()
+        expired = model.Session.query(db.PublishDraft).filter(db.PublishDraft.expires < now).all()
+
+        for entry in expired:
+            if entry.image:
+                self._delete_image(entry.image)
+            model.Session.delete(entry)
+
+        if expired:
+            model.Session.commit()
+
+    def load(self, user_name, package_id):
+        '''
+        :returns: The fields and the reference to the image (None if not provided)
+            of the draft or None when there is no draft
+        :rtype: dict
+        '''
+
+        entry = self._get_entry(user_name, package_id)
+
+        if entry is None:
+            return None
+        elif entry.expires < datetime.datetime.utcnow():
+            self.delete(user_name, package_id)
+            return None
+        else:
+            return {'fields': json.loads(entry.fields), 'image': entry.image}
+
+    def save(self, user_name, package_id, fields, image_ref=None):
+        '''
+        Creates or replaces the draft of the given user for the given dataset. Its
+        expiration time is also renewed.
+
+        :param fields: The fields submitted by the user
+        :type fields: dict
+
+        :param image_ref: The reference to the image returned by save_image
+        :type image_ref: string
+        '''
+
+        self.purge_expired()
+        entry = self._get_entry(user_name, package_id)
+
+        if entry is None:
+            entry = db.PublishDraft()
+            entry.user_name = user_name
+            entry.package_id = package_id
+            model.Session.add(entry)
+        elif entry.image and entry.image != image_ref:
+            self._delete_image(entry.image)
+
+        entry.fields = json.dumps(fields)
+        entry.image = image_ref
+        entry.expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl)
+        model.Session.commit()
+
+    def delete(self, user_name, package_id):
+        entry = self._get_entry(user_name, package_id)
+
+        if entry is not None:
+            if entry.image:
+                self._delete_image(entry.image)
+            model.Session.delete(entry)
+            model.Session.commit()
+
+    def save_image(self, fileobj):
+        '''
+        Copies the content of the given file into the drafts directory.
+
+        :returns: The reference to the saved image
+        :rtype: string
+        '''
+
+        if not os.path.isdir(self.images_dir):
+            os.makedirs(self.images_dir)
+
+        image_ref = uuid.uuid4().hex
+        fileobj.seek(0)
+        with open(self._get_image_path(image_ref), 'wb') as image_file:
+            shutil.copyfileobj(fileobj, image_file)
+
+        return image_ref
+
+    def open_image(self, image_ref):
+        '''
+        :returns: The file that contains the image or None when it does not exist
+        :rtype: file
+        '''
+
+        try:
+            return open(self._get_image_path(image_ref), 'rb')
+        except (IOError, ValueError) as e:
+            log.warn('Draft image %s could not be opened: %s' % (image_ref, e))
+            return None
@@ -0,0 +1,203 @@
+/*
+ * (C) Copyright 2014 CoNWeT Lab., Universidad Politécnica de Madrid
+ *
+ * This file is part of CKAN Store Publisher Extension.
+ *
+ * CKAN Store Publisher Extension is free software: you can redistribute it and/or
+ * modify it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation, either version 3 of the
+ * License, or (at your option) any later version.
+ *
+ * CKAN Store Publisher Extension is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+ * License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with CKAN Store Publisher Extension. If not, see
+ * <http://www.gnu.org/licenses/>.
+ *
+ */
+
+(function()  {
+    var default_style = 'inline-block'
+    var hidden_style = 'none'
+
+    var form = $('#storepublisher-publish-form');
+    var image_pending = false;
+    var image_error = null;
+    var submit_button = null;
+
+    // Same number format accepted by the server (float)
+    var PRICE_RE = /^\s*[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?\s*$/;
+    var MISSING_ERROR = 'This filed is required to publish the offering';
+
+    var reset_image_input = function() {
+        var image_input = $('#field-image_upload');
+        image_input.replaceWith(image_input.clone(true));
+    };
+
+    var show_errors = function(errors) {
+        var box = form.find('.error-explanation');
+        if (box.length === 0) {
+            box = $('<div class="error-explanation alert alert-error"><p></p><ul></ul></div>');
+            box.find('p').text('The offering could not be published:');
+            form.prepend(box);
+        }
+
+        var list = box.find('ul').empty();
+        $.each(errors, function(key, error) {
+            list.append($('<li></li>').attr('data-field-label', key).text(key + ': ' + error));
+        });
+        $('html, body').scrollTop(box.offset().top);
+    };
+
+    var set_image_pending = function(pending) {
+        // Buttons disabled by the server (e.g. the Store cannot be reached) are not enabled
+        image_pending = pending;
+        form.find('button[name="save"]').each(function() {
+            if (pending && !this.disabled) {
+                $(this).attr('data-image-pending', 'true').prop('disabled', true);
+            } else if (!pending && $(this).attr('data-image-pending')) {
+                $(this).removeAttr('data-image-pending').prop('disabled', false);
+            }
+        });
+    };
+
+    var resize_image = function(file, max_size, quality) {
+        var reader = new FileReader();
+        var image = new Image();
+
+        image.onload = function() {
+            var scale = max_size / Math.max(image.width, image.height);
+
+            // Images that are small enough are uploaded as they are
+            if (scale < 1) {
+                var canvas = document.createElement('canvas');
+                canvas.width = Math.max(1, Math.round(image.width * scale));
+                canvas.height = Math.max(1, Math.round(image.height * scale));
+                canvas.getContext('2d').drawImage(image, 0, 0, canvas.width, canvas.height);
+
+                // PNG images are kept as PNG so transparency is not lost
+                var type = file.type === 'image/png' ? 'image/png' : 'image/jpeg';
+                var data_url = canvas.toDataURL(type, quality);
+                var encoded = data_url.substring(data_url.indexOf(',') + 1);
+
+                // The resized image is only used when it is smaller than the original one
+                if (encoded.length * 3 / 4 < file.size) {
+                    $('#field-image_resized').val(encoded);
+                    reset_image_input();
+                }
+            }
+            set_image_pending(false);
+        };
+
+        image.onerror = function() {
+            image_error = 'The file is not a valid image';
+            reset_image_input();
+            set_image_pending(false);
+        };
+
+        reader.onload = function() {
+            image.src = reader.result;
+        };
+        reader.readAsDataURL(file);
+    };
+
+    form.on('change', '#field-image_upload', function() {
+        var file = this.files && this.files[0];
+        var max_size = parseInt($(this).attr('data-max-size'), 10);
+        var quality = parseFloat($(this).attr('data-quality'));
+
+        $('#field-image_resized').val('');
+        image_error = null;
+        $('#button-upload').css('display', hidden_style);
+        $('#button-remove').css('display', default_style);
+
+        if (!file) {
+            return;
+        }
+
+        if (file.type && file.type.indexOf('image/') !== 0) {
+            image_error = 'The file is not an image';
+            return;
+        }
+
+        // Browsers that cannot resize images upload the original one
+        var canvas = document.createElement('canvas');
+        if (max_size > 0 && window.FileReader && canvas.getContext) {
+            set_image_pending(true);
+            resize_image(file, max_size, quality);
+        }
+    });
+
+    $('#button-remove').on('click', function(){
+        reset_image_input();
+        $('#field-image_resized').val('');
+        image_error = null;
+        // The image uploaded in a previous attempt is not used anymore
+        $('#field-image_draft').val('');
+        $('#button-upload').css('display', default_style);
+        $('#button-remove').css('display', hidden_style);
+    });
+
+    $('#button-upload').on('click', function() {
+        $('#field-image_upload').click();
+    });
+
+    form.find('button[type="submit"]').on('click', function() {
+        submit_button = this.name;
+    });
+
+    // The form is checked before being sent, as the server does, so invalid
+    // offerings do not have to be submitted
+    form.on('submit', function(event) {
+        var errors = {};
+
+        // Discarding a publication does not require valid fields
+        if (submit_button === 'abort') {
+            return true;
+        }
+
+        if (image_pending) {
+            event.preventDefault();
+            return false;
+        }
+
+        if ($.trim(form.find('input[name="pkg_id"]').val()) === '') {
+            errors['Pkg_id'] = MISSING_ERROR;
+        }
+        if ($.trim($('#field-name').val()) === '') {
+            errors['Name'] = MISSING_ERROR;
+        }
+        if ($.trim($('#field-version').val()) === '') {
+            errors['Version'] = MISSING_ERROR;
+        }
+
+        var private_dataset = form.attr('data-private') === 'true';
+        var price_input = $('#field-price');
+        if (price_input.length && price_input.val() !== '') {
+            if (!PRICE_RE.test(price_input.val())) {
+                errors['Price'] = '"' + price_input.val() + '" is not a valid number';
+            } else if (!private_dataset && parseFloat(price_input.val()) !== 0) {
+                errors['Price'] = 'You cannot set a price to a dataset that is public since everyone can access it';
+            }
+        }
+
+        if (private_dataset && $('#field-open').is(':checked')) {
+            errors['Open'] = 'Private Datasets cannot be offered as Open Offerings';
+        }
+
+        if (image_error) {
+            errors['Image'] = image_error;
+        }
+
+        if (!$.isEmptyObject(errors)) {
+            event.preventDefault();
+            show_errors(errors);
+            return false;
+        }
+
+        return true;
+    });
+})();
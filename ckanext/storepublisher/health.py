@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import logging
+import threading
+import time
+
+from ckanext.storepublisher.store_connector import MultiStoreConnector
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class HealthMonitor(object):
+    '''
+    Checks whether the Stores can be reached in a background thread every
+    ``ckan.storepublisher.health_interval`` seconds. The last result is cached so
+    asking for the status of the Stores never sends requests to them.
+    '''
+
+    def __init__(self, store_connector, config):
+        self._store_connector = store_connector
+        self.interval = float(config.get('ckan.storepublisher.health_interval', 30))
+
+        self._lock = threading.Lock()
+        self._thread = None
+        # Stores are not known to be reachable or unreachable until they are checked
+        self._status = OrderedDict((store_name, {'reachable': None, 'latency': None, 'checked': None, 'error': None})
+                                   for store_name in store_connector.connectors)
+
+    def start(self):
+        '''Starts checking the Stores in background (only once)'''
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='storepublisher-health')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                log.warn('Stores could not be checked: %s' % e)
+            time.sleep(self.interval)
+
+    def check(self):
+        '''Checks all the Stores and caches the results'''
+
+        results = self._store_connector.probe()
+        checked = datetime.datetime.utcnow().isoformat()
+
+        with self._lock:
+            for store_name, (latency, error) in results.items():
+                if error is None:
+                    status = {'reachable': True, 'latency': round(latency * 1000, 1), 'error': None}
+                else:
+                    log.warn('Store %s cannot be reached: %s' % (store_name, error))
+                    status = {'reachable': False, 'latency': None, 'error': str(error)}
+
+                status['checked'] = checked
+                self._status[store_name] = status
+
+    def get_status(self):
+        '''
+        :returns: Whether the Stores are healthy (none of them is known to be
+            unreachable), the interval between checks and the last status of each
+            Store (reachable, latency in milliseconds, time of the check and error)
+        :rtype: dict
+        '''
+
+        self.start()
+
+        with self._lock:
+            stores = [dict(status, name=store_name) for store_name, status in self._status.items()]
+
+        return {
+            'healthy': all(store['reachable'] is not False for store in stores),
+            'interval': self.interval,
+            'stores': stores
+        }
+
+    def is_available(self):
+        '''
+        :returns: False when all the Stores are known to be unreachable. True otherwise
+        :rtype: bool
+        '''
+
+        stores = self.get_status()['stores']
+        return any(store['reachable'] is not False for store in stores)
+
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+
+def get_health_monitor(config):
+    '''
+    :returns: The monitor of the Stores of this process. It is created (and started)
+        the first time it is requested
+    :rtype: HealthMonitor
+    '''
+
+    global _monitor
+    with _monitor_lock:
+        if _monitor is None:
+            _monitor = HealthMonitor(MultiStoreConnector(config), config)
+
+    _monitor.start()
+    return _monitor
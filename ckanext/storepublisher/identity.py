@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckan.plugins as plugins
+
+
+class IdentityUnavailable(ValueError):
+    pass
+
+
+class StoreIdentity(object):
+    '''
+    The user on behalf of whom the requests are sent to the Stores and its OAuth2
+    token. Connectors bound to an identity (see StoreConnector.with_identity) do
+    not depend on the request that created them, so they can be used from other
+    threads and background jobs. Identities can be serialized with to_dict to be
+    sent to other processes.
+
+    Identities created from a request can only refresh their token while the
+    work started by that request is running (e.g. the tasks of a publication or
+    a short coalescing window). Identities that outlive their request must be
+    created with a refresh function that does not depend on it.
+    '''
+
+    def __init__(self, user, token, refresh_token=None):
+        '''
+        :param user: The name of the user
+        :type user: string
+
+        :param token: The OAuth2 token of the user
+        :type token: dict
+
+        :param refresh_token: Function that refreshes the token and returns the new
+            one. Tokens cannot be refreshed when it is not given
+        :type refresh_token: callable
+        '''
+
+        self.user = user
+        self.token = token
+        self._refresh_token = refresh_token
+
+    def __repr__(self):
+        return '<StoreIdentity %s>' % self.user
+
+    def refresh(self):
+        '''
+        Replaces the token of the identity by a new one.
+
+        :raises ValueError: When the token cannot be refreshed
+        '''
+
+        if self._refresh_token is None:
+            raise ValueError('The token of the user %s cannot be refreshed' % self.user)
+
+        self.token = self._refresh_token()
+
+    def to_dict(self):
+        return {'user': self.user, 'token': self.token}
+
+    @classmethod
+    def from_dict(cls, data, refresh_token=None):
+        return cls(data['user'], data['token'], refresh_token)
+
+    @classmethod
+    def from_request(cls):
+        '''
+        :returns: The identity of the user of the current request. Its token is
+            refreshed by the extension that manages the tokens, even from other
+            threads, within the context of the request
+        :rtype: StoreIdentity
+
+        :raises IdentityUnavailable: When there is no request in this thread or its
+            user has no token
+        '''
+
+        c = plugins.toolkit.c
+        try:
+            tmpl_context = c._current_obj()
+        except AttributeError:
+            # The context is not a proxy
+            tmpl_context = None
+        except TypeError:
+            raise IdentityUnavailable('There is no request whose user can contact the Stores')
+
+        user = getattr(c, 'user', None)
+        token = getattr(c, 'usertoken', None)
+        if not user or not token:
+            raise IdentityUnavailable('The user of the request has no token to contact the Stores')
+
+        def _refresh_token():
+            # The new token is stored in the context of the request
+            if tmpl_context is not None:
+                c._push_object(tmpl_context)
+            try:
+                c.usertoken_refresh()
+                return c.usertoken
+            finally:
+                if tmpl_context is not None:
+                    c._pop_object(tmpl_context)
+
+        return cls(user, token, _refresh_token)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckan.model as model
+import ckanext.storepublisher.db as db
+import datetime
+import json
+
+from collections import OrderedDict
+
+# Steps required to publish an offering, in order
+RESOURCE_STEP = 'resource'
+OFFERING_STEP = 'offering'
+TAG_STEP = 'tag'
+PUBLISH_STEP = 'publish'
+STEPS = (RESOURCE_STEP, OFFERING_STEP, TAG_STEP, PUBLISH_STEP)
+
+PENDING = 'pending'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+
+class SagaJournal(object):
+    '''
+    Records the status and the result of each step of the publication of an
+    offering, so a failed publication can be resumed from the first step that
+    was not completed.
+    '''
+
+    def __init__(self, key, steps=None):
+        self.key = key
+        self.steps = steps or OrderedDict((step, {'status': PENDING}) for step in STEPS)
+
+    def is_completed(self, step):
+        return self.steps[step]['status'] == COMPLETED
+
+    def get_result(self, step):
+        return self.steps[step].get('result')
+
+    def complete(self, step, result=None):
+        self.steps[step] = {'status': COMPLETED, 'result': result}
+
+    def fail(self, step, error):
+        self.steps[step] = {'status': FAILED, 'error': error}
+
+    @property
+    def completed(self):
+        return all(self.is_completed(step) for step in STEPS)
+
+    @property
+    def next_step(self):
+        for step in STEPS:
+            if not self.is_completed(step):
+                return step
+        return None
+
+
+class JournalStore(object):
+    '''
+    Saves the journals of the publications in the database so they can be resumed
+    by any worker. Journals are identified by a (store, user, package_id,
+    offering_name, offering_version) tuple.
+    '''
+
+    def _get_entry(self, key):
+        db.init_db(model)
+        store, user_name, package_id, offering_name, offering_version = key
+        return db.PublishJournal.get(store=store, user_name=user_name, package_id=package_id,
+                                     offering_name=offering_name, offering_version=offering_version)
+
+    def load(self, key):
+        entry = self._get_entry(key)
+
+        if entry is None:
+            return None
+        else:
+            return SagaJournal(key, json.loads(entry.steps, object_pairs_hook=OrderedDict))
+
+    def save(self, journal):
+        entry = self._get_entry(journal.key)
+
+        if entry is None:
+            entry = db.PublishJournal()
+            entry.store, entry.user_name, entry.package_id, entry.offering_name, entry.offering_version = journal.key
+            model.Session.add(entry)
+
+        entry.steps = json.dumps(journal.steps)
+        entry.updated = datetime.datetime.utcnow()
+        model.Session.commit()
+
+    def delete(self, key):
+        entry = self._get_entry(key)
+
+        if entry is not None:
+            model.Session.delete(entry)
+            model.Session.commit()
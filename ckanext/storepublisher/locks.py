@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckan.model as model
+import contextlib
+import hashlib
+import logging
+import struct
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.1
+
+
+class LockTimeout(Exception):
+    pass
+
+
+# Locks of the datasets held or awaited in this process: {name: [lock, users]}
+_local_locks = {}
+_local_locks_lock = threading.Lock()
+
+
+def _get_local_lock(name):
+    with _local_locks_lock:
+        entry = _local_locks.setdefault(name, [threading.Lock(), 0])
+        entry[1] += 1
+        return entry[0]
+
+
+def _put_local_lock(name):
+    # Locks are discarded once nobody holds or waits for them
+    with _local_locks_lock:
+        entry = _local_locks[name]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _local_locks[name]
+
+
+def _get_lock_id(name):
+    # PostgreSQL advisory locks are identified by a signed 64-bit integer
+    return struct.unpack('>q', hashlib.md5(name.encode('utf-8')).digest()[:8])[0]
+
+
+def _acquire(try_acquire, deadline):
+    while not try_acquire():
+        if time.time() >= deadline:
+            return False
+        time.sleep(POLL_INTERVAL)
+    return True
+
+
+class DatasetLock(object):
+    '''
+    Ensures that a dataset is only published in a Store by one request at a time,
+    even if the requests are served by different processes. Threads of the same
+    process are synchronized with a lock and processes with a PostgreSQL advisory
+    lock (other databases only get the lock of the process). Requests wait up to
+    ``ckan.storepublisher.publish_lock_timeout`` seconds.
+    '''
+
+    def __init__(self, config):
+        self.timeout = float(config.get('ckan.storepublisher.publish_lock_timeout', 120))
+
+    @contextlib.contextmanager
+    def hold(self, store, package_id):
+        '''
+        Holds the lock of the given dataset in the given Store while the block is
+        run.
+
+        :raises LockTimeout: When the lock cannot be acquired before the timeout
+        '''
+
+        name = u'storepublisher:%s:%s' % (store, package_id)
+        lock_id = _get_lock_id(name)
+        local_lock = _get_local_lock(name)
+        deadline = time.time() + self.timeout
+
+        try:
+            if not _acquire(lambda: local_lock.acquire(False), deadline):
+                raise LockTimeout('The dataset is being published by another request. Please, try again later')
+
+            connection = None
+            try:
+                engine = model.meta.engine
+                if engine.dialect.name == 'postgresql':
+                    # Advisory locks belong to the connection, so a dedicated one is used
+                    connection = engine.connect()
+
+                    def _try_advisory_lock():
+                        return connection.execute('SELECT pg_try_advisory_lock(%s)' % lock_id).scalar()
+
+                    if not _acquire(_try_advisory_lock, deadline):
+                        raise LockTimeout('The dataset is being published by another request. Please, try again later')
+
+                    try:
+                        yield
+                    finally:
+                        connection.execute('SELECT pg_advisory_unlock(%s)' % lock_id)
+                else:
+                    yield
+            finally:
+                if connection is not None:
+                    connection.close()
+                local_lock.release()
+        finally:
+            _put_local_lock(name)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckan.model as model
+import ckanext.storepublisher.db as db
+import datetime
+import logging
+import re
+import threading
+import time
+
+from ckanext.storepublisher.identity import StoreIdentity
+
+log = logging.getLogger(__name__)
+
+PUBLISHED = 'published'
+DATE_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
+
+def _parse_date(value):
+    # Dates are returned by the Store as strings in UTC
+    value = re.sub(r'(Z|[+-]\d\d:?\d\d)$', '', value or '')
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+
+    return None
+
+
+class OfferingMirror(object):
+    '''
+    Keeps a copy of the offerings of the Stores that contain datasets of this
+    instance (``storepublisher_offering`` table), so dataset pages can show them
+    without querying the Stores. The copy is refreshed in a background thread every
+    ``ckan.storepublisher.mirror_interval`` seconds: the offerings are requested
+    from the last published and only the ones published after the previous
+    synchronization (the watermark) are read. The whole catalogue is read every
+    ``ckan.storepublisher.mirror_full_sync`` seconds to forget the offerings that
+    are not published anymore.
+
+    The Stores only list the published offerings to registered users, so the
+    requests are sent on behalf of a service account whose OAuth2 access token is
+    set in ``ckan.storepublisher.mirror_token``. The copy is not refreshed when it
+    is not set.
+    '''
+
+    def __init__(self, store_connector, config):
+        self._store_connector = store_connector
+        self.interval = float(config.get('ckan.storepublisher.mirror_interval', 300))
+        self.full_sync_interval = float(config.get('ckan.storepublisher.mirror_full_sync', 3600))
+
+        # The token of the service account cannot be refreshed
+        token = config.get('ckan.storepublisher.mirror_token')
+        user = config.get('ckan.storepublisher.mirror_user', 'storepublisher')
+        self._identity = StoreIdentity(user, {'access_token': token, 'token_type': 'Bearer'}) if token else None
+
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        '''Starts refreshing the copy in background (only once)'''
+
+        if self._identity is None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='storepublisher-mirror')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sync()
+            except Exception as e:
+                log.warn('Offerings could not be synchronized: %s' % e)
+            finally:
+                model.Session.remove()
+            time.sleep(self.interval)
+
+    def sync(self):
+        '''
+        Refreshes the copy of the offerings of all the Stores. Stores synchronized
+        by other processes less than ``mirror_interval`` seconds ago are skipped.
+        '''
+
+        identity = self._identity
+        if identity is None:
+            log.debug('Offerings are not synchronized since ckan.storepublisher.mirror_token is not set')
+            return
+
+        db.init_db(model)
+        for store_name, connector in self._store_connector.connectors.items():
+            try:
+                self._sync_store(store_name, connector.with_identity(identity))
+            except Exception as e:
+                log.warn('Offerings of the Store %s could not be synchronized: %s' % (store_name, e))
+                model.Session.rollback()
+
+    def _get_entries(self, store_name, connector, offering):
+        # The datasets of this instance are identified by the links of the resources
+        dataset_url_prefix = connector._get_dataset_url({'id': ''})
+        price = connector._get_offering_info(offering)['price']
+        owner = offering.get('owner_organization', '')
+        offering_url = '%s/offering/%s/%s/%s' % (connector.store_url, owner, offering['name'].replace(' ', '%20'),
+                                                 offering['version'])
+
+        for resource in offering.get('resources', []):
+            link = resource.get('link') or ''
+            if link.startswith(dataset_url_prefix):
+                yield {
+                    'store': store_name,
+                    'package_id': link[len(dataset_url_prefix):].strip('/'),
+                    'owner': owner,
+                    'name': offering['name'],
+                    'version': offering['version'],
+                    'state': offering.get('state', PUBLISHED),
+                    'price': price,
+                    'offering_url': offering_url,
+                    'resource_name': resource.get('name', ''),
+                    'resource_link': link,
+                    'published': _parse_date(offering.get('publication_date'))
+                }
+
+    def _sync_store(self, store_name, connector):
+        now = datetime.datetime.utcnow()
+
+        state = db.MirrorSync.get(store=store_name)
+        if state is None:
+            state = db.MirrorSync()
+            state.store = store_name
+            model.Session.add(state)
+        elif state.synced is not None and (now - state.synced).total_seconds() < self.interval:
+            return
+
+        full_sync = state.full_synced is None or (now - state.full_synced).total_seconds() >= self.full_sync_interval
+        watermark = None if full_sync else state.watermark
+        keys = set()
+
+        # Offerings are retrieved page by page, so no more pages are requested once the watermark is reached
+        for offering in connector._get_offerings(PUBLISHED, sort='date'):
+            published = _parse_date(offering.get('publication_date'))
+            if watermark is not None and published is not None and published <= watermark:
+                break
+
+            if published is not None and (state.watermark is None or published > state.watermark):
+                state.watermark = published
+
+            for fields in self._get_entries(store_name, connector, offering):
+                key = (fields['package_id'], fields['owner'], fields['name'], fields['version'])
+                keys.add(key)
+                entry = db.MirroredOffering.get(store=store_name, package_id=key[0], owner=key[1], name=key[2],
+                                                version=key[3])
+                new_entry = entry is None
+                if new_entry:
+                    entry = db.MirroredOffering()
+
+                for field, value in fields.items():
+                    setattr(entry, field, value)
+                entry.synced = now
+
+                if new_entry:
+                    model.Session.add(entry)
+
+        if full_sync:
+            # Offerings that are not published anymore are forgotten
+            for entry in model.Session.query(db.MirroredOffering).filter_by(store=store_name).all():
+                if (entry.package_id, entry.owner, entry.name, entry.version) not in keys:
+                    model.Session.delete(entry)
+            state.full_synced = now
+
+        state.synced = now
+        model.Session.commit()
+        log.info('%d offerings of the Store %s synchronized' % (len(keys), store_name))
+
+    def get(self, package_id):
+        '''
+        :returns: The published offerings that contain the given dataset, the last
+            published first. They are read from the copy, so the Stores are never queried
+        :rtype: list
+        '''
+
+        db.init_db(model)
+        return [{
+            'store': entry.store,
+            'owner': entry.owner,
+            'name': entry.name,
+            'version': entry.version,
+            'price': entry.price,
+            'offering_url': entry.offering_url,
+            'resource_name': entry.resource_name,
+            'published': entry.published.isoformat() if entry.published else None
+        } for entry in db.MirroredOffering.get_package_offerings(package_id) if entry.state == PUBLISHED]
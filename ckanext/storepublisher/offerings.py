@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+__dir__ = os.path.dirname(os.path.abspath(__file__))
+filepath = os.path.join(__dir__, 'assets/logo-ckan.png')
+
+# Image of the offerings published without one
+with open(filepath, 'rb') as f:
+    LOGO_CKAN_B64 = base64.b64encode(f.read())
+
+REQUIRED_FIELDS = ('pkg_id', 'name', 'version')
+
+
+def parse_price(price):
+    '''
+    :returns: The price as a float (0.0 when it is empty)
+    :rtype: float
+
+    :raises ValueError: When the price is not a number
+    '''
+
+    if price is None or price == '':
+        return 0.0
+
+    try:
+        return float(price)
+    except (TypeError, ValueError):
+        raise ValueError('"%s" is not a valid number' % price)
+
+
+def validate_offering(dataset, offering_info, errors):
+    '''
+    Checks that the offering can be created with the given dataset. The price of
+    the offering is converted into float when it is valid.
+
+    :param errors: The errors found so far, indexed by the capitalized name of the
+        field. New errors are added to it
+    :type errors: dict
+
+    :returns: The errors dict
+    :rtype: dict
+    '''
+
+    if 'price' in offering_info:
+        try:
+            offering_info['price'] = parse_price(offering_info['price'])
+        except ValueError as e:
+            log.warn('%r is not a valid price' % offering_info['price'])
+            errors['Price'] = [e.message]
+
+    # Check that all the required fields are provided
+    for field in REQUIRED_FIELDS:
+        if not offering_info.get(field):
+            log.warn('Field %r was not provided' % field)
+            errors[field.capitalize()] = ['This filed is required to publish the offering']
+
+    # Private datasets cannot be offered as open offerings
+    if dataset['private'] is True and offering_info.get('is_open'):
+        log.warn('User tried to create an open offering for a private dataset')
+        errors['Open'] = ['Private Datasets cannot be offered as Open Offerings']
+
+    # Public datasets cannot be offered with price
+    if 'price' in offering_info and dataset['private'] is False and offering_info['price'] != 0.0 and 'Price' not in errors:
+        log.warn('User tried to create a paid offering for a public dataset')
+        errors['Price'] = ['You cannot set a price to a dataset that is public since everyone can access it']
+
+    return errors
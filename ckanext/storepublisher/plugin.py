@@ -18,19 +18,109 @@
 # along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
 
 import ckan.plugins as plugins
-
-from store_connector import StoreConnector
+import actions
+import auth
+import logging
+import os
+import threading
+
+from batch_connector import BatchStoreConnector
+from bulkhead import get_bulkhead
+from cleanup import DeletionCoalescer
+from mirror import OfferingMirror
+from publications import PublicationStore
+from resource_sync import ResourceSynchronizer, SKIP_RESOURCE_SYNC
+from stats import activity
+from store_connector import DEFAULT_STORE, MultiStoreConnector
 from pylons import config
 
+log = logging.getLogger(__name__)
+
 
 class StorePublisher(plugins.SingletonPlugin):
 
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IMiddleware, inherit=True)
     plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.IRoutes, inherit=True)
+    plugins.implements(plugins.ITemplateHelpers)
 
     def __init__(self, name=None):
-        self._store_connector = StoreConnector(config)
+        self._store_connector = MultiStoreConnector(config)
+        self._resource_syncs = [ResourceSynchronizer(connector, config)
+                                for connector in self._store_connector.connectors.values()]
+        self._publication_store = PublicationStore()
+        self._offering_mirror = OfferingMirror(self._store_connector, config)
+        self._warm_up_enabled = False
+        # Process where the connections were opened
+        self._warm_up_pid = None
+        self._warm_up_lock = threading.Lock()
+
+        # Resources of deleted datasets are removed from the Stores in batches
+        batch_connectors = [BatchStoreConnector(config, None if store_name == DEFAULT_STORE else store_name)
+                            for store_name in self._store_connector.connectors]
+        self._deletion_coalescer = DeletionCoalescer(batch_connectors, config)
+
+        # Shown in the dashboard
+        for store_name in self._store_connector.connectors:
+            activity.register_store(store_name)
+        activity.register_gauge('resource_updates', self._get_pending_updates)
+        activity.register_gauge('resource_deletions', lambda: self._deletion_coalescer.pending_deletions)
+        bulkhead = get_bulkhead(config)
+        activity.register_gauge('store_operations', lambda: bulkhead.in_flight)
+        activity.register_gauge('queued_store_operations', lambda: bulkhead.queued)
+
+    def _get_pending_updates(self):
+        return sum(resource_sync.pending_updates for resource_sync in self._resource_syncs)
+
+    ######################################################################
+    ############################## IACTIONS ##############################
+    ######################################################################
+
+    def get_actions(self):
+        return {
+            'dataset_publish': actions.dataset_publish,
+            'dataset_publish_validate': actions.dataset_publish_validate,
+            'dataset_publish_version': actions.dataset_publish_version,
+            'storepublisher_dashboard': actions.storepublisher_dashboard,
+            'storepublisher_dataset_acquired': actions.storepublisher_dataset_acquired,
+            'storepublisher_health': actions.storepublisher_health
+        }
+
+    ######################################################################
+    ########################### AUTH FUNCTIONS ###########################
+    ######################################################################
+
+    def get_auth_functions(self):
+        return {
+            'dataset_publish': auth.dataset_publish,
+            'dataset_publish_validate': auth.dataset_publish_validate,
+            'dataset_publish_version': auth.dataset_publish_version,
+            'storepublisher_dashboard': auth.storepublisher_dashboard,
+            'storepublisher_dataset_acquired': auth.storepublisher_dataset_acquired,
+            'storepublisher_health': auth.storepublisher_health
+        }
+
+    ######################################################################
+    ########################## TEMPLATE HELPERS ##########################
+    ######################################################################
+
+    def get_helpers(self):
+        return {
+            'storepublisher_offerings': self._get_offerings
+        }
+
+    def _get_offerings(self, package_id):
+        # The offerings are synchronized in background with the service account
+        self._offering_mirror.start()
+
+        try:
+            return self._offering_mirror.get(package_id)
+        except Exception as e:
+            log.warn('Offerings of the dataset %s could not be read: %s' % (package_id, e))
+            return []
 
     def update_config(self, config):
         # Add this plugin's templates dir to CKAN's extra_template_paths, so
@@ -40,20 +130,97 @@ class StorePublisher(plugins.SingletonPlugin):
         # Register this plugin's fanstatic directory with CKAN.
         plugins.toolkit.add_resource('fanstatic', 'storepublisher')
 
+        self._warm_up_enabled = config.get('ckan.storepublisher.warm_up', 'false').lower() == 'true'
+
+    def make_middleware(self, app, config):
+        def _app(environ, start_response):
+            self._start_warm_up()
+            return app(environ, start_response)
+
+        return _app
+
+    def _start_warm_up(self):
+        # Connections are opened on the first request of each process, since the
+        # process that loads the application can fork the workers (e.g. uwsgi or
+        # gunicorn --preload) and they cannot share sockets or threads
+        pid = os.getpid()
+        if not self._warm_up_enabled or self._warm_up_pid == pid:
+            return
+
+        with self._warm_up_lock:
+            if self._warm_up_pid == pid:
+                return
+            self._warm_up_pid = pid
+
+        # The connections are opened in background so the request is not delayed
+        warm_up_thread = threading.Thread(target=self._warm_up, name='storepublisher-warm-up')
+        warm_up_thread.daemon = True
+        warm_up_thread.start()
+
+    def _warm_up(self):
+        try:
+            self._store_connector.warm_up()
+        except Exception as e:
+            log.warn('Connections with the Stores could not be opened: %s' % e)
+
     def before_map(self, m):
         # Publish data offering controller
         m.connect('dataset_publish', '/dataset/publish/{id}', action='publish',
                   controller='ckanext.storepublisher.controllers.ui_controller:PublishControllerUI',
                   ckan_icon='shopping-cart')
+
+        # Activity of the Store Publisher (sysadmins only)
+        m.connect('storepublisher_dashboard', '/ckan-admin/storepublisher', action='dashboard',
+                  controller='ckanext.storepublisher.controllers.admin_controller:AdminControllerUI',
+                  ckan_icon='bar-chart')
+
+        # Status of the Stores (for load balancers)
+        m.connect('storepublisher_health', '/storepublisher/health', action='health',
+                  controller='ckanext.storepublisher.controllers.health_controller:HealthController')
         return m
 
     ######################################################################
     ######################### IPACKAGECONTROLLER #########################
     ######################################################################
 
+    def after_update(self, context, pkg_dict):
+
+        if context.get(SKIP_RESOURCE_SYNC):
+            return pkg_dict
+
+        # Only the fields used to build the Store resource are required
+        dataset = {
+            'id': pkg_dict['id'],
+            'title': pkg_dict.get('title') or '',
+            'notes': pkg_dict.get('notes') or ''
+        }
+        for resource_sync in self._resource_syncs:
+            resource_sync.dataset_updated(dataset)
+
+        return pkg_dict
+
     def after_delete(self, context, pkg_dict):
 
-        dataset = plugins.toolkit.get_action('package_show')(context, pkg_dict)
-        self._store_connector.delete_attached_resources(dataset)
+        # Only the id of the dataset is required to find its resources. The id given
+        # can also be the name of the dataset
+        package = context['model'].Package.get(pkg_dict['id'])
+
+        if package is not None:
+            self._deletion_coalescer.dataset_deleted({'id': package.id})
+            self._publication_store.delete(package.id)
+
+        return pkg_dict
+
+    def before_index(self, pkg_dict):
+
+        # Offerings are indexed so datasets can be filtered by their publication status.
+        # vocab_* fields are multivalued strings in the CKAN Solr schema
+        publications = self._publication_store.get(pkg_dict['id'])
+
+        pkg_dict['storepublisher_published'] = 'true' if publications else 'false'
+        pkg_dict['vocab_storepublisher_stores'] = sorted(set(publication['store'] for publication in publications))
+        pkg_dict['vocab_storepublisher_offerings'] = [publication['offering_url'] for publication in publications]
+        pkg_dict['vocab_storepublisher_resources'] = sorted(set(publication['resource_name'] for publication in publications))
+        pkg_dict['vocab_storepublisher_prices'] = [str(publication['price']) for publication in publications]
 
         return pkg_dict
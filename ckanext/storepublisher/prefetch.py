@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class _Lookup(object):
+    '''Looks for a resource in a different thread'''
+
+    def __init__(self, find_resource):
+        self.started = time.time()
+        self.resource = None
+        self.error = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(find_resource,), name='storepublisher-prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, find_resource):
+        try:
+            self.resource = find_resource()
+        except Exception as e:
+            self.error = e
+        finally:
+            self._done.set()
+
+    def wait(self):
+        self._done.wait()
+
+
+class ResourcePrefetcher(object):
+    '''
+    Looks for the Store resources of the datasets in background while the users
+    fill in the publish form, so publications do not have to scan the catalogue
+    of the Store. Lookups are identified by a (store, user, package_id) tuple and
+    their result is kept for ``ckan.storepublisher.prefetch_ttl`` seconds. Each
+    result is used by one publication at most.
+    '''
+
+    def __init__(self, config):
+        self.ttl = float(config.get('ckan.storepublisher.prefetch_ttl', 600))
+
+        self._lock = threading.Lock()
+        self._lookups = {}
+
+    def _purge(self, now):
+        for key, lookup in self._lookups.items():
+            if now - lookup.started >= self.ttl:
+                del self._lookups[key]
+
+    def start(self, key, find_resource):
+        '''
+        Starts looking for a resource unless it is already being looked for.
+
+        :param find_resource: Function that returns the resource (as returned by the
+            Store) or None if it does not exist
+        :type find_resource: callable
+        '''
+
+        if self.ttl <= 0:
+            return
+
+        with self._lock:
+            self._purge(time.time())
+            if key not in self._lookups:
+                self._lookups[key] = _Lookup(find_resource)
+
+    def take(self, key):
+        '''
+        :returns: A (found, resource) tuple. found is False when the resource was not
+            looked for, the lookup failed or its result has expired. If the lookup is
+            still running, it is waited for instead of being started again. resource
+            is None when the dataset has no resource in the Store yet
+        :rtype: tuple
+        '''
+
+        with self._lock:
+            lookup = self._lookups.pop(key, None)
+
+        if lookup is None:
+            return False, None
+
+        lookup.wait()
+
+        if lookup.error is not None:
+            log.info('The prefetched resource of %s cannot be used: %s' % (key, lookup.error))
+            return False, None
+
+        if time.time() - lookup.started >= self.ttl:
+            return False, None
+
+        return True, lookup.resource
+
+    def discard(self, key):
+        with self._lock:
+            self._lookups.pop(key, None)
+
+
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
+
+
+def get_prefetcher(config):
+    '''
+    :returns: The prefetcher shared by all the connectors of this process. It is
+        created the first time it is requested
+    :rtype: ResourcePrefetcher
+    '''
+
+    global _prefetcher
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = ResourcePrefetcher(config)
+
+    return _prefetcher
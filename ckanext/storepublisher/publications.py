@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckan.model as model
+import ckanext.storepublisher.db as db
+import datetime
+
+
+class PublicationStore(object):
+    '''
+    Records the offerings published successfully so CKAN knows which datasets are
+    offered in the Stores without querying them (e.g. to index them).
+    '''
+
+    def add(self, store, package_id, user_name, offering_info, resource_name, offering_url):
+        db.init_db(model)
+        entry = db.Publication.get(store=store, package_id=package_id, offering_name=offering_info['name'],
+                                   offering_version=offering_info['version'])
+
+        if entry is None:
+            entry = db.Publication()
+            entry.store = store
+            entry.package_id = package_id
+            entry.offering_name = offering_info['name']
+            entry.offering_version = offering_info['version']
+            model.Session.add(entry)
+
+        entry.user_name = user_name
+        entry.offering_url = offering_url
+        entry.resource_name = resource_name
+        entry.price = offering_info.get('price', 0.0)
+        entry.published = datetime.datetime.utcnow()
+        model.Session.commit()
+
+    def get_offering_url(self, store, package_id, user_name, offering_info, since):
+        '''
+        :returns: The URL of the given offering if the user published it in the Store
+            after the given date. None otherwise
+        :rtype: string
+        '''
+
+        db.init_db(model)
+        entry = db.Publication.get(store=store, package_id=package_id, offering_name=offering_info['name'],
+                                   offering_version=offering_info['version'])
+
+        if entry is not None and entry.user_name == user_name and entry.published >= since:
+            return entry.offering_url
+
+    def get(self, package_id):
+        '''
+        :returns: The offerings that contain the given dataset, the oldest first
+        :rtype: list
+        '''
+
+        db.init_db(model)
+        return [{
+            'store': entry.store,
+            'offering_name': entry.offering_name,
+            'offering_version': entry.offering_version,
+            'offering_url': entry.offering_url,
+            'resource_name': entry.resource_name,
+            'price': entry.price
+        } for entry in db.Publication.get_package_publications(package_id)]
+
+    def delete(self, package_id):
+        '''
+        Forgets the offerings that contain the given dataset. Changes are committed
+        with the current transaction (e.g. the one that deletes the dataset).
+        '''
+
+        db.init_db(model)
+        for entry in model.Session.query(db.Publication).filter_by(package_id=package_id).all():
+            model.Session.delete(entry)
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckan.model as model
+import ckanext.storepublisher.db as db
+import logging
+import sqlalchemy as sa
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Classes of endpoints whose requests are limited separately
+CATALOGUE = 'catalogue'
+WRITE = 'write'
+ENDPOINTS = (CATALOGUE, WRITE)
+
+# Requests that only read the catalogue of the Store
+CATALOGUE_METHODS = ('get', 'head', 'options')
+
+# Times buckets are taken again when other processes create them at the same time
+DATABASE_ATTEMPTS = 3
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+def get_endpoint(method):
+    '''Returns the class of endpoint of a request sent with the given method'''
+    return CATALOGUE if method.lower() in CATALOGUE_METHODS else WRITE
+
+
+def parse_limit(value):
+    '''
+    Parses limits set as ``<requests>/<seconds>``.
+
+    :returns: The rate (tokens per second) and the capacity of the bucket
+    :rtype: tuple
+    '''
+
+    try:
+        requests, seconds = value.split('/')
+        requests, seconds = float(requests), float(seconds)
+    except ValueError:
+        raise ValueError('Invalid rate limit %r. Expected <requests>/<seconds>' % value)
+
+    if requests <= 0 or seconds <= 0:
+        raise ValueError('Invalid rate limit %r. Values must be positive' % value)
+
+    return requests / seconds, requests
+
+
+def take_tokens(buckets, states, now):
+    '''
+    Refills the given buckets and takes one token from each of them if all of
+    them have one available. Otherwise, no token is taken.
+
+    :param buckets: The key, rate and capacity of each bucket
+    :type buckets: list
+
+    :param states: The tokens and the last update of each bucket by key. It is
+        updated in place
+    :type states: dict
+
+    :returns: The number of seconds to wait until a token is available in all
+        the buckets (0 when the tokens have been taken)
+    :rtype: float
+    '''
+
+    wait = 0.0
+
+    for key, rate, capacity in buckets:
+        tokens, updated = states.get(key, (capacity, now))
+        tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+        states[key] = (tokens, now)
+
+        if tokens < 1:
+            wait = max(wait, (1 - tokens) / rate)
+
+    if wait == 0.0:
+        for key, _, _ in buckets:
+            tokens, updated = states[key]
+            states[key] = (tokens - 1, updated)
+
+    return wait
+
+
+class MemoryBackend(object):
+    '''Keeps the buckets in memory so they are only shared by the threads of a process'''
+
+    _lock = threading.Lock()
+    _states = {}
+
+    def __init__(self, config):
+        pass
+
+    def take(self, buckets):
+        with self._lock:
+            return take_tokens(buckets, self._states, time.time())
+
+
+class DatabaseBackend(object):
+    '''
+    Keeps the buckets in the database so they are shared by all the processes.
+    Buckets are locked while they are updated and changes are committed in their
+    own session, so the transaction of the current request is not affected.
+    '''
+
+    def __init__(self, config):
+        self._session_factory = None
+
+    def _get_session(self):
+        if self._session_factory is None:
+            self._session_factory = sa.orm.sessionmaker(bind=model.meta.engine)
+        return self._session_factory()
+
+    def _take(self, session, buckets):
+        keys = sorted(key for key, _, _ in buckets)
+        query = session.query(db.RateLimitBucket).filter(db.RateLimitBucket.key.in_(keys))
+        entries = dict((entry.key, entry) for entry in query.with_lockmode('update').all())
+        states = dict((key, (entry.tokens, entry.updated)) for key, entry in entries.items())
+
+        wait = take_tokens(buckets, states, time.time())
+
+        for key in keys:
+            if key not in entries:
+                entries[key] = db.RateLimitBucket()
+                entries[key].key = key
+                session.add(entries[key])
+            entries[key].tokens, entries[key].updated = states[key]
+
+        session.commit()
+        return wait
+
+    def take(self, buckets):
+        db.init_db(model)
+
+        for attempt in range(DATABASE_ATTEMPTS):
+            session = self._get_session()
+            try:
+                return self._take(session, buckets)
+            except sa.exc.IntegrityError:
+                # Another process has just created the same bucket
+                session.rollback()
+                if attempt == DATABASE_ATTEMPTS - 1:
+                    raise
+            finally:
+                session.close()
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'database': DatabaseBackend
+}
+
+
+def load_backend(config):
+    '''
+    Creates the backend set in ``ckan.storepublisher.rate_limit.backend``: ``memory``
+    (default), ``database`` or the path of a class (``package.module:Class``) that
+    implements ``take(buckets)``.
+    '''
+
+    name = config.get('ckan.storepublisher.rate_limit.backend', 'memory')
+
+    if name in BACKENDS:
+        backend_class = BACKENDS[name]
+    else:
+        module_name, _, class_name = name.partition(':')
+        module = __import__(module_name, fromlist=[class_name])
+        backend_class = getattr(module, class_name)
+
+    return backend_class(config)
+
+
+class RateLimiter(object):
+    '''
+    Limits the requests sent to a Store with a global token bucket and a token
+    bucket per user for each class of endpoint. Limits are set as
+    ``<requests>/<seconds>`` in ``ckan.storepublisher.rate_limit.<endpoint>.global``
+    and ``ckan.storepublisher.rate_limit.<endpoint>.user``. Requests above the
+    limits wait up to ``ckan.storepublisher.rate_limit.max_wait`` seconds.
+    '''
+
+    def __init__(self, config, scope, backend=None):
+        self.scope = scope
+        self.max_wait = float(config.get('ckan.storepublisher.rate_limit.max_wait', 10))
+        self.limits = {}
+
+        for endpoint in ENDPOINTS:
+            for bucket in ('global', 'user'):
+                value = config.get('ckan.storepublisher.rate_limit.%s.%s' % (endpoint, bucket))
+                if value:
+                    self.limits[(endpoint, bucket)] = parse_limit(value)
+
+        self._backend = backend if backend is not None else (load_backend(config) if self.limits else None)
+
+    def _get_buckets(self, endpoint, user):
+        buckets = []
+
+        for bucket in ('global', 'user'):
+            if (endpoint, bucket) in self.limits:
+                key = ':'.join((self.scope, endpoint, bucket) + ((user or '',) if bucket == 'user' else ()))
+                rate, capacity = self.limits[(endpoint, bucket)]
+                buckets.append((key, rate, capacity))
+
+        return buckets
+
+    def acquire(self, endpoint, user):
+        '''
+        Waits until the given user is allowed to send a request to the given class of
+        endpoint.
+
+        :raises RateLimitExceeded: When the request cannot be sent before the deadline
+        '''
+
+        buckets = self._get_buckets(endpoint, user)
+        if not buckets:
+            return
+
+        deadline = time.time() + self.max_wait
+
+        while True:
+            wait = self._backend.take(buckets)
+
+            if wait == 0.0:
+                return
+            elif time.time() + wait > deadline:
+                log.warn('Rate limit of %s exceeded for %s requests of %s' % (self.scope, endpoint, user))
+                raise RateLimitExceeded('Too many requests are being sent to the Store. Please, try again later')
+
+            time.sleep(wait)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+
+from ckanext.storepublisher.identity import IdentityUnavailable, StoreIdentity
+
+log = logging.getLogger(__name__)
+
+# Fields of the Store resource that are built from the dataset metadata. The name
+# is not included: it identifies the resource in the Store, which cannot rename it
+RESOURCE_FIELDS = ('description', 'link')
+
+# Key of the context of the updates that do not change the Store resources
+SKIP_RESOURCE_SYNC = 'storepublisher_skip_resource_sync'
+
+
+class ResourceSynchronizer(object):
+    '''
+    Keeps the Store resources up to date with the metadata of the datasets they
+    contain. Updates are coalesced per dataset: only the last version of a dataset
+    edited several times within the update window is pushed to the Store. The
+    Store is not contacted when no relevant field has changed.
+    '''
+
+    def __init__(self, store_connector, config):
+        self._store_connector = store_connector
+        self.update_window = float(config.get('ckan.storepublisher.update_window', 5))
+        self.catalogue_ttl = float(config.get('ckan.storepublisher.catalogue_ttl', 300))
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        # Store resources of each user indexed by link: {user: (timestamp, {link: resource})}
+        self._catalogues = {}
+        # Datasets waiting to be pushed to the Store: {(user, dataset_id): (identity, dataset)}
+        self._pending = {}
+
+    @property
+    def pending_updates(self):
+        '''Number of datasets waiting to be pushed to the Store'''
+        with self._lock:
+            return len(self._pending)
+
+    def _get_cached_catalogue(self, user, ttl=None):
+        with self._lock:
+            entry = self._catalogues.get(user)
+
+        if entry is not None and time.time() - entry[0] < (self.catalogue_ttl if ttl is None else ttl):
+            return entry[1]
+        else:
+            return None
+
+    def _get_catalogue(self, connector, ttl=None):
+        user = connector.identity.user
+        catalogue = self._get_cached_catalogue(user, ttl)
+
+        if catalogue is None:
+            with self._refresh_lock:
+                # The catalogue could have been retrieved while waiting for the lock
+                catalogue = self._get_cached_catalogue(user, ttl)
+                if catalogue is None:
+                    resources = connector._get_resources()
+                    catalogue = dict((resource.get('link'), resource) for resource in resources
+                                     if resource.get('state') != 'deleted')
+                    with self._lock:
+                        self._catalogues[user] = (time.time(), catalogue)
+
+        return catalogue
+
+    def get_changes(self, store_resource, dataset):
+        '''
+        Compares the resource stored in the Store with the one that would be built
+        from the dataset.
+
+        :param store_resource: The resource as returned by the Store
+        :type store_resource: dict
+
+        :param dataset: The dataset contained in the resource
+        :type dataset: dict
+
+        :returns: The fields that have changed with their new values
+        :rtype: dict
+        '''
+
+        resource = self._store_connector._get_resource(dataset)
+        changes = {}
+
+        for field in RESOURCE_FIELDS:
+            if store_resource.get(field) != resource[field]:
+                changes[field] = resource[field]
+
+        return changes
+
+    def dataset_updated(self, dataset, identity=None):
+        '''
+        Method to be called every time a dataset is updated. If the Store resource
+        that contains the dataset may be outdated, the update is scheduled.
+
+        :param dataset: The updated dataset. It must contain, at least, its id,
+            title and notes
+        :type dataset: dict
+
+        :param identity: The user that updated the dataset. By default, the user of
+            the current request. The update is skipped when there is no request
+        :type identity: StoreIdentity
+        '''
+
+        try:
+            identity = identity or StoreIdentity.from_request()
+        except IdentityUnavailable as e:
+            log.warn('Dataset %s is not synchronized with the Stores: %s' % (dataset['id'], e))
+            return
+
+        user = identity.user
+        key = (user, dataset['id'])
+        catalogue = self._get_cached_catalogue(user)
+
+        # When the catalogue is not cached or the dataset is not found in it (it may
+        # have been published since), the check is delayed until the update is flushed
+        store_resource = catalogue.get(self._store_connector._get_dataset_url(dataset)) if catalogue is not None else None
+        if store_resource is not None and not self.get_changes(store_resource, dataset):
+            # Nothing relevant has changed
+            with self._lock:
+                self._pending.pop(key, None)
+            return
+
+        with self._lock:
+            scheduled = key in self._pending
+            self._pending[key] = (identity, dataset)
+
+        # Subsequent updates only replace the pending version of the dataset
+        if not scheduled:
+            timer = threading.Timer(self.update_window, self._flush, args=(key,))
+            timer.daemon = True
+            timer.start()
+
+    def _flush(self, key):
+        with self._lock:
+            identity, dataset = self._pending.pop(key, (None, None))
+
+        if dataset is None:
+            return
+
+        # The resource is updated on behalf of the user that updated the dataset
+        connector = self._store_connector.with_identity(identity)
+        dataset_url = connector._get_dataset_url(dataset)
+
+        try:
+            catalogue = self._get_catalogue(connector)
+            store_resource = catalogue.get(dataset_url)
+            if store_resource is None:
+                # Catalogues retrieved before the update was scheduled do not include
+                # the resources published since, so the catalogue is retrieved again
+                catalogue = self._get_catalogue(connector, self.update_window)
+                store_resource = catalogue.get(dataset_url)
+            if store_resource is None:
+                log.debug('Dataset %s is not offered in the Store' % dataset['id'])
+                return
+
+            changes = self.get_changes(store_resource, dataset)
+            if changes:
+                connector.update_resource(store_resource, changes)
+                with self._lock:
+                    store_resource.update(changes)
+                    if store_resource.get('link') != dataset_url:
+                        catalogue.pop(dataset_url, None)
+                        catalogue[store_resource['link']] = store_resource
+                log.info('Resource %s updated with fields %s' % (store_resource['name'], ', '.join(changes)))
+        except Exception as e:
+            log.warn('The resource of the dataset %s could not be updated: %s' % (dataset['id'], e))
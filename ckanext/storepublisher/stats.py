@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import re
+import threading
+import time
+
+from collections import deque, OrderedDict
+
+# Number of publications and deletions shown in the dashboard
+MAX_OPERATIONS = 50
+
+PUBLISH = 'publish'
+DELETE = 'delete'
+
+# Paths of the Store API are grouped by endpoint: /api/offering/offerings/{owner}/{name}/{version}/tag
+ENDPOINT_RE = re.compile(r'^/api/offering/(resources|offerings)(/[^/]+/[^/]+/[^/]+)?(/[a-z_]+)?/?$')
+
+
+def get_endpoint(method, path):
+    '''Returns the name of the Store endpoint a request was sent to'''
+
+    path = path.split('?')[0]
+    match = ENDPOINT_RE.match(path)
+    if match:
+        kind, entity, action = match.groups()
+        path = '/api/offering/%s%s%s' % (kind, '/{owner}/{name}/{version}' if entity else '', action or '')
+
+    return '%s %s' % (method.upper(), path)
+
+
+def _format_time(timestamp):
+    return None if timestamp is None else datetime.datetime.utcfromtimestamp(timestamp).isoformat()
+
+
+def _to_ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+class ActivityStats(object):
+    '''
+    Aggregates the activity of this process: the last publications and deletions,
+    the requests sent to each endpoint of the Stores and whether the Stores could
+    be reached the last time they were contacted. The Stores are never queried to
+    build these statistics.
+    '''
+
+    def __init__(self, max_operations=MAX_OPERATIONS):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self._operations = deque(maxlen=max_operations)
+        self._endpoints = OrderedDict()
+        self._stores = OrderedDict()
+        self._gauges = OrderedDict()
+
+    def _get_store(self, store):
+        return self._stores.setdefault(store, {'reachable': None, 'last_success': None,
+                                               'last_error': None, 'error': None})
+
+    def register_store(self, store):
+        with self._lock:
+            self._get_store(store)
+
+    def register_gauge(self, name, function):
+        '''
+        Registers a function that returns the amount of pending work of the given kind
+        (e.g. updates waiting to be pushed to the Store). It is called when the
+        statistics are requested.
+        '''
+
+        with self._lock:
+            self._gauges[name] = function
+
+    def record_request(self, store, method, path, elapsed, status_code=None, error=None):
+        '''
+        Records a request sent to a Store. Requests that could not be sent (error) mark
+        the Store as unreachable. Responses with 4xx/5xx status codes are counted as
+        errors of the endpoint.
+        '''
+
+        now = time.time()
+
+        with self._lock:
+            endpoint = self._endpoints.setdefault((store, get_endpoint(method, path)),
+                                                  {'requests': 0, 'errors': 0, 'total_time': 0.0})
+            endpoint['requests'] += 1
+            endpoint['total_time'] += elapsed
+            if error is not None or status_code >= 400:
+                endpoint['errors'] += 1
+
+            store_status = self._get_store(store)
+            if error is None:
+                store_status.update({'reachable': True, 'last_success': now})
+            else:
+                store_status.update({'reachable': False, 'last_error': now, 'error': str(error)})
+
+    def record_operation(self, operation, store, package_id, phases, error=None):
+        '''
+        Records a publication or a deletion and the time spent in each of its phases.
+
+        :param phases: The seconds spent in each phase by name
+        :type phases: OrderedDict
+        '''
+
+        with self._lock:
+            self._operations.appendleft({
+                'operation': operation,
+                'store': store,
+                'package_id': package_id,
+                'finished': _format_time(time.time()),
+                'outcome': 'success' if error is None else 'error',
+                'error': error,
+                'phases': OrderedDict((phase, _to_ms(elapsed)) for phase, elapsed in phases.items()),
+                'total': _to_ms(sum(phases.values()))
+            })
+
+    def get_summary(self):
+        '''
+        :returns: The statistics of this process. Latencies are given in milliseconds
+        :rtype: dict
+        '''
+
+        with self._lock:
+            operations = list(self._operations)
+            endpoints = [{
+                'store': store,
+                'endpoint': endpoint,
+                'requests': counters['requests'],
+                'errors': counters['errors'],
+                'error_rate': float(counters['errors']) / counters['requests'],
+                'avg_latency': _to_ms(counters['total_time'] / counters['requests'])
+            } for (store, endpoint), counters in self._endpoints.items()]
+            stores = [{
+                'name': store,
+                'reachable': status['reachable'],
+                'last_success': _format_time(status['last_success']),
+                'last_error': _format_time(status['last_error']),
+                'error': status['error']
+            } for store, status in self._stores.items()]
+            gauges = self._gauges.items()
+
+        return {
+            'since': _format_time(self.started),
+            'operations': operations,
+            'endpoints': endpoints,
+            'stores': stores,
+            'pending': OrderedDict((name, function()) for name, function in gauges)
+        }
+
+
+# Statistics of this process
+activity = ActivityStats()
@@ -17,15 +17,34 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
+import ckan.lib.search as search
 import ckan.model as model
 import ckan.plugins as plugins
+import copy
+import datetime
+import functools
 import json
 import logging
 import re
 import requests
-
+import time
+
+from collections import OrderedDict
+from ckanext.storepublisher.bulkhead import get_bulkhead
+from ckanext.storepublisher.catalogue import PagedListing
+from ckanext.storepublisher.journal import (JournalStore, SagaJournal, OFFERING_STEP, PUBLISH_STEP,
+                                            RESOURCE_STEP, STEPS, TAG_STEP)
+from ckanext.storepublisher.identity import StoreIdentity
+from ckanext.storepublisher.locks import DatasetLock, LockTimeout
+from ckanext.storepublisher.prefetch import get_prefetcher
+from ckanext.storepublisher.publications import PublicationStore
+from ckanext.storepublisher.rate_limit import RateLimiter, get_endpoint
+from ckanext.storepublisher.stats import activity, DELETE, PUBLISH
+from ckanext.storepublisher.streaming import Base64Stream, GzipBody, JSONStreamBody
+from ckanext.storepublisher.transport import load_transport
+from ckanext.storepublisher.workers import run_concurrently
 from unicodedata import normalize
-from requests_oauthlib import OAuth2Session
 
 log = logging.getLogger(__name__)
 
@@ -43,16 +62,108 @@ def slugify(text, delim=' '):
     return delim.join(result)
 
 
+def bound(method):
+    '''
+    Runs the decorated method in a copy of the connector bound to the identity of
+    the current request when the connector is not bound to any identity. Methods
+    that send requests from other threads must be decorated.
+    '''
+
+    @functools.wraps(method)
+    def _wrapper(self, *args, **kwargs):
+        if self.identity is None:
+            self = self.with_identity(StoreIdentity.from_request())
+        return method(self, *args, **kwargs)
+
+    return _wrapper
+
+
+def limited(method):
+    '''
+    Runs the decorated method in one of the slots of the bulkhead of the process.
+    Methods called while serving requests that wait for the Stores must be
+    decorated. BulkheadFull is raised when there are no free slots.
+    '''
+
+    @functools.wraps(method)
+    def _wrapper(self, *args, **kwargs):
+        with self._bulkhead.enter():
+            return method(self, *args, **kwargs)
+
+    return _wrapper
+
+
 class StoreException(Exception):
     pass
 
 
+DEFAULT_STORE = 'default'
+
+
 class StoreConnector(object):
 
-    def __init__(self, config):
+    def __init__(self, config, store_name=None):
+        # Stores can be configured individually: ckan.storepublisher.<store_name>.<setting>
+        prefix = 'ckan.storepublisher.' if store_name is None else 'ckan.storepublisher.%s.' % store_name
+        timeout = config.get(prefix + 'timeout', config.get('ckan.storepublisher.timeout'))
+
+        self.name = store_name or DEFAULT_STORE
         self.site_url = self._get_url(config, 'ckan.site_url')
-        self.store_url = self._get_url(config, 'ckan.storepublisher.store_url')
-        self.repository = config.get('ckan.storepublisher.repository')
+        self.store_url = self._get_url(config, prefix + 'store_url')
+        self.repository = config.get(prefix + 'repository')
+        self.timeout = float(timeout) if timeout else None
+        # auto: offerings are compressed only if the Store announces that it accepts gzip bodies
+        self.compress_requests = config.get(prefix + 'compress_requests',
+                                            config.get('ckan.storepublisher.compress_requests', 'auto')).lower()
+        # State shared with the copies of the connector bound to identities
+        self._state = {'compressed_requests': {'true': True, 'false': False}.get(self.compress_requests)}
+        # Requests are sent on behalf of the user of the current request unless the
+        # connector is bound to an identity
+        self.identity = None
+        # Only one Store can be set as the place where private datasets are acquired
+        self.manage_acquire_url = True
+        # The acquire URL is saved by the caller when the connector is run in threads
+        # that cannot use the actions of CKAN (see MultiStoreConnector)
+        self.defer_acquire_url = False
+        self._journal_store = JournalStore()
+        self._publication_store = PublicationStore()
+        self._dataset_lock = DatasetLock(config)
+        self._rate_limiter = RateLimiter(config, self.name)
+        self._prefetcher = get_prefetcher(config)
+        # Connections are kept open and reused by all the requests sent to the Store
+        self.pool_size = int(config.get('ckan.storepublisher.pool_size', 10))
+        self.warm_up_connections = min(self.pool_size, int(config.get('ckan.storepublisher.warm_up_connections', 2)))
+        # Requests are sent through HTTP unless another transport is set (e.g. memory)
+        transport = config.get(prefix + 'transport', config.get('ckan.storepublisher.transport', 'http'))
+        self._transport = load_transport(transport, config, self.store_url)
+        # Listings of the Store are retrieved page by page (0: all at once)
+        self.page_size = int(config.get('ckan.storepublisher.page_size', 100))
+        self.prefetch_pages = config.get('ckan.storepublisher.prefetch_pages', 'true').lower() == 'true'
+
+    @property
+    def _compressed_requests(self):
+        return self._state['compressed_requests']
+
+    @_compressed_requests.setter
+    def _compressed_requests(self, value):
+        self._state['compressed_requests'] = value
+
+    def with_identity(self, identity):
+        '''
+        :param identity: The identity on behalf of whom the requests will be sent
+        :type identity: StoreIdentity
+
+        :returns: A copy of the connector bound to the given identity. It shares the
+            connections and the rest of the state of this connector
+        :rtype: StoreConnector
+        '''
+
+        connector = copy.copy(self)
+        connector.identity = identity
+        return connector
+
+    def _get_identity(self):
+        return self.identity if self.identity is not None else StoreIdentity.from_request()
 
     def _get_url(self, config, config_property):
         url = config.get(config_property, '')
@@ -62,6 +173,10 @@ class StoreConnector(object):
     def _get_dataset_url(self, dataset):
         return '%s/dataset/%s' % (self.site_url, dataset['id'])
 
+    def _get_journal_key(self, dataset, offering_info):
+        return (self.name, self._get_identity().user, dataset['id'],
+                offering_info['name'], offering_info['version'])
+
     def _get_resource(self, dataset):
         resource = {}
         resource['name'] = slugify('Dataset %s - ID %s' % (dataset['title'], dataset['id']))
@@ -79,10 +194,17 @@ class StoreConnector(object):
         offering = {}
         offering['name'] = offering_info['name']
         offering['version'] = offering_info['version']
-        offering['notification_url'] = '%s/api/action/dataset_acquired' % self.site_url
+        # Acquisitions are applied in batches (see AcquisitionQueue)
+        offering['notification_url'] = '%s/api/action/storepublisher_dataset_acquired' % self.site_url
+        # Uploaded images are encoded while the offering is being sent
+        if offering_info.get('image_file') is not None:
+            image_data = Base64Stream(offering_info['image_file'])
+        else:
+            image_data = offering_info['image_base64']
+
         offering['image'] = {
             'name': 'ckan.png',
-            'data': offering_info['image_base64']
+            'data': image_data
         }
         offering['related_images'] = []
         offering['resources'] = []
@@ -118,30 +240,129 @@ class StoreConnector(object):
 
         return {'tags': list(new_tags)}
 
-    def _make_request(self, method, url, headers={}, data=None):
+    def _accepts_compressed_requests(self):
+        if self._compressed_requests is None:
+            # Servers can list the encodings accepted for request bodies in the
+            # Accept-Encoding header of their responses (RFC 7694). _make_request
+            # records it, so the capability is only probed once per Store. The probe
+            # is sent through the transport since this runs inside _make_request,
+            # whose subclasses may hold resources (e.g. batch slots) while it runs
+            try:
+                self._update_compression_support(self._send_probe())
+            except Exception as e:
+                log.info('Store %s could not be probed for compression support: %s' % (self.name, e))
+
+            if self._compressed_requests is None:
+                self._compressed_requests = False
+
+        return self._compressed_requests
+
+    def _update_compression_support(self, req):
+        accept_encoding = req.headers.get('Accept-Encoding')
+        if self.compress_requests == 'auto' and accept_encoding:
+            self._compressed_requests = 'gzip' in accept_encoding.lower()
+
+    def _send_probe(self):
+        # Probes are not authenticated: they are only used to check the connection
+        response = self._transport.send('options', '%s/api/offering/offerings' % self.store_url,
+                                        {'Accept-Encoding': 'gzip, deflate'}, timeout=self.timeout)
+        # The connection only returns to the pool when the response has been read
+        response.content
+        return response
+
+    def warm_up(self):
+        '''
+        Opens connections with the Store and keeps them in the pool, so the first
+        requests do not have to wait for the DNS resolution and the TLS handshake.
+        Compression support is also checked. The catalogue is not fetched since the
+        Store only returns it to the user that owns it.
+
+        :returns: The number of connections opened
+        :rtype: int
+        '''
+
+        # Requests are sent at the same time so each one uses its own connection
+        opened = 0
+        tasks = [self._send_probe] * self.warm_up_connections
+        for response, error in run_concurrently(tasks):
+            if error is not None:
+                log.warn('Connection with the Store %s could not be opened: %s' % (self.name, error))
+            else:
+                self._update_compression_support(response)
+                opened += 1
+
+        log.info('%d connections opened with the Store %s' % (opened, self.name))
+        return opened
+
+    def probe(self):
+        '''
+        Checks whether the Store can be reached.
+
+        :returns: The number of seconds the Store took to answer
+        :rtype: float
+
+        :raises StoreException: When the Store returns a server error. Connection
+            errors are raised as they are
+        '''
+
+        started = time.time()
+        response = self._send_probe()
+        elapsed = time.time() - started
+
+        if response.status_code >= 500:
+            raise StoreException('The Store returned the status code %d' % response.status_code)
+
+        return elapsed
+
+    def _make_request(self, method, url, headers={}, data=None, compress=False):
+
+        identity = self._get_identity()
 
         def _get_headers_and_make_request(method, url, headers, data):
-            # Include access token in the request
-            usertoken = plugins.toolkit.c.usertoken
             final_headers = headers.copy()
             # Receive the content in JSON to parse the errors easily
             final_headers['Accept'] = 'application/json'
-            # OAuth2Session
-            oauth_request = OAuth2Session(token=usertoken)
-
-            req_method = getattr(oauth_request, method)
-            req = req_method(url, headers=final_headers, data=data)
+            # Ask for compressed responses (requests decompresses them transparently)
+            final_headers['Accept-Encoding'] = 'gzip, deflate'
+            # Streamed bodies must be sent from the beginning when the request is retried
+            if hasattr(data, 'seek'):
+                data.seek(0)
+            # Wait until the Store can be contacted without exceeding the rate limits
+            self._rate_limiter.acquire(get_endpoint(method), identity.user)
+
+            path = url[len(self.store_url):] if url.startswith(self.store_url) else url
+            started = time.time()
+            try:
+                req = self._transport.send(method, url, final_headers, data, identity, self.timeout)
+            except Exception as e:
+                activity.record_request(self.name, method, path, time.time() - started, error=e)
+                raise
+            activity.record_request(self.name, method, path, time.time() - started, req.status_code)
+            self._update_compression_support(req)
 
             return req
 
-        req = _get_headers_and_make_request(method, url, headers, data)
+        # Bodies are only compressed when the Store accepts compressed requests
+        request_headers, request_data = headers, data
+        if compress and data is not None and self._accepts_compressed_requests():
+            request_headers = dict(headers, **{'Content-Encoding': 'gzip'})
+            request_data = GzipBody(data)
+
+        req = _get_headers_and_make_request(method, url, request_headers, request_data)
+
+        # The Store can reject compressed bodies even if it seemed to accept them
+        if req.status_code == 415 and request_data is not data:
+            log.info('%s(%s): returned 415. Request will be retried without compression' % (method, url))
+            self._compressed_requests = False
+            request_headers, request_data = headers, data
+            req = _get_headers_and_make_request(method, url, request_headers, request_data)
 
         # When a 401 status code is got, we should refresh the token and retry the request.
         if req.status_code == 401:
             log.info('%s(%s): returned 401. Token expired? Request will be retried with a refresehd token' % (method, url))
-            plugins.toolkit.c.usertoken_refresh()
+            identity.refresh()
             # Update the header 'Authorization'
-            req = _get_headers_and_make_request(method, url, headers, data)
+            req = _get_headers_and_make_request(method, url, request_headers, request_data)
 
         log.info('%s(%s): %s %s' % (method, url, req.status_code, req.text))
 
@@ -157,51 +378,118 @@ class StoreConnector(object):
 
     def _update_acquire_url(self, dataset, resource):
         # Set needed variables
-        c = plugins.toolkit.c
-        tk = plugins.toolkit
-        context = {'model': model, 'session': model.Session,
-                   'user': c.user or c.author, 'auth_user_obj': c.userobj,
-                   }
-
-        if dataset['private']:
-            user_nickname = c.user
+        user_nickname = self._get_identity().user
+
+        if dataset['private'] and self.manage_acquire_url:
             name = resource['name'].replace(' ', '%20')
             resource_url = '%s/search/resource/%s/%s/%s' % (self.store_url, user_nickname,
                                                             name, resource['version'])
 
             if dataset.get('acquire_url', '') != resource_url:
                 dataset['acquire_url'] = resource_url
-                tk.get_action('package_update')(context, dataset)
-                log.info('Acquire URL updated correctly to %s' % resource_url)
+                if not self.defer_acquire_url:
+                    self._save_acquire_url(dataset)
+
+    def _save_acquire_url(self, dataset):
+        context = {'model': model, 'session': model.Session, 'user': self._get_identity().user}
+        plugins.toolkit.get_action('package_update')(context, dataset)
+        log.info('Acquire URL updated correctly to %s' % dataset['acquire_url'])
 
     def _generate_resource_info(self, resource):
         return {
-            'provider': plugins.toolkit.c.user,
+            'provider': self._get_identity().user,
             'name': resource.get('name'),
             'version': resource.get('version')
         }
 
+    @bound
+    def _get_listing(self, path, params=None):
+        def _fetch_page(start, limit):
+            page_params = dict(params or {})
+            if start is not None:
+                page_params.update({'start': start, 'limit': limit})
+            query = '&'.join('%s=%s' % (key, value) for key, value in sorted(page_params.items()))
+            url = '%s%s%s' % (self.store_url, path, '?' + query if query else '')
+            return self._make_request('get', url).json()
+
+        return PagedListing(_fetch_page, self.page_size, self.prefetch_pages)
+
+    def _get_resources(self):
+        '''
+        :returns: The resources of the current user. They are retrieved lazily, page by
+            page, while iterating over them
+        :rtype: PagedListing
+        '''
+
+        return self._get_listing('/api/offering/resources')
+
+    def _get_offerings(self, offerings_filter='provided', sort=None):
+        '''
+        :param offerings_filter: The offerings to be retrieved: provided, published or
+            purchased
+        :type offerings_filter: string
+
+        :param sort: The order of the offerings (e.g. date: the last published first).
+            The order of the Store is used when it is not given
+        :type sort: string
+
+        :returns: The offerings of the current user. They are retrieved lazily, page by
+            page, while iterating over them
+        :rtype: PagedListing
+        '''
+
+        params = {'filter': offerings_filter}
+        if sort is not None:
+            params['sort'] = sort
+
+        return self._get_listing('/api/offering/offerings', params)
+
+    def _is_dataset_resource(self, resource, dataset_url):
+        return resource.get('state') != 'deleted' and resource.get('link', '') == dataset_url
+
     def _get_existing_resources(self, dataset):
         dataset_url = self._get_dataset_url(dataset)
-        req = self._make_request('get', '%s/api/offering/resources' % self.store_url)
-        resources = req.json()
+        return [resource for resource in self._get_resources() if self._is_dataset_resource(resource, dataset_url)]
 
-        def _valid_resources_filter(resource):
-            return resource.get('state') != 'deleted' and resource.get('link', '') == dataset_url
+    def _find_resource(self, dataset):
+        dataset_url = self._get_dataset_url(dataset)
 
-        return filter(_valid_resources_filter, resources)
+        # The rest of the catalogue is not retrieved once the resource is found
+        for resource in self._get_resources():
+            if self._is_dataset_resource(resource, dataset_url):
+                return resource
 
-    def _get_existing_resource(self, dataset):
+        return None
 
-        valid_resources = self._get_existing_resources(dataset)
+    def _get_existing_resource(self, dataset):
+        # The resource looked for when the publish form was opened is used if possible
+        found, resource = self._prefetcher.take(self._get_prefetch_key(dataset))
+        if not found:
+            resource = self._find_resource(dataset)
 
-        if len(valid_resources) > 0:
-            resource = valid_resources.pop(0)
-            self._update_acquire_url(dataset, resource)
-            return self._generate_resource_info(resource)
-        else:
+        if resource is None:
             return None
 
+        self._update_acquire_url(dataset, resource)
+        return self._generate_resource_info(resource)
+
+    def _get_prefetch_key(self, dataset):
+        return (self.name, self._get_identity().user, dataset['id'])
+
+    @bound
+    def prefetch_resource(self, dataset):
+        '''
+        Starts looking for the resource that contains the given dataset in
+        background, so it is already known when the offering is published. The
+        result is only used by the next publication of the dataset by the same
+        user (see create_offering).
+
+        :param dataset: The dataset whose resource is looked for
+        :type dataset: dict
+        '''
+
+        self._prefetcher.start(self._get_prefetch_key(dataset), lambda: self._find_resource(dataset))
+
     def _create_resource(self, dataset):
         # Create the resource
         resource = self._get_resource(dataset)
@@ -216,7 +504,7 @@ class StoreConnector(object):
 
     def _rollback(self, offering_info, offering_created):
 
-        user_nickname = plugins.toolkit.c.user
+        user_nickname = self._get_identity().user
 
         try:
             # Delete the offering only if it was created
@@ -226,6 +514,31 @@ class StoreConnector(object):
         except Exception as e:
             log.warn('Rollback failed %s' % e)
 
+    def update_resource(self, resource, changes):
+        '''
+        Method to update some fields of a resource that already exists in the Store.
+
+        :param resource: The resource (as returned by the Store) to be updated
+        :type resource: dict
+
+        :param changes: The fields of the resource that have changed and their new
+            values
+        :type changes: dict
+        '''
+
+        user_nickname = self._get_identity().user
+        name = resource['name'].replace(' ', '%20')
+        headers = {'Content-Type': 'application/json'}
+        self._make_request('put', '%s/api/offering/resources/%s/%s/%s' %
+                                  (self.store_url, user_nickname, name, resource['version']),
+                           headers, json.dumps(changes))
+
+    def _delete_resource(self, resource):
+        user_nickname = self._get_identity().user
+        name = resource['name'].replace(' ', '%20')
+        self._make_request('delete', '%s/api/offering/resources/%s/%s/%s' %
+                                     (self.store_url, user_nickname, name, resource['version']))
+
     def delete_attached_resources(self, dataset):
         '''
         Method to delete all the resources (and offerings) that containts the given
@@ -236,21 +549,36 @@ class StoreConnector(object):
         :type dataset: dict
         '''
 
-        resources = self._get_existing_resources(dataset)
-        user_nickname = plugins.toolkit.c.user
+        phases = OrderedDict()
+        error = None
+        started = time.time()
 
-        for resource in resources:
-            try:
-                name = resource['name'].replace(' ', '%20')
-                version = resource['version']
-                self._make_request('delete', '%s/api/offering/resources/%s/%s/%s' %
-                                             (self.store_url, user_nickname, name, version))
-            except requests.ConnectionError as e:
-                log.warn(e)
-            except Exception as e:
-                log.warn(e)
+        # The resource looked for in advance is about to be deleted
+        self._prefetcher.discard(self._get_prefetch_key(dataset))
 
-    def create_offering(self, dataset, offering_info):
+        try:
+            resources = self._get_existing_resources(dataset)
+            phases['lookup'] = time.time() - started
+
+            started = time.time()
+            for resource in resources:
+                try:
+                    self._delete_resource(resource)
+                except requests.ConnectionError as e:
+                    log.warn(e)
+                    error = str(e)
+                except Exception as e:
+                    log.warn(e)
+                    error = str(e)
+            phases['delete'] = time.time() - started
+        except Exception as e:
+            phases.setdefault('lookup', time.time() - started)
+            error = str(e)
+            raise
+        finally:
+            activity.record_operation(DELETE, self.name, dataset['id'], phases, error)
+
+    def create_offering(self, dataset, offering_info, resource=None):
         '''
         Method to create an offering in the store that will contain the given dataset.
         The method will check if there is a resource in the Store that contains the
@@ -263,61 +591,458 @@ class StoreConnector(object):
         :type dataset: dict
 
         :param offering_info: A dict that contains additional info for the offering: name,
-            description, license, offering version, price, image
+            description, license, offering version, price and image. The image can be
+            given encoded in base64 (image_base64) or as a file object (image_file)
         :type offering_info: dict
 
+        :param resource: The resource that contains the dataset when it is already known
+            (provider, name and version). In this case, the Store is not queried to look
+            for it
+        :type resource: dict
+
         :returns: The URL of the offering that contains the dataset
         :rtype: string
 
         :raises StoreException: When the store cannot be connected or when the Store
-            returns some errors
+            returns some errors. The steps completed so far are recorded, so calling
+            this method again resumes the publication from the failed step. Call
+            abort_offering to discard it. Identical publications requested at the same
+            time are run only once: the rest wait and get the same offering URL
         '''
 
-        user_nickname = plugins.toolkit.c.user
+        return self._publish_once(dataset, offering_info, resource)
+
+    def _publish_once(self, dataset, offering_info, resource, last_step=PUBLISH_STEP):
+        requested = datetime.datetime.utcnow()
+
+        try:
+            # Only one publication of the dataset is run at a time in each Store
+            with self._dataset_lock.hold(self.name, dataset['id']):
+                # The same offering may have been published while this request was waiting
+                offering_url = self._publication_store.get_offering_url(self.name, dataset['id'],
+                                                                        self._get_identity().user,
+                                                                        offering_info, requested)
+                if offering_url is not None:
+                    log.info('Offering %s was published by a concurrent request' % offering_info['name'])
+                    return offering_url
+
+                return self._publish(dataset, offering_info, resource, last_step)
+        except LockTimeout as e:
+            log.warn(e)
+            raise StoreException(e.message)
+
+    def _tag_offering(self, offering_info):
+        # Attach tags to the offerings
+        tags = self._get_tags(offering_info)
+        self._make_request('put', '%s/api/offering/offerings/%s/%s/%s/tag' %
+                                  (self.store_url, self._get_identity().user, offering_info['name'],
+                                   offering_info['version']),
+                           {'Content-Type': 'application/json'}, json.dumps(tags))
+
+    def _publish_offering(self, offering_info):
+        self._make_request('post', '%s/api/offering/offerings/%s/%s/%s/publish' %
+                                   (self.store_url, self._get_identity().user, offering_info['name'],
+                                    offering_info['version']),
+                           {'Content-Type': 'application/json'}, json.dumps({'marketplaces': []}))
+
+    def _complete_publication(self, dataset, offering_info, journal):
+        user_nickname = self._get_identity().user
+        self._journal_store.delete(journal.key)
+
+        # Return offering URL
+        name = offering_info['name'].replace(' ', '%20')
+        offering_url = '%s/offering/%s/%s/%s' % (self.store_url, user_nickname, name,
+                                                 offering_info['version'])
+
+        # Published offerings are recorded so they can be indexed with the dataset
+        try:
+            self._publication_store.add(self.name, dataset['id'], user_nickname, offering_info,
+                                        journal.get_result(RESOURCE_STEP)['name'], offering_url)
+        except Exception as e:
+            log.warn('Offering %s could not be recorded: %s' % (offering_url, e))
 
-        log.info('Creating Offering %s' % offering_info['name'])
-        offering_created = False
+        return offering_url
+
+    def _publish(self, dataset, offering_info, resource, last_step=PUBLISH_STEP):
+        offering_name = offering_info['name']
+
+        # Resume the publication if a previous attempt failed
+        journal = self._journal_store.load(self._get_journal_key(dataset, offering_info))
+        if journal is None or journal.completed:
+            journal = SagaJournal(self._get_journal_key(dataset, offering_info))
+        else:
+            log.info('Resuming the publication of the offering %s from the step %s' % (offering_name, journal.next_step))
+
+        log.info('Creating Offering %s' % offering_name)
 
         # Make the request to the server
         headers = {'Content-Type': 'application/json'}
 
-        try:
+        def _get_resource():
             # Get the resource. If it does not exist, it will be created
-            resource = self._get_existing_resource(dataset)
-            if resource is None:
-                resource = self._create_resource(dataset)
+            existing_resource = resource or self._get_existing_resource(dataset)
+            return existing_resource or self._create_resource(dataset)
 
-            offering = self._get_offering(offering_info, resource)
-            tags = self._get_tags(offering_info)
-            offering_name = offering_info['name']
-            offering_version = offering_info['version']
-
-            # Create the offering
+        def _create_offering():
+            offering = self._get_offering(offering_info, journal.get_result(RESOURCE_STEP))
             self._make_request('post', '%s/api/offering/offerings' % self.store_url,
-                               headers, json.dumps(offering))
-            offering_created = True
-
-            # Attach tags to the offerings
-            self._make_request('put', '%s/api/offering/offerings/%s/%s/%s/tag' %
-                                      (self.store_url, user_nickname, offering_name,
-                                       offering_version),
-                               headers, json.dumps(tags))
-
-            # Publish offering
-            self._make_request('post', '%s/api/offering/offerings/%s/%s/%s/publish' %
-                                       (self.store_url, user_nickname, offering_name,
-                                        offering_version),
-                               headers, json.dumps({'marketplaces': []}))
-
-            # Return offering URL
-            name = offering_info['name'].replace(' ', '%20')
-            return '%s/offering/%s/%s/%s' % (self.store_url, user_nickname, name,
-                                             offering_info['version'])
+                               headers, JSONStreamBody(offering), compress=True)
+
+        steps = [(RESOURCE_STEP, _get_resource), (OFFERING_STEP, _create_offering),
+                 (TAG_STEP, lambda: self._tag_offering(offering_info)),
+                 (PUBLISH_STEP, lambda: self._publish_offering(offering_info))]
+        # The remaining steps can be completed later (e.g. by a batch)
+        steps = steps[:STEPS.index(last_step) + 1]
+
+        # Time spent in each step, shown in the dashboard
+        phases = OrderedDict()
+        error = None
+
+        try:
+            for step, run_step in steps:
+                if not journal.is_completed(step):
+                    started = time.time()
+                    try:
+                        journal.complete(step, run_step())
+                    except Exception as e:
+                        # Completed steps are kept so the publication can be resumed
+                        journal.fail(step, str(e))
+                        self._journal_store.save(journal)
+                        raise
+                    finally:
+                        phases[step] = time.time() - started
+                    # The result of the last step is not needed to resume the publication
+                    if step != PUBLISH_STEP:
+                        self._journal_store.save(journal)
+
+            if not journal.completed:
+                return None
+
+            return self._complete_publication(dataset, offering_info, journal)
+        except requests.ConnectionError as e:
+            log.warn(e)
+            error = 'It was impossible to connect with the Store'
+            raise StoreException(error)
+        except Exception as e:
+            log.warn(e)
+            error = e.message
+            raise StoreException(error)
+        finally:
+            # Partial publications are recorded once they are completed
+            if error is not None or journal.completed:
+                activity.record_operation(PUBLISH, self.name, dataset['id'], phases, error)
+
+    def abort_offering(self, dataset, offering_info):
+        '''
+        Method to discard a publication that could not be completed. The offering is
+        deleted from the Store if it was already created.
+
+        :param dataset: The dataset included in the offering
+        :type dataset: dict
+
+        :param offering_info: The offering info used to publish the offering (only
+            its name and its version are required)
+        :type offering_info: dict
+
+        :returns: True if there was a pending publication. False otherwise
+        :rtype: bool
+        '''
+
+        key = self._get_journal_key(dataset, offering_info)
+        journal = self._journal_store.load(key)
+
+        if journal is None or journal.completed:
+            return False
+
+        log.info('Aborting the publication of the offering %s' % offering_info['name'])
+        self._rollback(offering_info, journal.is_completed(OFFERING_STEP))
+        self._journal_store.delete(key)
+
+        return True
+
+    def _get_offering_details(self, offering_name, offering_version):
+        user_nickname = self._get_identity().user
+        name = offering_name.replace(' ', '%20')
+        return self._make_request('get', '%s/api/offering/offerings/%s/%s/%s' %
+                                         (self.store_url, user_nickname, name, offering_version)).json()
+
+    def _get_offering_info(self, offering):
+        # Fields are read from the offering description returned by the Store
+        description = offering.get('offering_description', {})
+
+        legal = description.get('legal') or {}
+        if isinstance(legal, list):
+            legal = legal[0] if legal else {}
+
+        price = 0.0
+        for price_plan in description.get('pricing', {}).get('price_plans', [])[:1]:
+            for component in price_plan.get('price_components', [])[:1]:
+                price = float(component.get('value', 0.0))
+
+        return {
+            'name': offering['name'],
+            'description': description.get('description', ''),
+            'license_title': legal.get('title', ''),
+            'license_description': legal.get('text', ''),
+            'tags': [tag for tag in offering.get('tags', []) if tag != 'dataset'],
+            'price': price,
+            'is_open': offering.get('open', False)
+        }
+
+    def create_offering_version(self, dataset, base_offering, changes):
+        '''
+        Method to publish a new version of an offering that already exists in the
+        Store. The fields of the new version (description, license, price, tags,
+        whether it is open and image) are copied from the existing one and the given
+        changes are applied. The resource of the existing offering is reused, so the
+        catalogue of the Store is not queried to look for it.
+
+        :param dataset: The dataset included in the offering
+        :type dataset: dict
+
+        :param base_offering: The name and the version of the existing offering
+        :type base_offering: dict
+
+        :param changes: The fields of the offering that change (as in create_offering).
+            The version is required
+        :type changes: dict
+
+        :returns: The URL of the new offering
+        :rtype: string
+
+        :raises StoreException: When the existing offering cannot be retrieved or the
+            new version cannot be published. See create_offering
+        '''
+
+        try:
+            offering = self._get_offering_details(base_offering['name'], base_offering['version'])
+            offering_info = self._get_offering_info(offering)
+
+            # The image is copied from the Store unless a new one is given
+            if 'image_base64' not in changes and 'image_file' not in changes:
+                if offering.get('image_url'):
+                    image_url = offering['image_url']
+                    if not image_url.startswith('http'):
+                        image_url = self.store_url + image_url
+                    offering_info['image_base64'] = base64.b64encode(self._make_request('get', image_url).content)
+                else:
+                    raise ValueError('The offering %s has no image' % base_offering['name'])
         except requests.ConnectionError as e:
             log.warn(e)
-            self._rollback(offering_info, offering_created)
             raise StoreException('It was impossible to connect with the Store')
         except Exception as e:
             log.warn(e)
-            self._rollback(offering_info, offering_created)
             raise StoreException(e.message)
+
+        offering_info['pkg_id'] = dataset['id']
+        offering_info.update(changes)
+
+        resources = offering.get('resources', [])
+        resource = self._generate_resource_info(resources[0]) if resources else None
+
+        return self.create_offering(dataset, offering_info, resource)
+
+
+class MultiStoreConnector(object):
+    '''
+    Publishes datasets in all the configured Stores at the same time. Stores are
+    listed in the ``ckan.storepublisher.stores`` setting and each one is configured
+    with its own ``ckan.storepublisher.<store_name>.*`` settings. When that setting
+    is not provided, the single Store configured by ``ckan.storepublisher.store_url``
+    is used.
+    '''
+
+    def __init__(self, config):
+        store_names = config.get('ckan.storepublisher.stores', '').split()
+        self.connectors = OrderedDict()
+
+        if store_names:
+            for store_name in store_names:
+                self.connectors[store_name] = StoreConnector(config, store_name)
+        else:
+            self.connectors[DEFAULT_STORE] = StoreConnector(config)
+
+        # The acquire URL of private datasets points to the first Store. Stores are
+        # contacted from other threads, so it is saved once all of them finish
+        for connector in self.connectors.values()[1:]:
+            connector.manage_acquire_url = False
+        for connector in self.connectors.values():
+            connector.defer_acquire_url = True
+
+        self.identity = None
+        self._bulkhead = get_bulkhead(config)
+
+    def with_identity(self, identity):
+        '''
+        :returns: A copy of the connector whose Stores are contacted on behalf of the
+            given identity. See StoreConnector.with_identity
+        :rtype: MultiStoreConnector
+        '''
+
+        connector = copy.copy(self)
+        connector.identity = identity
+        connector.connectors = OrderedDict((store_name, store_connector.with_identity(identity))
+                                           for store_name, store_connector in self.connectors.items())
+        return connector
+
+    def _run_in_all_stores(self, method_name, *args):
+        tasks = []
+        for connector in self.connectors.values():
+            method = getattr(connector, method_name)
+            tasks.append(lambda method=method: method(*args))
+
+        results = run_concurrently(tasks)
+        return OrderedDict(zip(self.connectors.keys(), results))
+
+    def probe(self):
+        '''
+        Checks whether the Stores can be reached. See StoreConnector.probe.
+
+        :returns: A (latency, exception) tuple for each Store
+        :rtype: OrderedDict
+        '''
+
+        return self._run_in_all_stores('probe')
+
+    def warm_up(self):
+        '''
+        Opens connections with all the Stores. See StoreConnector.warm_up.
+
+        :returns: The number of connections opened with each Store (or the exception
+            raised while opening them)
+        :rtype: OrderedDict
+        '''
+
+        return OrderedDict((store_name, error or result) for store_name, (result, error)
+                           in self._run_in_all_stores('warm_up').items())
+
+    @bound
+    def prefetch_resource(self, dataset):
+        '''
+        Starts looking for the resource of the given dataset in all the Stores. See
+        StoreConnector.prefetch_resource.
+        '''
+
+        for connector in self.connectors.values():
+            connector.prefetch_resource(dataset)
+
+    @bound
+    @limited
+    def delete_attached_resources(self, dataset):
+        '''
+        Method to delete all the resources (and offerings) that contain the given
+        dataset in all the Stores.
+
+        :param dataset: The dataset whose attached offerings and resources want to be
+            deleted from the Stores
+        :type dataset: dict
+
+        :returns: The exception raised by each Store (None when no exception was raised)
+        :rtype: OrderedDict
+        '''
+
+        results = OrderedDict()
+
+        for store_name, (_, error) in self._run_in_all_stores('delete_attached_resources', dataset).items():
+            if error is not None:
+                log.warn('Resources of %s could not be deleted from the Store %s: %s' % (dataset['id'], store_name, error))
+            results[store_name] = error
+
+        return results
+
+    @bound
+    @limited
+    def create_offering(self, dataset, offering_info):
+        '''
+        Method to create an offering that contains the given dataset in all the
+        Stores. Each Store is contacted concurrently and keeps its own journal, so
+        a failure in one Store does not affect the other ones.
+
+        :param dataset: The dataset that will be include in the offering
+        :type dataset: dict
+
+        :param offering_info: A dict that contains additional info for the offering: name,
+            description, license, offering version, price, image
+        :type offering_info: dict
+
+        :returns: The URL of the created offering or the StoreException raised for each
+            Store
+        :rtype: OrderedDict
+
+        :raises BulkheadFull: When too many operations are waiting for the Stores in
+            this process
+        '''
+
+        acquire_url = dataset.get('acquire_url', '')
+        store_results = self._run_in_all_stores('create_offering', dataset, offering_info)
+        self._save_acquire_url(dataset, acquire_url)
+
+        return self._get_publication_results(dataset, store_results)
+
+    @bound
+    @limited
+    def create_offering_version(self, dataset, base_offering, changes):
+        '''
+        Method to publish a new version of an offering in all the Stores. See
+        StoreConnector.create_offering_version.
+
+        :returns: The URL of the new offering or the StoreException raised for each
+            Store
+        :rtype: OrderedDict
+        '''
+
+        return self._get_publication_results(dataset, self._run_in_all_stores('create_offering_version', dataset,
+                                                                             base_offering, changes))
+
+    def _save_acquire_url(self, dataset, previous_acquire_url):
+        # The actions of CKAN are only run in the thread of the request
+        if dataset.get('acquire_url', '') != previous_acquire_url:
+            try:
+                self.connectors.values()[0]._save_acquire_url(dataset)
+            except Exception as e:
+                log.warn('The acquire URL of %s could not be updated: %s' % (dataset['id'], e))
+
+    def _get_publication_results(self, dataset, store_results):
+        results = OrderedDict()
+
+        for store_name, (offering_url, error) in store_results.items():
+            if error is not None and not isinstance(error, StoreException):
+                error = StoreException(str(error))
+            results[store_name] = offering_url if error is None else error
+
+        # The dataset is indexed again to include the new offerings
+        published = [result for result in results.values() if not isinstance(result, StoreException)]
+        if published:
+            try:
+                search.rebuild(dataset['id'])
+            except Exception as e:
+                log.warn('Dataset %s could not be indexed: %s' % (dataset['id'], e))
+
+        return results
+
+    @bound
+    @limited
+    def abort_offering(self, dataset, offering_info):
+        '''
+        Method to discard the publications of an offering that could not be completed
+        in any of the Stores.
+
+        :param dataset: The dataset included in the offering
+        :type dataset: dict
+
+        :param offering_info: The offering info used to publish the offering
+        :type offering_info: dict
+
+        :returns: Whether there was a pending publication in each Store (or the
+            exception raised while aborting it)
+        :rtype: OrderedDict
+        '''
+
+        results = OrderedDict()
+
+        for store_name, (aborted, error) in self._run_in_all_stores('abort_offering', dataset, offering_info).items():
+            if error is not None:
+                log.warn('Offering %s could not be aborted in the Store %s: %s' % (offering_info['name'], store_name, error))
+            results[store_name] = aborted if error is None else error
+
+        return results
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import json
+import os
+import tempfile
+import threading
+import zlib
+
+# Bytes read from files each time. It must be a multiple of 3 to concatenate base64 chunks
+READ_SIZE = 48 * 1024
+# Approximate size of the chunks of the request bodies
+CHUNK_SIZE = 64 * 1024
+# Compressed bodies bigger than this are kept in disk instead of in memory
+MAX_COMPRESSED_IN_MEMORY = 1024 * 1024
+
+# Files can be shared by the requests sent to different Stores at the same time
+_read_lock = threading.Lock()
+
+
+class Base64Stream(object):
+    '''
+    Encodes the content of a file in base64 while it is being read, so the whole
+    content of the file is never held in memory. The file is read from its
+    current position every time the stream is iterated, so it must be seekable.
+    '''
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        try:
+            self._start = fileobj.tell()
+            with _read_lock:
+                fileobj.seek(self._start)
+        except (AttributeError, IOError):
+            raise ValueError('Only seekable files can be encoded')
+
+    def encoded_length(self):
+        '''
+        :returns: The length of the encoded content
+        :rtype: int
+        '''
+
+        with _read_lock:
+            self.fileobj.seek(0, os.SEEK_END)
+            size = self.fileobj.tell() - self._start
+
+        return 4 * ((size + 2) // 3)
+
+    def __iter__(self):
+        position = self._start
+        remainder = b''
+
+        while True:
+            with _read_lock:
+                self.fileobj.seek(position)
+                data = self.fileobj.read(READ_SIZE)
+
+            if not data:
+                break
+
+            position += len(data)
+
+            # Only groups of 3 bytes can be encoded without padding
+            data = remainder + data
+            cut = len(data) - len(data) % 3
+            remainder = data[cut:]
+            if cut:
+                yield base64.b64encode(data[:cut])
+
+        if remainder:
+            yield base64.b64encode(remainder)
+
+
+class JSONStreamBody(object):
+    '''
+    File-like object that encodes a JSON document while it is being read. The
+    Base64Stream values included in the document are encoded on the fly, so
+    the memory required to send the document does not depend on the size of the
+    files. The length of the document is computed in advance, so requests sends
+    it with a Content-Length header.
+    '''
+
+    def __init__(self, document):
+        self.document = document
+        self._length = self._compute_length()
+        self.seek(0)
+
+    def _pieces(self, value):
+        # Pieces are strings or Base64Streams (to be encoded as strings)
+        if isinstance(value, Base64Stream):
+            yield '"'
+            yield value
+            yield '"'
+        elif isinstance(value, dict):
+            yield '{'
+            for i, (key, item) in enumerate(value.items()):
+                yield ', ' if i else ''
+                yield json.dumps(key) + ': '
+                for piece in self._pieces(item):
+                    yield piece
+            yield '}'
+        elif isinstance(value, (list, tuple)):
+            yield '['
+            for i, item in enumerate(value):
+                yield ', ' if i else ''
+                for piece in self._pieces(item):
+                    yield piece
+            yield ']'
+        else:
+            yield json.dumps(value)
+
+    def _compute_length(self):
+        length = 0
+
+        for piece in self._pieces(self.document):
+            if isinstance(piece, Base64Stream):
+                length += piece.encoded_length()
+            else:
+                length += len(piece)
+
+        return length
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        buf = []
+        buf_size = 0
+
+        for piece in self._pieces(self.document):
+            chunks = piece if isinstance(piece, Base64Stream) else [piece]
+            for chunk in chunks:
+                buf.append(chunk)
+                buf_size += len(chunk)
+                if buf_size >= CHUNK_SIZE:
+                    yield ''.join(buf)
+                    buf = []
+                    buf_size = 0
+
+        if buf_size:
+            yield ''.join(buf)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        '''Only rewinding the body is supported'''
+        if offset != 0 or whence != os.SEEK_SET:
+            raise IOError('JSONStreamBody can only be rewound')
+
+        self._chunks = iter(self)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+
+        if size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        return data
+
+    def getvalue(self):
+        '''Returns the whole document (useful for debugging and testing)'''
+        return ''.join(self)
+
+
+class GzipBody(object):
+    '''
+    File-like object that contains the given body compressed with gzip. The body is
+    compressed chunk by chunk into a spooled temporary file, so big bodies are not
+    held in memory and the length of the compressed body is known before sending it.
+    '''
+
+    def __init__(self, body):
+        self._file = tempfile.SpooledTemporaryFile(max_size=MAX_COMPRESSED_IN_MEMORY)
+
+        # wbits = 31 generates the gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        chunks = [body] if isinstance(body, basestring) else body
+        for chunk in chunks:
+            self._file.write(compressor.compress(chunk))
+        self._file.write(compressor.flush())
+
+        self._length = self._file.tell()
+        self._file.seek(0)
+
+    def __len__(self):
+        return self._length
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._file.seek(offset, whence)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def __iter__(self):
+        self._file.seek(0)
+        while True:
+            chunk = self._file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.acquisitions as acquisitions
+import threading
+import unittest
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+
+class NotFound(Exception):
+    pass
+
+
+def _entry(user_name, dataset):
+    return MagicMock(user_name=user_name, dataset=dataset)
+
+
+class AcquisitionQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self._db = acquisitions.db
+        acquisitions.db = MagicMock()
+        self._model = acquisitions.model
+        acquisitions.model = MagicMock()
+        self._threading = acquisitions.threading
+        acquisitions.threading = MagicMock()
+        self._toolkit = acquisitions.plugins.toolkit
+        acquisitions.plugins.toolkit = MagicMock()
+        acquisitions.plugins.toolkit.ObjectNotFound = NotFound
+        self._DatasetLock = acquisitions.DatasetLock
+        acquisitions.DatasetLock = MagicMock()
+        self._Registry = acquisitions.Registry
+        acquisitions.Registry = MagicMock()
+
+        # Datasets
+        self.packages = {}
+        self.package_update = MagicMock()
+
+        def _get_action(action):
+            if action == 'get_site_user':
+                return MagicMock(return_value={'name': 'site_user'})
+            elif action == 'package_show':
+                def _package_show(context, data_dict):
+                    if data_dict['id'] not in self.packages:
+                        raise NotFound()
+                    return dict(self.packages[data_dict['id']])
+                return _package_show
+            else:
+                return self.package_update
+        acquisitions.plugins.toolkit.get_action.side_effect = _get_action
+
+        self.instance = acquisitions.AcquisitionQueue({'ckan.storepublisher.acquisition_window': '10'})
+
+    def tearDown(self):
+        acquisitions.db = self._db
+        acquisitions.model = self._model
+        acquisitions.threading = self._threading
+        acquisitions.plugins.toolkit = self._toolkit
+        acquisitions.DatasetLock = self._DatasetLock
+        acquisitions.Registry = self._Registry
+
+    def _set_entries(self, entries):
+        query = acquisitions.model.Session.query
+        query.return_value.order_by.return_value = [(entry.dataset,) for entry in entries]
+        query.return_value.filter_by.side_effect = lambda dataset: MagicMock(
+            all=MagicMock(return_value=[entry for entry in entries if entry.dataset == dataset]))
+
+    def test_init(self):
+        self.assertEquals(10.0, self.instance.acquisition_window)
+
+    def test_add(self):
+        self.instance.flush = MagicMock()
+        acquisitions.db.Acquisition.side_effect = lambda: MagicMock()
+
+        self.instance.add('aitor', ['dataset_a', 'dataset_b'])
+        self.instance.add('smg', ['dataset_a'])
+
+        # Acquisitions are saved as soon as they are received
+        entries = [call[0][0] for call in acquisitions.model.Session.add.call_args_list]
+        self.assertEquals([('aitor', 'dataset_a'), ('aitor', 'dataset_b'), ('smg', 'dataset_a')],
+                          [(entry.user_name, entry.dataset) for entry in entries])
+        self.assertEquals(3, len(set(entry.id for entry in entries)))
+        self.assertEquals(2, acquisitions.model.Session.commit.call_count)
+
+        # They are applied when the window expires (only one timer is started)
+        acquisitions.threading.Timer.assert_called_once_with(10.0, self.instance._run)
+        timer = acquisitions.threading.Timer.return_value
+        self.assertTrue(timer.daemon)
+        timer.start.assert_called_once_with()
+        self.assertEquals(0, self.instance.flush.call_count)
+
+    def test_add_no_window(self):
+        self.instance.acquisition_window = 0
+        self.instance.flush = MagicMock()
+
+        self.instance.add('aitor', ['dataset_a'])
+
+        self.instance.flush.assert_called_once_with()
+        self.assertEquals(0, acquisitions.threading.Timer.call_count)
+
+    def test_run(self):
+        registry = acquisitions.Registry.return_value
+        self.instance.flush = MagicMock(side_effect=lambda: self.assertEquals(1, registry.prepare.call_count))
+
+        self.instance._run()
+
+        # The Pylons globals used by the actions are registered while the acquisitions are applied
+        self.instance.flush.assert_called_once_with()
+        registered = [call[0][0] for call in registry.register.call_args_list]
+        self.assertEquals([acquisitions.pylons.translator, acquisitions.pylons.c], registered)
+        registry.cleanup.assert_called_once_with()
+        acquisitions.model.Session.remove.assert_called_once_with()
+
+    def test_run_error(self):
+        self.instance.flush = MagicMock(side_effect=Exception('Database error'))
+
+        self.assertRaises(Exception, self.instance._run)
+        acquisitions.Registry.return_value.cleanup.assert_called_once_with()
+        acquisitions.model.Session.remove.assert_called_once_with()
+
+    def test_flush(self):
+        self.packages['dataset_a'] = {'id': 'a', 'private': True, 'allowed_users': ['smg']}
+        self.packages['dataset_b'] = {'id': 'b', 'private': True, 'allowed_users': 'smg,aitor'}
+        self.packages['dataset_c'] = {'id': 'c', 'private': True}
+        entries = [_entry('aitor', 'dataset_a'), _entry('smg', 'dataset_a'), _entry('pepe', 'dataset_c'),
+                   _entry('aitor', 'dataset_a'), _entry('pepe', 'dataset_a'), _entry('aitor', 'dataset_b'),
+                   _entry('aitor', 'dataset_d')]
+        self._set_entries(entries)
+
+        self.instance.flush()
+
+        # Each dataset is updated once with all its new users. Datasets whose users are allowed already are not updated
+        updates = [call[0][1] for call in self.package_update.call_args_list]
+        self.assertEquals([{'id': 'a', 'private': True, 'allowed_users': ['smg', 'aitor', 'pepe']},
+                           {'id': 'c', 'private': True, 'allowed_users': ['pepe']}], updates)
+        context = self.package_update.call_args[0][0]
+        self.assertEquals(('site_user', True, True),
+                          (context['user'], context['ignore_auth'], context[acquisitions.SKIP_RESOURCE_SYNC]))
+
+        # Acquisitions are forgotten once they are applied (also the ones of datasets that do not exist)
+        self.assertEquals([entries[i] for i in (0, 1, 3, 4, 2, 5, 6)],
+                          [call[0][0] for call in acquisitions.model.Session.delete.call_args_list])
+        lock = self.instance._dataset_lock.hold
+        self.assertEquals([(acquisitions.ACQUISITIONS, dataset) for dataset in ('dataset_a', 'dataset_c', 'dataset_b', 'dataset_d')],
+                          [call[0] for call in lock.call_args_list])
+
+    @parameterized.expand([
+        ('package_update',),
+        ('lock',)
+    ])
+    def test_flush_error(self, failing):
+        self.packages['dataset_a'] = {'id': 'a'}
+        self.packages['dataset_b'] = {'id': 'b'}
+        entries = [_entry('aitor', 'dataset_a'), _entry('aitor', 'dataset_b')]
+        self._set_entries(entries)
+        if failing == 'package_update':
+            self.package_update.side_effect = [Exception('Solr down'), None]
+        else:
+            self.instance._dataset_lock.hold.return_value.__enter__.side_effect = [Exception('Timeout'), None]
+
+        self.instance.flush()
+
+        # Acquisitions that could not be applied are kept so they are applied in the next window
+        acquisitions.model.Session.rollback.assert_called_once_with()
+        self.assertEquals([entries[1]], [call[0][0] for call in acquisitions.model.Session.delete.call_args_list])
+
+
+class AcquisitionQueueCKANTest(unittest.TestCase):
+    '''
+    Applies the acquisitions with the actions of CKAN. It requires the CKAN test
+    environment (nosetests --ckan --with-pylons=test.ini)
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            from ckan.tests import CreateTestData
+        except ImportError:
+            raise unittest.SkipTest('The CKAN test environment is not available')
+
+        acquisitions.model.repo.rebuild_db()
+        CreateTestData.create()
+
+    @classmethod
+    def tearDownClass(cls):
+        acquisitions.model.repo.rebuild_db()
+
+    def test_run(self):
+        model = acquisitions.model
+        instance = acquisitions.AcquisitionQueue({'ckan.storepublisher.acquisition_window': '10'})
+        acquisitions.db.init_db(model)
+        entry = acquisitions.db.Acquisition()
+        entry.id = u'acquisition'
+        entry.user_name = u'tester'
+        entry.dataset = u'annakarenina'
+        entry.received = acquisitions.datetime.datetime.utcnow()
+        model.Session.add(entry)
+        model.Session.commit()
+        revision = model.Package.get(u'annakarenina').revision_id
+
+        # The acquisitions are applied in a thread that does not serve any request
+        thread = threading.Thread(target=instance._run)
+        thread.start()
+        thread.join()
+
+        # The dataset has been updated and the acquisition is not applied again
+        model.Session.remove()
+        self.assertNotEquals(revision, model.Package.get(u'annakarenina').revision_id)
+        self.assertEquals(0, model.Session.query(acquisitions.db.Acquisition).count())
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.actions as actions
+import ckanext.storepublisher.auth as auth
+import base64
+import unittest
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+DATASET = {'id': 'package_id', 'name': 'dataset', 'private': False}
+
+
+class ActionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._toolkit = actions.plugins.toolkit
+        actions.plugins.toolkit = MagicMock()
+
+        self._db = actions.db
+        actions.db = MagicMock()
+
+        self._model = actions.model
+        actions.model = MagicMock()
+
+        self._activity = actions.activity
+        actions.activity = MagicMock()
+
+        self._get_health_monitor = actions.get_health_monitor
+        actions.get_health_monitor = MagicMock()
+
+        self._store_connector = actions._store_connector
+        actions._store_connector = MagicMock()
+
+        self._draft_store = actions._draft_store
+        actions._draft_store = MagicMock()
+
+        self._acquisition_queue = actions._acquisition_queue
+        actions._acquisition_queue = MagicMock()
+
+        actions.plugins.toolkit.ValidationError = self._toolkit.ValidationError
+        actions.plugins.toolkit.NotAuthorized = self._toolkit.NotAuthorized
+        actions.plugins.toolkit.asbool.side_effect = lambda value: value in (True, 'true')
+        actions.plugins.toolkit.get_action.return_value.return_value = DATASET
+
+    def tearDown(self):
+        actions.plugins.toolkit = self._toolkit
+        actions.db = self._db
+        actions.model = self._model
+        actions.activity = self._activity
+        actions.get_health_monitor = self._get_health_monitor
+        actions._store_connector = self._store_connector
+        actions._draft_store = self._draft_store
+        actions._acquisition_queue = self._acquisition_queue
+
+    def test_storepublisher_dashboard(self):
+        actions.activity.get_summary.return_value = {'operations': [], 'pending': {'resource_updates': 1}}
+        counts = {actions.db.PublishJournal: 2, actions.db.PublishDraft: 3, actions.db.Acquisition: 4}
+        actions.model.Session.query.side_effect = lambda table: MagicMock(count=MagicMock(return_value=counts[table]))
+        context = {'user': 'admin'}
+
+        result = actions.storepublisher_dashboard(context, {})
+
+        actions.plugins.toolkit.check_access.assert_called_once_with('storepublisher_dashboard', context, {})
+        actions.db.init_db.assert_called_once_with(actions.model)
+        self.assertEquals({'operations': [], 'pending': {'resource_updates': 1, 'failed_publications': 2, 'drafts': 3,
+                                                         'acquisitions': 4}}, result)
+
+    def test_storepublisher_dashboard_not_authorized(self):
+        actions.plugins.toolkit.check_access.side_effect = self._toolkit.NotAuthorized
+
+        self.assertRaises(self._toolkit.NotAuthorized, actions.storepublisher_dashboard, {}, {})
+        self.assertEquals(0, actions.activity.get_summary.call_count)
+
+    def test_auth_storepublisher_dashboard(self):
+        self.assertEquals({'success': False}, auth.storepublisher_dashboard({'user': 'user'}, {}))
+
+    def test_storepublisher_health(self):
+        context = {'user': None}
+
+        result = actions.storepublisher_health(context, {})
+
+        actions.plugins.toolkit.check_access.assert_called_once_with('storepublisher_health', context, {})
+        actions.get_health_monitor.assert_called_once_with(actions.config)
+        self.assertEquals(actions.get_health_monitor.return_value.get_status.return_value, result)
+
+    def test_auth_storepublisher_health(self):
+        self.assertEquals({'success': True}, auth.storepublisher_health({'user': None}, {}))
+        self.assertTrue(auth.storepublisher_health.auth_allow_anonymous_access)
+
+    @parameterized.expand([
+        ({'name': 'Offering', 'version': '1.0'},
+         {'tags': [], 'price': 0.0, 'is_open': False}),
+        ({'name': 'Offering', 'version': '1.0', 'tags': 'a,b', 'price': '0', 'is_open': 'true'},
+         {'tags': ['a', 'b'], 'price': 0.0, 'is_open': True}),
+        ({'name': 'Offering', 'version': '1.0', 'tags': ['a'], 'description': 'Desc'},
+         {'tags': ['a'], 'description': 'Desc'}),
+        ({'version': '1.0', 'price': 'a'},
+         {'Name': ['This filed is required to publish the offering'], 'Price': ['"a" is not a valid number']}),
+        ({'name': 'Offering', 'version': '1.0', 'price': 2},
+         {'Price': ['You cannot set a price to a dataset that is public since everyone can access it']})
+    ])
+    def test_dataset_publish_validate(self, data, expected):
+        data_dict = dict(data, id='dataset')
+        context = {'user': 'smg'}
+        valid = expected.keys()[0].islower()
+
+        if valid:
+            result = actions.dataset_publish_validate(context, data_dict)
+            self.assertEquals('package_id', result['pkg_id'])
+            for field, value in expected.items():
+                self.assertEquals(value, result[field])
+        else:
+            with self.assertRaises(self._toolkit.ValidationError) as e:
+                actions.dataset_publish_validate(context, data_dict)
+            self.assertEquals(expected, e.exception.error_dict)
+
+        actions.plugins.toolkit.check_access.assert_called_once_with('dataset_publish_validate', context, data_dict)
+        actions.plugins.toolkit.get_action.assert_called_once_with('package_show')
+        actions.plugins.toolkit.get_action.return_value.assert_called_once_with(context, {'id': 'dataset'})
+
+    @parameterized.expand([
+        ({}, {'eu': 'http://eu/offering'}),
+        ({'image_base64': base64.b64encode('image')}, {'eu': 'http://eu/offering', 'us': 'http://us/offering'}),
+        ({'image_base64': base64.b64encode('image')}, {'eu': 'http://eu/offering', 'us': 'error'}),
+        ({}, {'eu': 'error'}),
+        ({'image_draft': 'image_ref'}, {'eu': 'error'}),
+        ({'image_draft': 'image_ref'}, {'eu': 'http://eu/offering'})
+    ])
+    def test_dataset_publish(self, image, store_results):
+        image_file = actions._draft_store.open_image.return_value
+        actions._draft_store.load.return_value = {'fields': {}, 'image': 'image_ref'}
+        actions._draft_store.save_image.return_value = 'new_image_ref'
+        actions._store_connector.create_offering.return_value = dict(
+            (store, actions.StoreException(result) if result == 'error' else result)
+            for store, result in store_results.items())
+        data_dict = dict(image, id='dataset', name='Offering', version='1.0', tags=['a', 'b'])
+        context = {'user': 'smg'}
+
+        result = actions.dataset_publish(context, data_dict)
+
+        actions.plugins.toolkit.check_access.assert_called_once_with('dataset_publish', context, data_dict)
+        offering_info = actions._store_connector.create_offering.call_args[0][1]
+        actions._store_connector.create_offering.assert_called_once_with(DATASET, offering_info)
+        if 'image_base64' in image:
+            self.assertEquals(image['image_base64'], offering_info['image_base64'])
+        elif 'image_draft' in image:
+            actions._draft_store.open_image.assert_called_once_with('image_ref')
+            self.assertEquals(image_file, offering_info['image_file'])
+            image_file.close.assert_called_once_with()
+        else:
+            self.assertEquals(actions.LOGO_CKAN_B64, offering_info['image_base64'])
+
+        failed = 'error' in store_results.values()
+        for store, store_result in store_results.items():
+            if store_result == 'error':
+                self.assertEquals({'success': False, 'error': 'error'}, result['offerings'][store])
+            else:
+                self.assertEquals({'success': True, 'offering_url': store_result}, result['offerings'][store])
+
+        if not failed:
+            self.assertIsNone(result['image_draft'])
+            actions._draft_store.delete.assert_called_once_with('smg', 'package_id')
+            self.assertEquals(0, actions._draft_store.save.call_count)
+        elif 'image_base64' in image or 'image_draft' in image:
+            # The image is kept to resume the publication
+            image_ref = 'new_image_ref' if 'image_base64' in image else 'image_ref'
+            self.assertEquals(image_ref, result['image_draft'])
+            if 'image_base64' in image:
+                self.assertEquals('image', actions._draft_store.save_image.call_args[0][0].read())
+            draft_fields = actions._draft_store.save.call_args[0][2]
+            self.assertEquals(('Offering', 'a,b'), (draft_fields['name'], draft_fields['tag_string']))
+            actions._draft_store.save.assert_called_once_with('smg', 'package_id', draft_fields, image_ref)
+        else:
+            self.assertIsNone(result['image_draft'])
+            self.assertEquals(0, actions._draft_store.save.call_count)
+
+    @parameterized.expand([
+        ({'name': 'Offering', 'version': '1.0', 'image_draft': 'other_ref'},      True,  {'Image': ['The image other_ref does not exist']}),
+        ({'name': 'Offering', 'version': '1.0', 'image_base64': 'a'},             True,  {'Image': ['The image is not encoded in base64']}),
+        ({'version': '1.0'},                                                      True,  {'Name': ['This filed is required to publish the offering']}),
+        ({'name': 'Offering', 'version': '1.0'},                                  False, {'Store': ['The Store cannot be reached right now. Please, try again later']})
+    ])
+    def test_dataset_publish_invalid(self, data, store_available, expected_errors):
+        actions._draft_store.load.return_value = {'fields': {}, 'image': 'image_ref'}
+        actions.get_health_monitor.return_value.is_available.return_value = store_available
+
+        with self.assertRaises(self._toolkit.ValidationError) as e:
+            actions.dataset_publish({'user': 'smg'}, dict(data, id='dataset'))
+
+        self.assertEquals(expected_errors, e.exception.error_dict)
+        self.assertEquals(0, actions._store_connector.create_offering.call_count)
+
+    @parameterized.expand([
+        ('dataset_publish',),
+        ('dataset_publish_validate',),
+        ('dataset_publish_version',)
+    ])
+    def test_auth_dataset_publish(self, function_name):
+        self._auth_toolkit = auth.plugins.toolkit
+        auth.plugins.toolkit = MagicMock()
+        auth.plugins.toolkit.NotAuthorized = self._toolkit.NotAuthorized
+        try:
+            context = {'user': 'smg'}
+            self.assertEquals({'success': True}, getattr(auth, function_name)(context, {'id': 'dataset'}))
+            auth.plugins.toolkit.check_access.assert_called_once_with('package_update', context, {'id': 'dataset'})
+
+            auth.plugins.toolkit.check_access.side_effect = self._toolkit.NotAuthorized
+            self.assertFalse(getattr(auth, function_name)(context, {'id': 'dataset'})['success'])
+        finally:
+            auth.plugins.toolkit = self._auth_toolkit
+
+    @parameterized.expand([
+        ({'version': '1.1'}, {'version': '1.1'}),
+        ({'version': '1.1', 'tags': 'a,b', 'is_open': 'true', 'description': 'New', 'other': 'field'},
+         {'version': '1.1', 'tags': ['a', 'b'], 'is_open': True, 'description': 'New'}),
+        ({'version': '1.1', 'price': '0', 'image_base64': base64.b64encode('image')},
+         {'version': '1.1', 'price': 0.0, 'image_base64': base64.b64encode('image')})
+    ])
+    def test_dataset_publish_version(self, data, expected_changes):
+        actions._store_connector.create_offering_version.return_value = {
+            'eu': 'http://eu/offering', 'us': actions.StoreException('error')}
+        data_dict = dict(data, id='dataset', base_name='Offering', base_version='1.0')
+        context = {'user': 'smg'}
+
+        result = actions.dataset_publish_version(context, data_dict)
+
+        actions.plugins.toolkit.check_access.assert_called_once_with('dataset_publish_version', context, data_dict)
+        actions._store_connector.create_offering_version.assert_called_once_with(
+            DATASET, {'name': 'Offering', 'version': '1.0'}, expected_changes)
+        self.assertEquals({'offerings': {'eu': {'success': True, 'offering_url': 'http://eu/offering'},
+                                         'us': {'success': False, 'error': 'error'}}}, result)
+
+    @parameterized.expand([
+        ({'base_name': 'Offering', 'base_version': '1.0'},                     True,  {'Version': ['This filed is required to publish the offering']}),
+        ({'base_version': '1.0', 'version': '1.1'},                            True,  {'Base_name': ['This field is required to publish a new version']}),
+        ({'base_name': 'Offering', 'base_version': '1.0', 'version': '1.1', 'price': '2'}, True,
+         {'Price': ['You cannot set a price to a dataset that is public since everyone can access it']}),
+        ({'base_name': 'Offering', 'base_version': '1.0', 'version': '1.1', 'image_base64': 'a'}, True,
+         {'Image': ['The image is not encoded in base64']}),
+        ({'base_name': 'Offering', 'base_version': '1.0', 'version': '1.1'},  False,
+         {'Store': ['The Store cannot be reached right now. Please, try again later']})
+    ])
+    def test_dataset_publish_version_invalid(self, data, store_available, expected_errors):
+        actions.get_health_monitor.return_value.is_available.return_value = store_available
+
+        with self.assertRaises(self._toolkit.ValidationError) as e:
+            actions.dataset_publish_version({'user': 'smg'}, dict(data, id='dataset'))
+
+        self.assertEquals(expected_errors, e.exception.error_dict)
+        self.assertEquals(0, actions._store_connector.create_offering_version.call_count)
+
+    @parameterized.expand([
+        ({'customer_name': 'aitor', 'resources': [{'url': 'https://ckan/dataset/dataset_a'}]}, 'aitor', ['dataset_a']),
+        ({'customer': 'aitor', 'resources': [{'url': 'https://ckan/dataset/dataset_a/'},
+                                             {'url': 'https://ckan/dataset/dataset_b?a=b'},
+                                             {'url': 'https://ckan/dataset/dataset_a'},
+                                             {'url': 'https://example.com/data'},
+                                             {'name': 'resource'}]}, 'aitor', ['dataset_a', 'dataset_b']),
+        ({'customer_name': 'aitor', 'resources': []}, 'aitor', [])
+    ])
+    def test_storepublisher_dataset_acquired(self, data_dict, user_name, datasets):
+        context = {'user': None}
+
+        result = actions.storepublisher_dataset_acquired(context, data_dict)
+
+        actions.plugins.toolkit.check_access.assert_called_once_with('storepublisher_dataset_acquired', context, data_dict)
+        self.assertEquals({'datasets': datasets}, result)
+        # Acquisitions are only saved. Datasets are updated later
+        if datasets:
+            actions._acquisition_queue.add.assert_called_once_with(user_name, datasets)
+        else:
+            self.assertEquals(0, actions._acquisition_queue.add.call_count)
+        self.assertEquals(0, actions.plugins.toolkit.get_action.call_count)
+
+    @parameterized.expand([
+        ({},                                                   ['Customer_name', 'Resources']),
+        ({'customer_name': 'aitor'},                           ['Resources']),
+        ({'customer_name': 'aitor', 'resources': 'dataset'},   ['Resources']),
+        ({'resources': [{'url': 'https://ckan/dataset/a'}]},  ['Customer_name'])
+    ])
+    def test_storepublisher_dataset_acquired_invalid(self, data_dict, fields):
+        with self.assertRaises(self._toolkit.ValidationError) as e:
+            actions.storepublisher_dataset_acquired({}, data_dict)
+
+        self.assertEquals(sorted(fields), sorted(e.exception.error_dict.keys()))
+        self.assertEquals(0, actions._acquisition_queue.add.call_count)
+
+    @parameterized.expand([
+        (None,),
+        (ValueError,),
+        ('NotAuthorized',)
+    ])
+    def test_auth_storepublisher_dataset_acquired(self, error):
+        self._auth_toolkit = auth.plugins.toolkit
+        auth.plugins.toolkit = MagicMock()
+        auth.plugins.toolkit.NotAuthorized = self._toolkit.NotAuthorized
+        auth.plugins.toolkit.check_access.side_effect = self._toolkit.NotAuthorized if error == 'NotAuthorized' else error
+        try:
+            context = {'user': None}
+            result = auth.storepublisher_dataset_acquired(context, {})
+
+            # The same users that can notify acquisitions to dataset_acquired
+            auth.plugins.toolkit.check_access.assert_called_once_with('dataset_acquired', context, {})
+            self.assertEquals(error is None, result['success'])
+            self.assertTrue(auth.storepublisher_dataset_acquired.auth_allow_anonymous_access)
+        finally:
+            auth.plugins.toolkit = self._auth_toolkit
+
+    @parameterized.expand([
+        ('dataset_publish',         'create_offering',         {'name': 'a', 'version': '1.0', 'image_base64': base64.b64encode('image')}),
+        ('dataset_publish_version', 'create_offering_version', {'base_name': 'Offering', 'base_version': '1.0', 'version': '1.1'})
+    ])
+    def test_dataset_publish_store_busy(self, action, method, data):
+        getattr(actions._store_connector, method).side_effect = actions.BulkheadFull('Full')
+
+        with self.assertRaises(self._toolkit.ValidationError) as e:
+            getattr(actions, action)({'user': 'smg'}, dict(data, id='dataset'))
+
+        self.assertEquals({'Store': [actions.BUSY_MESSAGE]}, e.exception.error_dict)
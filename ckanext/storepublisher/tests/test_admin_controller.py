@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.controllers.admin_controller as controller
+import unittest
+
+from mock import MagicMock
+
+
+class AdminControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._toolkit = controller.plugins.toolkit
+        controller.plugins.toolkit = MagicMock()
+        controller.plugins.toolkit.NotAuthorized = self._toolkit.NotAuthorized
+
+        self.instanceController = controller.AdminControllerUI()
+
+    def tearDown(self):
+        controller.plugins.toolkit = self._toolkit
+
+    def test_dashboard(self):
+        c = controller.plugins.toolkit.c
+        action = controller.plugins.toolkit.get_action.return_value
+
+        result = self.instanceController.dashboard()
+
+        controller.plugins.toolkit.get_action.assert_called_once_with('storepublisher_dashboard')
+        action.assert_called_once_with({'model': controller.model, 'session': controller.model.Session,
+                                        'user': c.user, 'auth_user_obj': c.userobj}, {})
+        self.assertEquals(action.return_value, c.dashboard)
+        controller.plugins.toolkit.render.assert_called_once_with('admin/storepublisher.html')
+        self.assertEquals(controller.plugins.toolkit.render.return_value, result)
+
+    def test_dashboard_not_authorized(self):
+        controller.plugins.toolkit.get_action.return_value.side_effect = self._toolkit.NotAuthorized
+        controller.plugins.toolkit._ = self._toolkit._
+        user = controller.plugins.toolkit.c.user
+
+        self.instanceController.dashboard()
+
+        controller.plugins.toolkit.abort.assert_called_once_with(401, 'User %s not authorized to see the Store Publisher dashboard' % user)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.batch_connector as batch_connector
+
+import unittest
+
+from ckanext.storepublisher.identity import StoreIdentity
+from ckanext.storepublisher.journal import SagaJournal, STEPS, OFFERING_STEP, PUBLISH_STEP, RESOURCE_STEP, TAG_STEP
+from mock import ANY, MagicMock
+from nose_parameterized import parameterized
+
+BASE_SITE_URL = 'https://localhost:8474'
+BASE_STORE_URL = 'https://store.example.com:7458'
+EXCEPTION_MSG = 'Exception Message'
+
+
+def _dataset(dataset_id):
+    return {'id': dataset_id, 'title': 'Dataset %s' % dataset_id, 'notes': ''}
+
+
+def _resource(dataset_id, name, state='active'):
+    return {'link': '%s/dataset/%s' % (BASE_SITE_URL, dataset_id), 'state': state, 'name': name, 'version': '1.0'}
+
+
+def _resource_info(name):
+    return {'provider': 'smg', 'name': name, 'version': '1.0'}
+
+
+def _raise_if(condition):
+    if condition:
+        raise Exception(EXCEPTION_MSG)
+
+
+class BatchStoreConnectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self._run_concurrently = batch_connector.run_concurrently
+
+        # Tasks are run sequentially to check the results easily
+        def _run_concurrently_side_effect(tasks, max_workers):
+            results = []
+            for task in tasks:
+                try:
+                    results.append((task(), None))
+                except Exception as e:
+                    results.append((None, e))
+            return results
+        batch_connector.run_concurrently = MagicMock(side_effect=_run_concurrently_side_effect)
+
+        self.config = {
+            'ckan.site_url': BASE_SITE_URL,
+            'ckan.storepublisher.store_url': BASE_STORE_URL,
+            'ckan.storepublisher.repository': 'Example Repo',
+            'ckan.storepublisher.batch_concurrency': '4'
+        }
+
+        # Batches are run on behalf of a given user (they do not depend on the request)
+        self.identity = StoreIdentity('smg', {'access_token': 'token'})
+        self.instance = batch_connector.BatchStoreConnector(self.config).with_identity(self.identity)
+        self.instance._update_acquire_url = MagicMock()
+        self.instance._generate_resource_info = MagicMock(side_effect=lambda resource: _resource_info(resource['name']))
+
+    def tearDown(self):
+        batch_connector.run_concurrently = self._run_concurrently
+
+    def test_init(self):
+        self.assertEquals(4, self.instance.concurrency)
+        self.assertEquals(BASE_STORE_URL, self.instance.store_url)
+
+    def test_make_request(self):
+        semaphore = self.instance._semaphore = MagicMock()
+        parent_make_request = batch_connector.StoreConnector._make_request
+        batch_connector.StoreConnector._make_request = MagicMock(return_value='response')
+
+        try:
+            result = self.instance._make_request('get', 'http://example.com', {'a': 'b'}, 'data', True)
+            self.assertEquals('response', result)
+            batch_connector.StoreConnector._make_request.assert_called_once_with('get', 'http://example.com', {'a': 'b'}, 'data', True)
+            semaphore.__enter__.assert_called_once_with()
+            self.assertEquals(1, semaphore.__exit__.call_count)
+        finally:
+            batch_connector.StoreConnector._make_request = parent_make_request
+
+    def test_batch_get_existing_resources(self):
+        self.instance._get_resources = MagicMock(return_value=[
+            _resource('a', 'deleted resource', 'deleted'),
+            _resource('a', 'resource a'),
+            _resource('a', 'resource a 2'),
+            _resource('c', 'resource c')
+        ])
+        datasets = [_dataset('a'), _dataset('b'), _dataset('c')]
+
+        results = self.instance.batch_get_existing_resources(datasets)
+
+        self.assertEquals([_resource_info('resource a'), None, _resource_info('resource c')], results)
+        self.instance._get_resources.assert_called_once_with()
+        self.assertEquals(2, self.instance._update_acquire_url.call_count)
+
+    def test_batch_create_resources(self):
+        error = Exception(EXCEPTION_MSG)
+        self.instance._create_resource = MagicMock(side_effect=[_resource_info('a'), error])
+
+        results = self.instance.batch_create_resources([_dataset('a'), _dataset('b')])
+
+        self.assertEquals(_resource_info('a'), results[0])
+        self.assertIsInstance(results[1], batch_connector.StoreException)
+        self.assertEquals(EXCEPTION_MSG, results[1].message)
+
+    @parameterized.expand([
+        (False,),
+        (True,)
+    ])
+    def test_batch_create_offerings(self, resource_creation_fails):
+        self.instance._get_resources = MagicMock(return_value=[_resource('a', 'resource a')])
+        created_resource = batch_connector.StoreException(EXCEPTION_MSG) if resource_creation_fails else _resource_info('resource b')
+        self.instance.batch_create_resources = MagicMock(return_value=[created_resource])
+        # Offerings are only created. The first one was published by a concurrent request
+        self.instance._publish_once = MagicMock(side_effect=lambda dataset, offering_info, resource, last_step:
+                                                'url 1' if offering_info['name'] == 'offering 1' else None)
+        self.instance.batch_tag_and_publish = MagicMock(side_effect=lambda offerings: [info['name'] for _, info in offerings])
+
+        offerings = [
+            (_dataset('a'), {'name': 'offering 1'}),
+            (_dataset('b'), {'name': 'offering 2'}),
+            (_dataset('b'), {'name': 'offering 3'})
+        ]
+        results = self.instance.batch_create_offerings(offerings)
+
+        # The missing resource is only created once
+        self.instance.batch_create_resources.assert_called_once_with([_dataset('b')])
+        self.assertEquals('url 1', results[0])
+        self.instance._publish_once.assert_any_call(_dataset('a'), {'name': 'offering 1'}, _resource_info('resource a'),
+                                                    batch_connector.OFFERING_STEP)
+
+        if resource_creation_fails:
+            self.assertEquals(1, self.instance._publish_once.call_count)
+            self.assertEquals([created_resource, created_resource], results[1:])
+            self.instance.batch_tag_and_publish.assert_called_once_with([])
+        else:
+            self.assertEquals(['offering 2', 'offering 3'], results[1:])
+            self.instance._publish_once.assert_any_call(_dataset('b'), {'name': 'offering 3'}, created_resource,
+                                                        batch_connector.OFFERING_STEP)
+            # The created offerings are tagged and published at once
+            self.instance.batch_tag_and_publish.assert_called_once_with(offerings[1:])
+
+    def test_batch_create_offerings_store_unavailable(self):
+        self.instance._get_resources = MagicMock(side_effect=Exception(EXCEPTION_MSG))
+        self.instance._publish_once = MagicMock()
+
+        results = self.instance.batch_create_offerings([(_dataset('a'), {}), (_dataset('b'), {})])
+
+        self.assertEquals(2, len(results))
+        for result in results:
+            self.assertIsInstance(result, batch_connector.StoreException)
+        self.assertEquals(0, self.instance._publish_once.call_count)
+
+    def _journal(self, dataset_id, offering_name, last_completed_step):
+        journal = SagaJournal(('store', 'smg', dataset_id, offering_name, '1.0'))
+        for step in STEPS[:STEPS.index(last_completed_step) + 1]:
+            journal.complete(step, _resource_info('resource') if step == RESOURCE_STEP else None)
+        return journal
+
+    def test_batch_tag_and_publish(self):
+        offerings = [(_dataset(dataset_id), {'name': 'offering %s' % dataset_id, 'version': '1.0'}) for dataset_id in 'abcde']
+        journals = {
+            'offering a': self._journal('a', 'offering a', OFFERING_STEP),
+            'offering b': self._journal('b', 'offering b', TAG_STEP),
+            'offering c': self._journal('c', 'offering c', OFFERING_STEP),
+            'offering d': self._journal('d', 'offering d', RESOURCE_STEP),
+            'offering e': None
+        }
+        self.instance._journal_store = MagicMock()
+        self.instance._journal_store.load.side_effect = lambda key: journals[key[3]]
+        self.instance._tag_offering = MagicMock()
+        self.instance._publish_offering = MagicMock(side_effect=lambda offering_info: _raise_if(offering_info['name'] == 'offering c'))
+        self.instance._complete_publication = MagicMock(side_effect=lambda dataset, offering_info, journal: 'url %s' % dataset['id'])
+        self._activity = batch_connector.activity
+        batch_connector.activity = MagicMock()
+
+        try:
+            results = self.instance.batch_tag_and_publish(offerings)
+        finally:
+            activity, batch_connector.activity = batch_connector.activity, self._activity
+
+        # The requests of all the offerings are sent at once
+        batch_connector.run_concurrently.assert_called_once_with(ANY, 4)
+        self.assertEquals(5, len(batch_connector.run_concurrently.call_args[0][0]))
+        self.assertEquals(2, self.instance._tag_offering.call_count)
+        self.assertEquals(3, self.instance._publish_offering.call_count)
+
+        self.assertEquals(['url a', 'url b'], results[:2])
+        self.assertEquals(2, self.instance._complete_publication.call_count)
+
+        # The journal of the failed publication is saved so it can be resumed
+        self.assertIsInstance(results[2], batch_connector.StoreException)
+        self.assertEquals(EXCEPTION_MSG, results[2].message)
+        self.instance._journal_store.save.assert_called_once_with(journals['offering c'])
+        self.assertTrue(journals['offering c'].is_completed(TAG_STEP))
+        self.assertEquals('failed', journals['offering c'].steps[PUBLISH_STEP]['status'])
+
+        # Offerings that have not been created are not published
+        for result in results[3:]:
+            self.assertIsInstance(result, batch_connector.StoreException)
+
+        self.assertEquals(3, activity.record_operation.call_count)
+        self.assertEquals([TAG_STEP, PUBLISH_STEP], activity.record_operation.call_args_list[0][0][3].keys())
+        self.assertEquals([PUBLISH_STEP], activity.record_operation.call_args_list[1][0][3].keys())
+        self.assertEquals(EXCEPTION_MSG, activity.record_operation.call_args_list[2][0][4])
+
+    def test_batch_tag_and_publish_connection_error(self):
+        self.instance._journal_store = MagicMock()
+        self.instance._journal_store.load.return_value = self._journal('a', 'offering a', OFFERING_STEP)
+        self.instance._tag_offering = MagicMock(side_effect=batch_connector.requests.ConnectionError(EXCEPTION_MSG))
+        self.instance._publish_offering = MagicMock()
+
+        results = self.instance.batch_tag_and_publish([(_dataset('a'), {'name': 'offering a', 'version': '1.0'})])
+
+        self.assertEquals('It was impossible to connect with the Store', results[0].message)
+
+    def test_batch_delete_attached_resources(self):
+        resources = [
+            _resource('a', 'resource a'),
+            _resource('a', 'deleted resource', 'deleted'),
+            _resource('b', 'resource b'),
+            _resource('c', 'resource c'),
+            _resource('d', 'resource d')
+        ]
+        self.instance._get_resources = MagicMock(return_value=resources)
+        error = Exception(EXCEPTION_MSG)
+        self.instance._delete_resource = MagicMock(side_effect=[None, error, None])
+
+        results = self.instance.batch_delete_attached_resources([_dataset('a'), _dataset('c'), _dataset('d')])
+
+        self.instance._get_resources.assert_called_once_with()
+        self.assertEquals([resources[0], resources[3], resources[4]], [resource for resource, _ in results])
+        self.assertIsNone(results[0][1])
+        self.assertIsInstance(results[1][1], batch_connector.StoreException)
+        self.assertIsNone(results[2][1])
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.bulkhead as bulkhead
+import threading
+import time
+import unittest
+
+from nose_parameterized import parameterized
+
+
+class BulkheadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instance = bulkhead.Bulkhead({
+            'ckan.storepublisher.bulkhead.max_concurrent': '2',
+            'ckan.storepublisher.bulkhead.queue_size': '1',
+            'ckan.storepublisher.bulkhead.max_wait': '0.2'
+        })
+
+    def tearDown(self):
+        bulkhead._bulkhead = None
+
+    def _hold(self, n_operations):
+        # Holds the given number of slots until the returned event is set
+        release = threading.Event()
+        started = threading.Semaphore(0)
+
+        def _operation():
+            with self.instance.enter():
+                started.release()
+                release.wait()
+
+        threads = [threading.Thread(target=_operation) for _ in range(n_operations)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for _ in threads:
+            started.acquire()
+
+        return release, threads
+
+    @parameterized.expand([
+        ({},                                                    4, 2, 2.0),
+        ({'ckan.storepublisher.bulkhead.max_concurrent': '10',
+          'ckan.storepublisher.bulkhead.queue_size': '0',
+          'ckan.storepublisher.bulkhead.max_wait': '0.5'},      10, 0, 0.5)
+    ])
+    def test_init(self, config, max_concurrent, queue_size, max_wait):
+        instance = bulkhead.Bulkhead(config)
+        self.assertEquals((max_concurrent, queue_size, max_wait),
+                          (instance.max_concurrent, instance.queue_size, instance.max_wait))
+        self.assertEquals((0, 0), (instance.in_flight, instance.queued))
+
+    def test_enter(self):
+        with self.instance.enter():
+            with self.instance.enter():
+                self.assertEquals(2, self.instance.in_flight)
+
+        self.assertEquals(0, self.instance.in_flight)
+
+    def test_enter_error(self):
+        def _operation():
+            with self.instance.enter():
+                raise ValueError()
+
+        # The slot is released even if the operation fails
+        self.assertRaises(ValueError, _operation)
+        self.assertEquals(0, self.instance.in_flight)
+
+    def test_queue_full(self):
+        release, threads = self._hold(2)
+        waiting = threading.Thread(target=lambda: self.assertRaises(bulkhead.BulkheadFull, self.instance._acquire))
+        waiting.start()
+        while self.instance.queued == 0:
+            time.sleep(0.01)
+
+        try:
+            # Operations are rejected immediately when the queue is full
+            started = time.time()
+            self.assertRaises(bulkhead.BulkheadFull, self.instance._acquire)
+            self.assertLess(time.time() - started, 0.1)
+        finally:
+            waiting.join()
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEquals((0, 0), (self.instance.in_flight, self.instance.queued))
+
+    def test_queue_timeout(self):
+        release, threads = self._hold(2)
+
+        try:
+            started = time.time()
+            self.assertRaises(bulkhead.BulkheadFull, self.instance._acquire)
+            self.assertGreaterEqual(time.time() - started, 0.2)
+            self.assertEquals((2, 0), (self.instance.in_flight, self.instance.queued))
+        finally:
+            release.set()
+            for thread in threads:
+                thread.join()
+
+    def test_queue_released(self):
+        self.instance.max_wait = 5
+        release, threads = self._hold(2)
+        timer = threading.Timer(0.05, release.set)
+        timer.start()
+
+        # The queued operation runs as soon as a slot is released
+        with self.instance.enter():
+            self.assertEquals(0, self.instance.queued)
+
+        for thread in threads:
+            thread.join()
+        self.assertEquals(0, self.instance.in_flight)
+
+    def test_not_limited(self):
+        self.instance.max_concurrent = 0
+        release, threads = self._hold(5)
+
+        self.assertEquals(5, self.instance.in_flight)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+    def test_get_bulkhead(self):
+        bulkhead._bulkhead = None
+
+        instance = bulkhead.get_bulkhead({'ckan.storepublisher.bulkhead.max_concurrent': '3'})
+
+        # Only one bulkhead is created per process
+        self.assertIs(instance, bulkhead.get_bulkhead({}))
+        self.assertEquals(3, instance.max_concurrent)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.catalogue as catalogue
+import unittest
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+
+class PagedListingTest(unittest.TestCase):
+
+    def setUp(self):
+        # Pages are prefetched as soon as the thread is started
+        def _thread_side_effect(target, args):
+            thread = MagicMock()
+            thread.start.side_effect = lambda: target(*args)
+            return thread
+        self._threading = catalogue.threading
+        catalogue.threading = MagicMock()
+        catalogue.threading.Thread.side_effect = _thread_side_effect
+
+    def tearDown(self):
+        catalogue.threading = self._threading
+
+    def _fetch_page(self, items):
+        def _fetch_page_side_effect(start, limit):
+            if start is None:
+                return items
+            return items[start - 1:start - 1 + limit]
+        return MagicMock(side_effect=_fetch_page_side_effect)
+
+    @parameterized.expand([
+        (0,  True,  [(None, None)]),
+        (3,  True,  [(1, 3), (4, 3), (7, 3)]),
+        (3,  False, [(1, 3), (4, 3), (7, 3)]),
+        (4,  True,  [(1, 4), (5, 4)]),
+        (10, True,  [(1, 10)])
+    ])
+    def test_iterate(self, page_size, prefetch, pages):
+        items = range(7)
+        fetch_page = self._fetch_page(items)
+
+        listing = catalogue.PagedListing(fetch_page, page_size, prefetch)
+
+        self.assertEquals(items, list(listing))
+        self.assertEquals([(page,) for page in pages], fetch_page.call_args_list)
+
+    @parameterized.expand([
+        (True,  2),
+        (False, 1)
+    ])
+    def test_stop_iterating(self, prefetch, n_pages):
+        fetch_page = self._fetch_page(range(100))
+        listing = catalogue.PagedListing(fetch_page, 5, prefetch)
+
+        for item in listing:
+            if item == 3:
+                break
+
+        # Only the first page (and the prefetched one) is retrieved
+        self.assertEquals(n_pages, fetch_page.call_count)
+
+    def test_pagination_not_supported(self):
+        # The Store returns the whole listing even if a page was requested
+        fetch_page = MagicMock(return_value=range(10))
+        listing = catalogue.PagedListing(fetch_page, 3)
+
+        self.assertEquals(range(10), list(listing))
+        fetch_page.assert_called_once_with(1, 3)
+
+    @parameterized.expand([
+        (True,),
+        (False,)
+    ])
+    def test_pagination_not_supported_page_size(self, prefetch):
+        # The whole listing has exactly the size of a page
+        fetch_page = MagicMock(return_value=range(10))
+        listing = catalogue.PagedListing(fetch_page, 10, prefetch)
+
+        self.assertEquals(range(10), list(listing))
+        self.assertEquals(2, fetch_page.call_count)
+
+    def test_prefetch_error(self):
+        fetch_page = MagicMock(side_effect=[[1, 2], Exception('Store down')])
+        listing = catalogue.PagedListing(fetch_page, 2)
+        iterator = iter(listing)
+
+        self.assertEquals(1, next(iterator))
+        self.assertEquals(2, next(iterator))
+        # Errors retrieving the next page are raised when it is reached
+        self.assertRaises(Exception, next, iterator)
+
+    def test_prefetch_threads(self):
+        fetch_page = self._fetch_page(range(4))
+        list(catalogue.PagedListing(fetch_page, 2))
+
+        # The pages after the first one are retrieved in background
+        self.assertEquals(2, catalogue.threading.Thread.call_count)
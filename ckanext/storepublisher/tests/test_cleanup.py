@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.cleanup as cleanup
+
+import unittest
+
+from ckanext.storepublisher.identity import IdentityUnavailable, StoreIdentity
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+
+class DeletionCoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+
+        # Mocks
+        self.user = 'smg'
+        self._StoreIdentity = cleanup.StoreIdentity
+        cleanup.StoreIdentity = MagicMock()
+        cleanup.StoreIdentity.from_request.side_effect = lambda: StoreIdentity(self.user, {'access_token': self.user})
+
+        self._threading = cleanup.threading
+        cleanup.threading = MagicMock()
+        cleanup.threading.Lock = self._threading.Lock
+
+        self.connectors = [MagicMock(), MagicMock()]
+        for connector in self.connectors:
+            connector.batch_delete_attached_resources.return_value = []
+            connector.with_identity.return_value = connector
+
+        self.instance = cleanup.DeletionCoalescer(self.connectors, {'ckan.storepublisher.delete_window': '5'})
+
+    def tearDown(self):
+        cleanup.StoreIdentity = self._StoreIdentity
+        cleanup.threading = self._threading
+
+    def test_init(self):
+        self.assertEquals(5.0, self.instance.delete_window)
+        self.assertEquals(2.0, cleanup.DeletionCoalescer([], {}).delete_window)
+
+    def test_dataset_deleted(self):
+        for i in range(3):
+            self.instance.dataset_deleted({'id': 'dataset%d' % i})
+
+        # Only one flush is scheduled per window
+        cleanup.threading.Timer.assert_called_once_with(5.0, self.instance._flush, args=('smg',))
+        timer = cleanup.threading.Timer.return_value
+        self.assertTrue(timer.daemon)
+        timer.start.assert_called_once_with()
+        self.assertEquals(3, self.instance.pending_deletions)
+        for connector in self.connectors:
+            self.assertEquals(0, connector.batch_delete_attached_resources.call_count)
+
+        # All the datasets are deleted at once in each Store
+        self.instance._flush('smg')
+
+        for connector in self.connectors:
+            datasets = connector.batch_delete_attached_resources.call_args[0][0]
+            self.assertEquals(['dataset0', 'dataset1', 'dataset2'], sorted(dataset['id'] for dataset in datasets))
+        self.assertEquals(0, self.instance.pending_deletions)
+
+        # A new window is started after flushing
+        self.instance.dataset_deleted({'id': 'dataset3'})
+        self.assertEquals(2, cleanup.threading.Timer.call_count)
+
+    def test_dataset_deleted_several_users(self):
+        self.instance.dataset_deleted({'id': 'dataset1'})
+        self.user = 'aitor'
+        self.instance.dataset_deleted({'id': 'dataset2'})
+
+        # The resources of each user are deleted with their own credentials
+        self.assertEquals([((5.0, self.instance._flush), {'args': ('smg',)}),
+                           ((5.0, self.instance._flush), {'args': ('aitor',)})],
+                          cleanup.threading.Timer.call_args_list)
+
+        self.instance._flush('aitor')
+        self.connectors[0].batch_delete_attached_resources.assert_called_once_with([{'id': 'dataset2'}])
+        self.assertEquals(1, self.instance.pending_deletions)
+        identity = self.connectors[0].with_identity.call_args[0][0]
+        self.assertEquals(('aitor', {'access_token': 'aitor'}), (identity.user, identity.token))
+
+    def test_dataset_deleted_identity(self):
+        # Datasets can be deleted on behalf of a given user (e.g. in background jobs)
+        identity = StoreIdentity('aitor', {'access_token': 'token'})
+        self.instance.dataset_deleted({'id': 'dataset1'}, identity)
+
+        cleanup.threading.Timer.assert_called_once_with(5.0, self.instance._flush, args=('aitor',))
+        self.assertEquals(0, cleanup.StoreIdentity.from_request.call_count)
+
+        self.instance._flush('aitor')
+        for connector in self.connectors:
+            connector.with_identity.assert_called_once_with(identity)
+            connector.batch_delete_attached_resources.assert_called_once_with([{'id': 'dataset1'}])
+
+    def test_dataset_deleted_without_request(self):
+        cleanup.StoreIdentity.from_request.side_effect = IdentityUnavailable('No request')
+
+        self.instance.dataset_deleted({'id': 'dataset1'})
+
+        # Nobody can delete the resources
+        self.assertEquals({}, self.instance._pending)
+        self.assertEquals(0, cleanup.threading.Timer.call_count)
+
+    def test_dataset_deleted_without_window(self):
+        instance = cleanup.DeletionCoalescer(self.connectors, {'ckan.storepublisher.delete_window': '0'})
+        instance.dataset_deleted({'id': 'dataset1'})
+
+        self.assertEquals(0, cleanup.threading.Timer.call_count)
+        for connector in self.connectors:
+            connector.batch_delete_attached_resources.assert_called_once_with([{'id': 'dataset1'}])
+
+    @parameterized.expand([
+        (Exception('Unreachable'),),
+        ([({'name': 'resource1'}, None), ({'name': 'resource2'}, Exception('Not found'))],)
+    ])
+    def test_flush_errors(self, first_result):
+        if isinstance(first_result, Exception):
+            self.connectors[0].batch_delete_attached_resources.side_effect = first_result
+        else:
+            self.connectors[0].batch_delete_attached_resources.return_value = first_result
+
+        self.instance.dataset_deleted({'id': 'dataset1'})
+        self.instance._flush('smg')
+
+        # Errors in one Store do not affect the other ones
+        self.connectors[1].batch_delete_attached_resources.assert_called_once_with([{'id': 'dataset1'}])
+
+    def test_flush_nothing_pending(self):
+        self.instance._flush('smg')
+        for connector in self.connectors:
+            self.assertEquals(0, connector.batch_delete_attached_resources.call_count)
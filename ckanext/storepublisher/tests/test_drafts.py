@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.drafts as drafts
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+from StringIO import StringIO
+
+USER = 'smg'
+PACKAGE_ID = 'package_id'
+
+
+class DraftStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self._db = drafts.db
+        drafts.db = MagicMock()
+
+        self._model = drafts.model
+        drafts.model = MagicMock()
+        drafts.model.Session.query.return_value.filter.return_value.all.return_value = []
+
+        self.images_dir = tempfile.mkdtemp()
+        self.instance = drafts.DraftStore({'ckan.storepublisher.drafts_dir': self.images_dir})
+
+    def tearDown(self):
+        drafts.db = self._db
+        drafts.model = self._model
+        shutil.rmtree(self.images_dir)
+
+    def _check_get(self):
+        drafts.db.init_db.assert_called_with(drafts.model)
+        drafts.db.PublishDraft.get.assert_called_with(user_name=USER, package_id=PACKAGE_ID)
+
+    @parameterized.expand([
+        ({}, os.path.join(tempfile.gettempdir(), 'storepublisher_drafts'), 3600),
+        ({'ckan.storage_path': '/var/lib/ckan'}, '/var/lib/ckan/storepublisher/drafts', 3600),
+        ({'ckan.storepublisher.drafts_dir': '/tmp/drafts', 'ckan.storepublisher.draft_ttl': '60'}, '/tmp/drafts', 60)
+    ])
+    def test_init(self, config, images_dir, ttl):
+        instance = drafts.DraftStore(config)
+        self.assertEquals(images_dir, instance.images_dir)
+        self.assertEquals(ttl, instance.ttl)
+
+    @parameterized.expand([
+        (None,       False),
+        ('image_ref', False),
+        ('image_ref', True)
+    ])
+    def test_load(self, image, expired):
+        fields = {'name': 'a', 'version': '1.0'}
+        delta = datetime.timedelta(seconds=-10 if expired else 10)
+        entry = MagicMock(fields=json.dumps(fields), image=image, expires=datetime.datetime.utcnow() + delta)
+        drafts.db.PublishDraft.get.return_value = entry
+
+        draft = self.instance.load(USER, PACKAGE_ID)
+
+        self._check_get()
+        if expired:
+            self.assertIsNone(draft)
+            drafts.model.Session.delete.assert_called_once_with(entry)
+        else:
+            self.assertEquals({'fields': fields, 'image': image}, draft)
+            self.assertEquals(0, drafts.model.Session.delete.call_count)
+
+    def test_load_not_found(self):
+        drafts.db.PublishDraft.get.return_value = None
+        self.assertIsNone(self.instance.load(USER, PACKAGE_ID))
+        self._check_get()
+
+    @parameterized.expand([
+        (True,  None),
+        (True,  'image_ref'),
+        (False, None),
+    ])
+    def test_save(self, exists, image_ref):
+        entry = MagicMock(image=None)
+        drafts.db.PublishDraft.get.return_value = entry if exists else None
+        drafts.db.PublishDraft.return_value = entry
+        fields = {'name': 'a'}
+
+        before = datetime.datetime.utcnow()
+        self.instance.save(USER, PACKAGE_ID, fields, image_ref)
+
+        self._check_get()
+        self.assertEquals(json.dumps(fields), entry.fields)
+        self.assertEquals(image_ref, entry.image)
+        self.assertTrue(entry.expires >= before + datetime.timedelta(seconds=self.instance.ttl))
+        if exists:
+            self.assertEquals(0, drafts.model.Session.add.call_count)
+        else:
+            self.assertEquals((USER, PACKAGE_ID), (entry.user_name, entry.package_id))
+            drafts.model.Session.add.assert_called_once_with(entry)
+        drafts.model.Session.commit.assert_called_once_with()
+
+    def test_save_replaces_image(self):
+        old_ref = self.instance.save_image(StringIO('old'))
+        drafts.db.PublishDraft.get.return_value = MagicMock(image=old_ref)
+
+        self.instance.save(USER, PACKAGE_ID, {}, 'image_ref')
+
+        # The previous image is not needed anymore
+        self.assertFalse(os.path.exists(os.path.join(self.images_dir, old_ref)))
+
+    @parameterized.expand([
+        (True,),
+        (False,)
+    ])
+    def test_delete(self, exists):
+        image_ref = self.instance.save_image(StringIO('image'))
+        entry = MagicMock(image=image_ref)
+        drafts.db.PublishDraft.get.return_value = entry if exists else None
+
+        self.instance.delete(USER, PACKAGE_ID)
+
+        self._check_get()
+        if exists:
+            drafts.model.Session.delete.assert_called_once_with(entry)
+            drafts.model.Session.commit.assert_called_once_with()
+            self.assertFalse(os.path.exists(os.path.join(self.images_dir, image_ref)))
+        else:
+            self.assertEquals(0, drafts.model.Session.delete.call_count)
+
+    def test_purge_expired(self):
+        image_ref = self.instance.save_image(StringIO('image'))
+        expired = [MagicMock(image=image_ref), MagicMock(image=None)]
+        drafts.model.Session.query.return_value.filter.return_value.all.return_value = expired
+
+        self.instance.purge_expired()
+
+        drafts.model.Session.query.assert_called_once_with(drafts.db.PublishDraft)
+        self.assertEquals([((entry,),) for entry in expired], drafts.model.Session.delete.call_args_list)
+        drafts.model.Session.commit.assert_called_once_with()
+        self.assertEquals([], os.listdir(self.images_dir))
+
+    def test_save_and_open_image(self):
+        content = 'a' * (1024 * 1024)
+        fileobj = StringIO(content)
+        fileobj.read(10)
+
+        image_ref = self.instance.save_image(fileobj)
+
+        # The whole file is copied even if it has been read before
+        image_file = self.instance.open_image(image_ref)
+        try:
+            self.assertEquals(content, image_file.read())
+        finally:
+            image_file.close()
+
+    @parameterized.expand([
+        ('0123456789abcdef0123456789abcdef',),
+        ('../../etc/passwd',)
+    ])
+    def test_open_image_not_found(self, image_ref):
+        self.assertIsNone(self.instance.open_image(image_ref))
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.health as health
+import unittest
+
+from collections import OrderedDict
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+
+class HealthMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self._threading = health.threading
+        health.threading = MagicMock()
+
+        self.store_connector = MagicMock()
+        self.store_connector.connectors = OrderedDict([('eu', MagicMock()), ('us', MagicMock())])
+        self.instance = health.HealthMonitor(self.store_connector, {'ckan.storepublisher.health_interval': '10'})
+
+    def tearDown(self):
+        health.threading = self._threading
+
+    def test_init(self):
+        self.assertEquals(10.0, self.instance.interval)
+
+        # Stores are not checked until the monitor is started
+        self.assertEquals(0, self.store_connector.probe.call_count)
+        self.assertEquals(0, health.threading.Thread.call_count)
+
+    def test_start(self):
+        self.instance.start()
+        self.instance.start()
+
+        # Only one thread is started
+        health.threading.Thread.assert_called_once_with(target=self.instance._run, name='storepublisher-health')
+        thread = health.threading.Thread.return_value
+        self.assertTrue(thread.daemon)
+        thread.start.assert_called_once_with()
+
+    def test_get_status_not_checked(self):
+        status = self.instance.get_status()
+
+        self.assertTrue(status['healthy'])
+        self.assertEquals(10.0, status['interval'])
+        self.assertEquals([{'name': 'eu', 'reachable': None, 'latency': None, 'checked': None, 'error': None},
+                           {'name': 'us', 'reachable': None, 'latency': None, 'checked': None, 'error': None}],
+                          status['stores'])
+        self.assertTrue(self.instance.is_available())
+        # The status is not checked when it is requested
+        self.assertEquals(0, self.store_connector.probe.call_count)
+
+    @parameterized.expand([
+        ((0.1234, None),      (0.2, None),                 True,  True),
+        ((0.1234, None),      (None, Exception('Down')),   False, True),
+        ((None, Exception()), (None, Exception('Down')),   False, False)
+    ])
+    def test_check(self, eu_result, us_result, healthy, available):
+        self.store_connector.probe.return_value = OrderedDict([('eu', eu_result), ('us', us_result)])
+
+        self.instance.check()
+        status = self.instance.get_status()
+
+        self.assertEquals(healthy, status['healthy'])
+        self.assertEquals(available, self.instance.is_available())
+        us_status = status['stores'][1]
+        self.assertEquals(us_result[1] is None, us_status['reachable'])
+        self.assertIsNotNone(us_status['checked'])
+        if us_result[1] is None:
+            self.assertEquals((200.0, None), (us_status['latency'], us_status['error']))
+        else:
+            self.assertEquals((None, 'Down'), (us_status['latency'], us_status['error']))
+        if eu_result[1] is None:
+            self.assertEquals(123.4, status['stores'][0]['latency'])
+
+    def test_get_health_monitor(self):
+        self._MultiStoreConnector = health.MultiStoreConnector
+        health.MultiStoreConnector = MagicMock()
+        health.MultiStoreConnector.return_value.connectors = {}
+        health._monitor = None
+        try:
+            config = {'ckan.storepublisher.health_interval': '5'}
+            monitor = health.get_health_monitor(config)
+
+            # The same monitor is used by all the requests of the process
+            self.assertIs(monitor, health.get_health_monitor(config))
+            health.MultiStoreConnector.assert_called_once_with(config)
+            self.assertEquals(5.0, monitor.interval)
+            health.threading.Thread.return_value.start.assert_called_once_with()
+        finally:
+            health.MultiStoreConnector = self._MultiStoreConnector
+            health._monitor = None
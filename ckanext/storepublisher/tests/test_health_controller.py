@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.controllers.health_controller as controller
+import json
+import unittest
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+
+class HealthControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._toolkit = controller.plugins.toolkit
+        controller.plugins.toolkit = MagicMock()
+
+        self._response = controller.response
+        controller.response = MagicMock()
+        controller.response.headers = {}
+
+        self._config = controller.config
+        controller.config = {}
+
+        self.instanceController = controller.HealthController()
+
+    def tearDown(self):
+        controller.plugins.toolkit = self._toolkit
+        controller.response = self._response
+        controller.config = self._config
+
+    @parameterized.expand([
+        ({},                                                         False),
+        ({'ckan.storepublisher.health_fail_unavailable': 'True'},    True),
+        ({'ckan.storepublisher.health_fail_unavailable': 'false'},   False)
+    ])
+    def test_init(self, config, fail_unavailable):
+        controller.config = config
+        self.assertEquals(fail_unavailable, controller.HealthController().fail_unavailable)
+
+    @parameterized.expand([
+        (True,  False, 200),
+        (False, False, 200),
+        (True,  True,  200),
+        (False, True,  503)
+    ])
+    def test_health(self, healthy, fail_unavailable, status_code):
+        self.instanceController.fail_unavailable = fail_unavailable
+        status = {'healthy': healthy, 'interval': 30.0, 'stores': []}
+        action = controller.plugins.toolkit.get_action.return_value
+        action.return_value = status
+
+        result = self.instanceController.health()
+
+        controller.plugins.toolkit.get_action.assert_called_once_with('storepublisher_health')
+        self.assertEquals(status, json.loads(result))
+        self.assertEquals(status_code, controller.response.status_int)
+        self.assertEquals('application/json;charset=utf-8', controller.response.headers['Content-Type'])
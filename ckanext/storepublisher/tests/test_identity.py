@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.identity as identity
+import json
+import unittest
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+TOKEN = {'token_type': 'bearer', 'access_token': 'access_token', 'refresh_token': 'refresh_token'}
+NEW_TOKEN = {'token_type': 'bearer', 'access_token': 'new_access_token', 'refresh_token': 'new_refresh_token'}
+
+
+class StoreIdentityTest(unittest.TestCase):
+
+    def setUp(self):
+        self._toolkit = identity.plugins.toolkit
+        identity.plugins.toolkit = MagicMock()
+
+    def tearDown(self):
+        identity.plugins.toolkit = self._toolkit
+
+    def test_refresh(self):
+        refresh_token = MagicMock(return_value=NEW_TOKEN)
+        instance = identity.StoreIdentity('smg', TOKEN, refresh_token)
+
+        instance.refresh()
+
+        refresh_token.assert_called_once_with()
+        self.assertEquals(NEW_TOKEN, instance.token)
+
+    def test_refresh_not_available(self):
+        instance = identity.StoreIdentity('smg', TOKEN)
+
+        self.assertRaises(ValueError, instance.refresh)
+        self.assertEquals(TOKEN, instance.token)
+
+    def test_serialize(self):
+        instance = identity.StoreIdentity('smg', TOKEN, MagicMock())
+
+        data = json.loads(json.dumps(instance.to_dict()))
+        refresh_token = MagicMock(return_value=NEW_TOKEN)
+        restored = identity.StoreIdentity.from_dict(data, refresh_token)
+
+        self.assertEquals(('smg', TOKEN), (restored.user, restored.token))
+        restored.refresh()
+        self.assertEquals(NEW_TOKEN, restored.token)
+
+    def test_from_request(self):
+        c = identity.plugins.toolkit.c
+        c.user = 'smg'
+        c.usertoken = TOKEN
+
+        def _usertoken_refresh():
+            c.usertoken = NEW_TOKEN
+        c.usertoken_refresh.side_effect = _usertoken_refresh
+
+        instance = identity.StoreIdentity.from_request()
+
+        self.assertEquals(('smg', TOKEN), (instance.user, instance.token))
+        self.assertEquals(0, c.usertoken_refresh.call_count)
+
+        # The token is refreshed within the context of the request that created the identity
+        instance.refresh()
+
+        c.usertoken_refresh.assert_called_once_with()
+        self.assertEquals(NEW_TOKEN, instance.token)
+        c._push_object.assert_called_once_with(c._current_obj.return_value)
+        c._pop_object.assert_called_once_with(c._current_obj.return_value)
+
+    def test_from_request_not_registered(self):
+        c = identity.plugins.toolkit.c
+        c.user = 'smg'
+        c._current_obj.side_effect = TypeError('No object registered')
+
+        self.assertRaises(identity.IdentityUnavailable, identity.StoreIdentity.from_request)
+
+    @parameterized.expand([
+        ('',    TOKEN),
+        ('smg', ''),
+        ('smg', None)
+    ])
+    def test_from_request_no_token(self, user, token):
+        c = identity.plugins.toolkit.c
+        c.user = user
+        c.usertoken = token
+
+        self.assertRaises(identity.IdentityUnavailable, identity.StoreIdentity.from_request)
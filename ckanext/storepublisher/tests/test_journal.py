@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.journal as journal
+
+import json
+import unittest
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+KEY = ('default', 'smg', 'package_id', 'Offering 1', '1.0')
+
+
+class SagaJournalTest(unittest.TestCase):
+
+    def test_new_journal(self):
+        saga = journal.SagaJournal(KEY)
+
+        self.assertEquals(KEY, saga.key)
+        self.assertEquals(list(journal.STEPS), saga.steps.keys())
+        self.assertFalse(saga.completed)
+        self.assertEquals(journal.RESOURCE_STEP, saga.next_step)
+
+    @parameterized.expand([
+        (0, journal.RESOURCE_STEP),
+        (1, journal.OFFERING_STEP),
+        (2, journal.TAG_STEP),
+        (3, journal.PUBLISH_STEP),
+        (4, None)
+    ])
+    def test_complete(self, n_steps, next_step):
+        saga = journal.SagaJournal(KEY)
+        for step in journal.STEPS[:n_steps]:
+            saga.complete(step, {'step': step})
+
+        for step in journal.STEPS[:n_steps]:
+            self.assertTrue(saga.is_completed(step))
+            self.assertEquals({'step': step}, saga.get_result(step))
+
+        self.assertEquals(next_step, saga.next_step)
+        self.assertEquals(next_step is None, saga.completed)
+
+    def test_fail(self):
+        saga = journal.SagaJournal(KEY)
+        saga.complete(journal.RESOURCE_STEP, 'resource')
+        saga.fail(journal.OFFERING_STEP, 'Timeout')
+
+        self.assertFalse(saga.is_completed(journal.OFFERING_STEP))
+        self.assertEquals(journal.OFFERING_STEP, saga.next_step)
+        self.assertEquals({'status': journal.FAILED, 'error': 'Timeout'}, saga.steps[journal.OFFERING_STEP])
+
+
+class JournalStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self._db = journal.db
+        journal.db = MagicMock()
+
+        self._model = journal.model
+        journal.model = MagicMock()
+
+        self.instance = journal.JournalStore()
+
+    def tearDown(self):
+        journal.db = self._db
+        journal.model = self._model
+
+    def _check_get(self):
+        journal.db.init_db.assert_called_with(journal.model)
+        journal.db.PublishJournal.get.assert_called_with(store=KEY[0], user_name=KEY[1], package_id=KEY[2],
+                                                         offering_name=KEY[3], offering_version=KEY[4])
+
+    def test_load(self):
+        saga = journal.SagaJournal(KEY)
+        saga.complete(journal.RESOURCE_STEP, {'name': 'resource'})
+        journal.db.PublishJournal.get.return_value = MagicMock(steps=json.dumps(saga.steps))
+
+        loaded = self.instance.load(KEY)
+
+        self._check_get()
+        self.assertEquals(KEY, loaded.key)
+        self.assertEquals(saga.steps, loaded.steps)
+        self.assertEquals(list(journal.STEPS), loaded.steps.keys())
+
+    def test_load_not_found(self):
+        journal.db.PublishJournal.get.return_value = None
+        self.assertIsNone(self.instance.load(KEY))
+        self._check_get()
+
+    @parameterized.expand([
+        (True,),
+        (False,)
+    ])
+    def test_save(self, exists):
+        entry = MagicMock()
+        journal.db.PublishJournal.get.return_value = entry if exists else None
+        journal.db.PublishJournal.return_value = entry
+        saga = journal.SagaJournal(KEY)
+
+        self.instance.save(saga)
+
+        self._check_get()
+        self.assertEquals(json.dumps(saga.steps), entry.steps)
+        if exists:
+            self.assertEquals(0, journal.model.Session.add.call_count)
+        else:
+            self.assertEquals(KEY, (entry.store, entry.user_name, entry.package_id, entry.offering_name, entry.offering_version))
+            journal.model.Session.add.assert_called_once_with(entry)
+        journal.model.Session.commit.assert_called_once_with()
+
+    @parameterized.expand([
+        (True,),
+        (False,)
+    ])
+    def test_delete(self, exists):
+        entry = MagicMock()
+        journal.db.PublishJournal.get.return_value = entry if exists else None
+
+        self.instance.delete(KEY)
+
+        self._check_get()
+        if exists:
+            journal.model.Session.delete.assert_called_once_with(entry)
+            journal.model.Session.commit.assert_called_once_with()
+        else:
+            self.assertEquals(0, journal.model.Session.delete.call_count)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.locks as locks
+import threading
+import unittest
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+
+class DatasetLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self._model = locks.model
+        locks.model = MagicMock()
+        locks.model.meta.engine.dialect.name = 'sqlite'
+
+        self.instance = locks.DatasetLock({'ckan.storepublisher.publish_lock_timeout': '0'})
+
+    def tearDown(self):
+        locks.model = self._model
+
+    def _hold_in_thread(self):
+        result = {}
+
+        def _hold():
+            try:
+                with self.instance.hold('eu', 'package_id'):
+                    result['held'] = True
+            except locks.LockTimeout:
+                result['held'] = False
+
+        thread = threading.Thread(target=_hold)
+        thread.start()
+        thread.join()
+        return result['held']
+
+    def test_default_timeout(self):
+        self.assertEquals(120, locks.DatasetLock({}).timeout)
+
+    def test_get_lock_id(self):
+        lock_id = locks._get_lock_id(u'storepublisher:eu:package_id')
+        self.assertEquals(lock_id, locks._get_lock_id(u'storepublisher:eu:package_id'))
+        self.assertNotEquals(lock_id, locks._get_lock_id(u'storepublisher:us:package_id'))
+        self.assertTrue(-2 ** 63 <= lock_id < 2 ** 63)
+
+    def test_hold_process(self):
+        with self.instance.hold('eu', 'package_id'):
+            # Other threads cannot get the lock of the dataset
+            self.assertFalse(self._hold_in_thread())
+
+        # The lock is released after the block
+        self.assertTrue(self._hold_in_thread())
+        self.assertEquals(0, locks.model.meta.engine.connect.call_count)
+        self.assertEquals({}, locks._local_locks)
+
+    def test_hold_other_datasets(self):
+        with self.instance.hold('eu', 'package_id'):
+            # Other datasets and Stores are not blocked
+            for store, package_id in [('eu', 'other_id'), ('us', 'package_id')]:
+                with self.instance.hold(store, package_id):
+                    pass
+
+        self.assertEquals({}, locks._local_locks)
+
+    def test_hold_released_on_error(self):
+        def _fail():
+            with self.instance.hold('eu', 'package_id'):
+                raise ValueError('Error')
+
+        self.assertRaises(ValueError, _fail)
+        self.assertTrue(self._hold_in_thread())
+
+    def test_hold_timeout(self):
+        with self.instance.hold('eu', 'package_id'):
+            self.assertFalse(self._hold_in_thread())
+            # The lock is kept while it is held
+            self.assertEquals(1, locks._local_locks[u'storepublisher:eu:package_id'][1])
+
+        self.assertEquals({}, locks._local_locks)
+
+    @parameterized.expand([
+        (True,),
+        (False,)
+    ])
+    def test_hold_postgresql(self, acquired):
+        locks.model.meta.engine.dialect.name = 'postgresql'
+        connection = locks.model.meta.engine.connect.return_value
+        connection.execute.return_value.scalar.return_value = acquired
+        lock_id = locks._get_lock_id(u'storepublisher:eu:package_id')
+        executed = []
+
+        def _hold():
+            with self.instance.hold('eu', 'package_id'):
+                executed.append(True)
+
+        if acquired:
+            _hold()
+            self.assertEquals([True], executed)
+            self.assertEquals('SELECT pg_try_advisory_lock(%s)' % lock_id, connection.execute.call_args_list[0][0][0])
+            connection.execute.assert_called_with('SELECT pg_advisory_unlock(%s)' % lock_id)
+        else:
+            # Another process holds the lock
+            self.assertRaises(locks.LockTimeout, _hold)
+            self.assertEquals([], executed)
+            self.assertEquals(1, connection.execute.call_count)
+
+        connection.close.assert_called_once_with()
+        # The lock of the process is always released
+        locks.model.meta.engine.dialect.name = 'sqlite'
+        self.assertTrue(self._hold_in_thread())
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.mirror as mirror
+import datetime
+import unittest
+
+from collections import OrderedDict
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+BASE_SITE_URL = 'https://localhost:8474'
+BASE_STORE_URL = 'https://store.example.com:7458'
+NOW = datetime.datetime(2015, 3, 10, 12)
+
+
+def _offering(name, publication_date, dataset_ids, price=0.0):
+    return {
+        'name': name,
+        'version': '1.0',
+        'owner_organization': 'smg',
+        'state': 'published',
+        'publication_date': publication_date,
+        'price': price,
+        'resources': [{'name': 'resource %s' % dataset_id, 'link': '%s/dataset/%s' % (BASE_SITE_URL, dataset_id)}
+                      for dataset_id in dataset_ids]
+    }
+
+
+class OfferingMirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self._db = mirror.db
+        mirror.db = MagicMock()
+        self._model = mirror.model
+        mirror.model = MagicMock()
+        self._threading = mirror.threading
+        mirror.threading = MagicMock()
+        self._datetime = mirror.datetime
+        mirror.datetime = MagicMock()
+        mirror.datetime.datetime.utcnow.return_value = NOW
+        mirror.datetime.datetime.strptime = datetime.datetime.strptime
+
+        # Entries are kept in a dict so the calls can be checked easily
+        self.entries = {}
+
+        def _get_entry(**kw):
+            return self.entries.get((kw['package_id'], kw['name']))
+        mirror.db.MirroredOffering.get.side_effect = _get_entry
+        mirror.db.MirroredOffering.side_effect = lambda: MagicMock()
+
+        def _add(entry):
+            if entry is not self.state:
+                self.entries[(entry.package_id, entry.name)] = entry
+        mirror.model.Session.add.side_effect = _add
+        self.state = MagicMock(store='eu', watermark=None, synced=None, full_synced=None)
+        mirror.db.MirrorSync.get.return_value = self.state
+
+        self.connector = MagicMock(store_url=BASE_STORE_URL)
+        self.connector.with_identity.return_value = self.connector
+        self.connector._get_dataset_url.side_effect = lambda dataset: '%s/dataset/%s' % (BASE_SITE_URL, dataset['id'])
+        self.connector._get_offering_info.side_effect = lambda offering: {'price': offering['price']}
+        self.store_connector = MagicMock()
+        self.store_connector.connectors = OrderedDict([('eu', self.connector)])
+
+        self.instance = mirror.OfferingMirror(self.store_connector, {'ckan.storepublisher.mirror_interval': '60',
+                                                                     'ckan.storepublisher.mirror_token': 'token'})
+        self.identity = self.instance._identity
+
+    def tearDown(self):
+        mirror.db = self._db
+        mirror.model = self._model
+        mirror.threading = self._threading
+        mirror.datetime = self._datetime
+
+    def test_init(self):
+        self.assertEquals(60.0, self.instance.interval)
+        self.assertEquals(3600.0, self.instance.full_sync_interval)
+        self.assertEquals(('storepublisher', {'access_token': 'token', 'token_type': 'Bearer'}),
+                          (self.identity.user, self.identity.token))
+        self.assertEquals('mirror', mirror.OfferingMirror(self.store_connector, {'ckan.storepublisher.mirror_token': 'token',
+                                                                                'ckan.storepublisher.mirror_user': 'mirror'})._identity.user)
+
+        # Offerings are not synchronized until the mirror is started
+        self.assertEquals(0, mirror.threading.Thread.call_count)
+
+    def test_start(self):
+        self.instance.start()
+        self.instance.start()
+
+        # Only one thread is started
+        mirror.threading.Thread.assert_called_once_with(target=self.instance._run, name='storepublisher-mirror')
+        thread = mirror.threading.Thread.return_value
+        self.assertTrue(thread.daemon)
+        thread.start.assert_called_once_with()
+
+    @parameterized.expand([
+        ('2015-03-10T10:20:30.123000Z', datetime.datetime(2015, 3, 10, 10, 20, 30, 123000)),
+        ('2015-03-10T10:20:30+00:00',   datetime.datetime(2015, 3, 10, 10, 20, 30)),
+        ('2015-03-10 10:20:30.123000',  datetime.datetime(2015, 3, 10, 10, 20, 30, 123000)),
+        ('2015-03-10 10:20:30',         datetime.datetime(2015, 3, 10, 10, 20, 30)),
+        ('invalid',                     None),
+        (None,                          None)
+    ])
+    def test_parse_date(self, value, expected):
+        self.assertEquals(expected, mirror._parse_date(value))
+
+    def test_no_token(self):
+        instance = mirror.OfferingMirror(self.store_connector, {})
+
+        instance.start()
+        instance.sync()
+
+        # The Stores are not contacted without the token of the service account
+        self.assertIsNone(instance._identity)
+        self.assertEquals(0, mirror.threading.Thread.call_count)
+        self.assertEquals(0, self.connector._get_offerings.call_count)
+
+    def test_sync_full(self):
+        old_entry = MagicMock(package_id='c', owner='smg', version='1.0')
+        old_entry.name = 'offering 3'
+        mirror.model.Session.query.return_value.filter_by.return_value.all.return_value = [old_entry]
+        self.connector._get_offerings.return_value = [
+            _offering('offering 2', '2015-03-10 10:00:00', ['b'], 2.5),
+            _offering('offering 1', '2015-03-09 10:00:00', ['a', 'b']),
+            dict(_offering('external', '2015-03-08 10:00:00', []), resources=[{'name': 'other', 'link': 'http://example.com/data'}])
+        ]
+
+        self.instance.sync()
+
+        self.connector.with_identity.assert_called_once_with(self.identity)
+        self.connector._get_offerings.assert_called_once_with('published', sort='date')
+
+        # Each dataset of the offering is mirrored. Resources that are not datasets of this instance are ignored
+        self.assertEquals([('a', 'offering 1'), ('b', 'offering 1'), ('b', 'offering 2')], sorted(self.entries.keys()))
+        entry = self.entries[('b', 'offering 2')]
+        self.assertEquals(('eu', 'smg', '1.0', 'published', 2.5, BASE_STORE_URL + '/offering/smg/offering%202/1.0',
+                           'resource b', BASE_SITE_URL + '/dataset/b', datetime.datetime(2015, 3, 10, 10), NOW),
+                          (entry.store, entry.owner, entry.version, entry.state, entry.price, entry.offering_url,
+                           entry.resource_name, entry.resource_link, entry.published, entry.synced))
+
+        # Offerings that are not published anymore are forgotten
+        mirror.model.Session.delete.assert_called_once_with(old_entry)
+        self.assertEquals((datetime.datetime(2015, 3, 10, 10), NOW, NOW),
+                          (self.state.watermark, self.state.synced, self.state.full_synced))
+        mirror.model.Session.commit.assert_called_once_with()
+
+    def test_sync_incremental(self):
+        self.state.watermark = datetime.datetime(2015, 3, 9, 10)
+        self.state.synced = self.state.full_synced = NOW - datetime.timedelta(seconds=120)
+        consumed = []
+
+        def _get_offerings(offerings_filter, sort):
+            for offering in [_offering('offering 3', '2015-03-10 11:00:00', ['c']),
+                             _offering('offering 2', '2015-03-10 10:00:00', ['b']),
+                             _offering('offering 1', '2015-03-09 10:00:00', ['a']),
+                             _offering('offering 0', '2015-03-08 10:00:00', ['a'])]:
+                consumed.append(offering['name'])
+                yield offering
+        self.connector._get_offerings.side_effect = _get_offerings
+
+        self.instance.sync()
+
+        # Offerings are not read once the watermark is reached
+        self.assertEquals(['offering 3', 'offering 2', 'offering 1'], consumed)
+        self.assertEquals([('b', 'offering 2'), ('c', 'offering 3')], sorted(self.entries.keys()))
+        self.assertEquals(0, mirror.model.Session.delete.call_count)
+        self.assertEquals(datetime.datetime(2015, 3, 10, 11), self.state.watermark)
+        self.assertEquals(NOW - datetime.timedelta(seconds=120), self.state.full_synced)
+
+    def test_sync_update(self):
+        entry = MagicMock(package_id='a', price=1.0)
+        entry.name = 'offering 1'
+        self.entries[('a', 'offering 1')] = entry
+        self.connector._get_offerings.return_value = [_offering('offering 1', '2015-03-09 10:00:00', ['a'], 3.0)]
+        mirror.model.Session.query.return_value.filter_by.return_value.all.return_value = [entry]
+
+        self.instance.sync()
+
+        self.assertEquals(3.0, entry.price)
+        self.assertEquals(0, mirror.db.MirroredOffering.call_count)
+        self.assertEquals(0, mirror.model.Session.delete.call_count)
+
+    def test_sync_recently(self):
+        # Other process synchronized the Store
+        self.state.synced = NOW - datetime.timedelta(seconds=30)
+
+        self.instance.sync()
+
+        self.assertEquals(0, self.connector._get_offerings.call_count)
+        self.assertEquals(0, mirror.model.Session.commit.call_count)
+
+    def test_sync_new_store(self):
+        mirror.db.MirrorSync.get.return_value = None
+        mirror.db.MirrorSync.return_value = self.state
+        self.connector._get_offerings.return_value = []
+
+        self.instance.sync()
+
+        mirror.model.Session.add.assert_called_once_with(self.state)
+        self.assertEquals('eu', self.state.store)
+        self.assertEquals(NOW, self.state.full_synced)
+
+    def test_sync_error(self):
+        us_connector = MagicMock()
+        us_connector.with_identity.return_value = us_connector
+        self.store_connector.connectors['us'] = us_connector
+        self.connector._get_offerings.side_effect = Exception('Store down')
+        us_connector._get_offerings.return_value = []
+
+        self.instance.sync()
+
+        # The rest of the Stores are synchronized
+        mirror.model.Session.rollback.assert_called_once_with()
+        us_connector._get_offerings.assert_called_once_with('published', sort='date')
+        mirror.model.Session.commit.assert_called_once_with()
+
+    def test_get(self):
+        entries = [
+            MagicMock(store='eu', owner='smg', version='1.0', price=2.5, state='published',
+                      offering_url='http://store/offering', resource_name='resource',
+                      published=datetime.datetime(2015, 3, 10, 10)),
+            MagicMock(state='deleted')
+        ]
+        entries[0].name = 'offering 1'
+        mirror.db.MirroredOffering.get_package_offerings.return_value = entries
+
+        result = self.instance.get('package_id')
+
+        mirror.db.init_db.assert_called_once_with(mirror.model)
+        mirror.db.MirroredOffering.get_package_offerings.assert_called_once_with('package_id')
+        self.assertEquals([{'store': 'eu', 'owner': 'smg', 'name': 'offering 1', 'version': '1.0', 'price': 2.5,
+                            'offering_url': 'http://store/offering', 'resource_name': 'resource',
+                            'published': '2015-03-10T10:00:00'}], result)
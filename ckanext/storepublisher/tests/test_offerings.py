@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.offerings as offerings
+import unittest
+
+from nose_parameterized import parameterized
+
+MISSING_ERROR = 'This filed is required to publish the offering'
+
+
+class OfferingsTest(unittest.TestCase):
+
+    @parameterized.expand([
+        ('',      0.0),
+        (None,    0.0),
+        ('2.5',   2.5),
+        (3,       3.0),
+        ('a',     None),
+        ([],      None)
+    ])
+    def test_parse_price(self, price, expected):
+        if expected is None:
+            self.assertRaises(ValueError, offerings.parse_price, price)
+        else:
+            self.assertEquals(expected, offerings.parse_price(price))
+
+    @parameterized.expand([
+        (False, {'pkg_id': 'id', 'name': 'a', 'version': '1.0', 'price': ''},    {}),
+        (False, {'pkg_id': 'id', 'name': 'a', 'version': '1.0'},                 {}),
+        (True,  {'pkg_id': 'id', 'name': 'a', 'version': '1.0', 'price': '1'},   {}),
+        (False, {'pkg_id': 'id', 'name': 'a', 'version': '1.0', 'price': '1'},
+         {'Price': ['You cannot set a price to a dataset that is public since everyone can access it']}),
+        (False, {'pkg_id': 'id', 'name': 'a', 'version': '1.0', 'price': 'a'},   {'Price': ['"a" is not a valid number']}),
+        (True,  {'pkg_id': 'id', 'name': 'a', 'version': '1.0', 'is_open': True},
+         {'Open': ['Private Datasets cannot be offered as Open Offerings']}),
+        (False, {'pkg_id': 'id', 'name': 'a', 'version': '1.0', 'is_open': True}, {}),
+        (False, {'pkg_id': '', 'name': '', 'version': '1.0'},                    {'Pkg_id': [MISSING_ERROR], 'Name': [MISSING_ERROR]}),
+        (False, {},                                                              {'Pkg_id': [MISSING_ERROR], 'Name': [MISSING_ERROR],
+                                                                                  'Version': [MISSING_ERROR]})
+    ])
+    def test_validate_offering(self, private, offering_info, expected_errors):
+        errors = {}
+
+        result = offerings.validate_offering({'private': private}, offering_info, errors)
+
+        self.assertIs(errors, result)
+        self.assertEquals(expected_errors, errors)
+        if 'Price' not in errors and 'price' in offering_info:
+            self.assertIsInstance(offering_info['price'], float)
+
+    def test_validate_offering_previous_errors(self):
+        errors = {'Store': ['Error']}
+
+        offerings.validate_offering({'private': False}, {'pkg_id': 'id', 'name': 'a', 'version': '1.0'}, errors)
+
+        self.assertEquals({'Store': ['Error']}, errors)
@@ -17,10 +17,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
 
+import ckanext.storepublisher.acquisitions as acquisitions
 import ckanext.storepublisher.plugin as plugin
 
 import unittest
 
+from collections import OrderedDict
 from mock import MagicMock
 from nose_parameterized import parameterized
 
@@ -32,25 +34,91 @@ class PluginTest(unittest.TestCase):
         # Mocks
         self._toolkit = plugin.plugins.toolkit
         plugin.plugins.toolkit = MagicMock()
-        self._StoreConnector = plugin.StoreConnector
+        self._MultiStoreConnector = plugin.MultiStoreConnector
         self._store_connector_instance = MagicMock()
-        plugin.StoreConnector = MagicMock(return_value=self._store_connector_instance)
+        self._store_connector_instance.connectors = OrderedDict([('store1', MagicMock()), (plugin.DEFAULT_STORE, MagicMock())])
+        plugin.MultiStoreConnector = MagicMock(return_value=self._store_connector_instance)
+        self._ResourceSynchronizer = plugin.ResourceSynchronizer
+        self._resource_sync_instances = {}
+
+        def _resource_synchronizer_side_effect(connector, config):
+            self._resource_sync_instances[connector] = MagicMock()
+            return self._resource_sync_instances[connector]
+        plugin.ResourceSynchronizer = MagicMock(side_effect=_resource_synchronizer_side_effect)
+        self._activity = plugin.activity
+        plugin.activity = MagicMock()
+        self._BatchStoreConnector = plugin.BatchStoreConnector
+        plugin.BatchStoreConnector = MagicMock(side_effect=lambda config, store_name: 'batch_%s' % store_name)
+        self._DeletionCoalescer = plugin.DeletionCoalescer
+        self._deletion_coalescer_instance = MagicMock()
+        plugin.DeletionCoalescer = MagicMock(return_value=self._deletion_coalescer_instance)
+        self._PublicationStore = plugin.PublicationStore
+        self._publication_store_instance = MagicMock()
+        plugin.PublicationStore = MagicMock(return_value=self._publication_store_instance)
+        self._OfferingMirror = plugin.OfferingMirror
+        self._offering_mirror_instance = MagicMock()
+        plugin.OfferingMirror = MagicMock(return_value=self._offering_mirror_instance)
+        self._get_bulkhead = plugin.get_bulkhead
+        plugin.get_bulkhead = MagicMock()
+        self._acquisitions_db = acquisitions.db
+        acquisitions.db = MagicMock()
+        self._acquisitions_model = acquisitions.model
+        acquisitions.model = MagicMock()
+        self._DatasetLock = acquisitions.DatasetLock
+        acquisitions.DatasetLock = MagicMock()
 
         # Create the plugin
         self.storePublisher = plugin.StorePublisher()
 
     def tearDown(self):
         plugin.plugins.toolkit = self._toolkit
-        plugin.StoreConnector = self._StoreConnector
+        plugin.MultiStoreConnector = self._MultiStoreConnector
+        plugin.ResourceSynchronizer = self._ResourceSynchronizer
+        plugin.activity = self._activity
+        plugin.PublicationStore = self._PublicationStore
+        plugin.BatchStoreConnector = self._BatchStoreConnector
+        plugin.DeletionCoalescer = self._DeletionCoalescer
+        plugin.OfferingMirror = self._OfferingMirror
+        plugin.get_bulkhead = self._get_bulkhead
+        acquisitions.db = self._acquisitions_db
+        acquisitions.model = self._acquisitions_model
+        acquisitions.DatasetLock = self._DatasetLock
 
     @parameterized.expand([
+        (plugin.plugins.IActions,),
+        (plugin.plugins.IAuthFunctions,),
         (plugin.plugins.IConfigurer,),
+        (plugin.plugins.IMiddleware,),
         (plugin.plugins.IRoutes,),
         (plugin.plugins.IPackageController,),
+        (plugin.plugins.ITemplateHelpers,),
     ])
     def test_implementation(self, interface):
         self.assertTrue(interface.implemented_by(plugin.StorePublisher))
 
+    def test_get_helpers(self):
+        helpers = self.storePublisher.get_helpers()
+        self.assertEquals(self.storePublisher._get_offerings, helpers['storepublisher_offerings'])
+        plugin.OfferingMirror.assert_called_once_with(self._store_connector_instance, plugin.config)
+
+    def test_get_offerings(self):
+        plugin.plugins.toolkit.c.user = 'smg'
+        plugin.plugins.toolkit.c.usertoken = {'access_token': 'token'}
+        self._offering_mirror_instance.get.return_value = [{'name': 'offering'}]
+
+        self.assertEquals([{'name': 'offering'}], self.storePublisher._get_offerings('package_id'))
+
+        # Offerings are read from the mirror. The identities of the visitors are not used
+        self._offering_mirror_instance.get.assert_called_once_with('package_id')
+        self._offering_mirror_instance.start.assert_called_once_with()
+        self.assertEquals(0, self._offering_mirror_instance.set_identity.call_count)
+
+    def test_get_offerings_error(self):
+        self._offering_mirror_instance.get.side_effect = Exception('Database error')
+
+        # Dataset pages are rendered even if the offerings cannot be read
+        self.assertEquals([], self.storePublisher._get_offerings('package_id'))
+
     def test_config(self):
         # Call the method
         config = {'config1': 'abcdef', 'config2': '12345'}
@@ -59,6 +127,67 @@ class PluginTest(unittest.TestCase):
         # Check that the config has been updated
         plugin.plugins.toolkit.add_template_directory.assert_called_once_with(config, 'templates')
         plugin.plugins.toolkit.add_resource.assert_called_once_with('fanstatic', 'storepublisher')
+        self.assertEquals(0, self._store_connector_instance.warm_up.call_count)
+
+    @parameterized.expand([
+        ('true',  True),
+        ('True',  True),
+        ('false', False)
+    ])
+    def test_config_warm_up(self, warm_up, started):
+        self._threading = plugin.threading
+        plugin.threading = MagicMock()
+        try:
+            self.storePublisher.update_config({'ckan.storepublisher.warm_up': warm_up})
+
+            # Connections are not opened by the process that loads the application
+            self.assertEquals(0, plugin.threading.Thread.call_count)
+
+            app = MagicMock()
+            middleware = self.storePublisher.make_middleware(app, {})
+            self.assertEquals(app.return_value, middleware('environ', 'start_response'))
+            middleware('environ', 'start_response')
+            app.assert_called_with('environ', 'start_response')
+
+            # The worker does not wait for the connections to be opened
+            if started:
+                plugin.threading.Thread.assert_called_once_with(target=self.storePublisher._warm_up,
+                                                                name='storepublisher-warm-up')
+                thread = plugin.threading.Thread.return_value
+                self.assertTrue(thread.daemon)
+                thread.start.assert_called_once_with()
+            else:
+                self.assertEquals(0, plugin.threading.Thread.call_count)
+        finally:
+            plugin.threading = self._threading
+
+    def test_warm_up_forked(self):
+        self._threading = plugin.threading
+        plugin.threading = MagicMock()
+        self._os = plugin.os
+        plugin.os = MagicMock()
+        try:
+            self.storePublisher.update_config({'ckan.storepublisher.warm_up': 'true'})
+            middleware = self.storePublisher.make_middleware(MagicMock(), {})
+
+            for pid in (100, 100, 101, 101):
+                plugin.os.getpid.return_value = pid
+                middleware('environ', 'start_response')
+
+            # Connections are opened once in each worker
+            self.assertEquals(2, plugin.threading.Thread.return_value.start.call_count)
+        finally:
+            plugin.threading = self._threading
+            plugin.os = self._os
+
+    @parameterized.expand([
+        (None,),
+        (Exception('Unreachable'),)
+    ])
+    def test_warm_up(self, error):
+        self._store_connector_instance.warm_up.side_effect = error
+        self.storePublisher._warm_up()
+        self._store_connector_instance.warm_up.assert_called_once_with()
 
     def test_map(self):
         # Call the method
@@ -66,21 +195,163 @@ class PluginTest(unittest.TestCase):
         self.storePublisher.before_map(m)
 
         # Test that the connect method has been called
-        m.connect.assert_called_once_with('dataset_publish', '/dataset/publish/{id}', action='publish',
-                                          controller='ckanext.storepublisher.controllers.ui_controller:PublishControllerUI',
-                                          ckan_icon='shopping-cart')
+        self.assertEquals(3, m.connect.call_count)
+        m.connect.assert_any_call('dataset_publish', '/dataset/publish/{id}', action='publish',
+                                  controller='ckanext.storepublisher.controllers.ui_controller:PublishControllerUI',
+                                  ckan_icon='shopping-cart')
+        m.connect.assert_any_call('storepublisher_health', '/storepublisher/health', action='health',
+                                  controller='ckanext.storepublisher.controllers.health_controller:HealthController')
+        m.connect.assert_any_call('storepublisher_dashboard', '/ckan-admin/storepublisher', action='dashboard',
+                                  controller='ckanext.storepublisher.controllers.admin_controller:AdminControllerUI',
+                                  ckan_icon='bar-chart')
+
+    def test_get_actions(self):
+        self.assertEquals({'storepublisher_dashboard': plugin.actions.storepublisher_dashboard,
+                           'storepublisher_dataset_acquired': plugin.actions.storepublisher_dataset_acquired,
+                           'storepublisher_health': plugin.actions.storepublisher_health,
+                           'dataset_publish': plugin.actions.dataset_publish,
+                           'dataset_publish_validate': plugin.actions.dataset_publish_validate,
+                           'dataset_publish_version': plugin.actions.dataset_publish_version},
+                          self.storePublisher.get_actions())
+
+    def test_get_auth_functions(self):
+        self.assertEquals({'storepublisher_dashboard': plugin.auth.storepublisher_dashboard,
+                           'storepublisher_dataset_acquired': plugin.auth.storepublisher_dataset_acquired,
+                           'storepublisher_health': plugin.auth.storepublisher_health,
+                           'dataset_publish': plugin.auth.dataset_publish,
+                           'dataset_publish_validate': plugin.auth.dataset_publish_validate,
+                           'dataset_publish_version': plugin.auth.dataset_publish_version},
+                          self.storePublisher.get_auth_functions())
+
+    def test_dashboard_registration(self):
+        # Stores are shown in the dashboard even if they have not been contacted yet
+        self.assertEquals(sorted([(('store1',),), ((plugin.DEFAULT_STORE,),)]),
+                          sorted(plugin.activity.register_store.call_args_list))
+
+        # Pending updates of all the Stores are added
+        plugin.activity.register_gauge.assert_any_call('resource_updates', self.storePublisher._get_pending_updates)
+        gauges = dict(call[0] for call in plugin.activity.register_gauge.call_args_list)
+        self._deletion_coalescer_instance.pending_deletions = 4
+        self.assertEquals(4, gauges['resource_deletions']())
+        for i, resource_sync in enumerate(self._resource_sync_instances.values()):
+            resource_sync.pending_updates = i + 2
+        self.assertEquals(5, self.storePublisher._get_pending_updates())
 
-    def test_after_delete(self):
-        dataset = MagicMock()
-        action = MagicMock(return_value=dataset)
-        plugin.plugins.toolkit.get_action = MagicMock(return_value=action)
+        # Operations running and waiting in the bulkhead of the process
+        bulkhead = plugin.get_bulkhead.return_value
+        bulkhead.in_flight, bulkhead.queued = 3, 1
+        self.assertEquals((3, 1), (gauges['store_operations'](), gauges['queued_store_operations']()))
+
+    def test_init_deletion_coalescer(self):
+        # The default Store is not configured with a name
+        plugin.DeletionCoalescer.assert_called_once_with(['batch_store1', 'batch_None'], plugin.config)
+
+    @parameterized.expand([
+        (True,),
+        (False,)
+    ])
+    def test_after_delete(self, exists):
+        package = MagicMock(id='example-pkg-id') if exists else None
+        context = {'user': MagicMock(), 'model': MagicMock()}
+        context['model'].Package.get.return_value = package
+        dataset_info = {'id': 'example-pkg-name'}
 
+        # Call the function
+        result = self.storePublisher.after_delete(context, dataset_info)
+
+        # Verifications
+        self.assertEquals(dataset_info, result)
+        context['model'].Package.get.assert_called_once_with('example-pkg-name')
+        # The dataset is not retrieved with package_show
+        self.assertEquals(0, plugin.plugins.toolkit.get_action.call_count)
+        self.assertEquals(0, self._store_connector_instance.delete_attached_resources.call_count)
+        if exists:
+            self._deletion_coalescer_instance.dataset_deleted.assert_called_once_with({'id': 'example-pkg-id'})
+            self._publication_store_instance.delete.assert_called_once_with('example-pkg-id')
+        else:
+            self.assertEquals(0, self._deletion_coalescer_instance.dataset_deleted.call_count)
+            self.assertEquals(0, self._publication_store_instance.delete.call_count)
+
+    @parameterized.expand([
+        ({'id': 'example-pkg-id', 'title': 'Title', 'notes': 'Notes', 'private': True},
+         {'id': 'example-pkg-id', 'title': 'Title', 'notes': 'Notes'}),
+        ({'id': 'example-pkg-id', 'title': 'Title', 'notes': None},
+         {'id': 'example-pkg-id', 'title': 'Title', 'notes': ''}),
+        ({'id': 'example-pkg-id'},
+         {'id': 'example-pkg-id', 'title': '', 'notes': ''})
+    ])
+    def test_after_update(self, pkg_dict, expected_dataset):
         # Call the function
         context = {'user': MagicMock()}
-        dataset_info = {'pkg_id': 'example-pkg-id'}
-        self.storePublisher.after_delete(context, dataset_info)
+        result = self.storePublisher.after_update(context, pkg_dict)
 
         # Verifications
-        self._store_connector_instance.delete_attached_resources.assert_called_once_with(dataset)
-        action.assert_called_once_with(context, dataset_info)
-        plugin.plugins.toolkit.get_action.assert_called_once_with('package_show')
+        self.assertEquals(pkg_dict, result)
+        # The dataset is checked for every Store
+        self.assertEquals(2, len(self._resource_sync_instances))
+        for connector in self._store_connector_instance.connectors.values():
+            self._resource_sync_instances[connector].dataset_updated.assert_called_once_with(expected_dataset)
+        self.assertEquals(0, plugin.plugins.toolkit.get_action.call_count)
+
+    def test_after_update_skip_resource_sync(self):
+        pkg_dict = {'id': 'example-pkg-id', 'title': 'Title'}
+
+        result = self.storePublisher.after_update({plugin.SKIP_RESOURCE_SYNC: True}, pkg_dict)
+
+        self.assertEquals(pkg_dict, result)
+        for resource_sync in self._resource_sync_instances.values():
+            self.assertEquals(0, resource_sync.dataset_updated.call_count)
+
+    def test_acquisitions_flush(self):
+        entries = [MagicMock(user_name='aitor', dataset='dataset_a')]
+        query = acquisitions.model.Session.query
+        query.return_value.order_by.return_value = [('dataset_a',)]
+        query.return_value.filter_by.return_value.all.return_value = entries
+
+        # package_update runs the hooks of the plugin as CKAN does
+        package_update = MagicMock(side_effect=lambda context, data_dict: self.storePublisher.after_update(context, data_dict))
+        actions = {
+            'get_site_user': MagicMock(return_value={'name': 'site_user'}),
+            'package_show': MagicMock(return_value={'id': 'a', 'title': 'A', 'private': True}),
+            'package_update': package_update
+        }
+        plugin.plugins.toolkit.get_action.side_effect = lambda action: actions[action]
+
+        acquisitions.AcquisitionQueue({}).flush()
+
+        # The allowed users are updated without synchronizing the Store resources,
+        # so the acquisitions are not applied again
+        package_update.assert_called_once_with(package_update.call_args[0][0],
+                                               {'id': 'a', 'title': 'A', 'private': True, 'allowed_users': ['aitor']})
+        for resource_sync in self._resource_sync_instances.values():
+            self.assertEquals(0, resource_sync.dataset_updated.call_count)
+        acquisitions.model.Session.delete.assert_called_once_with(entries[0])
+        self.assertEquals(0, acquisitions.model.Session.rollback.call_count)
+
+    @parameterized.expand([
+        ([], {
+            'storepublisher_published': 'false',
+            'vocab_storepublisher_stores': [],
+            'vocab_storepublisher_offerings': [],
+            'vocab_storepublisher_resources': [],
+            'vocab_storepublisher_prices': []
+        }),
+        ([{'store': 'eu', 'offering_url': 'http://eu/offering/a/1.0', 'resource_name': 'res', 'price': 0.0},
+          {'store': 'eu', 'offering_url': 'http://eu/offering/a/2.0', 'resource_name': 'res', 'price': 2.5},
+          {'store': 'asia', 'offering_url': 'http://asia/offering/a/1.0', 'resource_name': 'res2', 'price': 1.0}], {
+            'storepublisher_published': 'true',
+            'vocab_storepublisher_stores': ['asia', 'eu'],
+            'vocab_storepublisher_offerings': ['http://eu/offering/a/1.0', 'http://eu/offering/a/2.0', 'http://asia/offering/a/1.0'],
+            'vocab_storepublisher_resources': ['res', 'res2'],
+            'vocab_storepublisher_prices': ['0.0', '2.5', '1.0']
+        })
+    ])
+    def test_before_index(self, publications, expected_fields):
+        self._publication_store_instance.get.return_value = publications
+        pkg_dict = {'id': 'example-pkg-id', 'name': 'example'}
+
+        result = self.storePublisher.before_index(pkg_dict.copy())
+
+        self._publication_store_instance.get.assert_called_once_with('example-pkg-id')
+        expected_fields.update(pkg_dict)
+        self.assertEquals(expected_fields, result)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.prefetch as prefetch
+import threading
+import unittest
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+KEY = ('default', 'user', 'dataset')
+
+
+class ResourcePrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self._time = prefetch.time
+        prefetch.time = MagicMock()
+        prefetch.time.time.return_value = 100.0
+        self.instance = prefetch.ResourcePrefetcher({})
+
+    def tearDown(self):
+        prefetch.time = self._time
+
+    def test_init(self):
+        self.assertEquals(600.0, self.instance.ttl)
+        self.assertEquals(30.0, prefetch.ResourcePrefetcher({'ckan.storepublisher.prefetch_ttl': '30'}).ttl)
+
+    @parameterized.expand([
+        ({'name': 'resource'},),
+        (None,)
+    ])
+    def test_take(self, resource):
+        self.instance.start(KEY, lambda: resource)
+
+        self.assertEquals((True, resource), self.instance.take(KEY))
+
+        # Results are only used once
+        self.assertEquals((False, None), self.instance.take(KEY))
+
+    def test_take_not_started(self):
+        self.assertEquals((False, None), self.instance.take(KEY))
+
+    def test_take_error(self):
+        self.instance.start(KEY, MagicMock(side_effect=ValueError('Unreachable')))
+        self.assertEquals((False, None), self.instance.take(KEY))
+
+    def test_take_expired(self):
+        self.instance.start(KEY, lambda: {'name': 'resource'})
+        prefetch.time.time.return_value = 700.0
+        self.assertEquals((False, None), self.instance.take(KEY))
+
+    def test_take_running(self):
+        release = threading.Event()
+
+        def _find_resource():
+            release.wait()
+            return {'name': 'resource'}
+
+        self.instance.start(KEY, _find_resource)
+        threading.Timer(0.05, release.set).start()
+
+        # The running lookup is waited for
+        self.assertEquals((True, {'name': 'resource'}), self.instance.take(KEY))
+
+    def test_start_once(self):
+        find_resource = MagicMock(return_value=None)
+
+        self.instance.start(KEY, find_resource)
+        self.instance.start(KEY, find_resource)
+        self.instance.take(KEY)
+
+        self.assertEquals(1, find_resource.call_count)
+
+    def test_start_expired(self):
+        first, second = MagicMock(return_value={'name': 'old'}), MagicMock(return_value={'name': 'new'})
+
+        self.instance.start(KEY, first)
+        prefetch.time.time.return_value = 700.0
+        self.instance.start(KEY, second)
+
+        # Expired lookups are started again
+        self.assertEquals((True, {'name': 'new'}), self.instance.take(KEY))
+
+    def test_disabled(self):
+        instance = prefetch.ResourcePrefetcher({'ckan.storepublisher.prefetch_ttl': '0'})
+        find_resource = MagicMock()
+
+        instance.start(KEY, find_resource)
+
+        self.assertEquals(0, find_resource.call_count)
+        self.assertEquals((False, None), instance.take(KEY))
+
+    def test_discard(self):
+        self.instance.start(KEY, lambda: None)
+        self.instance.discard(KEY)
+        self.assertEquals((False, None), self.instance.take(KEY))
+
+    def test_get_prefetcher(self):
+        _prefetcher = prefetch._prefetcher
+        prefetch._prefetcher = None
+        try:
+            instance = prefetch.get_prefetcher({'ckan.storepublisher.prefetch_ttl': '60'})
+            self.assertEquals(60.0, instance.ttl)
+            self.assertIs(instance, prefetch.get_prefetcher({}))
+        finally:
+            prefetch._prefetcher = _prefetcher
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.publications as publications
+import datetime
+import unittest
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+OFFERING_INFO = {'name': 'Offering 1', 'version': '1.0', 'price': 2.5}
+
+
+class PublicationStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self._db = publications.db
+        publications.db = MagicMock()
+
+        self._model = publications.model
+        publications.model = MagicMock()
+
+        self.instance = publications.PublicationStore()
+
+    def tearDown(self):
+        publications.db = self._db
+        publications.model = self._model
+
+    @parameterized.expand([
+        (True,),
+        (False,)
+    ])
+    def test_add(self, exists):
+        entry = MagicMock()
+        publications.db.Publication.get.return_value = entry if exists else None
+        publications.db.Publication.return_value = entry
+
+        self.instance.add('eu', 'package_id', 'smg', OFFERING_INFO, 'resource', 'http://store/offering')
+
+        publications.db.init_db.assert_called_once_with(publications.model)
+        publications.db.Publication.get.assert_called_once_with(store='eu', package_id='package_id',
+                                                                offering_name='Offering 1', offering_version='1.0')
+        self.assertEquals(('smg', 'http://store/offering', 'resource', 2.5),
+                          (entry.user_name, entry.offering_url, entry.resource_name, entry.price))
+        self.assertIsInstance(entry.published, datetime.datetime)
+        if exists:
+            self.assertEquals(0, publications.model.Session.add.call_count)
+        else:
+            self.assertEquals(('eu', 'package_id', 'Offering 1', '1.0'),
+                              (entry.store, entry.package_id, entry.offering_name, entry.offering_version))
+            publications.model.Session.add.assert_called_once_with(entry)
+        publications.model.Session.commit.assert_called_once_with()
+
+    @parameterized.expand([
+        ('smg', 0,  'http://store/offering'),
+        ('smg', -1, None),
+        ('aitor', 0, None),
+        (None, 0, None)
+    ])
+    def test_get_offering_url(self, user_name, age, expected):
+        since = datetime.datetime(2015, 1, 1, 12)
+        entry = MagicMock(user_name=user_name, offering_url='http://store/offering',
+                          published=since + datetime.timedelta(seconds=age))
+        publications.db.Publication.get.return_value = entry if user_name else None
+
+        result = self.instance.get_offering_url('eu', 'package_id', 'smg', OFFERING_INFO, since)
+
+        self.assertEquals(expected, result)
+        publications.db.Publication.get.assert_called_once_with(store='eu', package_id='package_id',
+                                                                offering_name='Offering 1', offering_version='1.0')
+
+    def test_get(self):
+        entry = MagicMock(store='eu', offering_name='Offering 1', offering_version='1.0', offering_url='http://store/offering',
+                          resource_name='resource', price=0.0)
+        publications.db.Publication.get_package_publications.return_value = [entry]
+
+        result = self.instance.get('package_id')
+
+        publications.db.Publication.get_package_publications.assert_called_once_with('package_id')
+        self.assertEquals([{'store': 'eu', 'offering_name': 'Offering 1', 'offering_version': '1.0',
+                            'offering_url': 'http://store/offering', 'resource_name': 'resource', 'price': 0.0}], result)
+
+    def test_delete(self):
+        entries = [MagicMock(), MagicMock()]
+        query = publications.model.Session.query.return_value
+        query.filter_by.return_value.all.return_value = entries
+
+        self.instance.delete('package_id')
+
+        publications.model.Session.query.assert_called_once_with(publications.db.Publication)
+        query.filter_by.assert_called_once_with(package_id='package_id')
+        self.assertEquals([((entry,),) for entry in entries], publications.model.Session.delete.call_args_list)
+        # Changes are committed with the deletion of the dataset
+        self.assertEquals(0, publications.model.Session.commit.call_count)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.rate_limit as rate_limit
+import unittest
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+
+class RateLimitBackend(object):
+    '''Backend loaded by its path in the tests'''
+
+    def __init__(self, config):
+        self.config = config
+
+
+class RateLimitFunctionsTest(unittest.TestCase):
+
+    @parameterized.expand([
+        ('get',     rate_limit.CATALOGUE),
+        ('OPTIONS', rate_limit.CATALOGUE),
+        ('post',    rate_limit.WRITE),
+        ('put',     rate_limit.WRITE),
+        ('delete',  rate_limit.WRITE)
+    ])
+    def test_get_endpoint(self, method, endpoint):
+        self.assertEquals(endpoint, rate_limit.get_endpoint(method))
+
+    @parameterized.expand([
+        ('10/1',   (10.0, 10.0)),
+        ('30/60',  (0.5, 30.0)),
+        ('a/1',    None),
+        ('10',     None),
+        ('0/1',    None),
+        ('10/-1',  None)
+    ])
+    def test_parse_limit(self, value, expected):
+        if expected is None:
+            self.assertRaises(ValueError, rate_limit.parse_limit, value)
+        else:
+            self.assertEquals(expected, rate_limit.parse_limit(value))
+
+    def test_take_tokens(self):
+        buckets = [('global', 1.0, 2.0), ('user', 0.5, 1.0)]
+        states = {}
+
+        # New buckets are full
+        self.assertEquals(0.0, rate_limit.take_tokens(buckets, states, 100.0))
+        self.assertEquals({'global': (1.0, 100.0), 'user': (0.0, 100.0)}, states)
+
+        # No token is taken when one of the buckets is empty
+        self.assertEquals(1.0, rate_limit.take_tokens(buckets, states, 101.0))
+        self.assertEquals({'global': (2.0, 101.0), 'user': (0.5, 101.0)}, states)
+
+        # Buckets are refilled up to their capacity
+        self.assertEquals(0.0, rate_limit.take_tokens(buckets, states, 110.0))
+        self.assertEquals({'global': (1.0, 110.0), 'user': (0.0, 110.0)}, states)
+
+    def test_memory_backend_shared(self):
+        buckets = [('test_memory_backend_shared', 0.001, 1.0)]
+        self.assertEquals(0.0, rate_limit.MemoryBackend({}).take(buckets))
+        self.assertTrue(rate_limit.MemoryBackend({}).take(buckets) > 0)
+
+    @parameterized.expand([
+        ({},                                                     rate_limit.MemoryBackend),
+        ({'ckan.storepublisher.rate_limit.backend': 'memory'},   rate_limit.MemoryBackend),
+        ({'ckan.storepublisher.rate_limit.backend': 'database'}, rate_limit.DatabaseBackend),
+        ({'ckan.storepublisher.rate_limit.backend': __name__ + ':RateLimitBackend'}, RateLimitBackend)
+    ])
+    def test_load_backend(self, config, backend_class):
+        self.assertIsInstance(rate_limit.load_backend(config), backend_class)
+
+
+class DatabaseBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self._db = rate_limit.db
+        rate_limit.db = MagicMock()
+
+        self._sa = rate_limit.sa
+        rate_limit.sa = MagicMock()
+        rate_limit.sa.exc.IntegrityError = self._sa.exc.IntegrityError
+
+        self._time = rate_limit.time
+        rate_limit.time = MagicMock()
+        rate_limit.time.time.return_value = 100.0
+
+        self.session = rate_limit.sa.orm.sessionmaker.return_value.return_value
+        self.query = self.session.query.return_value.filter.return_value.with_lockmode.return_value
+
+        self.instance = rate_limit.DatabaseBackend({})
+
+    def tearDown(self):
+        rate_limit.db = self._db
+        rate_limit.sa = self._sa
+        rate_limit.time = self._time
+
+    def test_take(self):
+        existing = MagicMock(key='global', tokens=0.5, updated=99.0)
+        new = MagicMock()
+        rate_limit.db.RateLimitBucket.return_value = new
+        self.query.all.return_value = [existing]
+
+        wait = self.instance.take([('global', 1.0, 5.0), ('user', 1.0, 2.0)])
+
+        # Buckets are locked and updated in their own session
+        self.assertEquals(0.0, wait)
+        self.session.query.return_value.filter.return_value.with_lockmode.assert_called_once_with('update')
+        self.assertEquals((0.5, 100.0), (existing.tokens, existing.updated))
+        self.assertEquals(('user', 1.0, 100.0), (new.key, new.tokens, new.updated))
+        self.session.add.assert_called_once_with(new)
+        self.session.commit.assert_called_once_with()
+        self.session.close.assert_called_once_with()
+
+    def test_take_concurrent_creation(self):
+        self.query.all.return_value = []
+        self.session.commit.side_effect = [self._sa.exc.IntegrityError('INSERT', {}, Exception()), None]
+
+        self.assertEquals(0.0, self.instance.take([('global', 1.0, 5.0)]))
+
+        # The request is retried when another process creates the bucket
+        self.session.rollback.assert_called_once_with()
+        self.assertEquals(2, self.session.commit.call_count)
+
+    def test_take_integrity_error(self):
+        self.query.all.return_value = []
+        self.session.commit.side_effect = self._sa.exc.IntegrityError('INSERT', {}, Exception())
+
+        # Persistent errors are raised after a few attempts
+        self.assertRaises(self._sa.exc.IntegrityError, self.instance.take, [('global', 1.0, 5.0)])
+        self.assertEquals(rate_limit.DATABASE_ATTEMPTS, self.session.commit.call_count)
+        self.assertEquals(rate_limit.DATABASE_ATTEMPTS, self.session.rollback.call_count)
+        self.assertEquals(rate_limit.DATABASE_ATTEMPTS, self.session.close.call_count)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self._time = rate_limit.time
+        rate_limit.time = MagicMock()
+        self.now = [100.0]
+        rate_limit.time.time.side_effect = lambda: self.now[0]
+
+        def _sleep(seconds):
+            self.now[0] += seconds
+        rate_limit.time.sleep.side_effect = _sleep
+
+        self.backend = MagicMock()
+        self.config = {
+            'ckan.storepublisher.rate_limit.catalogue.global': '100/1',
+            'ckan.storepublisher.rate_limit.write.user': '2/60',
+            'ckan.storepublisher.rate_limit.max_wait': '5'
+        }
+        self.instance = rate_limit.RateLimiter(self.config, 'default', self.backend)
+
+    def tearDown(self):
+        rate_limit.time = self._time
+
+    def test_init(self):
+        self.assertEquals(5.0, self.instance.max_wait)
+        self.assertEquals({('catalogue', 'global'): (100.0, 100.0), ('write', 'user'): (2.0 / 60, 2.0)},
+                          self.instance.limits)
+
+    def test_init_without_limits(self):
+        instance = rate_limit.RateLimiter({}, 'default')
+        self.assertEquals({}, instance.limits)
+        instance.acquire(rate_limit.WRITE, 'smg')
+
+    @parameterized.expand([
+        (rate_limit.CATALOGUE, [('default:catalogue:global', 100.0, 100.0)]),
+        (rate_limit.WRITE,     [('default:write:user:smg', 2.0 / 60, 2.0)])
+    ])
+    def test_acquire(self, endpoint, buckets):
+        self.backend.take.return_value = 0.0
+        self.instance.acquire(endpoint, 'smg')
+        self.backend.take.assert_called_once_with(buckets)
+        self.assertEquals(0, rate_limit.time.sleep.call_count)
+
+    def test_acquire_waits(self):
+        self.backend.take.side_effect = [2.0, 2.5, 0.0]
+        self.instance.acquire(rate_limit.WRITE, 'smg')
+        self.assertEquals([((2.0,),), ((2.5,),)], rate_limit.time.sleep.call_args_list)
+
+    def test_acquire_deadline(self):
+        self.backend.take.side_effect = [3.0, 3.0]
+        self.assertRaises(rate_limit.RateLimitExceeded, self.instance.acquire, rate_limit.WRITE, 'smg')
+        # Callers do not wait when the token will not be available before the deadline
+        rate_limit.time.sleep.assert_called_once_with(3.0)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.resource_sync as resource_sync
+
+import unittest
+
+from ckanext.storepublisher.identity import IdentityUnavailable, StoreIdentity
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+BASE_SITE_URL = 'https://localhost:8474'
+
+DATASET = {
+    'id': 'example_id',
+    'title': 'Dataset A',
+    'notes': 'Dataset description'
+}
+
+DATASET_URL = '%s/dataset/%s' % (BASE_SITE_URL, DATASET['id'])
+
+RESOURCE = {
+    'name': 'Dataset Dataset A - ID example_id',
+    'description': 'Dataset description',
+    'link': DATASET_URL
+}
+
+
+class ResourceSynchronizerTest(unittest.TestCase):
+
+    def setUp(self):
+
+        # Mocks
+        self.identity = StoreIdentity('smg', {'access_token': 'token'})
+        self._StoreIdentity = resource_sync.StoreIdentity
+        resource_sync.StoreIdentity = MagicMock()
+        resource_sync.StoreIdentity.from_request.return_value = self.identity
+
+        self._threading = resource_sync.threading
+        resource_sync.threading = MagicMock()
+        resource_sync.threading.Lock = self._threading.Lock
+
+        self._time = resource_sync.time
+        resource_sync.time = MagicMock()
+        resource_sync.time.time.return_value = 1000
+
+        self.store_connector = MagicMock()
+        self.store_connector._get_resource = MagicMock(return_value=RESOURCE.copy())
+        self.store_connector._get_dataset_url = MagicMock(return_value=DATASET_URL)
+        # Bound connectors are the connector itself to check the requests easily
+        self.store_connector.with_identity.return_value = self.store_connector
+        self.store_connector.identity = self.identity
+
+        self.config = {
+            'ckan.storepublisher.update_window': '10',
+            'ckan.storepublisher.catalogue_ttl': '60'
+        }
+
+        self.instance = resource_sync.ResourceSynchronizer(self.store_connector, self.config)
+
+    def tearDown(self):
+        resource_sync.StoreIdentity = self._StoreIdentity
+        resource_sync.threading = self._threading
+        resource_sync.time = self._time
+
+    def test_init(self):
+        self.assertEquals(10.0, self.instance.update_window)
+        self.assertEquals(60.0, self.instance.catalogue_ttl)
+
+    @parameterized.expand([
+        ({},                                      ['description', 'link']),
+        (RESOURCE,                                []),
+        (dict(RESOURCE, description='Old desc'),  ['description']),
+        # The name of the resource is kept when the title of the dataset changes
+        (dict(RESOURCE, name='Old name'),         []),
+        (dict(RESOURCE, name='a', link='b'),      ['link'])
+    ])
+    def test_get_changes(self, store_resource, changed_fields):
+        changes = self.instance.get_changes(store_resource, DATASET)
+
+        self.store_connector._get_resource.assert_called_once_with(DATASET)
+        self.assertEquals(sorted(changed_fields), sorted(changes.keys()))
+        for field in changed_fields:
+            self.assertEquals(RESOURCE[field], changes[field])
+
+    def test_dataset_updated_catalogue_not_cached(self):
+        self.instance.dataset_updated(DATASET)
+        self.instance.dataset_updated(DATASET)
+
+        # Only one flush is scheduled for the burst of updates
+        resource_sync.threading.Timer.assert_called_once_with(10.0, self.instance._flush, args=(('smg', DATASET['id']),))
+        resource_sync.threading.Timer.return_value.start.assert_called_once_with()
+        self.assertEquals(0, self.store_connector._get_resources.call_count)
+
+    def test_dataset_updated_identity(self):
+        identity = StoreIdentity('aitor', {'access_token': 'token'})
+
+        self.instance.dataset_updated(DATASET, identity)
+
+        resource_sync.threading.Timer.assert_called_once_with(10.0, self.instance._flush, args=(('aitor', DATASET['id']),))
+        self.assertEquals((identity, DATASET), self.instance._pending[('aitor', DATASET['id'])])
+        self.assertEquals(0, resource_sync.StoreIdentity.from_request.call_count)
+
+    def test_dataset_updated_without_request(self):
+        resource_sync.StoreIdentity.from_request.side_effect = IdentityUnavailable('No request')
+
+        self.instance.dataset_updated(DATASET)
+
+        # Nobody can update the resource
+        self.assertEquals({}, self.instance._pending)
+        self.assertEquals(0, resource_sync.threading.Timer.call_count)
+
+    @parameterized.expand([
+        # Datasets not found may have been published since the catalogue was retrieved
+        ({},                                                        True),
+        ({DATASET_URL: RESOURCE},                                   False),
+        ({DATASET_URL: dict(RESOURCE, description='Old desc')},     True),
+        ({'http://example.com': dict(RESOURCE, description='Old')}, True)
+    ])
+    def test_dataset_updated_catalogue_cached(self, catalogue, scheduled):
+        self.instance._catalogues['smg'] = (990, catalogue)
+
+        self.instance.dataset_updated(DATASET)
+
+        self.assertEquals(1 if scheduled else 0, resource_sync.threading.Timer.call_count)
+        self.assertEquals(scheduled, ('smg', DATASET['id']) in self.instance._pending)
+        self.assertEquals(0, self.store_connector._get_resources.call_count)
+
+    def test_dataset_updated_reverted(self):
+        # A pending update is discarded when the dataset is reverted to its previous values
+        self.instance._catalogues['smg'] = (990, {DATASET_URL: RESOURCE.copy()})
+        self.instance._pending[('smg', DATASET['id'])] = (self.identity, DATASET)
+
+        self.instance.dataset_updated(DATASET)
+
+        self.assertEquals({}, self.instance._pending)
+        self.assertEquals(0, resource_sync.threading.Timer.call_count)
+
+    @parameterized.expand([
+        ([],                                                         False),
+        ([RESOURCE],                                                 False),
+        ([dict(RESOURCE, description='Old desc')],                   True),
+        ([dict(RESOURCE, description='Old desc', state='deleted')],  False)
+    ])
+    def test_flush(self, resources, should_update):
+        store_resources = [resource.copy() for resource in resources]
+        self.store_connector._get_resources = MagicMock(return_value=store_resources)
+        key = ('smg', DATASET['id'])
+        self.instance._pending[key] = (self.identity, DATASET)
+
+        self.instance._flush(key)
+
+        # The resource is updated on behalf of the user that updated the dataset
+        self.store_connector.with_identity.assert_called_once_with(self.identity)
+        self.store_connector._get_resources.assert_called_once_with()
+        self.assertEquals({}, self.instance._pending)
+
+        if should_update:
+            self.store_connector.update_resource.assert_called_once_with(store_resources[0], {'description': RESOURCE['description']})
+            # The cached catalogue is updated with the new values
+            self.assertEquals(RESOURCE['description'], self.instance._catalogues['smg'][1][DATASET_URL]['description'])
+        else:
+            self.assertEquals(0, self.store_connector.update_resource.call_count)
+
+    def test_flush_catalogue_cached(self):
+        self.instance._catalogues['smg'] = (990, {DATASET_URL: dict(RESOURCE, description='Old desc')})
+        key = ('smg', DATASET['id'])
+        self.instance._pending[key] = (self.identity, DATASET)
+
+        self.instance._flush(key)
+
+        self.assertEquals(0, self.store_connector._get_resources.call_count)
+        self.assertEquals(1, self.store_connector.update_resource.call_count)
+
+    @parameterized.expand([
+        (980, True),
+        (995, False)
+    ])
+    def test_flush_catalogue_cached_not_found(self, retrieved, retrieved_again):
+        self.instance._catalogues['smg'] = (retrieved, {})
+        self.store_connector._get_resources = MagicMock(return_value=[dict(RESOURCE, description='Old desc')])
+        key = ('smg', DATASET['id'])
+        self.instance._pending[key] = (self.identity, DATASET)
+
+        self.instance._flush(key)
+
+        # Catalogues retrieved before the update was scheduled are retrieved again
+        self.assertEquals(1 if retrieved_again else 0, self.store_connector._get_resources.call_count)
+        self.assertEquals(1 if retrieved_again else 0, self.store_connector.update_resource.call_count)
+
+    def test_flush_catalogue_expired(self):
+        self.instance._catalogues['smg'] = (900, {DATASET_URL: RESOURCE.copy()})
+        self.store_connector._get_resources = MagicMock(return_value=[])
+        key = ('smg', DATASET['id'])
+        self.instance._pending[key] = (self.identity, DATASET)
+
+        self.instance._flush(key)
+
+        self.store_connector._get_resources.assert_called_once_with()
+        self.assertEquals(0, self.store_connector.update_resource.call_count)
+
+    def test_flush_nothing_pending(self):
+        self.instance._flush(('smg', DATASET['id']))
+        self.assertEquals(0, self.store_connector._get_resources.call_count)
+
+    def test_flush_exception(self):
+        self.store_connector._get_resources = MagicMock(side_effect=Exception('Store down'))
+        key = ('smg', DATASET['id'])
+        self.instance._pending[key] = (self.identity, DATASET)
+
+        # Exceptions must not be propagated
+        self.instance._flush(key)
+        self.assertEquals(0, self.store_connector.update_resource.call_count)
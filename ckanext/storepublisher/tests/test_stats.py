@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.stats as stats
+import unittest
+
+from collections import OrderedDict
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+
+class StatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._time = stats.time
+        stats.time = MagicMock()
+        stats.time.time.return_value = 0.0
+
+        self.instance = stats.ActivityStats(max_operations=2)
+
+    def tearDown(self):
+        stats.time = self._time
+
+    @parameterized.expand([
+        ('get',    '/api/offering/resources',                             'GET /api/offering/resources'),
+        ('get',    '/api/offering/resources?open=true',                   'GET /api/offering/resources'),
+        ('post',   '/api/offering/offerings',                             'POST /api/offering/offerings'),
+        ('put',    '/api/offering/offerings/user/Offering%201/1.0/tag',    'PUT /api/offering/offerings/{owner}/{name}/{version}/tag'),
+        ('post',   '/api/offering/offerings/user/Offering/1.0/publish',   'POST /api/offering/offerings/{owner}/{name}/{version}/publish'),
+        ('delete', '/api/offering/resources/user/Resource/1.0',           'DELETE /api/offering/resources/{owner}/{name}/{version}'),
+        ('get',    '/other',                                              'GET /other')
+    ])
+    def test_get_endpoint(self, method, path, endpoint):
+        self.assertEquals(endpoint, stats.get_endpoint(method, path))
+
+    def test_record_request(self):
+        self.instance.register_store('default')
+        self.instance.register_store('eu')
+
+        stats.time.time.return_value = 60.0
+        self.instance.record_request('default', 'get', '/api/offering/resources', 0.1, 200)
+        self.instance.record_request('default', 'get', '/api/offering/resources', 0.3, 500)
+        stats.time.time.return_value = 120.0
+        self.instance.record_request('default', 'post', '/api/offering/offerings', 5.0, error=Exception('Timeout'))
+
+        summary = self.instance.get_summary()
+
+        self.assertEquals([{
+            'store': 'default', 'endpoint': 'GET /api/offering/resources', 'requests': 2, 'errors': 1,
+            'error_rate': 0.5, 'avg_latency': 200.0
+        }, {
+            'store': 'default', 'endpoint': 'POST /api/offering/offerings', 'requests': 1, 'errors': 1,
+            'error_rate': 1.0, 'avg_latency': 5000.0
+        }], summary['endpoints'])
+
+        # Reachability is given by the last request
+        self.assertEquals([{
+            'name': 'default', 'reachable': False, 'last_success': '1970-01-01T00:01:00',
+            'last_error': '1970-01-01T00:02:00', 'error': 'Timeout'
+        }, {
+            'name': 'eu', 'reachable': None, 'last_success': None, 'last_error': None, 'error': None
+        }], summary['stores'])
+
+    def test_record_operation(self):
+        phases = OrderedDict([('resource', 0.25), ('offering', 1.0)])
+        self.instance.record_operation(stats.PUBLISH, 'default', 'package1', phases)
+        self.instance.record_operation(stats.DELETE, 'eu', 'package2', {'lookup': 0.5}, 'Not found')
+        self.instance.record_operation(stats.PUBLISH, 'eu', 'package3', {}, 'Error')
+
+        operations = self.instance.get_summary()['operations']
+
+        # Only the last operations are kept. The newest one comes first
+        self.assertEquals(['package3', 'package2'], [operation['package_id'] for operation in operations])
+        self.assertEquals({
+            'operation': 'delete', 'store': 'eu', 'package_id': 'package2', 'finished': '1970-01-01T00:00:00',
+            'outcome': 'error', 'error': 'Not found', 'phases': {'lookup': 500.0}, 'total': 500.0
+        }, operations[1])
+
+        self.instance.record_operation(stats.PUBLISH, 'default', 'package1', phases)
+        operation = self.instance.get_summary()['operations'][0]
+        self.assertEquals(('success', None), (operation['outcome'], operation['error']))
+        self.assertEquals([('resource', 250.0), ('offering', 1000.0)], operation['phases'].items())
+        self.assertEquals(1250.0, operation['total'])
+
+    def test_gauges(self):
+        self.instance.register_gauge('resource_updates', MagicMock(return_value=3))
+        self.instance.register_gauge('other', MagicMock(return_value=0))
+
+        summary = self.instance.get_summary()
+
+        self.assertEquals('1970-01-01T00:00:00', summary['since'])
+        self.assertEquals([('resource_updates', 3), ('other', 0)], summary['pending'].items())
@@ -18,12 +18,19 @@
 # along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
 
 import ckanext.storepublisher.store_connector as store_connector
+import ckanext.storepublisher.transport as transport
 
+import base64
 import json
 import unittest
+import zlib
 
+from ckanext.storepublisher.bulkhead import BulkheadFull
+from ckanext.storepublisher.journal import STEPS
+from ckanext.storepublisher.rate_limit import RateLimitExceeded
 from mock import MagicMock
 from nose_parameterized import parameterized
+from StringIO import StringIO
 
 # Need to be defined here, since it will be used as tests parameter
 ConnectionError = store_connector.requests.ConnectionError
@@ -69,7 +76,10 @@ class StoreConnectorTest(unittest.TestCase):
         store_connector.requests = MagicMock()
         store_connector.requests.ConnectionError = ConnectionError    # Recover Exception
 
-        self._OAuth2Session = store_connector.OAuth2Session
+        self._transport_requests = transport.requests
+        transport.requests = MagicMock()
+
+        self._OAuth2Session = transport.OAuth2Session
 
         self.config = {
             'ckan.site_url': BASE_SITE_URL,
@@ -78,6 +88,9 @@ class StoreConnectorTest(unittest.TestCase):
         }
 
         self.instance = store_connector.StoreConnector(self.config)
+        self.instance._publication_store = MagicMock()
+        self.instance._publication_store.get_offering_url.return_value = None
+        self.instance._dataset_lock = MagicMock()
 
         # Save controller functions since it will be mocked in some tests
         self._make_request = self.instance._make_request
@@ -90,7 +103,8 @@ class StoreConnectorTest(unittest.TestCase):
     def tearDown(self):
         store_connector.plugins.toolkit = self._toolkit
         store_connector.requests = self._requests
-        store_connector.OAuth2Session = self._OAuth2Session
+        transport.requests = self._transport_requests
+        transport.OAuth2Session = self._OAuth2Session
         store_connector.model = self._model
 
         # Restore controller functions
@@ -118,6 +132,31 @@ class StoreConnectorTest(unittest.TestCase):
         instance = store_connector.StoreConnector(config)
         self.assertEquals(BASE_SITE_URL, instance.site_url)
         self.assertEquals(BASE_STORE_URL, instance.store_url)
+        self.assertEquals(store_connector.DEFAULT_STORE, instance.name)
+        self.assertIsNone(instance.timeout)
+
+    @parameterized.expand([
+        ({},                                           None),
+        ({'ckan.storepublisher.timeout': '5'},         5.0),
+        ({'ckan.storepublisher.eu.timeout': '2.5'},    2.5),
+        ({'ckan.storepublisher.timeout': '5',
+          'ckan.storepublisher.eu.timeout': '2.5'},    2.5)
+    ])
+    def test_init_store_name(self, extra_config, expected_timeout):
+
+        config = {
+            'ckan.site_url': BASE_SITE_URL,
+            'ckan.storepublisher.store_url': 'https://other.example.com',
+            'ckan.storepublisher.eu.store_url': '%s/' % BASE_STORE_URL,
+            'ckan.storepublisher.eu.repository': 'EU Repo'
+        }
+        config.update(extra_config)
+
+        instance = store_connector.StoreConnector(config, 'eu')
+        self.assertEquals('eu', instance.name)
+        self.assertEquals(BASE_STORE_URL, instance.store_url)
+        self.assertEquals('EU Repo', instance.repository)
+        self.assertEquals(expected_timeout, instance.timeout)
 
     @parameterized.expand([
         (DATASET['title'], DATASET['title']),
@@ -169,6 +208,17 @@ class StoreConnectorTest(unittest.TestCase):
             self.assertEquals('single_payment', offering['offering_info']['pricing']['price_model'])
             self.assertEquals(price, offering['offering_info']['pricing']['price'])
 
+    def test_get_offering_image_file(self):
+        offering_info = OFFERING_INFO_BASE.copy()
+        del offering_info['image_base64']
+        offering_info['image_file'] = StringIO('image content')
+        resource = {'provider': 'test', 'name': 'resource_name', 'version': '1.0'}
+        offering = self.instance._get_offering(offering_info, resource)
+
+        # The image is encoded when the offering is sent
+        self.assertIsInstance(offering['image']['data'], store_connector.Base64Stream)
+        self.assertEquals(base64.b64encode('image content'), ''.join(offering['image']['data']))
+
     def test_get_tags(self):
         expected_tags = list(OFFERING_INFO_BASE['tags'])
         expected_tags.append('dataset')
@@ -225,6 +275,7 @@ class StoreConnectorTest(unittest.TestCase):
 
         expected_headers = headers.copy()
         expected_headers['Accept'] = 'application/json'
+        expected_headers['Accept-Encoding'] = 'gzip, deflate'
 
         # Set the response status
         first_response = MagicMock()
@@ -234,7 +285,7 @@ class StoreConnectorTest(unittest.TestCase):
         second_response.status_code = 201
 
         request = MagicMock()
-        store_connector.OAuth2Session = MagicMock(return_value=request)
+        transport.OAuth2Session = MagicMock(return_value=request)
         req_method = MagicMock(side_effect=[first_response, second_response])
         setattr(request, method, req_method)
 
@@ -243,7 +294,7 @@ class StoreConnectorTest(unittest.TestCase):
             with self.assertRaises(Exception) as e:
                 self.instance._make_request(method, url, headers, data)
                 self.assertEquals(ERROR_MSG, e.message)
-                store_connector.OAuth2Session.assert_called_once_with(token=usertoken)
+                transport.OAuth2Session.assert_called_once_with(token=usertoken)
                 req_method.assert_called_once_with(url, headers=expected_headers, data=data)
         else:
             result = self.instance._make_request(method, url, headers, data)
@@ -252,15 +303,15 @@ class StoreConnectorTest(unittest.TestCase):
             if response_status != 401:
                 self.assertEquals(first_response, result)
                 req_method.assert_called_once_with(url, headers=expected_headers, data=data)
-                store_connector.OAuth2Session.assert_called_once_with(token=usertoken)
+                transport.OAuth2Session.assert_called_once_with(token=usertoken)
                 req_method.assert_called_once_with(url, headers=expected_headers, data=data)
             else:
                 # Check that the token has been refreshed
                 store_connector.plugins.toolkit.c.usertoken_refresh.assert_called_once_with()
 
                 # Check that both tokens has been used
-                self.assertEquals(usertoken, store_connector.OAuth2Session.call_args_list[0][1]['token'])
-                self.assertEquals(newtoken, store_connector.OAuth2Session.call_args_list[1][1]['token'])
+                self.assertEquals(usertoken, transport.OAuth2Session.call_args_list[0][1]['token'])
+                self.assertEquals(newtoken, transport.OAuth2Session.call_args_list[1][1]['token'])
 
                 # Check URL
                 self.assertEquals(url, req_method.call_args_list[0][0][0])
@@ -277,6 +328,251 @@ class StoreConnectorTest(unittest.TestCase):
                 # Check response
                 self.assertEquals(second_response, result)
 
+    def test_make_request_timeout(self):
+        url = 'http://example.com'
+        self.instance.timeout = 3.5
+
+        response = MagicMock()
+        response.status_code = 200
+        request = MagicMock()
+        request.get = MagicMock(return_value=response)
+        transport.OAuth2Session = MagicMock(return_value=request)
+
+        # Call the function
+        self.assertEquals(response, self.instance._make_request('get', url))
+        request.get.assert_called_once_with(url, headers={'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'},
+                                            data=None, timeout=3.5)
+
+    def test_make_request_streamed_body(self):
+        url = 'http://example.com'
+        data = MagicMock()
+        store_connector.plugins.toolkit.c.usertoken_refresh = MagicMock()
+
+        first_response = MagicMock()
+        first_response.status_code = 401
+        second_response = MagicMock()
+        second_response.status_code = 201
+        request = MagicMock()
+        request.post = MagicMock(side_effect=[first_response, second_response])
+        transport.OAuth2Session = MagicMock(return_value=request)
+
+        # Call the function
+        self.assertEquals(second_response, self.instance._make_request('post', url, {}, data))
+
+        # The body is rewound before sending it each time
+        self.assertEquals(2, data.seek.call_count)
+        data.seek.assert_called_with(0)
+
+    def test_make_request_activity(self):
+        self._activity = store_connector.activity
+        store_connector.activity = MagicMock()
+        try:
+            self._mock_session('get', [self._response(200), ConnectionError('Unreachable')])
+            self.instance._make_request('get', '%s/api/offering/resources' % BASE_STORE_URL)
+            self.assertRaises(ConnectionError, self.instance._make_request, 'get', '%s/api/offering/resources' % BASE_STORE_URL)
+
+            # Requests are recorded by their path in the Store
+            calls = store_connector.activity.record_request.call_args_list
+            self.assertEquals(2, len(calls))
+            self.assertEquals(('default', 'get', '/api/offering/resources'), calls[0][0][:3])
+            self.assertEquals(200, calls[0][0][4])
+            self.assertEquals(('default', 'get', '/api/offering/resources'), calls[1][0][:3])
+            self.assertIsInstance(calls[1][1]['error'], ConnectionError)
+        finally:
+            store_connector.activity = self._activity
+
+    def test_make_request_pooled_connections(self):
+        request = self._mock_session('get', [self._response(200)])
+
+        self.instance._make_request('get', 'http://example.com')
+
+        # All the requests share the same pool of connections
+        transport.OAuth2Session.return_value.mount.assert_called_once_with(BASE_STORE_URL, self.instance._transport.adapter)
+        self.assertEquals(1, request.call_count)
+
+    @parameterized.expand([
+        ({},                                                          2),
+        ({'ckan.storepublisher.warm_up_connections': '4'},            4),
+        ({'ckan.storepublisher.warm_up_connections': '20',
+          'ckan.storepublisher.pool_size': '5'},                      5)
+    ])
+    def test_warm_up(self, extra_config, connections):
+        config = dict(self.config, **extra_config)
+        instance = store_connector.StoreConnector(config)
+        instance.timeout = 3
+        session = transport.requests.Session.return_value
+        responses = [self._response(200, 'gzip')] * (connections - 1) + [ConnectionError('Unreachable')]
+        session.options.side_effect = responses
+
+        # Call the function
+        self.assertEquals(connections - 1, instance.warm_up())
+
+        transport.requests.adapters.HTTPAdapter.assert_called_with(pool_connections=1, pool_maxsize=instance.pool_size)
+        session.mount.assert_called_with(BASE_STORE_URL, instance._transport.adapter)
+        self.assertEquals([(('%s/api/offering/offerings' % BASE_STORE_URL,), {'headers': {'Accept-Encoding': 'gzip, deflate'}, 'data': None, 'timeout': 3})] * connections,
+                          session.options.call_args_list)
+        # Compression support is also probed
+        self.assertTrue(instance._compressed_requests)
+
+    @parameterized.expand([
+        (200,  None),
+        (401,  None),
+        (503,  'The Store returned the status code 503'),
+        (None, 'Unreachable')
+    ])
+    def test_probe(self, status_code, error):
+        self._time = store_connector.time
+        store_connector.time = MagicMock()
+        store_connector.time.time.side_effect = [10.0, 10.25]
+        session = transport.requests.Session.return_value
+        session.options.side_effect = [ConnectionError('Unreachable') if status_code is None else self._response(status_code)]
+
+        try:
+            if error is None:
+                self.assertEquals(0.25, self.instance.probe())
+            else:
+                with self.assertRaises(Exception) as context:
+                    self.instance.probe()
+                self.assertEquals(error, str(context.exception))
+        finally:
+            store_connector.time = self._time
+
+        # Probes are not authenticated
+        session.options.assert_called_once_with('%s/api/offering/offerings' % BASE_STORE_URL,
+                                                headers={'Accept-Encoding': 'gzip, deflate'}, data=None)
+
+    def test_make_request_rate_limited(self):
+        url = 'http://example.com'
+        self.instance._rate_limiter = MagicMock()
+        store_connector.plugins.toolkit.c.usertoken_refresh = MagicMock()
+        self._mock_session('post', [self._response(401), self._response(201)])
+
+        # Call the function
+        self.instance._make_request('post', url, {}, 'data')
+
+        # Each request sent to the Store takes its own token
+        self.assertEquals([(('write', store_connector.plugins.toolkit.c.user),)] * 2,
+                          self.instance._rate_limiter.acquire.call_args_list)
+
+    def test_make_request_rate_limit_exceeded(self):
+        self.instance._rate_limiter = MagicMock()
+        self.instance._rate_limiter.acquire.side_effect = RateLimitExceeded('Too many requests')
+        transport.OAuth2Session = MagicMock()
+
+        # Call the function
+        with self.assertRaises(RateLimitExceeded):
+            self.instance._make_request('get', 'http://example.com')
+
+        self.instance._rate_limiter.acquire.assert_called_once_with('catalogue', store_connector.plugins.toolkit.c.user)
+        self.assertEquals(0, transport.OAuth2Session.call_count)
+
+    @parameterized.expand([
+        ({},                                                    'auto',  None),
+        ({'ckan.storepublisher.compress_requests': 'True'},     'true',  True),
+        ({'ckan.storepublisher.compress_requests': 'false'},    'false', False),
+        ({'ckan.storepublisher.compress_requests': 'false',
+          'ckan.storepublisher.eu.compress_requests': 'auto'},  'auto',  None)
+    ])
+    def test_init_compression(self, extra_config, mode, supported):
+        config = self.config.copy()
+        config['ckan.storepublisher.eu.store_url'] = BASE_STORE_URL
+        config.update(extra_config)
+
+        instance = store_connector.StoreConnector(config, 'eu')
+        self.assertEquals(mode, instance.compress_requests)
+        self.assertEquals(supported, instance._compressed_requests)
+
+    def _mock_session(self, method, responses):
+        request = MagicMock()
+        req_method = MagicMock(side_effect=responses)
+        setattr(request, method, req_method)
+        transport.OAuth2Session = MagicMock(return_value=request)
+        return req_method
+
+    def _response(self, status_code, accept_encoding=None):
+        response = MagicMock()
+        response.status_code = status_code
+        response.headers = {} if accept_encoding is None else {'Accept-Encoding': accept_encoding}
+        return response
+
+    @parameterized.expand([
+        ('auto',  None,                     None),
+        ('auto',  'gzip',                   True),
+        ('auto',  'GZIP, deflate',          True),
+        ('auto',  'identity',               False),
+        ('false', 'gzip',                   False),
+        ('true',  'identity',               True)
+    ])
+    def test_make_request_compression_support(self, mode, accept_encoding, supported):
+        self.instance.compress_requests = mode
+        self.instance._compressed_requests = {'true': True, 'false': False}.get(mode)
+        self._mock_session('get', [self._response(200, accept_encoding)])
+
+        self.instance._make_request('get', 'http://example.com')
+
+        self.assertEquals(supported, self.instance._compressed_requests)
+
+    @parameterized.expand([
+        (None,  'gzip',     True),
+        (None,  None,       False),
+        (None,  'identity', False),
+        (True,  None,       True),
+        (False, 'gzip',     False)
+    ])
+    def test_accepts_compressed_requests(self, current_value, accept_encoding, expected):
+        self.instance._compressed_requests = current_value
+        # The probe is sent without the identity of the user
+        options = transport.requests.Session.return_value.options
+        options.side_effect = [self._response(200, accept_encoding)]
+        transport.OAuth2Session = MagicMock()
+
+        self.assertEquals(expected, self.instance._accepts_compressed_requests())
+        self.assertEquals(expected, self.instance._compressed_requests)
+
+        # The capability is only probed once
+        self.assertEquals(1 if current_value is None else 0, options.call_count)
+        self.instance._accepts_compressed_requests()
+        self.assertEquals(1 if current_value is None else 0, options.call_count)
+        self.assertEquals(0, transport.OAuth2Session.call_count)
+
+    def test_accepts_compressed_requests_probe_fails(self):
+        self.instance._compressed_requests = None
+        transport.requests.Session.return_value.options.side_effect = ConnectionError(EXCEPTION_MSG)
+
+        self.assertFalse(self.instance._accepts_compressed_requests())
+
+    @parameterized.expand([
+        (True,  [201],      True),
+        (False, [201],      False),
+        (True,  [415, 201], False),
+        (True,  [401, 201], True)
+    ])
+    def test_make_request_compressed(self, supported, status_codes, compressed):
+        url = 'http://example.com'
+        data = 'x' * 1000
+        self.instance._compressed_requests = supported
+        post = self._mock_session('post', [self._response(status_code) for status_code in status_codes])
+
+        self.instance._make_request('post', url, {'Content-Type': 'application/json'}, data, compress=True)
+
+        self.assertEquals(len(status_codes), post.call_count)
+        first_call, last_call = post.call_args_list[0], post.call_args_list[-1]
+        self.assertEquals(supported, first_call[1]['headers'].get('Content-Encoding') == 'gzip')
+
+        last_body = last_call[1]['data']
+        if compressed:
+            self.assertEquals('gzip', last_call[1]['headers']['Content-Encoding'])
+            self.assertIsInstance(last_body, store_connector.GzipBody)
+            last_body.seek(0)
+            self.assertEquals(data, zlib.decompress(last_body.read(), 31))
+        else:
+            self.assertNotIn('Content-Encoding', last_call[1]['headers'])
+            self.assertEquals(data, last_body)
+
+        # Stores that reject compressed requests are not sent compressed requests anymore
+        if 415 in status_codes:
+            self.assertFalse(self.instance._compressed_requests)
+
     def test_make_request_exception(self):
         method = 'get'
         url = 'http://example.com'
@@ -286,7 +582,7 @@ class StoreConnectorTest(unittest.TestCase):
         data = 'This is an example test...?'
 
         request = MagicMock()
-        store_connector.OAuth2Session = MagicMock(return_value=request)
+        transport.OAuth2Session = MagicMock(return_value=request)
         req_method = MagicMock(side_effect=ConnectionError)
         setattr(request, method, req_method)
 
@@ -299,8 +595,11 @@ class StoreConnectorTest(unittest.TestCase):
         (True,  '%s/search/resource/%s/%s/%s' % (BASE_STORE_URL, 'provider name', 'testResource', '1.0'), 'provider name', 'testResource', '1.0', False),
         (False, '',                                                                                       'provider_name', 'testResource', '1.0', False),
         (False, '%s/search/resource/%s/%s/%s' % (BASE_STORE_URL, 'provider name', 'testResource', '1.0'), 'provider name', 'testResource', '1.0', False),
+        # Secondary Stores do not update the acquire URL
+        (True, '',                                                                                        'provider_name', 'testResource', '1.0', False, False),
     ])
-    def test_update_acquire_url(self, private, acquire_url, resource_provider, resource_name, resource_version, should_update):
+    def test_update_acquire_url(self, private, acquire_url, resource_provider, resource_name, resource_version, should_update, manage_acquire_url=True):
+        self.instance.manage_acquire_url = manage_acquire_url
         c = store_connector.plugins.toolkit.c
         c.user = resource_provider
         package_update = MagicMock()
@@ -325,13 +624,24 @@ class StoreConnectorTest(unittest.TestCase):
 
         # Check that the acquire URL has been updated
         if should_update:
-            context = {'model': store_connector.model, 'session': store_connector.model.Session,
-                       'user': c.user or c.author, 'auth_user_obj': c.userobj,
-                       }
+            # The dataset is updated on behalf of the user of the connector
+            context = {'model': store_connector.model, 'session': store_connector.model.Session, 'user': c.user}
             package_update.assert_called_once_with(context, expected_dataset)
         else:
             self.assertEquals(0, package_update.call_count)
 
+    def test_update_acquire_url_deferred(self):
+        self.instance.defer_acquire_url = True
+        store_connector.plugins.toolkit.c.user = 'provider'
+        store_connector.plugins.toolkit.get_action = MagicMock()
+        dataset = {'private': True, 'acquire_url': ''}
+
+        self.instance._update_acquire_url(dataset, {'name': 'resource', 'version': '1.0'})
+
+        # The dataset is saved later by the caller
+        self.assertEquals('%s/search/resource/provider/resource/1.0' % BASE_STORE_URL, dataset['acquire_url'])
+        self.assertEquals(0, store_connector.plugins.toolkit.get_action.call_count)
+
     @parameterized.expand([
         ([], None),
         ([{'link': '%s/dataset/%s' % (BASE_SITE_URL, DATASET['id']), 'state': 'active', 'name': 'a', 'version': '1.0'}], 0),
@@ -375,6 +685,102 @@ class StoreConnectorTest(unittest.TestCase):
         if expected_resource is not None:
             self.instance._update_acquire_url.assert_called_once_with(dataset, current_user_resources[id_correct_resource])
 
+    @parameterized.expand([
+        ({},                                                    100, True),
+        ({'ckan.storepublisher.page_size': '0'},                0,   True),
+        ({'ckan.storepublisher.page_size': '20',
+          'ckan.storepublisher.prefetch_pages': 'False'},       20,  False)
+    ])
+    def test_get_resources(self, extra_config, page_size, prefetch):
+        instance = store_connector.StoreConnector(dict(self.config, **extra_config))
+        instance._make_request = MagicMock()
+        instance._make_request.return_value.json.return_value = []
+
+        listing = instance._get_resources()
+
+        # Resources are not retrieved until they are iterated
+        self.assertIsInstance(listing, store_connector.PagedListing)
+        self.assertEquals((page_size, prefetch), (listing.page_size, listing.prefetch))
+        self.assertEquals(0, instance._make_request.call_count)
+
+        self.assertEquals([], list(listing))
+        query = '?limit=%d&start=1' % page_size if page_size else ''
+        instance._make_request.assert_called_once_with('get', '%s/api/offering/resources%s' % (BASE_STORE_URL, query))
+
+    def test_get_offerings(self):
+        self.instance._make_request = MagicMock()
+        self.instance._make_request.return_value.json.return_value = [{'name': 'offering'}]
+
+        self.assertEquals([{'name': 'offering'}], list(self.instance._get_offerings()))
+        self.instance._make_request.assert_called_once_with('get', '%s/api/offering/offerings?filter=provided&limit=100&start=1' %
+                                                            BASE_STORE_URL)
+
+    def test_get_offerings_sorted(self):
+        self.instance._make_request = MagicMock()
+        self.instance._make_request.return_value.json.return_value = []
+
+        list(self.instance._get_offerings('published', 'date'))
+        self.instance._make_request.assert_called_once_with('get', '%s/api/offering/offerings?filter=published&limit=100&sort=date&start=1' %
+                                                            BASE_STORE_URL)
+
+    def test_get_existing_resource_stops(self):
+        dataset_url = '%s/dataset/%s' % (BASE_SITE_URL, DATASET['id'])
+        resources = [{'link': 'google.es', 'state': 'active'},
+                     {'link': dataset_url, 'state': 'active', 'name': 'a', 'version': '1.0'}]
+        consumed = []
+
+        def _resources():
+            for resource in resources:
+                consumed.append(resource)
+                yield resource
+            raise AssertionError('The whole catalogue should not be retrieved')
+
+        self.instance._get_resources = MagicMock(return_value=_resources())
+        self.instance._update_acquire_url = MagicMock()
+
+        result = self.instance._get_existing_resource(DATASET)
+
+        self.assertEquals('a', result['name'])
+        self.assertEquals(resources, consumed)
+
+    @parameterized.expand([
+        ({'name': 'a', 'version': '1.0'}, {'provider': 'user', 'name': 'a', 'version': '1.0'}),
+        (None,                            None)
+    ])
+    def test_get_existing_resource_prefetched(self, resource, expected_result):
+        self.instance._prefetcher = MagicMock()
+        self.instance._prefetcher.take.return_value = (True, resource)
+        self.instance._get_resources = MagicMock()
+        self.instance._update_acquire_url = MagicMock()
+        self.instance.identity = store_connector.StoreIdentity('user', {})
+
+        self.assertEquals(expected_result, self.instance._get_existing_resource(DATASET))
+
+        # The catalogue is not scanned again
+        self.instance._prefetcher.take.assert_called_once_with(('default', 'user', DATASET['id']))
+        self.assertEquals(0, self.instance._get_resources.call_count)
+        self.assertEquals(1 if resource else 0, self.instance._update_acquire_url.call_count)
+
+    def test_prefetch_resource(self):
+        self.instance._prefetcher = MagicMock()
+        self.instance._find_resource = MagicMock(return_value={'name': 'a'})
+
+        self.instance.prefetch_resource(DATASET)
+
+        key, find_resource = self.instance._prefetcher.start.call_args[0]
+        self.assertEquals(('default', store_connector.plugins.toolkit.c.user, DATASET['id']), key)
+        self.assertEquals({'name': 'a'}, find_resource())
+        self.instance._find_resource.assert_called_once_with(DATASET)
+
+    def test_delete_attached_resources_discards_prefetched(self):
+        self.instance._prefetcher = MagicMock()
+        self.instance._get_existing_resources = MagicMock(return_value=[])
+
+        self.instance.delete_attached_resources(DATASET)
+
+        self.instance._prefetcher.discard.assert_called_once_with(('default', store_connector.plugins.toolkit.c.user,
+                                                                   DATASET['id']))
+
     @parameterized.expand([
         (True,),
         (False,)
@@ -461,7 +867,10 @@ class StoreConnectorTest(unittest.TestCase):
         self.instance._create_resource = MagicMock(return_value=resource)
         self.instance._rollback = MagicMock()
         self.instance._make_request = MagicMock(side_effect=make_req_side_effect)
+        self.instance._journal_store = MagicMock()
+        self.instance._journal_store.load.return_value = None
         user_nickname = store_connector.plugins.toolkit.c.user = 'smg'
+        journal_key = (store_connector.DEFAULT_STORE, user_nickname, DATASET['id'], OFFERING_INFO_BASE['name'], OFFERING_INFO_BASE['version'])
 
         # Call the function
         try:
@@ -491,14 +900,225 @@ class StoreConnectorTest(unittest.TestCase):
             headers = {'Content-Type': 'application/json'}
             pkg_name = OFFERING_INFO_BASE['name']
             version = OFFERING_INFO_BASE['version']
-            check_make_request_calls(call_list[0], 'post', '%s/offerings' % base_url, headers, json.dumps(offering))
+            # The offering is streamed
+            body = call_list[0][0][3]
+            self.assertIsInstance(body, store_connector.JSONStreamBody)
+            check_make_request_calls(call_list[0], 'post', '%s/offerings' % base_url, headers, body)
+            self.assertEquals(json.dumps(offering), body.getvalue())
             check_make_request_calls(call_list[1], 'put', '%s/offerings/%s/%s/%s/tag' % (base_url, user_nickname, pkg_name, version), headers, json.dumps(tags))
             check_make_request_calls(call_list[2], 'post', '%s/offerings/%s/%s/%s/publish' % (base_url, user_nickname, pkg_name, version), headers, json.dumps({'marketplaces': []}))
 
+            # The journal is removed once the offering has been published
+            self.instance._journal_store.load.assert_called_once_with(journal_key)
+            self.instance._journal_store.delete.assert_called_once_with(journal_key)
+
+            # The offering is recorded so the dataset can be indexed as published
+            self.instance._publication_store.add.assert_called_once_with(store_connector.DEFAULT_STORE, DATASET['id'], user_nickname,
+                                                                         OFFERING_INFO_BASE, resource['name'], expected_result)
+
         except store_connector.StoreException as e:
-            self.instance._rollback.assert_called_once_with(OFFERING_INFO_BASE, offering_created)
             self.assertEquals(e.message, exception_text)
 
+            # Offerings are not rolled back automatically. The journal records the completed steps instead
+            self.assertEquals(0, self.instance._rollback.call_count)
+            self.assertEquals(0, self.instance._journal_store.delete.call_count)
+            journal = self.instance._journal_store.save.call_args[0][0]
+            self.assertEquals(journal_key, journal.key)
+            self.assertEquals(resource, journal.get_result(store_connector.RESOURCE_STEP))
+            self.assertEquals(offering_created, journal.is_completed(store_connector.OFFERING_STEP))
+            self.assertEquals(journal.steps[journal.next_step]['status'], 'failed')
+            self.assertEquals(0, self.instance._publication_store.add.call_count)
+
+    def test_create_offering_not_recorded(self):
+        self.instance._get_existing_resource = MagicMock(return_value={'provider': 'smg', 'name': 'resource', 'version': '1.0'})
+        self.instance._get_offering = MagicMock(return_value={})
+        self.instance._make_request = MagicMock()
+        self.instance._journal_store = MagicMock()
+        self.instance._journal_store.load.return_value = None
+        self.instance._publication_store.add.side_effect = Exception('Database error')
+        store_connector.plugins.toolkit.c.user = 'smg'
+
+        # The offering has been published even if it could not be recorded
+        result = self.instance.create_offering(DATASET, OFFERING_INFO_BASE)
+        self.assertTrue(result.startswith(BASE_STORE_URL + '/offering/smg/'))
+
+    def test_create_offering_partial(self):
+        resource = {'provider': 'smg', 'name': 'resource', 'version': '1.0'}
+        self.instance._get_existing_resource = MagicMock(return_value=resource)
+        self.instance._get_offering = MagicMock(return_value={})
+        self.instance._make_request = MagicMock()
+        self.instance._journal_store = MagicMock()
+        self.instance._journal_store.load.return_value = None
+        store_connector.plugins.toolkit.c.user = 'smg'
+        self._activity = store_connector.activity
+        store_connector.activity = MagicMock()
+
+        try:
+            # Batches create the offerings first and tag and publish them later
+            result = self.instance._publish_once(DATASET, OFFERING_INFO_BASE, None, store_connector.OFFERING_STEP)
+        finally:
+            activity, store_connector.activity = store_connector.activity, self._activity
+
+        self.assertIsNone(result)
+        self.assertEquals(1, self.instance._make_request.call_count)
+        journal = self.instance._journal_store.save.call_args[0][0]
+        self.assertTrue(journal.is_completed(store_connector.OFFERING_STEP))
+        self.assertEquals(store_connector.TAG_STEP, journal.next_step)
+        self.assertEquals(0, self.instance._journal_store.delete.call_count)
+        self.assertEquals(0, self.instance._publication_store.add.call_count)
+        self.assertEquals(0, activity.record_operation.call_count)
+
+    def test_create_offering_locked(self):
+        self.instance._publish = MagicMock(return_value='http://store/offering')
+        store_connector.plugins.toolkit.c.user = 'smg'
+
+        result = self.instance.create_offering(DATASET, OFFERING_INFO_BASE)
+
+        self.assertEquals('http://store/offering', result)
+        self.instance._dataset_lock.hold.assert_called_once_with(store_connector.DEFAULT_STORE, DATASET['id'])
+        lock = self.instance._dataset_lock.hold.return_value
+        self.assertEquals(1, lock.__enter__.call_count)
+        self.assertEquals(1, lock.__exit__.call_count)
+        self.instance._publish.assert_called_once_with(DATASET, OFFERING_INFO_BASE, None, store_connector.PUBLISH_STEP)
+        get_offering_url = self.instance._publication_store.get_offering_url
+        self.assertEquals((store_connector.DEFAULT_STORE, DATASET['id'], 'smg', OFFERING_INFO_BASE),
+                          get_offering_url.call_args[0][:4])
+
+    def test_create_offering_coalesced(self):
+        # The offering was published by another request while this one was waiting
+        self.instance._publish = MagicMock()
+        self.instance._publication_store.get_offering_url.return_value = 'http://store/offering'
+
+        result = self.instance.create_offering(DATASET, OFFERING_INFO_BASE)
+
+        self.assertEquals('http://store/offering', result)
+        self.assertEquals(0, self.instance._publish.call_count)
+
+    def test_create_offering_lock_timeout(self):
+        self.instance._publish = MagicMock()
+        self.instance._dataset_lock.hold.return_value.__enter__.side_effect = store_connector.LockTimeout(EXCEPTION_MSG)
+
+        with self.assertRaises(store_connector.StoreException) as e:
+            self.instance.create_offering(DATASET, OFFERING_INFO_BASE)
+
+        self.assertEquals(EXCEPTION_MSG, e.exception.message)
+        self.assertEquals(0, self.instance._publish.call_count)
+
+    @parameterized.expand([
+        (store_connector.RESOURCE_STEP, 4),
+        (store_connector.OFFERING_STEP, 3),
+        (store_connector.TAG_STEP,      2),
+        (store_connector.PUBLISH_STEP,  1)
+    ])
+    def test_create_offering_resume(self, failed_step, n_requests):
+        resource = {
+            'provider': 'provider name',
+            'name': 'resource name',
+            'version': 'resource version'
+        }
+        self.instance._get_offering = MagicMock(return_value={'offering': 1})
+        self.instance._get_existing_resource = MagicMock(return_value=resource)
+        self.instance._create_resource = MagicMock()
+        self.instance._make_request = MagicMock()
+        user_nickname = store_connector.plugins.toolkit.c.user = 'smg'
+
+        # Set the journal of the previous attempt
+        journal_key = (store_connector.DEFAULT_STORE, user_nickname, DATASET['id'], OFFERING_INFO_BASE['name'], OFFERING_INFO_BASE['version'])
+        journal = store_connector.SagaJournal(journal_key)
+        for step in STEPS[:STEPS.index(failed_step)]:
+            journal.complete(step, resource if step == store_connector.RESOURCE_STEP else None)
+        journal.fail(failed_step, 'Timeout')
+        self.instance._journal_store = MagicMock()
+        self.instance._journal_store.load.return_value = journal
+
+        # Call the function
+        self.instance.create_offering(DATASET, OFFERING_INFO_BASE)
+
+        # Only the pending steps are run
+        get_resource_calls = 1 if failed_step == store_connector.RESOURCE_STEP else 0
+        self.assertEquals(get_resource_calls, self.instance._get_existing_resource.call_count)
+        self.assertEquals(n_requests - get_resource_calls, self.instance._make_request.call_count)
+        if failed_step in (store_connector.RESOURCE_STEP, store_connector.OFFERING_STEP):
+            self.instance._get_offering.assert_called_once_with(OFFERING_INFO_BASE, resource)
+        self.instance._journal_store.delete.assert_called_once_with(journal_key)
+
+    @parameterized.expand([
+        (None,                           False, False),
+        (store_connector.RESOURCE_STEP,  True,  False),
+        (store_connector.OFFERING_STEP,  True,  False),
+        (store_connector.TAG_STEP,       True,  True),
+        (store_connector.PUBLISH_STEP,   True,  True),
+        ('completed',                    False, False)
+    ])
+    def test_abort_offering(self, failed_step, pending, offering_created):
+        user_nickname = store_connector.plugins.toolkit.c.user = 'smg'
+        journal_key = (store_connector.DEFAULT_STORE, user_nickname, DATASET['id'], OFFERING_INFO_BASE['name'], OFFERING_INFO_BASE['version'])
+
+        if failed_step is None:
+            journal = None
+        else:
+            journal = store_connector.SagaJournal(journal_key)
+            for step in STEPS:
+                if step == failed_step:
+                    journal.fail(step, 'Error')
+                    break
+                journal.complete(step)
+
+        self.instance._journal_store = MagicMock()
+        self.instance._journal_store.load.return_value = journal
+        self.instance._rollback = MagicMock()
+
+        # Call the function
+        self.assertEquals(pending, self.instance.abort_offering(DATASET, OFFERING_INFO_BASE))
+
+        self.instance._journal_store.load.assert_called_once_with(journal_key)
+        if pending:
+            self.instance._rollback.assert_called_once_with(OFFERING_INFO_BASE, offering_created)
+            self.instance._journal_store.delete.assert_called_once_with(journal_key)
+        else:
+            self.assertEquals(0, self.instance._rollback.call_count)
+            self.assertEquals(0, self.instance._journal_store.delete.call_count)
+
+    def test_create_offering_known_resource(self):
+        resource = {
+            'provider': 'provider name',
+            'name': 'resource name',
+            'version': 'resource version'
+        }
+        self.instance._get_offering = MagicMock(return_value={'offering': 1})
+        self.instance._get_existing_resource = MagicMock()
+        self.instance._create_resource = MagicMock()
+        self.instance._make_request = MagicMock()
+        self.instance._journal_store = MagicMock()
+        self.instance._journal_store.load.return_value = None
+        store_connector.plugins.toolkit.c.user = 'smg'
+
+        # Call the function
+        self.instance.create_offering(DATASET, OFFERING_INFO_BASE, resource)
+
+        # The Store is not queried to get the resource
+        self.assertEquals(0, self.instance._get_existing_resource.call_count)
+        self.assertEquals(0, self.instance._create_resource.call_count)
+        self.instance._get_offering.assert_called_once_with(OFFERING_INFO_BASE, resource)
+        self.assertEquals(3, self.instance._make_request.call_count)
+
+    @parameterized.expand([
+        ('resource name', '1.0', {'description': 'New description'}),
+        ('resource',      '2.0', {'name': 'New name', 'description': 'New description'})
+    ])
+    def test_update_resource(self, name, version, changes):
+        user_nickname = 'smg'
+        store_connector.plugins.toolkit.c.user = user_nickname
+        self.instance._make_request = MagicMock()
+
+        # Call the function
+        self.instance.update_resource({'name': name, 'version': version}, changes)
+
+        headers = {'Content-Type': 'application/json'}
+        self.instance._make_request.assert_called_once_with('put', '%s/api/offering/resources/%s/%s/%s' %
+                                                            (BASE_STORE_URL, user_nickname, name.replace(' ', '%20'), version),
+                                                            headers, json.dumps(changes))
+
     @parameterized.expand([
         ([], []),
         ([{'link': '%s/dataset/%s' % (BASE_SITE_URL, DATASET['id']), 'state': 'active', 'name': 'a', 'version': '1.0'}], [0]),
@@ -538,3 +1158,389 @@ class StoreConnectorTest(unittest.TestCase):
             resource = current_user_resources[valid_resource_id]
             self.instance._make_request.assert_any_call('delete', '%s/api/offering/resources/%s/%s/%s' %
                                                         (BASE_STORE_URL, user_nickname, resource['name'], resource['version']))
+
+
+    def test_with_identity(self):
+        identity = store_connector.StoreIdentity('aitor', {'access_token': 'token'})
+
+        connector = self.instance.with_identity(identity)
+
+        self.assertIsNot(self.instance, connector)
+        self.assertIsNone(self.instance.identity)
+        self.assertIs(identity, connector.identity)
+        self.assertIs(self.instance._transport, connector._transport)
+        self.assertIs(self.instance._rate_limiter, connector._rate_limiter)
+
+        # Bound connectors share the state of the Store
+        connector._compressed_requests = True
+        self.assertTrue(self.instance._compressed_requests)
+
+    def test_make_request_identity(self):
+        # Bound connectors do not use the context of the request
+        store_connector.plugins.toolkit.c = None
+        self.instance._rate_limiter = MagicMock()
+        refresh_token = MagicMock(return_value={'access_token': 'new_token'})
+        identity = store_connector.StoreIdentity('aitor', {'access_token': 'token'}, refresh_token)
+        connector = self.instance.with_identity(identity)
+
+        responses = [MagicMock(status_code=401), MagicMock(status_code=200)]
+        request = MagicMock()
+        request.get.side_effect = responses
+        transport.OAuth2Session = MagicMock(return_value=request)
+
+        self.assertEquals(responses[1], connector._make_request('get', BASE_STORE_URL + '/api/offering/resources'))
+
+        refresh_token.assert_called_once_with()
+        self.assertEquals([{'token': {'access_token': 'token'}}, {'token': {'access_token': 'new_token'}}],
+                          [call[1] for call in transport.OAuth2Session.call_args_list])
+        self.assertEquals({'access_token': 'new_token'}, identity.token)
+        self.instance._rate_limiter.acquire.assert_called_with(store_connector.get_endpoint('get'), 'aitor')
+
+    def test_get_identity(self):
+        store_connector.plugins.toolkit.c.user = 'smg'
+        store_connector.plugins.toolkit.c.usertoken = {'access_token': 'token'}
+
+        # Connectors that are not bound act on behalf of the user of the request
+        identity = self.instance._get_identity()
+        self.assertEquals(('smg', {'access_token': 'token'}), (identity.user, identity.token))
+
+        bound_identity = store_connector.StoreIdentity('aitor', {})
+        self.assertIs(bound_identity, self.instance.with_identity(bound_identity)._get_identity())
+
+    def test_get_listing_bound(self):
+        # Pages can be retrieved in background, so listings are bound to the user of the request
+        store_connector.plugins.toolkit.c.user = 'smg'
+        self.instance._make_request = MagicMock()
+        self.instance._make_request.return_value.json.return_value = []
+        self.instance.page_size = 0
+
+        self.assertEquals([], list(self.instance._get_resources()))
+        self.assertEquals(1, self.instance._make_request.call_count)
+
+    @parameterized.expand([
+        ({}, {'name': 'Offering 1', 'description': '', 'license_title': '', 'license_description': '', 'tags': [],
+              'price': 0.0, 'is_open': False}),
+        ({'tags': ['dataset', 'tag1'], 'open': True,
+          'offering_description': {'description': 'Desc', 'legal': [{'title': 'CC', 'text': 'License'}],
+                                   'pricing': {'price_plans': [{'price_components': [{'value': '2.5'}]}]}}},
+         {'name': 'Offering 1', 'description': 'Desc', 'license_title': 'CC', 'license_description': 'License',
+          'tags': ['tag1'], 'price': 2.5, 'is_open': True}),
+        ({'offering_description': {'legal': {'title': 'CC', 'text': 'License'}, 'pricing': {'price_plans': []}}},
+         {'name': 'Offering 1', 'description': '', 'license_title': 'CC', 'license_description': 'License',
+          'tags': [], 'price': 0.0, 'is_open': False})
+    ])
+    def test_get_offering_info(self, offering, expected):
+        self.assertEquals(expected, self.instance._get_offering_info(dict(offering, name='Offering 1')))
+
+    @parameterized.expand([
+        ({}, '/media/image.png', True),
+        ({}, 'http://media.example.com/image.png', True),
+        ({'image_base64': 'new image', 'description': 'New'}, '/media/image.png', False),
+        ({}, None, False)
+    ])
+    def test_create_offering_version(self, changes, image_url, image_copied):
+        offering = {'name': 'Offering 1', 'version': '1.0', 'tags': ['tag1'], 'open': True,
+                    'offering_description': {'description': 'Desc'},
+                    'resources': [{'name': 'resource', 'version': '1.0', 'link': 'http://dataset'}]}
+        if image_url:
+            offering['image_url'] = image_url
+        responses = {'offering': MagicMock(json=MagicMock(return_value=offering)),
+                     'image': MagicMock(content='image')}
+        self.instance._make_request = MagicMock(side_effect=lambda method, url: responses['offering' if '/api/' in url else 'image'])
+        self.instance.create_offering = MagicMock(return_value='http://store/offering')
+        store_connector.plugins.toolkit.c.user = 'smg'
+        changes = dict(changes, version='1.1')
+
+        if image_url is None and not changes.get('image_base64'):
+            with self.assertRaises(store_connector.StoreException) as e:
+                self.instance.create_offering_version(DATASET, {'name': 'Offering 1', 'version': '1.0'}, changes)
+            self.assertEquals('The offering Offering 1 has no image', e.exception.message)
+            self.assertEquals(0, self.instance.create_offering.call_count)
+            return
+
+        result = self.instance.create_offering_version(DATASET, {'name': 'Offering 1', 'version': '1.0'}, changes)
+
+        self.assertEquals('http://store/offering', result)
+        self.assertEquals(('get', '%s/api/offering/offerings/smg/Offering%%201/1.0' % BASE_STORE_URL),
+                          self.instance._make_request.call_args_list[0][0])
+
+        offering_info, resource = self.instance.create_offering.call_args[0][1:]
+        self.assertEquals({'provider': 'smg', 'name': 'resource', 'version': '1.0'}, resource)
+        self.assertEquals(('Offering 1', '1.1', ['tag1'], True, DATASET['id']),
+                          (offering_info['name'], offering_info['version'], offering_info['tags'],
+                           offering_info['is_open'], offering_info['pkg_id']))
+        self.assertEquals(changes.get('description', 'Desc'), offering_info['description'])
+
+        if image_copied:
+            expected_url = image_url if image_url.startswith('http') else BASE_STORE_URL + image_url
+            self.assertEquals(('get', expected_url), self.instance._make_request.call_args_list[1][0])
+            self.assertEquals(base64.b64encode('image'), offering_info['image_base64'])
+        else:
+            self.assertEquals(1, self.instance._make_request.call_count)
+            self.assertEquals('new image', offering_info['image_base64'])
+
+    @parameterized.expand([
+        (ConnectionError('Error'), CONNECTION_ERROR_MSG),
+        (store_connector.StoreException(EXCEPTION_MSG), EXCEPTION_MSG)
+    ])
+    def test_create_offering_version_not_found(self, error, expected_msg):
+        self.instance._make_request = MagicMock(side_effect=error)
+        self.instance.create_offering = MagicMock()
+
+        with self.assertRaises(store_connector.StoreException) as e:
+            self.instance.create_offering_version(DATASET, {'name': 'Offering 1', 'version': '1.0'}, {'version': '1.1'})
+
+        self.assertEquals(expected_msg, e.exception.message)
+        self.assertEquals(0, self.instance.create_offering.call_count)
+
+
+class MultiStoreConnectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self._StoreConnector = store_connector.StoreConnector
+        self._run_concurrently = store_connector.run_concurrently
+        self._search = store_connector.search
+        store_connector.search = MagicMock()
+
+        self._StoreIdentity = store_connector.StoreIdentity
+        store_connector.StoreIdentity = MagicMock()
+
+        def _store_connector_side_effect(config, store_name=None):
+            connector = MagicMock()
+            connector.name = store_name or store_connector.DEFAULT_STORE
+            # Bound connectors are the connector itself to check the calls easily
+            connector.with_identity.return_value = connector
+            return connector
+        store_connector.StoreConnector = MagicMock(side_effect=_store_connector_side_effect)
+
+        # Tasks are run sequentially to check the results easily
+        def _run_concurrently_side_effect(tasks):
+            results = []
+            for task in tasks:
+                try:
+                    results.append((task(), None))
+                except Exception as e:
+                    results.append((None, e))
+            return results
+        store_connector.run_concurrently = MagicMock(side_effect=_run_concurrently_side_effect)
+
+    def tearDown(self):
+        store_connector.StoreConnector = self._StoreConnector
+        store_connector.run_concurrently = self._run_concurrently
+        store_connector.search = self._search
+        store_connector.StoreIdentity = self._StoreIdentity
+
+    @parameterized.expand([
+        ({},                                               [store_connector.DEFAULT_STORE]),
+        ({'ckan.storepublisher.stores': 'eu'},             ['eu']),
+        ({'ckan.storepublisher.stores': 'eu us  asia'},    ['eu', 'us', 'asia'])
+    ])
+    def test_init(self, config, store_names):
+        instance = store_connector.MultiStoreConnector(config)
+
+        self.assertEquals(store_names, instance.connectors.keys())
+        for store_name, connector in instance.connectors.items():
+            self.assertEquals(store_name, connector.name)
+
+        # Only the first Store updates the acquire URL. It is saved once all the Stores finish
+        self.assertNotEquals(False, instance.connectors.values()[0].manage_acquire_url)
+        for connector in instance.connectors.values()[1:]:
+            self.assertFalse(connector.manage_acquire_url)
+        for connector in instance.connectors.values():
+            self.assertTrue(connector.defer_acquire_url)
+
+    def test_create_offering(self):
+        instance = store_connector.MultiStoreConnector({'ckan.storepublisher.stores': 'eu us asia'})
+        instance.connectors['eu'].create_offering.return_value = 'http://eu.example.com/offering'
+        instance.connectors['us'].create_offering.side_effect = store_connector.StoreException(EXCEPTION_MSG)
+        instance.connectors['asia'].create_offering.side_effect = ValueError(EXCEPTION_MSG)
+
+        results = instance.create_offering(DATASET, OFFERING_INFO_BASE)
+
+        self.assertEquals(['eu', 'us', 'asia'], results.keys())
+        self.assertEquals('http://eu.example.com/offering', results['eu'])
+        self.assertIsInstance(results['us'], store_connector.StoreException)
+        self.assertEquals(EXCEPTION_MSG, results['us'].message)
+        self.assertIsInstance(results['asia'], store_connector.StoreException)
+        self.assertEquals(EXCEPTION_MSG, results['asia'].message)
+
+        for connector in instance.connectors.values():
+            connector.create_offering.assert_called_once_with(DATASET, OFFERING_INFO_BASE)
+        self.assertEquals(1, store_connector.run_concurrently.call_count)
+
+        # The dataset is indexed again with its new offering
+        store_connector.search.rebuild.assert_called_once_with(DATASET['id'])
+
+    @parameterized.expand([
+        ('',                           None),
+        ('http://eu.example.com/res',  None),
+        ('http://eu.example.com/res',  Exception('Validation error'))
+    ])
+    def test_create_offering_acquire_url(self, acquire_url, save_error):
+        instance = store_connector.MultiStoreConnector({'ckan.storepublisher.stores': 'eu us'})
+        dataset = dict(DATASET, acquire_url='')
+        saved = []
+
+        def _create_offering(dataset, offering_info):
+            dataset['acquire_url'] = acquire_url or dataset['acquire_url']
+            return 'http://eu.example.com/offering'
+        instance.connectors['eu'].create_offering.side_effect = _create_offering
+
+        def _save_acquire_url(dataset):
+            if save_error is not None:
+                raise save_error
+            saved.append(store_connector.run_concurrently.call_count)
+        instance.connectors['eu']._save_acquire_url.side_effect = _save_acquire_url
+
+        results = instance.create_offering(dataset, OFFERING_INFO_BASE)
+
+        # The acquire URL is only saved once the Stores finish
+        self.assertEquals('http://eu.example.com/offering', results['eu'])
+        self.assertEquals(1 if acquire_url else 0, instance.connectors['eu']._save_acquire_url.call_count)
+        self.assertEquals([1] if acquire_url and save_error is None else [], saved)
+        self.assertEquals(0, instance.connectors['us']._save_acquire_url.call_count)
+
+    @parameterized.expand([
+        (False, None),
+        (True,  None),
+        (True,  Exception('Solr is down'))
+    ])
+    def test_create_offering_reindex(self, published, index_error):
+        instance = store_connector.MultiStoreConnector({'ckan.storepublisher.stores': 'eu us'})
+        instance.connectors['eu'].create_offering.side_effect = store_connector.StoreException(EXCEPTION_MSG)
+        if published:
+            instance.connectors['us'].create_offering.return_value = 'http://us.example.com/offering'
+        else:
+            instance.connectors['us'].create_offering.side_effect = store_connector.StoreException(EXCEPTION_MSG)
+        store_connector.search.rebuild.side_effect = index_error
+
+        results = instance.create_offering(DATASET, OFFERING_INFO_BASE)
+
+        # Index errors do not change the result of the publication
+        self.assertEquals(published, not isinstance(results['us'], store_connector.StoreException))
+        self.assertEquals(1 if published else 0, store_connector.search.rebuild.call_count)
+
+    def test_delete_attached_resources(self):
+        instance = store_connector.MultiStoreConnector({'ckan.storepublisher.stores': 'eu us'})
+        error = ConnectionError(EXCEPTION_MSG)
+        instance.connectors['us'].delete_attached_resources.side_effect = error
+
+        results = instance.delete_attached_resources(DATASET)
+
+        self.assertEquals({'eu': None, 'us': error}, results)
+        for connector in instance.connectors.values():
+            connector.delete_attached_resources.assert_called_once_with(DATASET)
+
+    @parameterized.expand([
+        ('delete_attached_resources', (DATASET,)),
+        ('create_offering',           (DATASET, OFFERING_INFO_BASE)),
+        ('create_offering_version',   (DATASET, {'name': 'Offering', 'version': '1.0'}, {'version': '1.1'})),
+        ('abort_offering',            (DATASET, OFFERING_INFO_BASE))
+    ])
+    def test_limited(self, method, args):
+        instance = store_connector.MultiStoreConnector({'ckan.storepublisher.stores': 'eu us'})
+        bulkhead = instance._bulkhead = MagicMock()
+
+        getattr(instance, method)(*args)
+
+        # Operations that wait for the Stores are run in the slots of the bulkhead
+        bulkhead.enter.assert_called_once_with()
+        self.assertEquals(1, bulkhead.enter.return_value.__enter__.call_count)
+        self.assertEquals(1, bulkhead.enter.return_value.__exit__.call_count)
+
+        # The Stores are not contacted when the bulkhead is full
+        bulkhead.enter.return_value.__enter__.side_effect = BulkheadFull('Full')
+        self.assertRaises(BulkheadFull, getattr(instance, method), *args)
+        for connector in instance.connectors.values():
+            self.assertEquals(1, getattr(connector, method).call_count)
+
+    def test_probe_not_limited(self):
+        instance = store_connector.MultiStoreConnector({'ckan.storepublisher.stores': 'eu us'})
+        instance._bulkhead = MagicMock()
+
+        # Health checks run in background, so they do not take any slot
+        instance.probe()
+        self.assertEquals(0, instance._bulkhead.enter.call_count)
+
+    def test_prefetch_resource(self):
+        instance = store_connector.MultiStoreConnector({'ckan.storepublisher.stores': 'eu us'})
+        instance._bulkhead = MagicMock()
+
+        instance.prefetch_resource(DATASET)
+
+        # Lookups run in background, so they do not take any slot
+        self.assertEquals(0, instance._bulkhead.enter.call_count)
+        for connector in instance.connectors.values():
+            connector.prefetch_resource.assert_called_once_with(DATASET)
+
+    def test_with_identity(self):
+        instance = store_connector.MultiStoreConnector({'ckan.storepublisher.stores': 'eu us'})
+        identity = MagicMock()
+
+        bound_instance = instance.with_identity(identity)
+
+        self.assertIs(identity, bound_instance.identity)
+        self.assertIsNone(instance.identity)
+        for store_name, connector in instance.connectors.items():
+            connector.with_identity.assert_called_once_with(identity)
+            self.assertIs(connector.with_identity.return_value, bound_instance.connectors[store_name])
+
+    def test_bound_to_request(self):
+        instance = store_connector.MultiStoreConnector({'ckan.storepublisher.stores': 'eu us'})
+        identity = store_connector.StoreIdentity.from_request.return_value
+
+        instance.create_offering(DATASET, OFFERING_INFO_BASE)
+        instance.probe()
+
+        # Stores are contacted from other threads on behalf of the user of the request
+        store_connector.StoreIdentity.from_request.assert_called_once_with()
+        for connector in instance.connectors.values():
+            connector.with_identity.assert_called_once_with(identity)
+
+    def test_create_offering_version(self):
+        instance = store_connector.MultiStoreConnector({'ckan.storepublisher.stores': 'eu us'})
+        instance.connectors['eu'].create_offering_version.return_value = 'http://eu.example.com/offering'
+        instance.connectors['us'].create_offering_version.side_effect = ValueError(EXCEPTION_MSG)
+        base_offering = {'name': 'Offering 1', 'version': '1.0'}
+
+        results = instance.create_offering_version(DATASET, base_offering, {'version': '1.1'})
+
+        self.assertEquals(['eu', 'us'], results.keys())
+        self.assertEquals('http://eu.example.com/offering', results['eu'])
+        self.assertIsInstance(results['us'], store_connector.StoreException)
+        for connector in instance.connectors.values():
+            connector.create_offering_version.assert_called_once_with(DATASET, base_offering, {'version': '1.1'})
+        store_connector.search.rebuild.assert_called_once_with(DATASET['id'])
+
+    def test_abort_offering(self):
+        instance = store_connector.MultiStoreConnector({'ckan.storepublisher.stores': 'eu us asia'})
+        error = Exception(EXCEPTION_MSG)
+        instance.connectors['eu'].abort_offering.return_value = True
+        instance.connectors['us'].abort_offering.return_value = False
+        instance.connectors['asia'].abort_offering.side_effect = error
+
+        results = instance.abort_offering(DATASET, OFFERING_INFO_BASE)
+
+        self.assertEquals(['eu', 'us', 'asia'], results.keys())
+        self.assertEquals([True, False, error], results.values())
+        for connector in instance.connectors.values():
+            connector.abort_offering.assert_called_once_with(DATASET, OFFERING_INFO_BASE)
+
+    def test_warm_up(self):
+        instance = store_connector.MultiStoreConnector({'ckan.storepublisher.stores': 'eu us'})
+        error = ConnectionError(EXCEPTION_MSG)
+        instance.connectors['eu'].warm_up.return_value = 2
+        instance.connectors['us'].warm_up.side_effect = error
+
+        results = instance.warm_up()
+
+        self.assertEquals(['eu', 'us'], results.keys())
+        self.assertEquals([2, error], results.values())
+
+    def test_probe(self):
+        instance = store_connector.MultiStoreConnector({'ckan.storepublisher.stores': 'eu us'})
+        error = ConnectionError(EXCEPTION_MSG)
+        instance.connectors['eu'].probe.return_value = 0.1
+        instance.connectors['us'].probe.side_effect = error
+
+        self.assertEquals([('eu', (0.1, None)), ('us', (None, error))], instance.probe().items())
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.streaming as streaming
+
+import base64
+import json
+import os
+import tempfile
+import unittest
+import zlib
+
+from collections import OrderedDict
+from mock import MagicMock
+from nose_parameterized import parameterized
+from StringIO import StringIO
+
+
+class ChunkedFile(object):
+    '''File that returns less data than requested'''
+
+    def __init__(self, content, max_read):
+        self._file = StringIO(content)
+        self.max_read = max_read
+
+    def read(self, size):
+        return self._file.read(min(size, self.max_read))
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+
+class Base64StreamTest(unittest.TestCase):
+
+    @parameterized.expand([
+        ('',),
+        ('a',),
+        ('ab',),
+        ('abc',),
+        ('x' * (streaming.READ_SIZE * 3 + 1),)
+    ])
+    def test_encode(self, content):
+        stream = streaming.Base64Stream(StringIO(content))
+
+        encoded = ''.join(stream)
+        self.assertEquals(base64.b64encode(content), encoded)
+        self.assertEquals(len(encoded), stream.encoded_length())
+
+        # The stream can be read several times
+        self.assertEquals(encoded, ''.join(stream))
+
+    @parameterized.expand([
+        (1,),
+        (2,),
+        (1000,)
+    ])
+    def test_encode_partial_reads(self, max_read):
+        content = os.urandom(5000)
+        stream = streaming.Base64Stream(ChunkedFile(content, max_read))
+        self.assertEquals(base64.b64encode(content), ''.join(stream))
+
+    def test_encode_from_current_position(self):
+        fileobj = StringIO('headerimage')
+        fileobj.read(6)
+
+        stream = streaming.Base64Stream(fileobj)
+        self.assertEquals(base64.b64encode('image'), ''.join(stream))
+        self.assertEquals(len(base64.b64encode('image')), stream.encoded_length())
+
+    def test_encode_real_file(self):
+        content = os.urandom(streaming.READ_SIZE + 7)
+        with tempfile.TemporaryFile() as fileobj:
+            fileobj.write(content)
+            fileobj.seek(0)
+            stream = streaming.Base64Stream(fileobj)
+            self.assertEquals(base64.b64encode(content), ''.join(stream))
+            self.assertEquals(len(base64.b64encode(content)), stream.encoded_length())
+
+    @parameterized.expand([
+        ({'tell.side_effect': IOError('Not seekable')},),
+        ({'tell.return_value': 0, 'seek.side_effect': IOError('Not seekable')},)
+    ])
+    def test_not_seekable(self, attributes):
+        fileobj = MagicMock(**attributes)
+        self.assertRaises(ValueError, streaming.Base64Stream, fileobj)
+
+
+class JSONStreamBodyTest(unittest.TestCase):
+
+    def _get_document(self, image_content):
+        return OrderedDict([
+            ('name', u'Offering ñ'),
+            ('version', '1.0'),
+            ('price', 3.5),
+            ('open', False),
+            ('notification_url', None),
+            ('image', {'name': 'ckan.png', 'data': streaming.Base64Stream(StringIO(image_content))}),
+            ('resources', [{'name': 'resource', 'version': '1.0'}, {}]),
+            ('related_images', [])
+        ])
+
+    def _get_expected(self, document, image_content):
+        expected = document.copy()
+        expected['image'] = {'name': 'ckan.png', 'data': base64.b64encode(image_content)}
+        return json.dumps(expected)
+
+    @parameterized.expand([
+        ('',),
+        ('image data',),
+        ('x' * (streaming.CHUNK_SIZE * 2),)
+    ])
+    def test_iter(self, image_content):
+        document = self._get_document(image_content)
+        body = streaming.JSONStreamBody(document)
+
+        expected = self._get_expected(document, image_content)
+        self.assertEquals(expected, ''.join(body))
+        self.assertEquals(len(expected), len(body))
+
+        # Chunks are not bigger than needed
+        for chunk in body:
+            self.assertLess(len(chunk), streaming.CHUNK_SIZE + streaming.READ_SIZE * 2)
+
+    @parameterized.expand([
+        (1,),
+        (100,),
+        (8192,),
+        (-1,)
+    ])
+    def test_read(self, size):
+        image_content = os.urandom(streaming.CHUNK_SIZE)
+        document = self._get_document(image_content)
+        body = streaming.JSONStreamBody(document)
+
+        def _read_all():
+            chunks = []
+            while True:
+                chunk = body.read(size)
+                if not chunk:
+                    return ''.join(chunks)
+                if size > 0:
+                    self.assertLessEqual(len(chunk), size)
+                chunks.append(chunk)
+
+        expected = self._get_expected(document, image_content)
+        self.assertEquals(expected, _read_all())
+
+        # The body can be rewound to send it again
+        body.seek(0)
+        self.assertEquals(expected, _read_all())
+
+    def test_seek_not_supported(self):
+        body = streaming.JSONStreamBody({})
+        with self.assertRaises(IOError):
+            body.seek(5)
+
+    def test_getvalue(self):
+        self.assertEquals(json.dumps({'a': [1, 2]}), streaming.JSONStreamBody({'a': [1, 2]}).getvalue())
+
+
+class GzipBodyTest(unittest.TestCase):
+
+    def setUp(self):
+        self._max_in_memory = streaming.MAX_COMPRESSED_IN_MEMORY
+
+    def tearDown(self):
+        streaming.MAX_COMPRESSED_IN_MEMORY = self._max_in_memory
+
+    @parameterized.expand([
+        ('',),
+        ('{"name": "offering"}',),
+        ('x' * (streaming.CHUNK_SIZE * 3),),
+        (streaming.JSONStreamBody({'image': streaming.Base64Stream(StringIO(os.urandom(100000)))}),)
+    ])
+    def test_compress(self, body):
+        # Force the compressed content to be stored in disk
+        streaming.MAX_COMPRESSED_IN_MEMORY = 1024
+        content = body if isinstance(body, basestring) else body.getvalue()
+
+        gzip_body = streaming.GzipBody(body)
+
+        compressed = gzip_body.read()
+        self.assertEquals(len(compressed), len(gzip_body))
+        self.assertEquals(content, zlib.decompress(compressed, 31))
+
+        # The body can be rewound and iterated
+        gzip_body.seek(0)
+        self.assertEquals(compressed, gzip_body.read())
+        self.assertEquals(compressed, ''.join(gzip_body))
@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.batch_connector as batch_connector
+import ckanext.storepublisher.store_connector as store_connector
+import ckanext.storepublisher.transport as transport
+import base64
+import copy
+import json
+import threading
+import unittest
+import zlib
+
+from ckanext.storepublisher.identity import StoreIdentity
+from ckanext.storepublisher.prefetch import ResourcePrefetcher
+from ckanext.storepublisher.resource_sync import ResourceSynchronizer
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+STORE_URL = 'https://store.example.com'
+IMAGE = base64.b64encode('PNG image data')
+
+DATASET = {
+    'id': 'example_id',
+    'title': u'Dataset A',
+    'notes': 'Dataset description',
+    'private': False
+}
+
+OFFERING_INFO = {
+    'pkg_id': 'example_id',
+    'name': 'Offering 1',
+    'description': 'Offering description',
+    'version': '1.0',
+    'tags': ['tag1', 'tag2'],
+    'license_title': 'Creative Commons',
+    'license_description': 'License description',
+    'price': 1.5,
+    'is_open': True,
+    'image_base64': IMAGE
+}
+
+
+class HTTPTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self._requests = transport.requests
+        transport.requests = MagicMock()
+        self._OAuth2Session = transport.OAuth2Session
+        transport.OAuth2Session = MagicMock()
+
+    def tearDown(self):
+        transport.requests = self._requests
+        transport.OAuth2Session = self._OAuth2Session
+
+    @parameterized.expand([
+        (None, {}),
+        (2.5,  {'timeout': 2.5})
+    ])
+    def test_send(self, timeout, extra_kwargs):
+        instance = transport.HTTPTransport({'ckan.storepublisher.pool_size': '3'}, STORE_URL)
+        identity = StoreIdentity('user', {'access_token': 'token'})
+        session = transport.OAuth2Session.return_value
+
+        response = instance.send('post', STORE_URL + '/api/offering/resources', {'a': 'b'}, 'data', identity, timeout)
+
+        self.assertEquals(session.post.return_value, response)
+        transport.requests.adapters.HTTPAdapter.assert_called_once_with(pool_connections=1, pool_maxsize=3)
+        transport.OAuth2Session.assert_called_once_with(token={'access_token': 'token'})
+        session.mount.assert_called_once_with(STORE_URL, instance.adapter)
+        session.post.assert_called_once_with(STORE_URL + '/api/offering/resources', headers={'a': 'b'},
+                                             data='data', **extra_kwargs)
+
+    def test_send_unauthenticated(self):
+        instance = transport.HTTPTransport({}, STORE_URL)
+        session = transport.requests.Session.return_value
+
+        response = instance.send('options', STORE_URL + '/api/offering/offerings', {})
+
+        self.assertEquals(session.options.return_value, response)
+        self.assertEquals(0, transport.OAuth2Session.call_count)
+        session.mount.assert_called_once_with(STORE_URL, instance.adapter)
+
+
+class LoadTransportTest(unittest.TestCase):
+
+    @parameterized.expand([
+        ('http',                                              transport.HTTPTransport),
+        ('memory',                                            transport.MemoryTransport),
+        ('ckanext.storepublisher.transport:MemoryTransport',  transport.MemoryTransport)
+    ])
+    def test_load_transport(self, name, expected_class):
+        instance = transport.load_transport(name, {}, STORE_URL)
+        self.assertIsInstance(instance, expected_class)
+        self.assertEquals(STORE_URL, instance.store_url)
+
+    @parameterized.expand([
+        ({},                                                        transport.HTTPTransport),
+        ({'ckan.storepublisher.transport': 'memory'},               transport.MemoryTransport),
+        ({'ckan.storepublisher.transport': 'memory',
+          'ckan.storepublisher.eu.transport': 'http'},              transport.HTTPTransport)
+    ])
+    def test_connector_transport(self, config, expected_class):
+        config = dict(config, **{'ckan.storepublisher.eu.store_url': STORE_URL})
+        connector = store_connector.StoreConnector(config, 'eu')
+        self.assertIsInstance(connector._transport, expected_class)
+
+
+class MemoryTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instance = transport.MemoryTransport({}, STORE_URL)
+        self.identity = StoreIdentity('user', {'access_token': 'token'})
+
+    def _send(self, method, path, body=None, identity=None, headers={}):
+        data = json.dumps(body) if body is not None else None
+        return self.instance.send(method, STORE_URL + path, headers, data, identity or self.identity)
+
+    def _create_resource(self, name='resource', identity=None, is_open=True):
+        return self._send('post', '/api/offering/resources', {'name': name, 'version': '1.0', 'open': is_open,
+                                                              'link': 'http://ckan/dataset/%s' % name}, identity)
+
+    def _create_offering(self, name='offering', resource='resource', provider='user', is_open=False, identity=None):
+        return self._send('post', '/api/offering/offerings', {
+            'name': name,
+            'version': '1.0',
+            'open': is_open,
+            'image': {'name': 'ckan.png', 'data': IMAGE},
+            'resources': [{'provider': provider, 'name': resource, 'version': '1.0'}],
+            'offering_info': {'description': 'Description', 'pricing': {'price_model': 'single_payment', 'price': 2}}
+        }, identity)
+
+    def test_options_unauthenticated(self):
+        response = self.instance.send('options', STORE_URL + '/api/offering/offerings', {})
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('gzip', response.headers['accept-encoding'])
+
+    @parameterized.expand([
+        ('get',  '/api/offering/resources'),
+        ('post', '/api/offering/offerings')
+    ])
+    def test_unauthenticated(self, method, path):
+        response = self.instance.send(method, STORE_URL + path, {})
+        self.assertEquals(401, response.status_code)
+
+    def test_not_found(self):
+        response = self._send('get', '/api/unknown')
+        self.assertEquals(404, response.status_code)
+        self.assertEquals('Not found', response.json()['message'])
+
+    def test_resources(self):
+        self.assertEquals(201, self._create_resource('resource1').status_code)
+        self.assertEquals(201, self._create_resource('resource2').status_code)
+        self._create_resource('resource3', StoreIdentity('other', {'access_token': 'other'}))
+
+        # Users only list their resources
+        resources = self._send('get', '/api/offering/resources').json()
+        self.assertEquals(['resource1', 'resource2'], [resource['name'] for resource in resources])
+        self.assertEquals('user', resources[0]['provider'])
+
+        # Pages start at 1
+        resources = self._send('get', '/api/offering/resources?start=2&limit=1').json()
+        self.assertEquals(['resource2'], [resource['name'] for resource in resources])
+
+        # Duplicated resources are rejected
+        response = self._create_resource('resource1')
+        self.assertEquals(400, response.status_code)
+        self.assertEquals('The resource already exists', response.json()['message'])
+
+    def test_update_resource(self):
+        self._create_resource('resource 1')
+
+        response = self._send('put', '/api/offering/resources/user/resource%201/1.0', {'description': 'New'})
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('New', self.instance.resources[('user', 'resource 1', '1.0')]['description'])
+
+        response = self._send('put', '/api/offering/resources/user/resource%201/1.0', {'description': 'Other'},
+                              StoreIdentity('other', {'access_token': 'other'}))
+        self.assertEquals(403, response.status_code)
+
+    def test_offerings(self):
+        self._create_resource()
+        self.assertEquals(201, self._create_offering().status_code)
+
+        offering = self._send('get', '/api/offering/offerings/user/offering/1.0').json()
+        self.assertEquals('uploaded', offering['state'])
+        self.assertEquals('user', offering['owner_organization'])
+        self.assertEquals('2', offering['offering_description']['pricing']['price_plans'][0]['price_components'][0]['value'])
+        self.assertEquals('resource', offering['resources'][0]['name'])
+
+        # The image can be downloaded
+        image = self._send('get', offering['image_url'])
+        self.assertEquals('PNG image data', image.content)
+
+        # Unpublished offerings can only be seen by their owners
+        other = StoreIdentity('other', {'access_token': 'other'})
+        self.assertEquals(404, self._send('get', '/api/offering/offerings/user/offering/1.0', identity=other).status_code)
+        self.assertEquals([], self._send('get', '/api/offering/offerings?filter=published').json())
+
+        self.assertEquals(200, self._send('put', '/api/offering/offerings/user/offering/1.0/tag', {'tags': ['a']}).status_code)
+        self.assertEquals(200, self._send('post', '/api/offering/offerings/user/offering/1.0/publish', {}).status_code)
+
+        offerings = self._send('get', '/api/offering/offerings?filter=published', identity=other).json()
+        self.assertEquals(1, len(offerings))
+        self.assertEquals(['a'], offerings[0]['tags'])
+        self.assertEquals('published', offerings[0]['state'])
+        self.assertIsNotNone(offerings[0]['publication_date'])
+
+        # Offerings are only published once
+        response = self._send('post', '/api/offering/offerings/user/offering/1.0/publish', {})
+        self.assertEquals(400, response.status_code)
+
+    @parameterized.expand([
+        ('unknown_resource', 'unknown', 'user',  False, 400, 'Resource not found'),
+        ('other_provider',   'other',   'other', False, 403, 'You are not the provider of the resource'),
+        ('non_open',         'closed',  'user',  True,  400, 'Open offerings cannot contain non open resources')
+    ])
+    def test_create_offering_invalid(self, _, resource, provider, is_open, status_code, message):
+        self._create_resource('other', StoreIdentity('other', {'access_token': 'other'}))
+        self._create_resource('closed', is_open=False)
+
+        response = self._create_offering(resource=resource, provider=provider, is_open=is_open)
+
+        self.assertEquals(status_code, response.status_code)
+        self.assertEquals(message, response.json()['message'])
+        self.assertEquals({}, self.instance.offerings)
+
+    def test_create_offering_compressed(self):
+        self._create_resource()
+        body = json.dumps({'name': 'offering', 'version': '1.0', 'image': {'name': 'ckan.png', 'data': IMAGE},
+                           'resources': [{'provider': 'user', 'name': 'resource', 'version': '1.0'}]})
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        data = compressor.compress(body) + compressor.flush()
+
+        response = self.instance.send('post', STORE_URL + '/api/offering/offerings',
+                                      {'Content-Encoding': 'gzip'}, data, self.identity)
+
+        self.assertEquals(201, response.status_code)
+        self.assertIn(('user', 'offering', '1.0'), self.instance.offerings)
+
+    def test_delete_offering(self):
+        self._create_resource()
+        self._create_offering('uploaded')
+        self._create_offering('published')
+        self._send('post', '/api/offering/offerings/user/published/1.0/publish', {})
+
+        self.assertEquals(204, self._send('delete', '/api/offering/offerings/user/uploaded/1.0').status_code)
+        self.assertEquals(204, self._send('delete', '/api/offering/offerings/user/published/1.0').status_code)
+
+        # Published offerings are kept
+        self.assertNotIn(('user', 'uploaded', '1.0'), self.instance.offerings)
+        self.assertEquals('deleted', self.instance.offerings[('user', 'published', '1.0')]['state'])
+        self.assertEquals([('user', 'published', '1.0')], self.instance.resources[('user', 'resource', '1.0')]['offerings'])
+        self.assertEquals(404, self._send('delete', '/api/offering/offerings/user/published/1.0').status_code)
+
+    @parameterized.expand([
+        (False, False),
+        (True,  True)
+    ])
+    def test_delete_resource(self, published, kept):
+        self._create_resource()
+        self._create_offering()
+        if published:
+            self._send('post', '/api/offering/offerings/user/offering/1.0/publish', {})
+
+        self.assertEquals(204, self._send('delete', '/api/offering/resources/user/resource/1.0').status_code)
+
+        # Resources included in published offerings are marked as deleted
+        resources = self._send('get', '/api/offering/resources').json()
+        if kept:
+            self.assertEquals(['deleted'], [resource['state'] for resource in resources])
+        else:
+            self.assertEquals([], resources)
+            self.assertEquals([], self.instance.offerings[('user', 'offering', '1.0')]['resources'])
+
+    def test_expire_token(self):
+        self.instance.expire_token('token')
+
+        response = self._send('get', '/api/offering/resources')
+
+        self.assertEquals(401, response.status_code)
+        self.assertEquals(200, self._send('get', '/api/offering/resources',
+                                          identity=StoreIdentity('user', {'access_token': 'new'})).status_code)
+
+    def test_fail(self):
+        self.instance.fail('post', r'/publish$', 503, 'Unavailable', times=2)
+        self._create_resource()
+        self._create_offering()
+
+        for _ in range(2):
+            response = self._send('post', '/api/offering/offerings/user/offering/1.0/publish', {})
+            self.assertEquals(503, response.status_code)
+            self.assertEquals('Unavailable', response.json()['message'])
+
+        self.assertEquals(200, self._send('post', '/api/offering/offerings/user/offering/1.0/publish', {}).status_code)
+        self.assertEquals(('post', '/api/offering/offerings/user/offering/1.0/publish'), self.instance.history[-1])
+
+
+class _JournalStore(object):
+
+    def __init__(self):
+        self.journals = {}
+
+    def load(self, key):
+        return copy.deepcopy(self.journals.get(key))
+
+    def save(self, journal):
+        self.journals[journal.key] = copy.deepcopy(journal)
+
+    def delete(self, key):
+        self.journals.pop(key, None)
+
+
+class MemoryStoreIntegrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self._toolkit = store_connector.plugins.toolkit
+        store_connector.plugins.toolkit = MagicMock()
+        self._activity = store_connector.activity
+        store_connector.activity = MagicMock()
+
+        config = {
+            'ckan.site_url': 'https://ckan.example.com',
+            'ckan.storepublisher.store_url': STORE_URL,
+            'ckan.storepublisher.transport': 'memory',
+            'ckan.storepublisher.page_size': '2'
+        }
+
+        self.refresh_token = MagicMock(return_value={'access_token': 'refreshed'})
+        self.instance = store_connector.StoreConnector(config).with_identity(
+            StoreIdentity('user', {'access_token': 'token'}, self.refresh_token))
+        self.instance._journal_store = _JournalStore()
+        self.instance._publication_store = MagicMock()
+        self.instance._publication_store.get_offering_url.return_value = None
+        self.instance._dataset_lock = MagicMock()
+        self.instance._prefetcher = ResourcePrefetcher({})
+        self.store = self.instance._transport
+
+    def tearDown(self):
+        store_connector.plugins.toolkit = self._toolkit
+        store_connector.activity = self._activity
+
+    def _dataset(self, i):
+        return dict(DATASET, id='dataset%d' % i, title=u'Dataset %d' % i)
+
+    def _offering_info(self, i):
+        return dict(OFFERING_INFO, name='Offering %d' % i, pkg_id='dataset%d' % i)
+
+    def test_create_offerings(self):
+        for i in range(10):
+            offering_url = self.instance.create_offering(self._dataset(i), self._offering_info(i))
+            self.assertEquals('%s/offering/user/Offering%%20%d/1.0' % (STORE_URL, i), offering_url)
+
+        # Listings are retrieved page by page
+        self.assertEquals(10, len(self.store.resources))
+        published = [offering for offering in self.store.offerings.values() if offering['state'] == 'published']
+        self.assertEquals(10, len(published))
+        self.assertEquals(['tag1', 'tag2', 'dataset'], published[0]['tags'])
+        self.assertEquals({}, self.instance._journal_store.journals)
+
+        # The resource of the dataset is reused by the next offerings
+        offering_info = dict(self._offering_info(0), version='2.0')
+        self.instance.create_offering(self._dataset(0), offering_info)
+        self.assertEquals(10, len(self.store.resources))
+        self.assertEquals(2, len(self.store.resources[('user', 'Dataset Dataset 0 - ID dataset0', '1.0')]['offerings']))
+
+    def test_create_offering_compressed(self):
+        self.instance.create_offering(self._dataset(0), self._offering_info(0))
+
+        # The Store accepts compressed offerings
+        self.assertTrue(self.instance._compressed_requests)
+        self.assertIn(('user', 'Offering 0', '1.0'), self.store.offerings)
+
+    def test_batch_create_offerings_compression_probe(self):
+        config = {
+            'ckan.site_url': 'https://ckan.example.com',
+            'ckan.storepublisher.store_url': STORE_URL,
+            'ckan.storepublisher.transport': 'memory',
+            'ckan.storepublisher.batch_concurrency': '1'
+        }
+        instance = batch_connector.BatchStoreConnector(config).with_identity(StoreIdentity('user', {'access_token': 'token'}))
+        instance._journal_store = _JournalStore()
+        instance._publication_store = self.instance._publication_store
+        instance._dataset_lock = MagicMock()
+        # The Store does not list the encodings it accepts, so compression support is probed
+        store = instance._transport
+        store._response = lambda status_code, body=None, content=None: transport.MemoryResponse(status_code, body, content)
+
+        results = []
+        thread = threading.Thread(target=lambda: results.extend(
+            instance.batch_create_offerings([(self._dataset(i), self._offering_info(i)) for i in range(2)])))
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+
+        # The probe does not wait for the slot held by the request being compressed
+        self.assertFalse(thread.is_alive())
+        self.assertEquals(['%s/offering/user/Offering%%20%d/1.0' % (STORE_URL, i) for i in range(2)], results)
+        self.assertFalse(instance._compressed_requests)
+        self.assertEquals(1, store.history.count(('options', '/api/offering/offerings')))
+
+    def test_sync_resource(self):
+        self.instance.create_offering(self._dataset(0), self._offering_info(0))
+        synchronizer = ResourceSynchronizer(self.instance, {})
+        key = ('user', 'dataset0')
+
+        # The title and then the description of the dataset are changed
+        for changes in ({'title': u'New title'}, {'title': u'New title', 'notes': 'New description'}):
+            synchronizer._pending[key] = (self.instance.identity, dict(self._dataset(0), **changes))
+            synchronizer._flush(key)
+
+        # The resource keeps its name, so it can still be updated
+        resource = self.store.resources[('user', 'Dataset Dataset 0 - ID dataset0', '1.0')]
+        self.assertEquals('New description', resource['description'])
+        self.assertEquals(1, len([path for method, path in self.store.history if method == 'put' and '/resources/' in path]))
+
+    def test_create_offering_expired_token(self):
+        self.store.expire_token('token')
+
+        self.instance.create_offering(self._dataset(0), self._offering_info(0))
+
+        self.refresh_token.assert_called_once_with()
+        self.assertEquals('published', self.store.offerings[('user', 'Offering 0', '1.0')]['state'])
+
+    def test_resume_and_abort(self):
+        self.store.fail('post', r'/publish$')
+
+        with self.assertRaises(store_connector.StoreException) as context:
+            self.instance.create_offering(self._dataset(0), self._offering_info(0))
+        self.assertEquals('Internal Server Error', context.exception.message)
+        self.assertEquals('uploaded', self.store.offerings[('user', 'Offering 0', '1.0')]['state'])
+
+        # The offering is deleted when the publication is aborted
+        self.assertTrue(self.instance.abort_offering(self._dataset(0), self._offering_info(0)))
+        self.assertEquals({}, self.store.offerings)
+        self.assertEquals([], self.store.resources[('user', 'Dataset Dataset 0 - ID dataset0', '1.0')]['offerings'])
+
+        # The publication can be started again
+        self.instance.create_offering(self._dataset(0), self._offering_info(0))
+        self.assertEquals('published', self.store.offerings[('user', 'Offering 0', '1.0')]['state'])
+
+    def test_create_offering_version(self):
+        self.instance.create_offering(self._dataset(0), self._offering_info(0))
+
+        offering_url = self.instance.create_offering_version(self._dataset(0), {'name': 'Offering 0', 'version': '1.0'},
+                                                             {'version': '1.1', 'price': 3})
+
+        self.assertEquals('%s/offering/user/Offering%%200/1.1' % STORE_URL, offering_url)
+        offering = self.store.offerings[('user', 'Offering 0', '1.1')]
+        self.assertEquals('3', offering['offering_description']['pricing']['price_plans'][0]['price_components'][0]['value'])
+        self.assertEquals('Offering description', offering['offering_description']['description'])
+        self.assertEquals(self.store.images[self.store.offerings[('user', 'Offering 0', '1.0')]['image_url']],
+                          self.store.images[offering['image_url']])
+
+    def test_delete_attached_resources(self):
+        self.instance.create_offering(self._dataset(0), self._offering_info(0))
+        self.instance.create_offering(self._dataset(1), self._offering_info(1))
+
+        self.instance.delete_attached_resources(self._dataset(0))
+
+        # The resource is kept since its offering was published
+        self.assertEquals('deleted', self.store.resources[('user', 'Dataset Dataset 0 - ID dataset0', '1.0')]['state'])
+        self.assertEquals('created', self.store.resources[('user', 'Dataset Dataset 1 - ID dataset1', '1.0')]['state'])
+        self.assertEquals([], self.instance._get_existing_resources(self._dataset(0)))
+
+    def test_create_offering_prefetched(self):
+        self.instance.create_offering(self._dataset(0), self._offering_info(0))
+        self.instance.prefetch_resource(self._dataset(0))
+        self.instance._prefetcher._lookups[('default', 'user', 'dataset0')].wait()
+        del self.store.history[:]
+
+        self.instance.create_offering(self._dataset(0), dict(self._offering_info(0), version='2.0'))
+
+        # The catalogue was scanned when the form was opened
+        self.assertNotIn(('get', '/api/offering/resources'), self.store.history)
+        self.assertEquals(2, len(self.store.resources[('user', 'Dataset Dataset 0 - ID dataset0', '1.0')]['offerings']))
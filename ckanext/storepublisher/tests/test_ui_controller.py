@@ -22,6 +22,7 @@ import base64
 import os
 import unittest
 
+from collections import OrderedDict
 from mock import MagicMock
 from nose_parameterized import parameterized
 
@@ -49,18 +50,29 @@ class UIControllerTest(unittest.TestCase):
         self._helpers = controller.helpers
         controller.helpers = MagicMock()
 
-        self._base64 = controller.base64
-        controller.base64 = MagicMock()
-
-        self._StoreConnector = controller.StoreConnector
+        self._MultiStoreConnector = controller.MultiStoreConnector
         self._store_connector_instance = MagicMock()
-        controller.StoreConnector = MagicMock(return_value=self._store_connector_instance)
+        controller.MultiStoreConnector = MagicMock(return_value=self._store_connector_instance)
+
+        self._DraftStore = controller.DraftStore
+        self._draft_store_instance = MagicMock()
+        self._draft_store_instance.load.return_value = None
+        controller.DraftStore = MagicMock(return_value=self._draft_store_instance)
+
+        self._get_health_monitor = controller.get_health_monitor
+        controller.get_health_monitor = MagicMock()
+        controller.get_health_monitor.return_value.is_available.return_value = True
 
         # Create the plugin
         self.instanceController = controller.PublishControllerUI()
 
     def tearDown(self):
-        controller.StoreConnector = self._StoreConnector
+        controller.plugins.toolkit = self._toolkit
+        controller.request = self._request
+        controller.helpers = self._helpers
+        controller.MultiStoreConnector = self._MultiStoreConnector
+        controller.DraftStore = self._DraftStore
+        controller.get_health_monitor = self._get_health_monitor
 
     @parameterized.expand([
         # (False, False, {},),
@@ -101,7 +113,7 @@ class UIControllerTest(unittest.TestCase):
     def test_publish(self, allowed, private, post_content={}, create_offering_res='http://some_url.com'):
 
         errors = {}
-        current_package = {'tags': [{'name': 'tag1'}, {'name': 'tag2'}], 'private': private, 'acquire_url': 'http://example.com'}
+        current_package = {'id': 'package_id', 'tags': [{'name': 'tag1'}, {'name': 'tag2'}], 'private': private, 'acquire_url': 'http://example.com'}
         package_show = MagicMock(return_value=current_package)
         package_update = MagicMock()
 
@@ -115,7 +127,7 @@ class UIControllerTest(unittest.TestCase):
         controller.plugins.toolkit.check_access = MagicMock(side_effect=self._toolkit.NotAuthorized if allowed is False else None)
         controller.plugins.toolkit._ = self._toolkit._
         controller.request.POST = post_content
-        self._store_connector_instance.create_offering = MagicMock(side_effect=[create_offering_res])
+        self._store_connector_instance.create_offering = MagicMock(return_value={controller.DEFAULT_STORE: create_offering_res})
         user = controller.plugins.toolkit.c.user
         pkg_id = 'dhjus2-fdsjwdf-fq-dsjager'
 
@@ -168,13 +180,13 @@ class UIControllerTest(unittest.TestCase):
             else:
 
                 # Default image should be used if the users has not uploaded a image
+                # Uploaded images are not read by the controller: they are streamed to the Store
                 image_field = post_content.get('image_upload', '')
                 if image_field != '':
-                    controller.base64.b64encode.assert_called_once_with(image_field.file.read.return_value)
-                    expected_image = controller.base64.b64encode.return_value
+                    image = {'image_file': image_field.file}
+                    self.assertEquals(0, image_field.file.read.call_count)
                 else:
-                    self.assertEquals(0, controller.base64.b64encode.call_count)
-                    expected_image = LOGO_CKAN_B64
+                    image = {'image_base64': LOGO_CKAN_B64}
 
                 expected_data = {
                     'name': post_content['name'],
@@ -185,14 +197,15 @@ class UIControllerTest(unittest.TestCase):
                     'license_description': post_content.get('license_description', ''),
                     'is_open': 'open' in post_content,
                     'tags': tags,
-                    'price': real_price,
-                    'image_base64': expected_image
+                    'price': real_price
                 }
+                expected_data.update(image)
 
                 self._store_connector_instance.create_offering.assert_called_once_with(current_package, expected_data)
 
                 if isinstance(create_offering_res, Exception):
                     errors['Store'] = [create_offering_res.message]
+                    self.assertTrue(controller.plugins.toolkit.c.pending_publication)
                     # The package should not be updated if the create_offering returns an error
                     # even if 'update_acquire_url' is present in the request content.
                     self.assertEquals(0, package_update.call_count)
@@ -202,9 +215,274 @@ class UIControllerTest(unittest.TestCase):
                                                                              '%s</a> published correctly.' % post_content['name'],
                                                                              allow_html=True)
 
+            # Drafts are kept only when the offering cannot be published
+            if errors:
+                image_field = post_content.get('image_upload', '')
+                if image_field != '':
+                    self._draft_store_instance.save_image.assert_called_once_with(image_field.file)
+                    image_ref = self._draft_store_instance.save_image.return_value
+                else:
+                    self.assertEquals(0, self._draft_store_instance.save_image.call_count)
+                    image_ref = None
+
+                draft_fields = self._draft_store_instance.save.call_args[0][2]
+                self._draft_store_instance.save.assert_called_once_with(user, 'package_id', draft_fields, image_ref)
+                for field in draft_fields:
+                    self.assertNotIn(field.capitalize(), errors)
+                self.assertEquals(0, self._draft_store_instance.delete.call_count)
+            else:
+                self.assertEquals(0, self._draft_store_instance.save.call_count)
+                self._draft_store_instance.delete.assert_called_once_with(user, 'package_id')
+
         expected_pkg = current_package.copy()
         expected_pkg['tag_string'] = ','.join([tag['name'] for tag in current_package['tags']])
         self.assertEquals(expected_pkg, controller.plugins.toolkit.c.pkg_dict)
         self.assertEquals(errors, controller.plugins.toolkit.c.errors)
 
         controller.plugins.toolkit.render('package/publish.html')
+
+    def test_publish_multiple_stores(self):
+        current_package = {'id': 'package_id', 'tags': [], 'private': True}
+        controller.plugins.toolkit.get_action = MagicMock(return_value=MagicMock(return_value=current_package))
+        controller.plugins.toolkit.check_access = MagicMock()
+        controller.plugins.toolkit._ = self._toolkit._
+        controller.request.POST = {'name': 'a', 'version': '1.0', 'pkg_id': 'package_id'}
+        results = OrderedDict([
+            ('eu', 'http://eu.example.com/offering'),
+            ('us', controller.StoreException('Impossible to connect with the Store'))
+        ])
+        self._store_connector_instance.create_offering = MagicMock(return_value=results)
+
+        # Call the function
+        self.instanceController.publish('package_id')
+
+        # Each Store reports its own result
+        controller.helpers.flash_success.assert_called_once_with('Offering <a href="http://eu.example.com/offering" target="_blank">' +
+                                                                 'a</a> published correctly in eu.', allow_html=True)
+        self.assertEquals({'Store (us)': ['Impossible to connect with the Store']}, controller.plugins.toolkit.c.errors)
+        self.assertTrue(controller.plugins.toolkit.c.pending_publication)
+
+    @parameterized.expand([
+        ({'default': True},              True),
+        ({'default': False},             False),
+        ({'eu': Exception(), 'us': True}, True)
+    ])
+    def test_publish_abort(self, abort_results, flash):
+        current_package = {'id': 'package_id', 'tags': [], 'private': True}
+        controller.plugins.toolkit.get_action = MagicMock(return_value=MagicMock(return_value=current_package))
+        controller.plugins.toolkit.check_access = MagicMock()
+        controller.plugins.toolkit._ = self._toolkit._
+        controller.request.POST = {'name': 'a', 'version': '1.0', 'pkg_id': 'package_id', 'abort': ''}
+        self._store_connector_instance.abort_offering = MagicMock(return_value=abort_results)
+
+        # Call the function
+        self.instanceController.publish('package_id')
+
+        # The offering is not published
+        self.assertEquals(0, self._store_connector_instance.create_offering.call_count)
+        offering_info = self._store_connector_instance.abort_offering.call_args[0][1]
+        self._store_connector_instance.abort_offering.assert_called_once_with(current_package, offering_info)
+        self.assertEquals('a', offering_info['name'])
+        self.assertEquals('1.0', offering_info['version'])
+
+        # The draft is discarded too
+        self._draft_store_instance.delete.assert_called_once_with(controller.plugins.toolkit.c.user, 'package_id')
+
+        if flash:
+            controller.helpers.flash_success.assert_called_once_with('The pending publication of the offering a has been discarded.')
+        else:
+            self.assertEquals(0, controller.helpers.flash_success.call_count)
+        controller.plugins.toolkit.render.assert_called_once_with('package/publish.html')
+
+    def _publish_with_draft(self, post_content, draft, image_file=None):
+        current_package = {'id': 'package_id', 'tags': [], 'private': True}
+        controller.plugins.toolkit.get_action = MagicMock(return_value=MagicMock(return_value=current_package))
+        controller.plugins.toolkit.check_access = MagicMock()
+        controller.plugins.toolkit._ = self._toolkit._
+        controller.request.POST = post_content
+        self._draft_store_instance.load.return_value = draft
+        self._draft_store_instance.open_image.return_value = image_file
+        self._store_connector_instance.create_offering = MagicMock(return_value={controller.DEFAULT_STORE: 'http://some_url.com'})
+
+        # Call the function
+        self.instanceController.publish('package_id')
+
+        self._draft_store_instance.load.assert_called_once_with(controller.plugins.toolkit.c.user, 'package_id')
+        call_args = self._store_connector_instance.create_offering.call_args
+        return call_args[0][1] if call_args else None
+
+    def test_publish_draft_fields(self):
+        draft = {'fields': {'pkg_id': 'package_id', 'name': 'a', 'version': '1.0', 'price': '2.5', 'description': 'Desc'},
+                 'image': None}
+        offering_info = self._publish_with_draft({'version': '2.0', 'tag_string': 'tag1'}, draft)
+
+        # Fields not submitted are taken from the draft
+        self.assertEquals('package_id', offering_info['pkg_id'])
+        self.assertEquals('a', offering_info['name'])
+        self.assertEquals('2.0', offering_info['version'])
+        self.assertEquals('Desc', offering_info['description'])
+        self.assertEquals(['tag1'], offering_info['tags'])
+        self.assertEquals(2.5, offering_info['price'])
+        self.assertEquals(LOGO_CKAN_B64, offering_info['image_base64'])
+        self.assertEquals({}, controller.plugins.toolkit.c.errors)
+        self._draft_store_instance.delete.assert_called_once_with(controller.plugins.toolkit.c.user, 'package_id')
+
+    @parameterized.expand([
+        ('image_ref', True,  True),
+        ('image_ref', False, False),
+        ('',          True,  False),
+        ('other_ref', True,  False)
+    ])
+    def test_publish_draft_image(self, image_draft, image_exists, used):
+        draft = {'fields': {'pkg_id': 'package_id', 'name': 'a', 'version': '1.0'}, 'image': 'image_ref'}
+        image_file = MagicMock() if image_exists else None
+        offering_info = self._publish_with_draft({'image_draft': image_draft}, draft, image_file)
+
+        if used:
+            # The image uploaded previously is sent again and closed afterwards
+            self.assertEquals(image_file, offering_info['image_file'])
+            self.assertNotIn('image_base64', offering_info)
+            image_file.close.assert_called_once_with()
+        else:
+            self.assertNotIn('image_file', offering_info)
+            self.assertEquals(LOGO_CKAN_B64, offering_info['image_base64'])
+
+    def test_publish_draft_image_kept_on_failure(self):
+        draft = {'fields': {'pkg_id': 'package_id', 'name': 'a', 'version': '1.0'}, 'image': 'image_ref'}
+        self._store_connector_instance.create_offering = MagicMock()
+        controller.plugins.toolkit.get_action = MagicMock(return_value=MagicMock(return_value={'id': 'package_id', 'tags': [], 'private': True}))
+        controller.plugins.toolkit.check_access = MagicMock()
+        controller.plugins.toolkit._ = self._toolkit._
+        controller.request.POST = {'image_draft': 'image_ref', 'version': ''}
+        self._draft_store_instance.load.return_value = draft
+
+        # Call the function
+        self.instanceController.publish('package_id')
+
+        # The image is not copied again and the invalid version is not kept
+        self.assertEquals(0, self._store_connector_instance.create_offering.call_count)
+        self.assertEquals(0, self._draft_store_instance.save_image.call_count)
+        self._draft_store_instance.save.assert_called_once_with(controller.plugins.toolkit.c.user, 'package_id', {
+            'pkg_id': 'package_id', 'name': 'a', 'description': '', 'license_title': '', 'license_description': '',
+            'tag_string': '', 'price': ''
+        }, 'image_ref')
+        self.assertEquals('image_ref', controller.plugins.toolkit.c.draft_image)
+
+    def test_publish_store_unavailable(self):
+        controller.get_health_monitor.return_value.is_available.return_value = False
+        controller.plugins.toolkit.get_action = MagicMock(return_value=MagicMock(return_value={'id': 'package_id', 'tags': [], 'private': True}))
+        controller.plugins.toolkit.check_access = MagicMock()
+        controller.plugins.toolkit._ = self._toolkit._
+        controller.request.POST = {'name': 'a', 'version': '1.0', 'pkg_id': 'package_id'}
+
+        # Call the function
+        self.instanceController.publish('package_id')
+
+        # The Store is not contacted when it is known to be unreachable
+        self.assertTrue(controller.plugins.toolkit.c.store_unavailable)
+        self.assertEquals(0, self._store_connector_instance.create_offering.call_count)
+        self.assertEquals({'Store': ['The Store cannot be reached right now. Please, try again later']},
+                          controller.plugins.toolkit.c.errors)
+
+    @parameterized.expand([
+        ('create_offering', {}),
+        ('abort_offering',  {'abort': ''})
+    ])
+    def test_publish_store_busy(self, method, extra_post):
+        getattr(self._store_connector_instance, method).side_effect = controller.BulkheadFull('Full')
+        controller.plugins.toolkit.get_action = MagicMock(return_value=MagicMock(return_value={'id': 'package_id', 'tags': [], 'private': True}))
+        controller.plugins.toolkit.check_access = MagicMock()
+        controller.request.POST = dict({'name': 'a', 'version': '1.0', 'pkg_id': 'package_id'}, **extra_post)
+        self._response = controller.response
+        controller.response = MagicMock()
+
+        try:
+            self.instanceController.publish('package_id')
+
+            # The user is asked to try again instead of waiting for the Store
+            self.assertEquals(503, controller.response.status_int)
+        finally:
+            controller.response = self._response
+
+        self.assertEquals({'Store': [controller.BUSY_MESSAGE]}, controller.plugins.toolkit.c.errors)
+        self.assertEquals(0, controller.helpers.flash_success.call_count)
+        self.assertEquals(0, self._draft_store_instance.delete.call_count)
+        if method == 'create_offering':
+            # The fields are kept so they do not have to be sent again
+            self.assertEquals('package_id', self._draft_store_instance.save.call_args[0][1])
+
+    @parameterized.expand([
+        ({'image_resized': base64.b64encode('resized')},),
+        ({'image_resized': base64.b64encode('resized'), 'image_draft': 'image_ref'},)
+    ])
+    def test_publish_resized_image(self, post_content):
+        draft = {'fields': {'pkg_id': 'package_id', 'name': 'a', 'version': '1.0'}, 'image': 'image_ref'}
+        offering_info = self._publish_with_draft(post_content, draft, MagicMock())
+
+        # The image of the draft is replaced by the one resized by the browser
+        self.assertEquals(0, self._draft_store_instance.open_image.call_count)
+        self.assertEquals(post_content['image_resized'], offering_info['image_base64'])
+        self.assertNotIn('image_file', offering_info)
+
+    def test_publish_resized_image_invalid(self):
+        draft = {'fields': {'pkg_id': 'package_id', 'name': 'a', 'version': '1.0'}, 'image': None}
+        self._store_connector_instance.create_offering = MagicMock()
+
+        self.assertIsNone(self._publish_with_draft({'image_resized': 'a'}, draft))
+
+        self.assertEquals(0, self._store_connector_instance.create_offering.call_count)
+        self.assertEquals({'Image': ['The image could not be read. Please, upload it again']},
+                          controller.plugins.toolkit.c.errors)
+
+    def test_publish_resized_image_kept_on_failure(self):
+        self._draft_store_instance.save_image.return_value = 'new_image_ref'
+        draft = {'fields': {'pkg_id': 'package_id', 'name': 'a'}, 'image': None}
+
+        self._publish_with_draft({'image_resized': base64.b64encode('resized')}, draft)
+
+        self.assertEquals('resized', self._draft_store_instance.save_image.call_args[0][0].read())
+        self.assertEquals('new_image_ref', self._draft_store_instance.save.call_args[0][3])
+        self.assertEquals('new_image_ref', controller.plugins.toolkit.c.draft_image)
+
+    def test_publish_image_settings(self):
+        controller.plugins.toolkit.get_action = MagicMock(return_value=MagicMock(return_value={'id': 'package_id', 'tags': [], 'private': True}))
+        controller.plugins.toolkit.check_access = MagicMock()
+        controller.request.POST = {}
+        config = controller.config
+        controller.config = {'ckan.storepublisher.image_max_size': '300', 'ckan.storepublisher.image_quality': '0.5'}
+        try:
+            self.instanceController = controller.PublishControllerUI()
+        finally:
+            controller.config = config
+
+        self.instanceController.publish('package_id')
+
+        self.assertEquals((300, 0.5), (controller.plugins.toolkit.c.image_max_size, controller.plugins.toolkit.c.image_quality))
+
+    @parameterized.expand([
+        ({},                                               True,  True),
+        ({'name': 'a', 'version': '1.0', 'pkg_id': 'id'},  True,  False),
+        ({},                                               False, False)
+    ])
+    def test_publish_prefetch_resource(self, post_content, store_available, prefetched):
+        dataset = {'id': 'package_id', 'tags': [], 'private': True}
+        controller.plugins.toolkit.get_action = MagicMock(return_value=MagicMock(return_value=dataset))
+        controller.plugins.toolkit.check_access = MagicMock()
+        controller.get_health_monitor.return_value.is_available.return_value = store_available
+        controller.request.POST = post_content
+
+        self.instanceController.publish('package_id')
+
+        # The resource is only looked for when the form is opened
+        prefetch_resource = self._store_connector_instance.prefetch_resource
+        self.assertEquals([((dataset,),)] if prefetched else [], prefetch_resource.call_args_list)
+
+    def test_publish_prefetch_resource_error(self):
+        controller.plugins.toolkit.get_action = MagicMock(return_value=MagicMock(return_value={'id': 'package_id', 'tags': []}))
+        controller.plugins.toolkit.check_access = MagicMock()
+        controller.request.POST = {}
+        self._store_connector_instance.prefetch_resource.side_effect = ValueError('Unknown user')
+
+        # The form is rendered anyway
+        self.instanceController.publish('package_id')
+        controller.plugins.toolkit.render.assert_called_once_with('package/publish.html')
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.storepublisher.workers as workers
+
+import threading
+import unittest
+
+from mock import MagicMock
+from nose_parameterized import parameterized
+
+
+class WorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        self._model = workers.model
+        workers.model = MagicMock()
+
+    def tearDown(self):
+        workers.model = self._model
+
+    @parameterized.expand([
+        (1,    None),
+        (5,    None),
+        (5,    1),
+        (10,   3),
+        (0,    None)
+    ])
+    def test_run_concurrently(self, n_tasks, max_workers):
+        threads = set()
+        lock = threading.Lock()
+
+        def _task(index):
+            with lock:
+                threads.add(threading.current_thread().ident)
+            if index % 2:
+                raise ValueError(index)
+            return index
+
+        # Sessions removed by each thread (the counters of the mocks are not thread-safe)
+        removed = []
+        workers.model.Session.remove.side_effect = lambda: removed.append(threading.current_thread().ident)
+
+        tasks = [lambda index=index: _task(index) for index in range(n_tasks)]
+        results = workers.run_concurrently(tasks, max_workers)
+
+        self.assertEquals(n_tasks, len(results))
+        for index, (result, error) in enumerate(results):
+            if index % 2:
+                self.assertIsNone(result)
+                self.assertIsInstance(error, ValueError)
+            else:
+                self.assertEquals(index, result)
+                self.assertIsNone(error)
+
+        # Tasks are run in the current thread when they cannot be parallelized. The
+        # database sessions of the other threads are removed
+        if n_tasks == 1 or max_workers == 1:
+            self.assertEquals(set([threading.current_thread().ident]), threads)
+            self.assertEquals([], removed)
+        else:
+            self.assertLessEqual(len(threads), max_workers or n_tasks)
+            self.assertEquals(min(max_workers or n_tasks, n_tasks), len(removed))
+            self.assertNotIn(threading.current_thread().ident, removed)
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import copy
+import datetime
+import json
+import re
+import requests
+import threading
+import urllib
+import urlparse
+import zlib
+
+from requests.structures import CaseInsensitiveDict
+from requests_oauthlib import OAuth2Session
+
+
+class HTTPTransport(object):
+    '''
+    Sends the requests to the Store through HTTP. Connections are kept open and
+    reused by all the requests (up to ``ckan.storepublisher.pool_size``).
+    '''
+
+    def __init__(self, config, store_url):
+        self.store_url = store_url
+        pool_size = int(config.get('ckan.storepublisher.pool_size', 10))
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+
+    def send(self, method, url, headers, data=None, identity=None, timeout=None):
+        '''
+        :param identity: The identity on behalf of whom the request is sent. The
+            request is not authenticated when it is not given
+        :type identity: StoreIdentity
+
+        :returns: The response of the Store
+        :rtype: requests.Response
+        '''
+
+        # Include access token in the request
+        if identity is not None:
+            session = OAuth2Session(token=identity.token)
+        else:
+            session = requests.Session()
+        session.mount(self.store_url, self.adapter)
+
+        # Timeouts are only set when configured
+        kwargs = {'timeout': timeout} if timeout else {}
+
+        return getattr(session, method)(url, headers=headers, data=data, **kwargs)
+
+
+class MemoryResponse(object):
+    '''The parts of requests.Response used by the connector'''
+
+    def __init__(self, status_code, body=None, content=None, headers=None):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers or {})
+        if content is None:
+            content = json.dumps(body) if body is not None else ''
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class MemoryStoreError(Exception):
+
+    def __init__(self, status_code, message):
+        super(MemoryStoreError, self).__init__(message)
+        self.status_code = status_code
+
+
+UPLOADED = 'uploaded'
+PUBLISHED = 'published'
+DELETED = 'deleted'
+
+
+class MemoryTransport(object):
+    '''
+    Keeps a WStore in memory, so the connector can be used without a network
+    (e.g. in integration and load tests). Resources, offerings, tags and
+    publications behave as in WStore: resources and offerings that have been
+    published are marked as deleted instead of being removed, offerings can only
+    include the resources of their owner and they can only be published once.
+    The user of each request is the one of its identity. ``expire_token`` and
+    ``fail`` simulate expired tokens and errors of the Store.
+    '''
+
+    ROUTES = [
+        ('options', r'^/api/offering/offerings$', '_options'),
+        ('get', r'^/api/offering/resources$', '_list_resources'),
+        ('post', r'^/api/offering/resources$', '_create_resource'),
+        ('put', r'^/api/offering/resources/([^/]+)/([^/]+)/([^/]+)$', '_update_resource'),
+        ('delete', r'^/api/offering/resources/([^/]+)/([^/]+)/([^/]+)$', '_delete_resource'),
+        ('get', r'^/api/offering/offerings$', '_list_offerings'),
+        ('post', r'^/api/offering/offerings$', '_create_offering'),
+        ('get', r'^/api/offering/offerings/([^/]+)/([^/]+)/([^/]+)$', '_get_offering'),
+        ('delete', r'^/api/offering/offerings/([^/]+)/([^/]+)/([^/]+)$', '_delete_offering'),
+        ('put', r'^/api/offering/offerings/([^/]+)/([^/]+)/([^/]+)/tag$', '_tag_offering'),
+        ('post', r'^/api/offering/offerings/([^/]+)/([^/]+)/([^/]+)/publish$', '_publish_offering'),
+        ('get', r'^/media/([^/]+)/([^/]+)/([^/]+)/([^/]+)$', '_get_image')
+    ]
+
+    def __init__(self, config, store_url):
+        self.store_url = store_url
+        self.resources = {}
+        self.offerings = {}
+        self.images = {}
+        # Method and path of every request received
+        self.history = []
+        self._expired_tokens = set()
+        self._failures = []
+        self._lock = threading.Lock()
+
+    def expire_token(self, access_token):
+        '''The requests sent with the given token are rejected with a 401 status code'''
+
+        with self._lock:
+            self._expired_tokens.add(access_token)
+
+    def fail(self, method, path, status_code=500, message='Internal Server Error', times=1):
+        '''
+        The next requests (``times``) whose method and path match the given ones are
+        rejected with the given status code. The path is a regular expression.
+        '''
+
+        with self._lock:
+            self._failures.append([method, re.compile(path), status_code, message, times])
+
+    def send(self, method, url, headers, data=None, identity=None, timeout=None):
+        parsed_url = urlparse.urlparse(url)
+        path = parsed_url.path
+        params = dict(urlparse.parse_qsl(parsed_url.query))
+
+        with self._lock:
+            self.history.append((method, path))
+
+            try:
+                user = self._authenticate(method, identity)
+                self._check_failures(method, path)
+
+                for route_method, pattern, handler in self.ROUTES:
+                    match = re.match(pattern, path)
+                    if route_method == method and match:
+                        args = [urllib.unquote(arg) for arg in match.groups()]
+                        body = self._read_body(headers, data)
+                        return getattr(self, handler)(user, params, body, *args)
+
+                raise MemoryStoreError(404, 'Not found')
+            except MemoryStoreError as e:
+                return self._response(e.status_code, {'result': 'error', 'message': e.message})
+
+    def _authenticate(self, method, identity):
+        # The Store only answers unauthenticated requests to describe its API
+        if identity is None:
+            if method != 'options':
+                raise MemoryStoreError(401, 'Authentication required')
+            return None
+
+        token = identity.token or {}
+        if token.get('access_token') in self._expired_tokens:
+            raise MemoryStoreError(401, 'The token has expired')
+
+        return identity.user
+
+    def _check_failures(self, method, path):
+        for failure in self._failures:
+            failure_method, pattern, status_code, message, times = failure
+            if failure_method == method and pattern.search(path):
+                failure[4] -= 1
+                if failure[4] <= 0:
+                    self._failures.remove(failure)
+                raise MemoryStoreError(status_code, message)
+
+    def _read_body(self, headers, data):
+        if data is None:
+            return None
+
+        if hasattr(data, 'read'):
+            data = data.read()
+        elif not isinstance(data, basestring):
+            data = b''.join(data)
+
+        if CaseInsensitiveDict(headers).get('Content-Encoding') == 'gzip':
+            data = zlib.decompress(data, 31)
+
+        try:
+            return json.loads(data)
+        except ValueError:
+            raise MemoryStoreError(400, 'The body is not a valid JSON document')
+
+    def _response(self, status_code, body=None, content=None):
+        # Compressed request bodies are accepted (RFC 7694)
+        return MemoryResponse(status_code, body, content, {'Accept-Encoding': 'gzip'})
+
+    def _page(self, items, params):
+        start = max(int(params.get('start', 1)), 1)
+        if 'limit' in params:
+            items = items[start - 1:start - 1 + int(params['limit'])]
+        else:
+            items = items[start - 1:]
+        return self._response(200, [copy.deepcopy(item) for item in items])
+
+    def _options(self, user, params, body):
+        return self._response(200)
+
+    def _get_resource(self, provider, name, version):
+        resource = self.resources.get((provider, name, version))
+        if resource is None:
+            raise MemoryStoreError(404, 'Resource not found')
+        return resource
+
+    def _list_resources(self, user, params, body):
+        resources = [resource for key, resource in sorted(self.resources.items()) if key[0] == user]
+        return self._page(resources, params)
+
+    def _create_resource(self, user, params, body):
+        if not body or not body.get('name') or not body.get('version'):
+            raise MemoryStoreError(400, 'Missing required fields')
+
+        key = (user, body['name'], body['version'])
+        if key in self.resources:
+            raise MemoryStoreError(400, 'The resource already exists')
+
+        resource = dict(body, provider=user, state='created', offerings=[])
+        self.resources[key] = resource
+        return self._response(201, {'result': 'correct'})
+
+    def _update_resource(self, user, params, body, provider, name, version):
+        resource = self._get_resource(provider, name, version)
+        if provider != user:
+            raise MemoryStoreError(403, 'You are not allowed to edit the resource')
+        if resource['state'] == DELETED:
+            raise MemoryStoreError(403, 'Deleted resources cannot be edited')
+
+        for field in ('description', 'content_type', 'resource_type', 'open', 'link'):
+            if field in (body or {}):
+                resource[field] = body[field]
+
+        return self._response(200, {'result': 'correct'})
+
+    def _delete_resource(self, user, params, body, provider, name, version):
+        resource = self._get_resource(provider, name, version)
+        if provider != user:
+            raise MemoryStoreError(403, 'You are not allowed to delete the resource')
+
+        # Resources included in published offerings are kept since they may be purchased
+        offerings = [self.offerings[key] for key in resource['offerings'] if key in self.offerings]
+        if any(offering['state'] != UPLOADED for offering in offerings):
+            resource['state'] = DELETED
+        else:
+            for offering in offerings:
+                offering['resources'] = [item for item in offering['resources']
+                                         if (item['provider'], item['name'], item['version']) != (provider, name, version)]
+            del self.resources[(provider, name, version)]
+
+        return self._response(204)
+
+    def _get_owned_offering(self, user, owner, name, version):
+        offering = self.offerings.get((owner, name, version))
+        if offering is None or offering['state'] == DELETED:
+            raise MemoryStoreError(404, 'Offering not found')
+        if owner != user:
+            raise MemoryStoreError(403, 'You are not the owner of the offering')
+        return offering
+
+    def _list_offerings(self, user, params, body):
+        offerings_filter = params.get('filter', 'published')
+
+        if offerings_filter == 'provided':
+            offerings = [offering for key, offering in sorted(self.offerings.items())
+                         if key[0] == user and offering['state'] != DELETED]
+        elif offerings_filter == 'published':
+            offerings = [offering for key, offering in sorted(self.offerings.items())
+                         if offering['state'] == PUBLISHED]
+        else:
+            # Purchases are not modelled
+            offerings = []
+
+        if params.get('sort') == 'date':
+            # The last published first. Offerings that have not been published go last
+            offerings.sort(key=lambda offering: offering.get('publication_date') or '', reverse=True)
+
+        return self._page(offerings, params)
+
+    def _create_offering(self, user, params, body):
+        if not body or not body.get('name') or not body.get('version'):
+            raise MemoryStoreError(400, 'Missing required fields')
+
+        key = (user, body['name'], body['version'])
+        if key in self.offerings:
+            raise MemoryStoreError(400, 'The offering already exists')
+
+        image = body.get('image') or {}
+        if not image.get('data'):
+            raise MemoryStoreError(400, 'Missing offering image')
+
+        resources = []
+        for item in body.get('resources', []):
+            resource_key = (item.get('provider'), item.get('name'), item.get('version'))
+            resource = self.resources.get(resource_key)
+            if resource is None or resource['state'] == DELETED:
+                raise MemoryStoreError(400, 'Resource not found')
+            if resource['provider'] != user:
+                raise MemoryStoreError(403, 'You are not the provider of the resource')
+            if body.get('open') and not resource.get('open'):
+                raise MemoryStoreError(400, 'Open offerings cannot contain non open resources')
+            resources.append(resource_key)
+
+        image_path = '/media/%s/%s/%s/%s' % (user, body['name'], body['version'], image.get('name', 'image.png'))
+        self.images[image_path] = base64.b64decode(image['data'])
+
+        offering_info = body.get('offering_info', {})
+        pricing = offering_info.get('pricing', {})
+        price_plans = []
+        if pricing.get('price_model') == 'single_payment':
+            price_plans.append({
+                'title': 'Single payment',
+                'price_components': [{'title': 'Price', 'unit': 'single payment',
+                                      'value': str(pricing.get('price')), 'currency': 'EUR'}]
+            })
+        legal = offering_info.get('legal')
+
+        self.offerings[key] = {
+            'name': body['name'],
+            'version': body['version'],
+            'owner_organization': user,
+            'owner_admin_user_id': user,
+            'state': UPLOADED,
+            'open': body.get('open', False),
+            'notification_url': body.get('notification_url'),
+            'image_url': image_path,
+            'tags': [],
+            'rating': 0,
+            'publication_date': None,
+            'offering_description': {
+                'description': offering_info.get('description', ''),
+                'pricing': {'price_plans': price_plans},
+                'legal': [legal] if legal else []
+            },
+            'resources': [self._describe_resource(resource_key) for resource_key in resources]
+        }
+
+        for resource_key in resources:
+            self.resources[resource_key]['offerings'].append(key)
+
+        return self._response(201, {'result': 'correct'})
+
+    def _describe_resource(self, resource_key):
+        resource = self.resources[resource_key]
+        return dict((field, resource.get(field)) for field in
+                    ('provider', 'name', 'version', 'description', 'content_type', 'open', 'link'))
+
+    def _get_offering(self, user, params, body, owner, name, version):
+        offering = self.offerings.get((owner, name, version))
+        # Offerings can only be seen by their owners until they are published
+        if offering is None or (owner != user and offering['state'] != PUBLISHED):
+            raise MemoryStoreError(404, 'Offering not found')
+        return self._response(200, copy.deepcopy(offering))
+
+    def _delete_offering(self, user, params, body, owner, name, version):
+        offering = self._get_owned_offering(user, owner, name, version)
+
+        # Published offerings are kept since they may have been purchased
+        if offering['state'] == PUBLISHED:
+            offering['state'] = DELETED
+        else:
+            for item in offering['resources']:
+                resource = self.resources.get((item['provider'], item['name'], item['version']))
+                if resource is not None:
+                    resource['offerings'].remove((owner, name, version))
+            del self.offerings[(owner, name, version)]
+            self.images.pop(offering['image_url'], None)
+
+        return self._response(204)
+
+    def _tag_offering(self, user, params, body, owner, name, version):
+        offering = self._get_owned_offering(user, owner, name, version)
+        offering['tags'] = list((body or {}).get('tags', []))
+        return self._response(200, {'result': 'correct'})
+
+    def _publish_offering(self, user, params, body, owner, name, version):
+        offering = self._get_owned_offering(user, owner, name, version)
+
+        if offering['state'] != UPLOADED:
+            raise MemoryStoreError(400, 'The offering cannot be published')
+        if not offering['resources']:
+            raise MemoryStoreError(400, 'Offerings without resources cannot be published')
+
+        offering['state'] = PUBLISHED
+        offering['publication_date'] = datetime.datetime.utcnow().isoformat()
+        return self._response(200, {'result': 'correct'})
+
+    def _get_image(self, user, params, body, owner, name, version, image_name):
+        path = '/media/%s/%s/%s/%s' % (owner, name, version, image_name)
+        if path not in self.images:
+            raise MemoryStoreError(404, 'Not found')
+        return self._response(200, content=self.images[path])
+
+
+TRANSPORTS = {
+    'http': HTTPTransport,
+    'memory': MemoryTransport
+}
+
+
+def load_transport(name, config, store_url):
+    '''
+    Creates the transport used to send the requests to a Store: ``http``
+    (default), ``memory`` or the path of a class (``package.module:Class``) that
+    implements ``send(method, url, headers, data, identity, timeout)``.
+    '''
+
+    if name in TRANSPORTS:
+        transport_class = TRANSPORTS[name]
+    else:
+        module_name, _, class_name = name.partition(':')
+        module = __import__(module_name, fromlist=[class_name])
+        transport_class = getattr(module, class_name)
+
+    return transport_class(config, store_url)
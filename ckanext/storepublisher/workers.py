@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN Store Publisher Extension.
+
+# CKAN Store Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Store Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Store Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckan.model as model
+import Queue
+import threading
+
+
+def run_concurrently(tasks, max_workers=None):
+    '''
+    Runs the given tasks concurrently in different threads. Tasks cannot access the
+    template context (c) of the current request, so connectors used by them must be
+    bound to an identity (see StoreConnector.with_identity).
+
+    :param tasks: The functions to be run. They cannot receive any argument
+    :type tasks: list
+
+    :param max_workers: The max number of tasks run at the same time. By default,
+        all the tasks are run at the same time
+    :type max_workers: int
+
+    :returns: A (result, exception) tuple for each task, in the same order than the
+        tasks. Exceptions raised by a task do not affect the other ones
+    :rtype: list
+    '''
+
+    results = [None] * len(tasks)
+    pending = Queue.Queue()
+    for index, task in enumerate(tasks):
+        pending.put((index, task))
+
+    def _worker():
+        while True:
+            try:
+                index, task = pending.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                results[index] = (task(), None)
+            except Exception as e:
+                results[index] = (None, e)
+
+    def _thread_worker():
+        try:
+            _worker()
+        finally:
+            # Each thread gets its own database session (e.g. journals and publications)
+            model.Session.remove()
+
+    n_workers = min(max_workers or len(tasks), len(tasks))
+
+    # Threads are not worth it when tasks have to be run one by one
+    if n_workers <= 1:
+        _worker()
+    else:
+        threads = [threading.Thread(target=_thread_worker) for _ in range(n_workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return results